@@ -52,9 +52,15 @@ setup(
             'remote_daemon = turnstile.tools:remote_daemon.console',
             'turnstile_command = turnstile.tools:turnstile_command.console',
             'compactor_daemon = turnstile.tools:compactor.console',
+            'turnstile_bench = turnstile.tools:turnstile_bench.console',
+            'turnstile_microbench = '
+            'turnstile.tools:turnstile_microbench.console',
+            'turnstile_replay = turnstile.tools:turnstile_replay.console',
         ],
         'turnstile.redis_client': [
             'redis = redis:StrictRedis',
+            'memory = turnstile.memdb:MemoryRedis',
+            'counting = turnstile.memdb:counting_client',
         ],
         'turnstile.connection_class': [
             'redis = redis:Connection',
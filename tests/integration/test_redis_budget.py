@@ -0,0 +1,477 @@
+# Copyright 2013 Rackspace
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import os
+import shutil
+import tempfile
+
+import eventlet
+import mock
+import unittest2
+
+from turnstile import control
+from turnstile import database
+from turnstile import limits
+from turnstile import memdb
+from turnstile import middleware
+
+
+# The name of the in-memory server used by these tests
+HOST = 'turnstile_budget'
+
+# The configuration used by the middleware under test
+CONF = {
+    'redis.redis_client': 'tests.integration.test_redis_budget:'
+                          'counting_client',
+    'redis.host': HOST,
+    'control.channel': 'budget:control',
+    'control.limits_key': 'budget:limits',
+    'control.errors_key': 'budget:errors',
+    'control.errors_channel': 'budget:errors',
+}
+
+
+# The counting database handles, keyed by host; see counting_client()
+_counters = {}
+
+
+def counting_client(host='localhost', **kwargs):
+    """
+    A Redis client for use with the "redis.redis_client"
+    configuration option.  Returns an in-memory client wrapped in a
+    CountingDatabase; all handles for the same host share one
+    CountingDatabase, so that the commands issued by the middleware
+    and by the control daemon are counted together.
+    """
+
+    if host not in _counters:
+        _counters[host] = memdb.CountingDatabase(
+            memdb.MemoryRedis(host, **kwargs))
+    return _counters[host]
+
+
+def fake_app(environ, start_response):
+    start_response('200 OK', [('Content-Type', 'text/plain')])
+    return ['OK']
+
+
+class RedisBudgetTestCase(unittest2.TestCase):
+    """
+    Base class for tests asserting the number of Redis commands and
+    round trips required to process a request.  The middleware is
+    run against the in-memory Redis stand-in, with its database
+    handles wrapped in a CountingDatabase by way of the
+    "redis.redis_client" configuration option.  Changes which add work for
+    the Redis server should fail these tests; if the additional work
+    is intended, the budgets should be updated along with the change.
+    """
+
+    def setUp(self):
+        memdb.reset(HOST)
+        _counters.clear()
+
+    def tearDown(self):
+        memdb.reset(HOST)
+        _counters.clear()
+
+    @property
+    def counter(self):
+        return counting_client(HOST)
+
+    def make_middleware(self, lims, **options):
+        conf = dict(CONF)
+        conf.update(options)
+
+        # Install the limits
+        db = memdb.MemoryRedis(HOST)
+        database.limit_update(db, conf['control.limits_key'], lims)
+
+        # Set up the middleware; only the commands issued after it has
+        # started are counted
+        midware = middleware.TurnstileMiddleware(fake_app, conf)
+        self.counter.reset_counts()
+
+        return midware, self.counter
+
+    def request(self, midware, path, method='GET', **extra):
+        environ = {
+            'REQUEST_METHOD': method,
+            'SCRIPT_NAME': '',
+            'PATH_INFO': path,
+            'SERVER_NAME': 'localhost',
+            'SERVER_PORT': '80',
+            'wsgi.url_scheme': 'http',
+        }
+        environ.update(extra)
+        status = []
+
+        midware(environ, lambda st, headers: status.append(st))
+
+        return status[0]
+
+    def assertBudget(self, counter, commands, round_trips):
+        self.assertEqual((counter.commands, counter.round_trips),
+                         (commands, round_trips),
+                         "Expected %d commands in %d round trips; got %d "
+                         "commands in %d round trips" %
+                         (commands, round_trips, counter.commands,
+                          counter.round_trips))
+        counter.reset_counts()
+
+
+class TestRequestBudget(RedisBudgetTestCase):
+    def make_limit(self, db=None, **kwargs):
+        attrs = dict(uuid='limit1', uri='/v1/{tenant}', value=2,
+                     unit='minute', use=['tenant'])
+        attrs.update(kwargs)
+        return limits.Limit(db, **attrs)
+
+    def test_no_match(self):
+        midware, counter = self.make_middleware([self.make_limit()])
+
+        self.assertEqual(self.request(midware, '/v2/t1'), '200 OK')
+        self.assertBudget(counter, 0, 0)
+
+    def test_first_hit(self):
+        midware, counter = self.make_middleware([self.make_limit()])
+
+        self.assertEqual(self.request(midware, '/v1/t1'), '200 OK')
+        # expire, rpush, lrange; then expireat
+        self.assertBudget(counter, 4, 2)
+
+    def test_steady_state_hit(self):
+        midware, counter = self.make_middleware([
+            self.make_limit(value=100)])
+        for _i in range(10):
+            self.request(midware, '/v1/t1')
+        counter.reset_counts()
+
+        self.assertEqual(self.request(midware, '/v1/t1'), '200 OK')
+        self.assertBudget(counter, 4, 2)
+
+    def test_rejected_hit(self):
+        midware, counter = self.make_middleware([self.make_limit()])
+        for _i in range(2):
+            self.assertEqual(self.request(midware, '/v1/t1'), '200 OK')
+        counter.reset_counts()
+
+        self.assertEqual(self.request(midware, '/v1/t1'),
+                         '413 Request Entity Too Large')
+        self.assertBudget(counter, 4, 2)
+
+    def test_summarize_hit(self):
+        midware, counter = self.make_middleware([
+            self.make_limit(value=100)], **{'compactor.max_updates': '3'})
+        for _i in range(2):
+            self.request(midware, '/v1/t1')
+            self.assertBudget(counter, 4, 2)
+
+        self.assertEqual(self.request(midware, '/v1/t1'), '200 OK')
+        # The summarize record and the compactor instruction ride
+        # along in the second batch
+        self.assertBudget(counter, 6, 2)
+
+        # Once summarized, no further summarize record is needed
+        self.request(midware, '/v1/t1')
+        self.assertBudget(counter, 4, 2)
+
+    def test_multiple_limits(self):
+        midware, counter = self.make_middleware([
+            self.make_limit(continue_scan=True),
+            self.make_limit(uuid='limit2', uri='/v1/{tenant}', value=10,
+                            unit='hour'),
+        ])
+
+        self.assertEqual(self.request(midware, '/v1/t1'), '200 OK')
+        # Each matching limit costs two round trips
+        self.assertBudget(counter, 8, 4)
+
+    def test_bucket_set(self):
+        midware, counter = self.make_middleware([self.make_limit()])
+
+        self.request(midware, '/v1/t1', **{'turnstile.bucket_set': 'set'})
+        self.assertBudget(counter, 5, 2)
+
+    def test_filter(self):
+        counter = self.counter
+        lim = self.make_limit(db=counter)
+        environ = {'REQUEST_METHOD': 'GET'}
+
+        lim._filter(environ, {'tenant': 't1'})
+
+        self.assertFalse('turnstile.delay' in environ)
+        self.assertBudget(counter, 4, 2)
+
+    def test_filter_deferred(self):
+        counter = self.counter
+        lim = self.make_limit(db=counter, queries=['required'])
+        environ = {'REQUEST_METHOD': 'GET'}
+
+        lim._filter(environ, {'tenant': 't1'})
+
+        self.assertBudget(counter, 0, 0)
+
+
+class TestReloadBudget(RedisBudgetTestCase):
+    def make_limits(self, count):
+        return [limits.Limit(None, uuid='limit%d' % i, uri='/v%d/{tenant}' % i,
+                             value=10, unit='minute')
+                for i in range(count)]
+
+    def update_limits(self, count):
+        db = memdb.MemoryRedis(HOST)
+        database.limit_update(db, CONF['control.limits_key'],
+                              self.make_limits(count))
+
+    def test_reload(self):
+        midware, counter = self.make_middleware(self.make_limits(100))
+
+        midware.control_daemon.reload()
+
+        # Only the version is checked when nothing has changed
+        self.assertBudget(counter, 1, 1)
+
+    def test_reload_changed(self):
+        midware, counter = self.make_middleware(self.make_limits(100))
+        self.update_limits(50)
+
+        midware.control_daemon.reload()
+
+        # The version, then all the limits
+        self.assertBudget(counter, 2, 2)
+        self.assertEqual(len(midware.control_daemon.limits.limit_data), 50)
+
+    def test_cache_file(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        cache_file = os.path.join(tmpdir, 'limits.cache')
+
+        # The first start saves the limits to the cache file
+        midware, counter = self.make_middleware(
+            self.make_limits(100), **{'control.cache_file': cache_file})
+        self.assertTrue(os.path.exists(cache_file))
+
+        # A cold start with Redis unreachable serves the cached limits
+        conf = dict(CONF)
+        conf['control.cache_file'] = cache_file
+        with mock.patch.object(memdb.MemoryRedis, 'get',
+                               side_effect=ValueError('unreachable')):
+            with mock.patch.object(memdb.MemoryRedis, 'zrange',
+                                   side_effect=ValueError('unreachable')):
+                with mock.patch.object(eventlet, 'spawn_n'):
+                    midware = middleware.TurnstileMiddleware(fake_app, conf)
+
+        self.assertEqual(len(midware.limits), 100)
+        self.assertEqual(midware.limit_sum,
+                         midware.control_daemon.limits.limit_sum)
+        self.assertNotEqual(midware.mapper, None)
+
+        # The background revalidation finds the limits current
+        counter = self.counter
+        counter.reset_counts()
+        eventlet.sleep(0)
+        self.assertBudget(counter, 1, 1)
+
+    @mock.patch.object(control, '_daemons', {})
+    def test_shared_daemon(self):
+        db = memdb.MemoryRedis(HOST)
+        database.limit_update(db, CONF['control.limits_key'],
+                              self.make_limits(10))
+        conf = dict(CONF)
+        conf['control.shared'] = 'yes'
+
+        with mock.patch.object(control.ControlDaemon, 'listen') as listen:
+            midware1 = middleware.TurnstileMiddleware(fake_app, conf)
+            midware2 = middleware.TurnstileMiddleware(fake_app, conf)
+            eventlet.sleep(0)
+
+        # One daemon, listening once, with one copy of the limits
+        self.assertIs(midware1.control_daemon, midware2.control_daemon)
+        listen.assert_called_once_with()
+        midware1.recheck_limits()
+        midware2.recheck_limits()
+        self.assertEqual(len(midware1.limits), 10)
+        self.assertEqual(len(midware2.limits), 10)
+
+    def test_prefork(self):
+        lims = self.make_limits(100)
+        db = memdb.MemoryRedis(HOST)
+        database.limit_update(db, CONF['control.limits_key'], lims)
+        conf = dict(CONF)
+        conf['control.prefork'] = 'yes'
+        midware = middleware.TurnstileMiddleware(fake_app, conf)
+
+        # Nothing happens until the pre-fork hook is called
+        self.assertEqual(midware.control_daemon.listen_thread, None)
+        self.assertEqual(midware.limits, [])
+
+        with mock.patch.object(eventlet, 'spawn_n') as mock_spawn_n:
+            middleware.pre_fork()
+
+            self.assertFalse(mock_spawn_n.called)
+            self.assertEqual(len(midware.limits), 100)
+            old_limits = midware.limits
+
+            # In the worker, the limits are found to be current
+            counter = self.counter
+            counter.reset_counts()
+            with mock.patch.object(limits.Limit, 'hydrate') as mock_hyd:
+                middleware.post_fork()
+                midware.recheck_limits()
+
+            self.assertEqual(mock_spawn_n.call_count, 1)
+
+        self.assertFalse(mock_hyd.called)
+        self.assertIs(midware.limits, old_limits)
+        self.assertIs(midware.limits[0].db, counter)
+        self.assertBudget(counter, 1, 1)
+
+    def test_poll(self):
+        midware, counter = self.make_middleware(self.make_limits(100))
+        daemon = midware.control_daemon
+
+        with mock.patch.object(eventlet, 'sleep',
+                               side_effect=[None, ValueError]):
+            self.assertRaises(ValueError, daemon.poll, 30.0)
+        eventlet.sleep(0)
+
+        # When the limits are unchanged, a poll costs only the
+        # version check
+        self.assertBudget(counter, 1, 1)
+
+    def test_reload_burst(self):
+        midware, counter = self.make_middleware(self.make_limits(100))
+        daemon = midware.control_daemon
+        performed = daemon.reload_counts['performed']
+
+        for _i in range(10):
+            control.reload(daemon, 'immediate')
+        eventlet.sleep(0)
+
+        # The burst is coalesced into a single reload, which fetches
+        # the limits, since reload commands without the "versioned"
+        # marker may come from tools which don't update the version
+        # key
+        self.assertEqual(daemon.reload_counts['performed'], performed + 1)
+        self.assertEqual(daemon.reload_counts['coalesced'], 9)
+        self.assertBudget(counter, 1, 1)
+        self.assertEqual(len(daemon.limits.limit_data), 100)
+
+    def test_reload_burst_versioned(self):
+        midware, counter = self.make_middleware(self.make_limits(100))
+        daemon = midware.control_daemon
+        performed = daemon.reload_counts['performed']
+
+        for _i in range(10):
+            control.reload(daemon, 'immediate', 'versioned')
+        eventlet.sleep(0)
+
+        # The burst comes from tools which update the version key, so
+        # the coalesced reload only checks the version
+        self.assertEqual(daemon.reload_counts['performed'], performed + 1)
+        self.assertEqual(daemon.reload_counts['coalesced'], 9)
+        self.assertBudget(counter, 1, 1)
+
+    def test_reload_error(self):
+        midware, counter = self.make_middleware(self.make_limits(1))
+        self.update_limits(2)
+
+        with mock.patch.object(control.LimitData, 'set_limits',
+                               side_effect=ValueError('bad limits')):
+            midware.control_daemon.reload()
+
+        # get and zrange; then sadd and publish to report the error
+        self.assertBudget(counter, 4, 4)
+
+    def test_recheck_limits(self):
+        midware, counter = self.make_middleware(self.make_limits(1))
+        self.update_limits(10)
+        midware.control_daemon.reload()
+        counter.reset_counts()
+
+        midware.recheck_limits()
+
+        # Rebuilding the routes from the loaded limits needs no
+        # database access
+        self.assertEqual(len(midware.limits), 10)
+        self.assertBudget(counter, 0, 0)
+
+    def test_recheck_limits_reuse(self):
+        lims = self.make_limits(10)
+        midware, counter = self.make_middleware(lims)
+        self.request(midware, '/v0/t1')
+        old_limits = midware.limits
+
+        # Change one limit and add another, with a full update
+        lims[3] = limits.Limit(None, uuid='limit3', uri='/v3/{tenant}',
+                               value=5, unit='minute')
+        lims.append(limits.Limit(None, uuid='limit10', uri='/v10/{tenant}',
+                                 value=10, unit='minute'))
+        db = memdb.MemoryRedis(HOST)
+        database.limit_update(db, CONF['control.limits_key'], lims)
+        midware.control_daemon.reload()
+        counter.reset_counts()
+
+        # Only the new and changed limits are hydrated
+        with mock.patch.object(limits.Limit, 'hydrate',
+                               wraps=limits.Limit.hydrate) as mock_hydrate:
+            midware.recheck_limits()
+
+        self.assertEqual(mock_hydrate.call_count, 2)
+        self.assertEqual(len(midware.limits), 11)
+        self.assertEqual(midware.limits[3].value, 5)
+        self.assertIsNot(midware.limits[3], old_limits[3])
+        for i in range(10):
+            if i != 3:
+                self.assertIs(midware.limits[i], old_limits[i])
+        self.assertBudget(counter, 0, 0)
+
+    def test_limit_set(self):
+        lims = self.make_limits(100)
+        midware, counter = self.make_middleware(lims)
+        self.request(midware, '/v0/t1')
+        counter.reset_counts()
+        old_limits = midware.limits
+
+        new = limits.Limit(None, uuid='limit50', uri='/v50/{tenant}',
+                           value=5, unit='minute')
+        db = memdb.MemoryRedis(HOST)
+        score = database.limit_set(db, CONF['control.limits_key'], new)
+        control.limit_set(midware.control_daemon, str(score), new.uuid)
+
+        # Only the changed limit is fetched
+        self.assertBudget(counter, 1, 1)
+
+        # ...and only the changed limit is hydrated
+        with mock.patch.object(limits.Limit, 'hydrate',
+                               wraps=limits.Limit.hydrate) as mock_hydrate:
+            midware.recheck_limits()
+
+        self.assertEqual(mock_hydrate.call_count, 1)
+        self.assertEqual(midware.limits[50].value, 5)
+        self.assertIs(midware.limits[49], old_limits[49])
+        self.assertEqual(midware.limit_sum,
+                         midware.control_daemon.limits.limit_sum)
+        self.assertBudget(counter, 0, 0)
+
+    def test_limit_delete(self):
+        midware, counter = self.make_middleware(self.make_limits(10))
+
+        control.limit_delete(midware.control_daemon, 'limit5')
+        midware.recheck_limits()
+
+        self.assertEqual([lim.uuid for lim in midware.limits],
+                         ['limit%d' % i for i in range(10) if i != 5])
+        self.assertBudget(counter, 0, 0)
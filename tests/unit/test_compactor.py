@@ -14,6 +14,7 @@
 #    under the License.
 
 import mock
+import msgpack
 import unittest2
 
 from turnstile import compactor
@@ -21,6 +22,7 @@ from turnstile import config
 from turnstile import control
 from turnstile import database
 from turnstile import limits
+from turnstile import metrics
 from turnstile import remote
 
 from tests.unit import utils as test_utils
@@ -292,6 +294,7 @@ class TestLimitContainer(unittest2.TestCase):
         self.assertEqual(lc.limits, [])
         self.assertEqual(lc.limit_map, {})
         self.assertEqual(lc.limit_sum, None)
+        self.assertIsInstance(lc.metrics, metrics.Metrics)
         self.assertEqual(lc.control_daemon,
                          mock_ControlDaemon.return_value)
 
@@ -322,6 +325,29 @@ class TestLimitContainer(unittest2.TestCase):
             mock.call().start(),
         ])
 
+    @mock.patch('os.getpid', return_value=1234)
+    @mock.patch.object(control.ControlDaemon, 'start')
+    def test_stats(self, mock_start, mock_getpid):
+        db = mock.Mock()
+        lc = compactor.LimitContainer(config.Config(conf_dict={
+            'control.node_name': 'node',
+        }), db)
+        lc.limit_sum = 'sum'
+
+        control.stats(lc.control_daemon, 'reply')
+
+        channel, data = db.publish.call_args[0]
+        self.assertEqual(channel, 'reply')
+        self.assertEqual(msgpack.loads(data[6:]), {
+            'node': 'node',
+            'pid': 1234,
+            'limit_sum': 'sum',
+            'reloads_requested': 0,
+            'reloads_coalesced': 0,
+            'reloads': 0,
+            'cache_hit_rate': None,
+        })
+
     @mock.patch.object(control, 'ControlDaemon')
     @mock.patch.object(compactor.LimitContainer, 'recheck_limits')
     def test_getitem(self, mock_recheck_limits, mock_ControlDaemon):
@@ -337,8 +363,8 @@ class TestLimitContainer(unittest2.TestCase):
     @mock.patch.object(control, 'ControlDaemon')
     @mock.patch.object(compactor.LOG, 'exception')
     @mock.patch.object(database, 'limits_hydrate', return_value=[
-        mock.Mock(uuid='uuid1'),
-        mock.Mock(uuid='uuid2'),
+        mock.Mock(uuid='uuid1', key_ident='uuid1'),
+        mock.Mock(uuid='uuid2', key_ident='17'),
     ])
     def test_recheck_limits_basic(self, mock_limits_hydrate, mock_exception,
                                   mock_ControlDaemon, mock_format_exc):
@@ -361,10 +387,11 @@ class TestLimitContainer(unittest2.TestCase):
                                                     ['limit1', 'limit2'])
         self.assertEqual(lc.limits, mock_limits_hydrate.return_value)
         self.assertEqual(lc.limit_sum, 'new_sum')
-        self.assertEqual(lc.limit_map, dict(
-            uuid1=mock_limits_hydrate.return_value[0],
-            uuid2=mock_limits_hydrate.return_value[1],
-        ))
+        self.assertEqual(lc.limit_map, {
+            'uuid1': mock_limits_hydrate.return_value[0],
+            'uuid2': mock_limits_hydrate.return_value[1],
+            '17': mock_limits_hydrate.return_value[1],
+        })
         self.assertFalse(mock_exception.called)
         self.assertFalse(mock_format_exc.called)
         self.assertEqual(len(lc.db.method_calls), 0)
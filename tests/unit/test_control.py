@@ -13,12 +13,19 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import os
+import shutil
+import tempfile
+
 import eventlet.semaphore
 import mock
+import msgpack
 import unittest2
 
 from turnstile import config
 from turnstile import control
+from turnstile import database
+from turnstile import profiler
 from turnstile import utils
 
 from tests.unit import utils as test_utils
@@ -119,12 +126,174 @@ class TestLimitData(unittest2.TestCase):
         self.assertEqual(result, (self.TEST_DATA_CHECKSUM, self.TEST_DATA))
 
 
+class TestLimitDataChanges(unittest2.TestCase):
+    def make_limit(self, uuid, value=1):
+        return msgpack.dumps({'uuid': uuid, 'value': value})
+
+    def make_data(self):
+        ld = control.LimitData()
+        ld.set_limits([self.make_limit('uuid1'), self.make_limit('uuid2'),
+                       self.make_limit('uuid3')], [10.0, 20.0, 30.0])
+        return ld
+
+    def get_uuids(self, ld):
+        return [lim['uuid'] for lim in ld.limit_data]
+
+    def test_set_limits_scores(self):
+        ld = self.make_data()
+        ld.limit_changes = ['change']
+
+        self.assertEqual(ld.limit_scores, [10.0, 20.0, 30.0])
+        self.assertEqual(ld.limit_raw, [self.make_limit('uuid1'),
+                                        self.make_limit('uuid2'),
+                                        self.make_limit('uuid3')])
+
+        ld.set_limits([self.make_limit('uuid1')], [10.0])
+
+        self.assertEqual(self.get_uuids(ld), ['uuid1'])
+        self.assertEqual(ld.limit_scores, [10.0])
+        self.assertEqual(ld.limit_changes, [])
+
+    def test_set_limit_update(self):
+        ld = self.make_data()
+        old_sum = ld.limit_sum
+
+        result = ld.set_limit(self.make_limit('uuid2', 5), 20.0)
+
+        self.assertEqual(result, True)
+        self.assertEqual(self.get_uuids(ld), ['uuid1', 'uuid2', 'uuid3'])
+        self.assertEqual(ld.limit_data[1], {'uuid': 'uuid2', 'value': 5})
+        self.assertEqual(ld.limit_scores, [10.0, 20.0, 30.0])
+        self.assertEqual(ld.limit_sum, database.limits_checksum(ld.limit_raw))
+        self.assertEqual(ld.limit_changes, [
+            (old_sum, ld.limit_sum,
+             ('uuid2', 1, {'uuid': 'uuid2', 'value': 5})),
+        ])
+
+    def test_set_limit_add(self):
+        ld = self.make_data()
+
+        result = ld.set_limit(self.make_limit('uuid4'), 25.0)
+
+        self.assertEqual(result, True)
+        self.assertEqual(self.get_uuids(ld),
+                         ['uuid1', 'uuid2', 'uuid4', 'uuid3'])
+        self.assertEqual(ld.limit_scores, [10.0, 20.0, 25.0, 30.0])
+        self.assertEqual(ld.limit_changes[0][2],
+                         ('uuid4', 2, {'uuid': 'uuid4', 'value': 1}))
+
+    def test_set_limit_move(self):
+        ld = self.make_data()
+
+        ld.set_limit(self.make_limit('uuid1'), 40.0)
+
+        self.assertEqual(self.get_uuids(ld), ['uuid2', 'uuid3', 'uuid1'])
+        self.assertEqual(ld.limit_scores, [20.0, 30.0, 40.0])
+
+    def test_set_limit_unchanged(self):
+        ld = self.make_data()
+        old_sum = ld.limit_sum
+
+        result = ld.set_limit(self.make_limit('uuid2'), 20.0)
+
+        self.assertEqual(result, True)
+        self.assertEqual(ld.limit_sum, old_sum)
+        self.assertEqual(ld.limit_changes, [])
+
+    def test_set_limit_noscores(self):
+        ld = control.LimitData()
+        ld.set_limits([self.make_limit('uuid1')])
+
+        result = ld.set_limit(self.make_limit('uuid1', 5), 10.0)
+
+        self.assertEqual(result, False)
+        self.assertEqual(ld.limit_data, [{'uuid': 'uuid1', 'value': 1}])
+
+    def test_delete_limit(self):
+        ld = self.make_data()
+        old_sum = ld.limit_sum
+
+        ld.delete_limit('uuid2')
+
+        self.assertEqual(self.get_uuids(ld), ['uuid1', 'uuid3'])
+        self.assertEqual(ld.limit_scores, [10.0, 30.0])
+        self.assertEqual(ld.limit_changes, [
+            (old_sum, ld.limit_sum, ('uuid2', None, None)),
+        ])
+
+    def test_delete_limit_no_scores(self):
+        ld = control.LimitData()
+        ld.set_limits([self.make_limit('uuid1'), self.make_limit('uuid2'),
+                       self.make_limit('uuid3')])
+        old_sum = ld.limit_sum
+
+        ld.delete_limit('uuid2')
+
+        self.assertEqual(self.get_uuids(ld), ['uuid1', 'uuid3'])
+        self.assertEqual(ld.limit_scores, None)
+        self.assertEqual(ld.limit_changes, [
+            (old_sum, ld.limit_sum, ('uuid2', None, None)),
+        ])
+
+    def test_delete_limit_missing(self):
+        ld = self.make_data()
+        old_sum = ld.limit_sum
+
+        ld.delete_limit('uuid4')
+
+        self.assertEqual(ld.limit_sum, old_sum)
+        self.assertEqual(ld.limit_changes, [])
+
+    def test_journal_bounded(self):
+        ld = self.make_data()
+        ld.max_changes = 2
+
+        for i in range(3):
+            ld.set_limit(self.make_limit('uuid1', i + 2), 10.0)
+
+        self.assertEqual(len(ld.limit_changes), 2)
+        self.assertEqual(ld.limit_changes[-1][2][2]['value'], 4)
+
+    def test_get_changes_nochange(self):
+        ld = self.make_data()
+
+        self.assertRaises(control.NoChangeException, ld.get_changes,
+                          ld.limit_sum)
+
+    def test_get_changes(self):
+        ld = self.make_data()
+        sum1 = ld.limit_sum
+        ld.set_limit(self.make_limit('uuid4'), 40.0)
+        sum2 = ld.limit_sum
+        ld.delete_limit('uuid1')
+
+        self.assertEqual(ld.get_changes(sum1), (ld.limit_sum, [
+            ('uuid4', 3, {'uuid': 'uuid4', 'value': 1}),
+            ('uuid1', None, None),
+        ]))
+        self.assertEqual(ld.get_changes(sum2), (ld.limit_sum, [
+            ('uuid1', None, None),
+        ]))
+
+    def test_get_changes_unavailable(self):
+        ld = self.make_data()
+        ld.set_limit(self.make_limit('uuid4'), 40.0)
+
+        self.assertEqual(ld.get_changes(), (ld.limit_sum, None))
+        self.assertEqual(ld.get_changes('other'), (ld.limit_sum, None))
+
+
 class TestControlDaemon(unittest2.TestCase):
     @mock.patch.dict(control.ControlDaemon._commands)
     def test_register(self):
         self.assertEqual(control.ControlDaemon._commands, {
             'ping': control.ping,
             'reload': control.reload,
+            'stats': control.stats,
+            'profile_start': control.profile_start,
+            'profile_stop': control.profile_stop,
+            'limit_set': control.limit_set,
+            'limit_delete': control.limit_delete,
         })
 
         control.ControlDaemon._register('spam', 'ni')
@@ -132,6 +301,11 @@ class TestControlDaemon(unittest2.TestCase):
         self.assertEqual(control.ControlDaemon._commands, {
             'ping': control.ping,
             'reload': control.reload,
+            'stats': control.stats,
+            'profile_start': control.profile_start,
+            'profile_stop': control.profile_stop,
+            'limit_set': control.limit_set,
+            'limit_delete': control.limit_delete,
             'spam': 'ni',
         })
 
@@ -144,18 +318,176 @@ class TestControlDaemon(unittest2.TestCase):
         self.assertIsInstance(cd.limits, control.LimitData)
         self.assertIsInstance(cd.pending, eventlet.semaphore.Semaphore)
         self.assertEqual(cd.listen_thread, None)
+        self.assertEqual(cd.profiling, None)
+        self.assertEqual(cd.reload_queued, None)
+        self.assertEqual(cd.reload_deadline, None)
+        self.assertEqual(cd.reload_counts, dict(requested=0, coalesced=0,
+                                                performed=0))
 
     @mock.patch.object(eventlet, 'spawn_n', return_value='listen_thread')
     @mock.patch.object(control.ControlDaemon, 'reload')
     def test_start(self, mock_reload, mock_spawn_n):
-        cd = control.ControlDaemon('middleware', 'config')
+        cd = control.ControlDaemon('middleware', config.Config())
 
         cd.start()
 
         mock_spawn_n.assert_called_once_with(cd.listen)
         self.assertEqual(cd.listen_thread, 'listen_thread')
+        self.assertEqual(cd.poll_thread, None)
+        mock_reload.assert_called_once_with()
+
+    @mock.patch.object(eventlet, 'spawn_n', return_value='listen_thread')
+    @mock.patch.object(control.ControlDaemon, 'reload')
+    def test_start_started(self, mock_reload, mock_spawn_n):
+        cd = control.ControlDaemon('middleware', config.Config())
+        cd.listen_thread = 'running'
+
+        cd.start()
+
+        self.assertFalse(mock_spawn_n.called)
+        self.assertFalse(mock_reload.called)
+        self.assertEqual(cd.listen_thread, 'running')
+
+    @mock.patch.object(eventlet, 'spawn_n', return_value='listen_thread')
+    @mock.patch.object(control.ControlDaemon, 'reload')
+    @mock.patch.object(control.ControlDaemon, 'schedule_reload')
+    @mock.patch.object(control.ControlDaemon, '_load_cache',
+                       return_value=True)
+    def test_start_cached(self, mock_load_cache, mock_schedule_reload,
+                          mock_reload, mock_spawn_n):
+        cd = control.ControlDaemon('middleware', config.Config())
+
+        cd.start()
+
+        mock_load_cache.assert_called_once_with()
+        mock_schedule_reload.assert_called_once_with()
+        self.assertFalse(mock_reload.called)
+
+    @mock.patch.object(eventlet, 'spawn_n', return_value='thread')
+    @mock.patch.object(control.ControlDaemon, 'reload')
+    def test_start_poll(self, mock_reload, mock_spawn_n):
+        cd = control.ControlDaemon('middleware', config.Config(conf_dict={
+            'control.poll_interval': '30',
+        }))
+
+        cd.start()
+
+        mock_spawn_n.assert_has_calls([
+            mock.call(cd.listen),
+            mock.call(cd.poll, 30.0),
+        ])
+        self.assertEqual(cd.listen_thread, 'thread')
+        self.assertEqual(cd.poll_thread, 'thread')
         mock_reload.assert_called_once_with()
 
+    def test_load_cache_unset(self):
+        cd = control.ControlDaemon('middleware', config.Config())
+        cd.limits = mock.Mock()
+
+        self.assertFalse(cd._load_cache())
+        self.assertFalse(cd.limits.set_limits.called)
+
+    def test_limits_changed(self):
+        cd = control.ControlDaemon('middleware', config.Config())
+
+        with mock.patch.object(cd, '_save_cache') as mock_save_cache:
+            cd._limits_changed()
+
+        mock_save_cache.assert_called_once_with()
+
+    def test_get_interval(self):
+        cd = control.ControlDaemon('middleware', config.Config(conf_dict={
+            'control.good': '2.5',
+            'control.bad': 'bad',
+            'control.zero': '0',
+        }))
+
+        self.assertEqual(cd._get_interval('good'), 2.5)
+        self.assertEqual(cd._get_interval('good', 1.0), 2.5)
+        self.assertEqual(cd._get_interval('bad'), None)
+        self.assertEqual(cd._get_interval('bad', 1.0), 1.0)
+        self.assertEqual(cd._get_interval('zero', 1.0), 1.0)
+        self.assertEqual(cd._get_interval('missing', 1.0), 1.0)
+
+    @mock.patch.object(eventlet, 'sleep')
+    @mock.patch.object(control, 'reload')
+    @mock.patch.object(config.Config, 'get_database')
+    @mock.patch.object(control.LOG, 'info')
+    @mock.patch.object(control.LOG, 'exception')
+    def test_listen_reconnect(self, mock_exception, mock_info,
+                              mock_get_database, mock_reload, mock_sleep):
+        pubsub1 = mock.Mock(**{
+            'listen.side_effect': test_utils.TestException,
+            'close.side_effect': test_utils.TestException,
+        })
+        pubsub2 = mock.Mock(**{'listen.return_value': []})
+        mock_get_database.side_effect = [
+            mock.Mock(**{'pubsub.return_value': pubsub1}),
+            test_utils.TestException,
+            mock.Mock(**{'pubsub.return_value': pubsub2}),
+        ]
+        cd = control.ControlDaemon('middleware', config.Config())
+
+        cd.listen()
+
+        self.assertEqual(mock_get_database.call_count, 3)
+        pubsub1.subscribe.assert_called_once_with('control')
+        pubsub1.close.assert_called_once_with()
+        pubsub2.subscribe.assert_called_once_with('control')
+        self.assertFalse(pubsub2.close.called)
+        mock_sleep.assert_has_calls([mock.call(1.0), mock.call(2.0)])
+        self.assertEqual(mock_sleep.call_count, 2)
+        mock_exception.assert_has_calls([
+            mock.call("Control listener lost its connection; "
+                      "reconnecting in 1.0 seconds"),
+            mock.call("Control listener lost its connection; "
+                      "reconnecting in 2.0 seconds"),
+        ])
+        mock_info.assert_called_once_with("Control listener reconnected")
+        mock_reload.assert_called_once_with(cd)
+
+    @mock.patch.object(eventlet, 'sleep')
+    @mock.patch.object(control, 'reload')
+    @mock.patch.object(config.Config, 'get_database')
+    @mock.patch.object(control.LOG, 'info')
+    @mock.patch.object(control.LOG, 'exception')
+    def test_listen_backoff(self, mock_exception, mock_info,
+                            mock_get_database, mock_reload, mock_sleep):
+        pubsub = mock.Mock(**{'listen.return_value': []})
+        mock_get_database.side_effect = [
+            test_utils.TestException,
+            test_utils.TestException,
+            test_utils.TestException,
+            test_utils.TestException,
+            mock.Mock(**{'pubsub.return_value': pubsub}),
+        ]
+        cd = control.ControlDaemon('middleware', config.Config(conf_dict={
+            'control.reconnect_delay': '2',
+            'control.reconnect_max_delay': '5',
+        }))
+
+        cd.listen()
+
+        mock_sleep.assert_has_calls([
+            mock.call(2.0),
+            mock.call(4.0),
+            mock.call(5.0),
+            mock.call(5.0),
+        ])
+        self.assertEqual(mock_sleep.call_count, 4)
+        mock_reload.assert_called_once_with(cd)
+
+    @mock.patch.object(eventlet, 'sleep',
+                       side_effect=[None, None, test_utils.TestException])
+    @mock.patch.object(control.ControlDaemon, 'schedule_reload')
+    def test_poll(self, mock_schedule_reload, mock_sleep):
+        cd = control.ControlDaemon('middleware', config.Config())
+
+        self.assertRaises(test_utils.TestException, cd.poll, 30.0)
+
+        mock_sleep.assert_has_calls([mock.call(30.0)] * 3)
+        self.assertEqual(mock_schedule_reload.call_count, 2)
+
     @mock.patch.dict(control.ControlDaemon._commands, clear=True,
                      ping=mock.Mock(), _ping=mock.Mock(),
                      fail=mock.Mock(side_effect=test_utils.TestException))
@@ -467,12 +799,38 @@ class TestControlDaemon(unittest2.TestCase):
             mock.call.listen(),
         ])
 
+    @mock.patch.object(eventlet, 'spawn_n')
+    @mock.patch.object(control.ControlDaemon, 'reload')
+    def test_preload(self, mock_reload, mock_spawn_n):
+        cd = control.ControlDaemon('middleware', 'config')
+
+        cd.preload()
+
+        self.assertFalse(mock_spawn_n.called)
+        self.assertEqual(cd.listen_thread, None)
+        mock_reload.assert_called_once_with()
+
+    def test_reset(self):
+        cd = control.ControlDaemon('middleware', 'config')
+        cd._db = 'db'
+
+        cd.reset()
+
+        self.assertEqual(cd._db, None)
+
     def test_get_limits(self):
         cd = control.ControlDaemon('middleware', 'config')
         cd.limits = 'limits'
 
         self.assertEqual(cd.get_limits(), 'limits')
 
+    def test_get_database(self):
+        conf = mock.Mock(**{'get_database.return_value': 'database'})
+        cd = control.ControlDaemon('middleware', conf)
+
+        self.assertEqual(cd.get_database(), 'database')
+        conf.get_database.assert_called_once_with()
+
     @mock.patch.object(control.LOG, 'exception')
     @mock.patch('traceback.format_exc', return_value='<traceback>')
     def test_reload_noacquire(self, mock_format_exc, mock_exception):
@@ -498,7 +856,10 @@ class TestControlDaemon(unittest2.TestCase):
         cd = control.ControlDaemon('middleware', config.Config())
         cd.pending = mock.Mock(**{'acquire.return_value': True})
         cd.limits = mock.Mock()
-        cd._db = mock.Mock(**{'zrange.return_value': ['limit1', 'limit2']})
+        cd._db = mock.Mock(**{
+            'get.return_value': None,
+            'zrange.return_value': [('limit1', 10.0), ('limit2', 20.0)],
+        })
 
         cd.reload()
 
@@ -507,14 +868,212 @@ class TestControlDaemon(unittest2.TestCase):
             mock.call.release(),
         ])
         self.assertEqual(len(cd.pending.method_calls), 2)
-        cd.limits.set_limits.assert_called_once_with(['limit1', 'limit2'])
+        cd.limits.set_limits.assert_called_once_with(['limit1', 'limit2'],
+                                                     [10.0, 20.0])
         cd._db.assert_has_calls([
-            mock.call.zrange('limits', 0, -1),
+            mock.call.get('limits:version'),
+            mock.call.zrange('limits', 0, -1, withscores=True),
         ])
-        self.assertEqual(len(cd._db.method_calls), 1)
+        self.assertEqual(len(cd._db.method_calls), 2)
         self.assertFalse(mock_exception.called)
         self.assertFalse(mock_format_exc.called)
 
+    @mock.patch('time.time', return_value=100.0)
+    @mock.patch.object(eventlet, 'spawn_after', return_value='thread')
+    def test_schedule_reload(self, mock_spawn_after, mock_time):
+        cd = control.ControlDaemon('middleware', config.Config())
+
+        cd.schedule_reload(5.0)
+
+        mock_spawn_after.assert_called_once_with(5.0, cd._queued_reload)
+        self.assertEqual(cd.reload_queued, 'thread')
+        self.assertEqual(cd.reload_deadline, 105.0)
+        self.assertEqual(cd.reload_counts, dict(requested=1, coalesced=0,
+                                                performed=0))
+
+    @mock.patch('time.time', return_value=100.0)
+    @mock.patch.object(eventlet, 'spawn_after', return_value='thread')
+    def test_schedule_reload_immediate(self, mock_spawn_after, mock_time):
+        cd = control.ControlDaemon('middleware', config.Config())
+
+        cd.schedule_reload()
+
+        mock_spawn_after.assert_called_once_with(0.0, cd._queued_reload)
+        self.assertEqual(cd.reload_deadline, 100.0)
+
+    @mock.patch('time.time', return_value=100.0)
+    @mock.patch.object(eventlet, 'spawn_after', return_value='thread')
+    def test_schedule_reload_coalesced(self, mock_spawn_after, mock_time):
+        cd = control.ControlDaemon('middleware', config.Config())
+        queued = mock.Mock()
+        cd.reload_queued = queued
+        cd.reload_deadline = 102.0
+
+        cd.schedule_reload(5.0)
+
+        self.assertFalse(mock_spawn_after.called)
+        self.assertFalse(queued.cancel.called)
+        self.assertEqual(cd.reload_queued, queued)
+        self.assertEqual(cd.reload_deadline, 102.0)
+        self.assertEqual(cd.reload_counts, dict(requested=1, coalesced=1,
+                                                performed=0))
+
+    @mock.patch('time.time', return_value=100.0)
+    @mock.patch.object(eventlet, 'spawn_after', return_value='thread')
+    def test_schedule_reload_earlier(self, mock_spawn_after, mock_time):
+        cd = control.ControlDaemon('middleware', config.Config())
+        queued = mock.Mock()
+        cd.reload_queued = queued
+        cd.reload_deadline = 110.0
+
+        cd.schedule_reload(5.0)
+
+        queued.cancel.assert_called_once_with()
+        mock_spawn_after.assert_called_once_with(5.0, cd._queued_reload)
+        self.assertEqual(cd.reload_queued, 'thread')
+        self.assertEqual(cd.reload_deadline, 105.0)
+        self.assertEqual(cd.reload_counts, dict(requested=1, coalesced=1,
+                                                performed=0))
+
+    @mock.patch('time.time', return_value=100.0)
+    @mock.patch.object(control.ControlDaemon, '_reload')
+    def test_queued_reload(self, mock_reload, mock_time):
+        cd = control.ControlDaemon('middleware', config.Config())
+        cd.pending = mock.MagicMock()
+        cd.reload_queued = 'thread'
+        cd.reload_deadline = 99.0
+
+        def check(full):
+            # The queued state is cleared once the reload is running
+            self.assertEqual(cd.reload_queued, None)
+            self.assertEqual(cd.reload_deadline, None)
+        mock_reload.side_effect = check
+
+        cd._queued_reload()
+
+        cd.pending.assert_has_calls([
+            mock.call.__enter__(),
+            mock.call.__exit__(None, None, None),
+        ])
+        mock_reload.assert_called_once_with(False)
+
+    @mock.patch('time.time', return_value=100.0)
+    @mock.patch.object(control.ControlDaemon, '_reload')
+    @mock.patch.object(eventlet, 'spawn_after', return_value='thread')
+    def test_queued_reload_full(self, mock_spawn_after, mock_reload,
+                                mock_time):
+        cd = control.ControlDaemon('middleware', config.Config())
+
+        # A full reload request is not lost by being coalesced
+        cd.schedule_reload(5.0, full=True)
+        cd.schedule_reload(5.0)
+        self.assertEqual(cd.reload_full, True)
+
+        cd._queued_reload()
+
+        mock_reload.assert_called_once_with(True)
+        self.assertEqual(cd.reload_full, False)
+
+    @mock.patch.object(control.ControlDaemon, '_reload')
+    def test_queued_reload_waiting(self, mock_reload):
+        cd = control.ControlDaemon('middleware', config.Config())
+        cd.reload_queued = 'thread'
+        cd.reload_deadline = 110.0
+        cd.pending.acquire()
+
+        # Simulate a request arriving while the queued reload waits
+        # for the reload in progress
+        def in_progress():
+            cd.schedule_reload(5.0)
+            cd.pending.release()
+        thread = eventlet.spawn(cd._queued_reload)
+        eventlet.spawn_n(in_progress)
+        thread.wait()
+
+        mock_reload.assert_called_once_with(False)
+        self.assertEqual(cd.reload_queued, None)
+        self.assertEqual(cd.reload_counts['coalesced'], 1)
+
+    @mock.patch.object(control.LOG, 'exception')
+    @mock.patch('traceback.format_exc', return_value='<traceback>')
+    def test_reload_unchanged(self, mock_format_exc, mock_exception):
+        cd = control.ControlDaemon('middleware', config.Config())
+        cd.pending = mock.Mock(**{'acquire.return_value': True})
+        cd.limits = mock.Mock(limit_sum='sum')
+        cd._db = mock.Mock(**{'get.return_value': '5:sum'})
+
+        cd.reload()
+
+        cd.pending.assert_has_calls([
+            mock.call.acquire(False),
+            mock.call.release(),
+        ])
+        self.assertFalse(cd.limits.set_limits.called)
+        cd._db.get.assert_called_once_with('limits:version')
+        self.assertEqual(len(cd._db.method_calls), 1)
+        self.assertFalse(mock_exception.called)
+
+    @mock.patch.object(control.ControlDaemon, '_limits_changed')
+    @mock.patch.object(control.ControlDaemon, '_load_error')
+    def test_reload_full(self, mock_load_error, mock_limits_changed):
+        cd = control.ControlDaemon('middleware', config.Config())
+        cd.limits = mock.Mock(limit_sum='sum')
+        cd._db = mock.Mock(**{
+            'get.return_value': '5:sum',
+            'zrange.return_value': [('limit1', 10.0)],
+        })
+
+        cd._reload(True)
+
+        # The version key is not consulted
+        self.assertFalse(cd._db.get.called)
+        cd._db.zrange.assert_called_once_with('limits', 0, -1,
+                                              withscores=True)
+        cd.limits.set_limits.assert_called_once_with(['limit1'], [10.0])
+        self.assertFalse(mock_load_error.called)
+
+    @mock.patch.object(control.ControlDaemon, '_limits_changed')
+    @mock.patch.object(control.ControlDaemon, '_load_error')
+    def test_reload_notify(self, mock_load_error, mock_limits_changed):
+        cd = control.ControlDaemon('middleware', config.Config())
+        cd.limits = mock.Mock(limit_sum='sum')
+        cd._db = mock.Mock(**{
+            'get.return_value': '6:other',
+            'zrange.return_value': [('limit1', 10.0)],
+        })
+
+        # Changed limits are announced...
+        cd._reload()
+        mock_limits_changed.assert_called_once_with()
+
+        # ...but unchanged limits are not...
+        cd._db.get.return_value = '6:sum'
+        cd._reload()
+        self.assertEqual(mock_limits_changed.call_count, 1)
+
+        # ...and nor are failures
+        cd._db.get.side_effect = test_utils.TestException
+        cd._reload()
+        self.assertEqual(mock_limits_changed.call_count, 1)
+        mock_load_error.assert_called_once_with()
+
+    @mock.patch.object(control.LOG, 'exception')
+    @mock.patch('traceback.format_exc', return_value='<traceback>')
+    def test_reload_changed(self, mock_format_exc, mock_exception):
+        cd = control.ControlDaemon('middleware', config.Config())
+        cd.pending = mock.Mock(**{'acquire.return_value': True})
+        cd.limits = mock.Mock(limit_sum='sum')
+        cd._db = mock.Mock(**{
+            'get.return_value': '6:other',
+            'zrange.return_value': [('limit1', 10.0)],
+        })
+
+        cd.reload()
+
+        cd.limits.set_limits.assert_called_once_with(['limit1'], [10.0])
+        self.assertEqual(len(cd._db.method_calls), 2)
+        self.assertFalse(mock_exception.called)
+
     @mock.patch.object(control.LOG, 'exception')
     @mock.patch('traceback.format_exc', return_value='<traceback>')
     def test_reload_altlimits(self, mock_format_exc, mock_exception):
@@ -523,7 +1082,10 @@ class TestControlDaemon(unittest2.TestCase):
         }))
         cd.pending = mock.Mock(**{'acquire.return_value': True})
         cd.limits = mock.Mock()
-        cd._db = mock.Mock(**{'zrange.return_value': ['limit1', 'limit2']})
+        cd._db = mock.Mock(**{
+            'get.return_value': None,
+            'zrange.return_value': [('limit1', 10.0), ('limit2', 20.0)],
+        })
 
         cd.reload()
 
@@ -532,11 +1094,13 @@ class TestControlDaemon(unittest2.TestCase):
             mock.call.release(),
         ])
         self.assertEqual(len(cd.pending.method_calls), 2)
-        cd.limits.set_limits.assert_called_once_with(['limit1', 'limit2'])
+        cd.limits.set_limits.assert_called_once_with(['limit1', 'limit2'],
+                                                     [10.0, 20.0])
         cd._db.assert_has_calls([
-            mock.call.zrange('other', 0, -1),
+            mock.call.get('other:version'),
+            mock.call.zrange('other', 0, -1, withscores=True),
         ])
-        self.assertEqual(len(cd._db.method_calls), 1)
+        self.assertEqual(len(cd._db.method_calls), 2)
         self.assertFalse(mock_exception.called)
         self.assertFalse(mock_format_exc.called)
 
@@ -548,7 +1112,10 @@ class TestControlDaemon(unittest2.TestCase):
         cd.limits = mock.Mock(**{
             'set_limits.side_effect': test_utils.TestException,
         })
-        cd._db = mock.Mock(**{'zrange.return_value': ['limit1', 'limit2']})
+        cd._db = mock.Mock(**{
+            'get.return_value': None,
+            'zrange.return_value': [('limit1', 10.0), ('limit2', 20.0)],
+        })
 
         cd.reload()
 
@@ -557,13 +1124,15 @@ class TestControlDaemon(unittest2.TestCase):
             mock.call.release(),
         ])
         self.assertEqual(len(cd.pending.method_calls), 2)
-        cd.limits.set_limits.assert_called_once_with(['limit1', 'limit2'])
+        cd.limits.set_limits.assert_called_once_with(['limit1', 'limit2'],
+                                                     [10.0, 20.0])
         cd._db.assert_has_calls([
-            mock.call.zrange('limits', 0, -1),
+            mock.call.get('limits:version'),
+            mock.call.zrange('limits', 0, -1, withscores=True),
             mock.call.sadd('errors', 'Failed to load limits: <traceback>'),
             mock.call.publish('errors', 'Failed to load limits: <traceback>'),
         ])
-        self.assertEqual(len(cd._db.method_calls), 3)
+        self.assertEqual(len(cd._db.method_calls), 4)
         mock_exception.assert_called_once_with('Could not load limits')
         mock_format_exc.assert_called_once_with()
 
@@ -578,7 +1147,10 @@ class TestControlDaemon(unittest2.TestCase):
         cd.limits = mock.Mock(**{
             'set_limits.side_effect': test_utils.TestException,
         })
-        cd._db = mock.Mock(**{'zrange.return_value': ['limit1', 'limit2']})
+        cd._db = mock.Mock(**{
+            'get.return_value': None,
+            'zrange.return_value': [('limit1', 10.0), ('limit2', 20.0)],
+        })
 
         cd.reload()
 
@@ -587,17 +1159,102 @@ class TestControlDaemon(unittest2.TestCase):
             mock.call.release(),
         ])
         self.assertEqual(len(cd.pending.method_calls), 2)
-        cd.limits.set_limits.assert_called_once_with(['limit1', 'limit2'])
+        cd.limits.set_limits.assert_called_once_with(['limit1', 'limit2'],
+                                                     [10.0, 20.0])
         cd._db.assert_has_calls([
-            mock.call.zrange('limits', 0, -1),
+            mock.call.get('limits:version'),
+            mock.call.zrange('limits', 0, -1, withscores=True),
             mock.call.sadd('alt_err', 'Failed to load limits: <traceback>'),
             mock.call.publish('alt_chan',
                               'Failed to load limits: <traceback>'),
         ])
-        self.assertEqual(len(cd._db.method_calls), 3)
+        self.assertEqual(len(cd._db.method_calls), 4)
         mock_exception.assert_called_once_with('Could not load limits')
         mock_format_exc.assert_called_once_with()
 
+    @mock.patch.object(control.ControlDaemon, 'reload')
+    @mock.patch.object(control.ControlDaemon, '_load_error')
+    @mock.patch.object(control.ControlDaemon, '_limits_changed')
+    def test_reload_limit(self, mock_limits_changed, mock_load_error,
+                          mock_reload):
+        cd = control.ControlDaemon('middleware', config.Config())
+        cd.pending = mock.MagicMock()
+        cd.limits = mock.Mock(**{'set_limit.return_value': True})
+        cd._db = mock.Mock(**{'zrangebyscore.return_value': [
+            msgpack.dumps({'uuid': 'other'}),
+            msgpack.dumps({'uuid': 'uuid1'}),
+        ]})
+
+        cd.reload_limit('uuid1', 20.0)
+
+        cd.pending.__enter__.assert_called_once_with()
+        cd._db.zrangebyscore.assert_called_once_with('limits', 20.0, 20.0)
+        cd.limits.set_limit.assert_called_once_with(
+            msgpack.dumps({'uuid': 'uuid1'}), 20.0)
+        mock_limits_changed.assert_called_once_with()
+        self.assertFalse(mock_reload.called)
+        self.assertFalse(mock_load_error.called)
+
+    @mock.patch.object(control.ControlDaemon, 'reload')
+    @mock.patch.object(control.ControlDaemon, '_load_error')
+    def test_reload_limit_missing(self, mock_load_error, mock_reload):
+        cd = control.ControlDaemon('middleware', config.Config(conf_dict={
+            'control.limits_key': 'other',
+        }))
+        cd.limits = mock.Mock()
+        cd._db = mock.Mock(**{'zrangebyscore.return_value': [
+            msgpack.dumps({'uuid': 'other'}),
+        ]})
+
+        cd.reload_limit('uuid1', 20.0)
+
+        cd._db.zrangebyscore.assert_called_once_with('other', 20.0, 20.0)
+        self.assertFalse(cd.limits.set_limit.called)
+        mock_reload.assert_called_once_with()
+        self.assertFalse(mock_load_error.called)
+
+    @mock.patch.object(control.ControlDaemon, 'reload')
+    @mock.patch.object(control.ControlDaemon, '_load_error')
+    def test_reload_limit_noscores(self, mock_load_error, mock_reload):
+        cd = control.ControlDaemon('middleware', config.Config())
+        cd.limits = mock.Mock(**{'set_limit.return_value': False})
+        cd._db = mock.Mock(**{'zrangebyscore.return_value': [
+            msgpack.dumps({'uuid': 'uuid1'}),
+        ]})
+
+        cd.reload_limit('uuid1', 20.0)
+
+        self.assertEqual(cd.limits.set_limit.call_count, 1)
+        mock_reload.assert_called_once_with()
+        self.assertFalse(mock_load_error.called)
+
+    @mock.patch.object(control.ControlDaemon, 'reload')
+    @mock.patch.object(control.ControlDaemon, '_load_error')
+    def test_reload_limit_exception(self, mock_load_error, mock_reload):
+        cd = control.ControlDaemon('middleware', config.Config())
+        cd.limits = mock.Mock()
+        cd._db = mock.Mock(**{
+            'zrangebyscore.side_effect': test_utils.TestException,
+        })
+
+        cd.reload_limit('uuid1', 20.0)
+
+        mock_load_error.assert_called_once_with()
+        self.assertFalse(cd.limits.set_limit.called)
+        self.assertFalse(mock_reload.called)
+
+    @mock.patch.object(control.ControlDaemon, '_limits_changed')
+    def test_remove_limit(self, mock_limits_changed):
+        cd = control.ControlDaemon('middleware', config.Config())
+        cd.pending = mock.MagicMock()
+        cd.limits = mock.Mock()
+
+        cd.remove_limit('uuid1')
+
+        cd.pending.__enter__.assert_called_once_with()
+        cd.limits.delete_limit.assert_called_once_with('uuid1')
+        mock_limits_changed.assert_called_once_with()
+
     def test_db_present(self):
         middleware = mock.Mock(db='midware_db')
         cd = control.ControlDaemon(middleware, config.Config())
@@ -679,87 +1336,645 @@ class TestPing(unittest2.TestCase):
         db.publish.assert_called_once_with('reply', 'pong:node:data')
 
 
+class TestStats(unittest2.TestCase):
+    def test_no_channel(self):
+        db = mock.Mock()
+        daemon = mock.Mock(config=config.Config(), db=db)
+
+        control.stats(daemon, '')
+
+        self.assertFalse(db.publish.called)
+
+    @mock.patch('socket.gethostname', return_value='host')
+    @mock.patch('os.getpid', return_value=1234)
+    def test_no_middleware(self, mock_getpid, mock_gethostname):
+        db = mock.Mock()
+        daemon = mock.Mock(config=config.Config(), db=db, middleware=None,
+                           limits=mock.Mock(limit_sum='sum'),
+                           reload_counts=dict(requested=5, coalesced=3,
+                                              performed=2))
+
+        control.stats(daemon, 'reply')
+
+        channel, data = db.publish.call_args[0]
+        self.assertEqual(channel, 'reply')
+        self.assertTrue(data.startswith('stats:'))
+        self.assertEqual(msgpack.loads(data[6:]), {
+            'node': 'host',
+            'pid': 1234,
+            'limit_sum': 'sum',
+            'reloads_requested': 5,
+            'reloads_coalesced': 3,
+            'reloads': 2,
+            'cache_hit_rate': None,
+        })
+
+    @mock.patch('os.getpid', return_value=1234)
+    def test_with_middleware(self, mock_getpid):
+        db = mock.Mock()
+        middleware = mock.Mock(limit_sum='mid_sum', **{
+            'metrics.summary.return_value': dict(request_rate=5.0),
+        })
+        daemon = mock.Mock(config=config.Config(conf_dict={
+            'control.node_name': 'node',
+        }), db=db, middleware=middleware, limits=mock.Mock(limit_sum='sum'),
+            reload_counts=dict(requested=1, coalesced=0, performed=1))
+
+        control.stats(daemon, 'reply')
+
+        channel, data = db.publish.call_args[0]
+        self.assertEqual(channel, 'reply')
+        self.assertTrue(data.startswith('stats:'))
+        self.assertEqual(msgpack.loads(data[6:]), {
+            'node': 'node',
+            'pid': 1234,
+            'limit_sum': 'mid_sum',
+            'reloads_requested': 1,
+            'reloads_coalesced': 0,
+            'reloads': 1,
+            'cache_hit_rate': None,
+            'request_rate': 5.0,
+        })
+
+    @mock.patch('os.getpid', return_value=1234)
+    def test_remote_middleware(self, mock_getpid):
+        db = mock.Mock()
+        middleware = mock.Mock(limit_sum='mid_sum', **{
+            'metrics.summary.return_value': dict(request_rate=0.0),
+        })
+        daemon = mock.Mock(config=config.Config(conf_dict={
+            'control.node_name': 'node',
+        }), db=db, middleware=middleware, limits=mock.Mock(limit_sum='sum'),
+            reload_counts=dict(requested=1, coalesced=0, performed=1),
+            serves_requests=False)
+
+        control.stats(daemon, 'reply')
+
+        channel, data = db.publish.call_args[0]
+        self.assertEqual(msgpack.loads(data[6:]), {
+            'node': 'node',
+            'pid': 1234,
+            'limit_sum': 'sum',
+            'reloads_requested': 1,
+            'reloads_coalesced': 0,
+            'reloads': 1,
+            'cache_hit_rate': None,
+        })
+        self.assertFalse(middleware.metrics.summary.called)
+
+
+class TestGetDaemon(unittest2.TestCase):
+    @mock.patch.object(control, '_daemons', {})
+    def test_unshared(self):
+        klass = mock.Mock(side_effect=lambda x, y: mock.Mock())
+        conf = config.Config()
+
+        result1 = control.get_daemon(klass, 'midware1', conf)
+        result2 = control.get_daemon(klass, 'midware2', conf)
+
+        self.assertNotEqual(result1, result2)
+        klass.assert_has_calls([
+            mock.call('midware1', conf),
+            mock.call('midware2', conf),
+        ])
+        self.assertEqual(control._daemons, {})
+
+    @mock.patch.object(control, '_daemons', {})
+    def test_shared(self):
+        klass = mock.Mock(side_effect=lambda x, y: mock.Mock())
+        conf1 = config.Config(conf_dict={
+            'redis.host': 'example.com',
+            'control.shared': 'yes',
+        })
+        conf2 = config.Config(conf_dict={
+            'redis.host': 'example.com',
+            'control.shared': 'yes',
+        })
+
+        result1 = control.get_daemon(klass, 'midware1', conf1)
+        result2 = control.get_daemon(klass, 'midware2', conf2)
+
+        self.assertEqual(result1, result2)
+        klass.assert_called_once_with('midware1', conf1)
+
+    @mock.patch.object(control, '_daemons', {})
+    def test_shared_different(self):
+        klass = mock.Mock(side_effect=lambda x, y: mock.Mock())
+        other_klass = mock.Mock(side_effect=lambda x, y: mock.Mock())
+        confs = [
+            config.Config(conf_dict={
+                'redis.host': 'example.com',
+                'control.shared': 'yes',
+            }),
+            config.Config(conf_dict={
+                'redis.host': 'example.org',
+                'control.shared': 'yes',
+            }),
+            config.Config(conf_dict={
+                'redis.host': 'example.com',
+                'control.shared': 'yes',
+                'control.channel': 'other',
+            }),
+        ]
+
+        results = [control.get_daemon(klass, 'midware', conf)
+                   for conf in confs]
+        results.append(control.get_daemon(other_klass, 'midware', confs[0]))
+
+        self.assertEqual(len(set(id(r) for r in results)), 4)
+        self.assertEqual(klass.call_count, 3)
+        other_klass.assert_called_once_with('midware', confs[0])
+
+
+class TestLimitsCache(unittest2.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'cache')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def make_daemon(self):
+        return control.ControlDaemon('middleware', config.Config(conf_dict={
+            'control.cache_file': self.path,
+        }))
+
+    def write_cache(self, limits, scores=None, limit_sum=None):
+        if limit_sum is None:
+            limit_sum = database.limits_checksum(limits)
+        with open(self.path, 'wb') as f:
+            f.write(msgpack.dumps({
+                'limit_sum': limit_sum,
+                'limits': limits,
+                'scores': scores,
+            }))
+
+    @mock.patch.object(control.LOG, 'info')
+    @mock.patch.object(control.ControlDaemon, '_limits_changed')
+    def test_load_cache(self, mock_limits_changed, mock_info):
+        limits = [msgpack.dumps({'uuid': 'uuid1'})]
+        self.write_cache(limits, [10.0])
+        cd = self.make_daemon()
+
+        self.assertTrue(cd._load_cache())
+
+        self.assertEqual(cd.limits.limit_raw, limits)
+        self.assertEqual(cd.limits.limit_data, [{'uuid': 'uuid1'}])
+        self.assertEqual(cd.limits.limit_scores, [10.0])
+        self.assertEqual(cd.limits.limit_sum,
+                         database.limits_checksum(limits))
+        self.assertEqual(cd.cache_sum, cd.limits.limit_sum)
+        mock_limits_changed.assert_called_once_with()
+        mock_info.assert_called_once_with(
+            "Loaded 1 limits from cache %r" % self.path)
+
+    @mock.patch.object(control.LOG, 'warning')
+    def test_load_cache_missing(self, mock_warning):
+        cd = self.make_daemon()
+
+        self.assertFalse(cd._load_cache())
+
+        self.assertEqual(cd.limits.limit_data, [])
+        self.assertEqual(cd.cache_sum, None)
+        self.assertEqual(mock_warning.call_count, 1)
+
+    @mock.patch.object(control.LOG, 'warning')
+    def test_load_cache_corrupt(self, mock_warning):
+        self.write_cache([msgpack.dumps({'uuid': 'uuid1'})],
+                         limit_sum='bad_sum')
+        cd = self.make_daemon()
+
+        self.assertFalse(cd._load_cache())
+
+        self.assertEqual(cd.limits.limit_data, [])
+        mock_warning.assert_called_once_with(
+            "Could not load limits cache %r: Checksum mismatch" % self.path)
+
+    def test_save_cache(self):
+        cd = self.make_daemon()
+        limits = [msgpack.dumps({'uuid': 'uuid1'})]
+        cd.limits.set_limits(limits, [10.0])
+
+        cd._save_cache()
+
+        with open(self.path, 'rb') as f:
+            self.assertEqual(msgpack.loads(f.read()), {
+                'limit_sum': cd.limits.limit_sum,
+                'limits': limits,
+                'scores': [10.0],
+            })
+        self.assertEqual(cd.cache_sum, cd.limits.limit_sum)
+        self.assertEqual(os.listdir(self.tmpdir), ['cache'])
+
+    def test_save_cache_unchanged(self):
+        cd = self.make_daemon()
+        cd.cache_sum = cd.limits.limit_sum
+
+        cd._save_cache()
+
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_save_cache_unset(self):
+        cd = control.ControlDaemon('middleware', config.Config())
+        cd.limits = mock.Mock(limit_sum='sum')
+
+        cd._save_cache()
+
+        self.assertEqual(cd.cache_sum, None)
+
+    @mock.patch.object(control.LOG, 'exception')
+    def test_save_cache_error(self, mock_exception):
+        self.path = os.path.join(self.tmpdir, 'missing', 'cache')
+        cd = self.make_daemon()
+
+        cd._save_cache()
+
+        mock_exception.assert_called_once_with(
+            "Could not save limits cache %r" % self.path)
+        self.assertEqual(cd.cache_sum, None)
+
+    @mock.patch.object(control.LOG, 'info')
+    def test_round_trip(self, mock_info):
+        limits = [msgpack.dumps({'uuid': 'uuid%d' % i}) for i in range(3)]
+        cd = self.make_daemon()
+        cd.limits.set_limits(limits, [10.0, 20.0, 30.0])
+        cd._save_cache()
+
+        new_cd = self.make_daemon()
+
+        self.assertTrue(new_cd._load_cache())
+        self.assertEqual(new_cd.limits.limit_sum, cd.limits.limit_sum)
+        self.assertEqual(new_cd.limits.limit_data, cd.limits.limit_data)
+
+
 class TestReload(unittest2.TestCase):
-    @mock.patch.object(eventlet, 'spawn_after')
-    @mock.patch.object(eventlet, 'spawn_n')
     @mock.patch('random.random', return_value=0.5)
-    def test_basic(self, mock_random, mock_spawn_n, mock_spawn_after):
-        daemon = mock.Mock(reload='reload', config=config.Config())
+    def test_basic(self, mock_random):
+        daemon = mock.Mock(config=config.Config())
 
         control.reload(daemon)
 
         self.assertFalse(mock_random.called)
-        self.assertFalse(mock_spawn_after.called)
-        mock_spawn_n.assert_called_once_with('reload')
+        daemon.schedule_reload.assert_called_once_with(full=True)
 
-    @mock.patch.object(eventlet, 'spawn_after')
-    @mock.patch.object(eventlet, 'spawn_n')
     @mock.patch('random.random', return_value=0.5)
-    def test_configured_spread(self, mock_random, mock_spawn_n,
-                               mock_spawn_after):
-        daemon = mock.Mock(reload='reload', config=config.Config(conf_dict={
+    def test_configured_spread(self, mock_random):
+        daemon = mock.Mock(config=config.Config(conf_dict={
             'control.reload_spread': '20.4',
         }))
 
         control.reload(daemon)
 
         mock_random.assert_called_once_with()
-        mock_spawn_after.assert_called_once_with(10.2, 'reload')
-        self.assertFalse(mock_spawn_n.called)
+        daemon.schedule_reload.assert_called_once_with(10.2, full=True)
 
-    @mock.patch.object(eventlet, 'spawn_after')
-    @mock.patch.object(eventlet, 'spawn_n')
     @mock.patch('random.random', return_value=0.5)
-    def test_configured_spread_bad(self, mock_random, mock_spawn_n,
-                                   mock_spawn_after):
-        daemon = mock.Mock(reload='reload', config=config.Config(conf_dict={
+    def test_configured_spread_bad(self, mock_random):
+        daemon = mock.Mock(config=config.Config(conf_dict={
             'control.reload_spread': '20.4.3',
         }))
 
         control.reload(daemon)
 
         self.assertFalse(mock_random.called)
-        self.assertFalse(mock_spawn_after.called)
-        mock_spawn_n.assert_called_once_with('reload')
+        daemon.schedule_reload.assert_called_once_with(full=True)
 
-    @mock.patch.object(eventlet, 'spawn_after')
-    @mock.patch.object(eventlet, 'spawn_n')
     @mock.patch('random.random', return_value=0.5)
-    def test_configured_spread_override(self, mock_random, mock_spawn_n,
-                                        mock_spawn_after):
-        daemon = mock.Mock(reload='reload', config=config.Config(conf_dict={
+    def test_configured_spread_override(self, mock_random):
+        daemon = mock.Mock(config=config.Config(conf_dict={
             'control.reload_spread': '20.4',
         }))
 
         control.reload(daemon, 'immediate')
 
         self.assertFalse(mock_random.called)
-        self.assertFalse(mock_spawn_after.called)
-        mock_spawn_n.assert_called_once_with('reload')
+        daemon.schedule_reload.assert_called_once_with(full=True)
 
-    @mock.patch.object(eventlet, 'spawn_after')
-    @mock.patch.object(eventlet, 'spawn_n')
     @mock.patch('random.random', return_value=0.5)
-    def test_forced_spread(self, mock_random, mock_spawn_n, mock_spawn_after):
-        daemon = mock.Mock(reload='reload', config=config.Config())
+    def test_forced_spread(self, mock_random):
+        daemon = mock.Mock(config=config.Config())
 
         control.reload(daemon, 'spread', '20.4')
 
         mock_random.assert_called_once_with()
-        mock_spawn_after.assert_called_once_with(10.2, 'reload')
-        self.assertFalse(mock_spawn_n.called)
+        daemon.schedule_reload.assert_called_once_with(10.2, full=True)
 
-    @mock.patch.object(eventlet, 'spawn_after')
-    @mock.patch.object(eventlet, 'spawn_n')
     @mock.patch('random.random', return_value=0.5)
-    def test_bad_spread_fallback(self, mock_random, mock_spawn_n,
-                                 mock_spawn_after):
-        daemon = mock.Mock(reload='reload', config=config.Config(conf_dict={
+    def test_bad_spread_fallback(self, mock_random):
+        daemon = mock.Mock(config=config.Config(conf_dict={
             'control.reload_spread': '40.8',
         }))
 
         control.reload(daemon, 'spread', '20.4.3')
 
         mock_random.assert_called_once_with()
-        mock_spawn_after.assert_called_once_with(20.4, 'reload')
-        self.assertFalse(mock_spawn_n.called)
+        daemon.schedule_reload.assert_called_once_with(20.4, full=True)
+
+    @mock.patch('random.random', return_value=0.5)
+    def test_versioned(self, mock_random):
+        daemon = mock.Mock(config=config.Config())
+
+        control.reload(daemon, 'versioned')
+
+        self.assertFalse(mock_random.called)
+        daemon.schedule_reload.assert_called_once_with(full=False)
+
+    @mock.patch('random.random', return_value=0.5)
+    def test_versioned_configured_spread(self, mock_random):
+        daemon = mock.Mock(config=config.Config(conf_dict={
+            'control.reload_spread': '20.4',
+        }))
+
+        control.reload(daemon, 'versioned')
+
+        mock_random.assert_called_once_with()
+        daemon.schedule_reload.assert_called_once_with(10.2, full=False)
+
+    @mock.patch('random.random', return_value=0.5)
+    def test_versioned_immediate(self, mock_random):
+        daemon = mock.Mock(config=config.Config(conf_dict={
+            'control.reload_spread': '20.4',
+        }))
+
+        control.reload(daemon, 'immediate', 'versioned')
+
+        self.assertFalse(mock_random.called)
+        daemon.schedule_reload.assert_called_once_with(full=False)
+
+    @mock.patch('random.random', return_value=0.5)
+    def test_versioned_spread(self, mock_random):
+        daemon = mock.Mock(config=config.Config())
+
+        control.reload(daemon, 'spread', '20.4', 'versioned')
+
+        mock_random.assert_called_once_with()
+        daemon.schedule_reload.assert_called_once_with(10.2, full=False)
+
+    @mock.patch.object(control.ControlDaemon, 'schedule_reload')
+    def test_dispatch_versioned(self, mock_schedule_reload):
+        cd = control.ControlDaemon('middleware', config.Config())
+
+        cd._dispatch('control', {
+            'type': 'message',
+            'channel': 'control',
+            'data': 'reload:spread:0:versioned',
+        })
+        cd._dispatch('control', {
+            'type': 'message',
+            'channel': 'control',
+            'data': 'reload',
+        })
+
+        mock_schedule_reload.assert_has_calls([
+            mock.call(full=False),
+            mock.call(full=True),
+        ])
+
+
+class TestLimitSet(unittest2.TestCase):
+    def test_limit_set(self):
+        daemon = mock.Mock()
+
+        control.limit_set(daemon, '20.0', 'uuid1')
+
+        daemon.reload_limit.assert_called_once_with('uuid1', 20.0)
+
+
+class TestLimitDelete(unittest2.TestCase):
+    def test_limit_delete(self):
+        daemon = mock.Mock()
+
+        control.limit_delete(daemon, 'uuid1')
+
+        daemon.remove_limit.assert_called_once_with('uuid1')
+
+
+class TestProfileReply(unittest2.TestCase):
+    def test_no_channel(self):
+        daemon = mock.Mock(config=config.Config())
+
+        control._profile_reply(daemon, None, 'status', 'message')
+
+        self.assertFalse(daemon.db.publish.called)
+
+    def test_no_nodename(self):
+        daemon = mock.Mock(config=config.Config())
+
+        control._profile_reply(daemon, 'reply', 'status', 'message')
+
+        daemon.db.publish.assert_called_once_with(
+            'reply', 'profile::status:message')
+
+    def test_with_nodename(self):
+        daemon = mock.Mock(config=config.Config(conf_dict={
+            'control.node_name': 'node',
+        }))
+
+        control._profile_reply(daemon, 'reply', 'status', 'message')
+
+        daemon.db.publish.assert_called_once_with(
+            'reply', 'profile:node:status:message')
+
+
+class TestProfileFinish(unittest2.TestCase):
+    @mock.patch.object(control, '_profile_reply')
+    def test_saved(self, mock_profile_reply):
+        prof = mock.Mock(**{'summary.return_value': 'summary'})
+        daemon = mock.Mock(profiling=(prof, 'file', 'reply', 'timer'))
+
+        control._profile_finish(daemon)
+
+        self.assertEqual(daemon.profiling, None)
+        prof.assert_has_calls([
+            mock.call.stop(),
+            mock.call.save('file'),
+            mock.call.summary(),
+        ])
+        mock_profile_reply.assert_has_calls([
+            mock.call(daemon, 'reply', 'saved', 'file (summary)'),
+            mock.call(daemon, None, 'saved', 'file (summary)'),
+        ], any_order=True)
+
+    @mock.patch.object(control, '_profile_reply')
+    def test_same_channel(self, mock_profile_reply):
+        prof = mock.Mock(**{'summary.return_value': 'summary'})
+        daemon = mock.Mock(profiling=(prof, 'file', 'reply', 'timer'))
+
+        control._profile_finish(daemon, 'reply')
+
+        mock_profile_reply.assert_called_once_with(
+            daemon, 'reply', 'saved', 'file (summary)')
+
+    @mock.patch.object(control, '_profile_reply')
+    @mock.patch.object(control.LOG, 'exception')
+    def test_save_failed(self, mock_exception, mock_profile_reply):
+        prof = mock.Mock(**{'save.side_effect': IOError('failed')})
+        daemon = mock.Mock(profiling=(prof, 'file', 'reply', 'timer'))
+
+        control._profile_finish(daemon, 'reply')
+
+        self.assertEqual(daemon.profiling, None)
+        self.assertFalse(prof.summary.called)
+        mock_exception.assert_called_once_with(
+            "Failed to save profile to 'file'")
+        mock_profile_reply.assert_called_once_with(
+            daemon, 'reply', 'error', 'failed to save file: failed')
+
+
+class TestProfileStart(unittest2.TestCase):
+    @mock.patch.object(control, '_profile_reply')
+    @mock.patch.object(eventlet, 'spawn_after')
+    def test_disabled(self, mock_spawn_after, mock_profile_reply):
+        daemon = mock.Mock(config=config.Config(), profiling=None)
+
+        control.profile_start(daemon, 'reply')
+
+        self.assertEqual(daemon.profiling, None)
+        self.assertFalse(mock_spawn_after.called)
+        mock_profile_reply.assert_called_once_with(
+            daemon, 'reply', 'error', 'profiling not enabled')
+
+    @mock.patch.object(control, '_profile_reply')
+    @mock.patch.object(eventlet, 'spawn_after')
+    def test_running(self, mock_spawn_after, mock_profile_reply):
+        daemon = mock.Mock(config=config.Config(conf_dict={
+            'control.profile_dir': '/tmp',
+        }), profiling='running')
+
+        control.profile_start(daemon, 'reply')
+
+        self.assertEqual(daemon.profiling, 'running')
+        self.assertFalse(mock_spawn_after.called)
+        mock_profile_reply.assert_called_once_with(
+            daemon, 'reply', 'error', 'profiler already running')
+
+    @mock.patch.object(control, '_profile_reply')
+    @mock.patch.object(eventlet, 'spawn_after')
+    def test_bad_mode(self, mock_spawn_after, mock_profile_reply):
+        daemon = mock.Mock(config=config.Config(conf_dict={
+            'control.profile_dir': '/tmp',
+        }), profiling=None)
+
+        control.profile_start(daemon, 'reply', '10', 'spam')
+
+        self.assertEqual(daemon.profiling, None)
+        self.assertFalse(mock_spawn_after.called)
+        mock_profile_reply.assert_called_once_with(
+            daemon, 'reply', 'error', "unknown mode 'spam'")
+
+    @mock.patch.dict(profiler.profilers, sample=mock.Mock(**{
+        'return_value.extension': 'collapsed',
+    }))
+    @mock.patch.object(control, '_profile_reply')
+    @mock.patch.object(eventlet, 'spawn_after', return_value='timer')
+    @mock.patch('socket.gethostname', return_value='host')
+    @mock.patch('os.getpid', return_value=1234)
+    @mock.patch('time.time', return_value=1000000.1)
+    def test_defaults(self, mock_time, mock_getpid, mock_gethostname,
+                      mock_spawn_after, mock_profile_reply):
+        prof = profiler.profilers['sample'].return_value
+        daemon = mock.Mock(config=config.Config(conf_dict={
+            'control.profile_dir': '/tmp',
+        }), profiling=None)
+
+        control.profile_start(daemon, 'reply')
+
+        prof.start.assert_called_once_with()
+        mock_spawn_after.assert_called_once_with(
+            60.0, control._profile_finish, daemon)
+        self.assertEqual(daemon.profiling, (
+            prof, '/tmp/turnstile-host-1234-1000000.collapsed', 'reply',
+            'timer'))
+        mock_profile_reply.assert_called_once_with(
+            daemon, 'reply', 'started', 'sample for 60 seconds')
+
+    @mock.patch.dict(profiler.profilers, pstats=mock.Mock(**{
+        'return_value.extension': 'pstats',
+    }))
+    @mock.patch.object(control, '_profile_reply')
+    @mock.patch.object(eventlet, 'spawn_after', return_value='timer')
+    @mock.patch('os.getpid', return_value=1234)
+    @mock.patch('time.time', return_value=1000000.1)
+    def test_configured(self, mock_time, mock_getpid, mock_spawn_after,
+                        mock_profile_reply):
+        prof = profiler.profilers['pstats'].return_value
+        daemon = mock.Mock(config=config.Config(conf_dict={
+            'control.profile_dir': '/tmp',
+            'control.profile_max_duration': '30',
+            'control.node_name': 'node',
+        }), profiling=None)
+
+        control.profile_start(daemon, 'reply', '5.5', 'pstats')
+
+        mock_spawn_after.assert_called_once_with(
+            5.5, control._profile_finish, daemon)
+        self.assertEqual(daemon.profiling, (
+            prof, '/tmp/turnstile-node-1234-1000000.pstats', 'reply',
+            'timer'))
+        mock_profile_reply.assert_called_once_with(
+            daemon, 'reply', 'started', 'pstats for 5.5 seconds')
+
+    @mock.patch.dict(profiler.profilers, sample=mock.Mock(**{
+        'return_value.extension': 'collapsed',
+    }))
+    @mock.patch.object(control, '_profile_reply')
+    @mock.patch.object(eventlet, 'spawn_after', return_value='timer')
+    def test_capped(self, mock_spawn_after, mock_profile_reply):
+        daemon = mock.Mock(config=config.Config(conf_dict={
+            'control.profile_dir': '/tmp',
+            'control.profile_max_duration': '30',
+        }), profiling=None)
+
+        control.profile_start(daemon, 'reply', '3600')
+
+        mock_spawn_after.assert_called_once_with(
+            30.0, control._profile_finish, daemon)
+
+    @mock.patch.dict(profiler.profilers, sample=mock.Mock(**{
+        'return_value.extension': 'collapsed',
+        'return_value.start.side_effect': ValueError(
+            'signal only works in main thread'),
+    }))
+    @mock.patch.object(control, '_profile_reply')
+    @mock.patch.object(control.LOG, 'exception')
+    @mock.patch.object(eventlet, 'spawn_after')
+    def test_start_failed(self, mock_spawn_after, mock_exception,
+                          mock_profile_reply):
+        daemon = mock.Mock(config=config.Config(conf_dict={
+            'control.profile_dir': '/tmp',
+        }), profiling=None)
+
+        control.profile_start(daemon, 'reply')
+
+        self.assertFalse(mock_spawn_after.called)
+        self.assertEqual(daemon.profiling, None)
+        mock_exception.assert_called_once_with(
+            "Failed to start sample profiler")
+        mock_profile_reply.assert_called_once_with(
+            daemon, 'reply', 'error',
+            'failed to start profiler: signal only works in main thread')
+
+
+class TestProfileStop(unittest2.TestCase):
+    @mock.patch.object(control, '_profile_reply')
+    @mock.patch.object(control, '_profile_finish')
+    def test_not_running(self, mock_profile_finish, mock_profile_reply):
+        daemon = mock.Mock(profiling=None)
+
+        control.profile_stop(daemon, 'reply')
+
+        self.assertFalse(mock_profile_finish.called)
+        mock_profile_reply.assert_called_once_with(
+            daemon, 'reply', 'error', 'profiler not running')
+
+    @mock.patch.object(control, '_profile_reply')
+    @mock.patch.object(control, '_profile_finish')
+    def test_running(self, mock_profile_finish, mock_profile_reply):
+        timer = mock.Mock()
+        daemon = mock.Mock(profiling=('prof', 'file', 'start', timer))
+
+        control.profile_stop(daemon, 'reply')
+
+        timer.cancel.assert_called_once_with()
+        mock_profile_finish.assert_called_once_with(daemon, 'reply')
+        self.assertFalse(mock_profile_reply.called)
@@ -14,11 +14,13 @@
 #    under the License.
 
 import mock
+import msgpack
 import redis
 import unittest2
 
 from turnstile import database
 from turnstile import limits
+from turnstile import memdb
 from turnstile import utils
 
 
@@ -236,19 +238,51 @@ class TestInitialize(unittest2.TestCase):
 
 class TestLimitsHydrate(unittest2.TestCase):
     @mock.patch.object(limits.Limit, 'hydrate',
-                       side_effect=lambda x, y: "limit:%s" % y)
+                       side_effect=lambda x, y: "limit:%s" % y.pop('id'))
     def test_hydrate(self, mock_hydrate):
-        result = database.limits_hydrate('db', ['lim1', 'lim2', 'lim3'])
+        lims = [{'id': 'lim1'}, {'id': 'lim2'}, {'id': 'lim3'}]
+
+        result = database.limits_hydrate('db', lims)
 
         self.assertEqual(result, ['limit:lim1', 'limit:lim2', 'limit:lim3'])
-        mock_hydrate.assert_has_calls([
-            mock.call('db', 'lim1'),
-            mock.call('db', 'lim2'),
-            mock.call('db', 'lim3'),
-        ])
+        self.assertEqual(mock_hydrate.call_count, 3)
+        self.assertEqual(lims, [{'id': 'lim1'}, {'id': 'lim2'},
+                                {'id': 'lim3'}])
+
+
+class TestLimitsChecksum(unittest2.TestCase):
+    def test_checksum(self):
+        self.assertEqual(database.limits_checksum([]),
+                         'd41d8cd98f00b204e9800998ecf8427e')
+        self.assertEqual(database.limits_checksum(['Nobody', 'inspects']),
+                         database.limits_checksum(['Nobodyinspects']))
+
+
+class TestVersion(unittest2.TestCase):
+    def test_version_key(self):
+        self.assertEqual(database.version_key('limits'), 'limits:version')
+
+    def test_parse_version(self):
+        self.assertEqual(database.parse_version('5:sum'), (5, 'sum'))
+        self.assertEqual(database.parse_version('5:'), (5, None))
+        self.assertEqual(database.parse_version(None), (0, None))
+        self.assertEqual(database.parse_version('bad:sum'), (0, None))
 
 
 class TestLimitUpdate(unittest2.TestCase):
+    def test_version(self):
+        db = memdb.MemoryRedis('test_limit_update')
+        self.addCleanup(memdb.reset, 'test_limit_update')
+        lims = [limits.Limit(None, uuid='uuid%d' % i, uri='/%d' % i,
+                             value=1, unit='second') for i in range(3)]
+
+        database.limit_update(db, 'limits', lims)
+        database.limit_update(db, 'limits', lims[1:])
+
+        self.assertEqual(database.parse_version(db.get('limits:version')),
+                         (2, database.limits_checksum(
+                             db.zrange('limits', 0, -1))))
+
     @mock.patch('msgpack.dumps', side_effect=lambda x: x)
     def test_limit_update(self, mock_dumps):
         limits = [
@@ -266,6 +300,7 @@ class TestLimitUpdate(unittest2.TestCase):
                 'limit6',
                 'limit8',
             ],
+            'get.return_value': '4:oldsum',
         })
         pipe.__enter__.return_value = pipe
         pipe.__exit__.return_value = False
@@ -282,11 +317,14 @@ class TestLimitUpdate(unittest2.TestCase):
             mock.call('limit5'),
             mock.call('limit6'),
         ])
+        checksum = database.limits_checksum(['limit%d' % i
+                                             for i in range(1, 7)])
         db.pipeline.assert_called_once_with()
         pipe.assert_has_calls([
             mock.call.__enter__(),
-            mock.call.watch('limit_key'),
+            mock.call.watch('limit_key', 'limit_key:version'),
             mock.call.zrange('limit_key', 0, -1),
+            mock.call.get('limit_key:version'),
             mock.call.multi(),
             mock.call.zrem('limit_key', 'limit8'),
             mock.call.zadd('limit_key', 10, 'limit1'),
@@ -295,6 +333,7 @@ class TestLimitUpdate(unittest2.TestCase):
             mock.call.zadd('limit_key', 40, 'limit4'),
             mock.call.zadd('limit_key', 50, 'limit5'),
             mock.call.zadd('limit_key', 60, 'limit6'),
+            mock.call.set('limit_key:version', '5:' + checksum),
             mock.call.execute(),
             mock.call.__exit__(None, None, None),
         ])
@@ -317,6 +356,7 @@ class TestLimitUpdate(unittest2.TestCase):
                 'limit8',
             ],
             'execute.side_effect': [redis.WatchError, None],
+            'get.return_value': '4:oldsum',
         })
         pipe.__enter__.return_value = pipe
         pipe.__exit__.return_value = False
@@ -333,11 +373,14 @@ class TestLimitUpdate(unittest2.TestCase):
             mock.call('limit5'),
             mock.call('limit6'),
         ])
+        checksum = database.limits_checksum(['limit%d' % i
+                                             for i in range(1, 7)])
         db.pipeline.assert_called_once_with()
         pipe.assert_has_calls([
             mock.call.__enter__(),
-            mock.call.watch('limit_key'),
+            mock.call.watch('limit_key', 'limit_key:version'),
             mock.call.zrange('limit_key', 0, -1),
+            mock.call.get('limit_key:version'),
             mock.call.multi(),
             mock.call.zrem('limit_key', 'limit8'),
             mock.call.zadd('limit_key', 10, 'limit1'),
@@ -346,9 +389,11 @@ class TestLimitUpdate(unittest2.TestCase):
             mock.call.zadd('limit_key', 40, 'limit4'),
             mock.call.zadd('limit_key', 50, 'limit5'),
             mock.call.zadd('limit_key', 60, 'limit6'),
+            mock.call.set('limit_key:version', '5:' + checksum),
             mock.call.execute(),
-            mock.call.watch('limit_key'),
+            mock.call.watch('limit_key', 'limit_key:version'),
             mock.call.zrange('limit_key', 0, -1),
+            mock.call.get('limit_key:version'),
             mock.call.multi(),
             mock.call.zrem('limit_key', 'limit8'),
             mock.call.zadd('limit_key', 10, 'limit1'),
@@ -357,11 +402,158 @@ class TestLimitUpdate(unittest2.TestCase):
             mock.call.zadd('limit_key', 40, 'limit4'),
             mock.call.zadd('limit_key', 50, 'limit5'),
             mock.call.zadd('limit_key', 60, 'limit6'),
+            mock.call.set('limit_key:version', '5:' + checksum),
             mock.call.execute(),
             mock.call.__exit__(None, None, None),
         ])
 
 
+class TestLimitSet(unittest2.TestCase):
+    def setUp(self):
+        self.db = memdb.MemoryRedis('test_limit_set')
+        database.limit_update(self.db, 'limits', [
+            limits.Limit(None, uuid='uuid1', uri='/a', value=1,
+                         unit='second'),
+            limits.Limit(None, uuid='uuid2', uri='/b', value=1,
+                         unit='second'),
+        ])
+
+    def tearDown(self):
+        memdb.reset('test_limit_set')
+
+    def get_limits(self):
+        return [(msgpack.loads(lim)['uuid'], msgpack.loads(lim)['value'],
+                 score)
+                for lim, score in self.db.zrange('limits', 0, -1,
+                                                 withscores=True)]
+
+    def get_version(self):
+        return database.parse_version(self.db.get('limits:version'))
+
+    def test_update(self):
+        result = database.limit_set(self.db, 'limits', limits.Limit(
+            None, uuid='uuid1', uri='/a', value=5, unit='second'))
+
+        self.assertEqual(result, 10)
+        self.assertEqual(self.get_limits(), [
+            ('uuid1', 5, 10),
+            ('uuid2', 1, 20),
+        ])
+        self.assertEqual(self.get_version(), (2, database.limits_checksum(
+            self.db.zrange('limits', 0, -1))))
+
+    def test_add(self):
+        result = database.limit_set(self.db, 'limits', limits.Limit(
+            None, uuid='uuid3', uri='/c', value=5, unit='second'))
+
+        self.assertEqual(result, 30)
+        self.assertEqual(self.get_limits(), [
+            ('uuid1', 1, 10),
+            ('uuid2', 1, 20),
+            ('uuid3', 5, 30),
+        ])
+        self.assertEqual(self.get_version(), (2, database.limits_checksum(
+            self.db.zrange('limits', 0, -1))))
+
+    def test_add_empty(self):
+        result = database.limit_set(self.db, 'other', limits.Limit(
+            None, uuid='uuid3', uri='/c', value=5, unit='second'))
+
+        self.assertEqual(result, 10)
+
+    @mock.patch('msgpack.dumps', return_value='new')
+    @mock.patch('msgpack.loads', side_effect=lambda x: {'uuid': x})
+    def test_retry(self, mock_loads, mock_dumps):
+        limit = mock.Mock(uuid='uuid1')
+        pipe = mock.MagicMock(**{
+            'zrange.return_value': [('uuid1', 10.0), ('uuid2', 20.0)],
+            'get.return_value': None,
+            'execute.side_effect': [redis.WatchError, None],
+        })
+        pipe.__enter__.return_value = pipe
+        pipe.__exit__.return_value = False
+        db = mock.Mock(**{'pipeline.return_value': pipe})
+
+        result = database.limit_set(db, 'limits', limit)
+
+        self.assertEqual(result, 10.0)
+        version = '1:' + database.limits_checksum(['new', 'uuid2'])
+        pipe.assert_has_calls([
+            mock.call.__enter__(),
+            mock.call.watch('limits', 'limits:version'),
+            mock.call.zrange('limits', 0, -1, withscores=True),
+            mock.call.get('limits:version'),
+            mock.call.multi(),
+            mock.call.zrem('limits', 'uuid1'),
+            mock.call.zadd('limits', 10.0, 'new'),
+            mock.call.set('limits:version', version),
+            mock.call.execute(),
+            mock.call.watch('limits', 'limits:version'),
+            mock.call.zrange('limits', 0, -1, withscores=True),
+            mock.call.get('limits:version'),
+            mock.call.multi(),
+            mock.call.zrem('limits', 'uuid1'),
+            mock.call.zadd('limits', 10.0, 'new'),
+            mock.call.set('limits:version', version),
+            mock.call.execute(),
+            mock.call.__exit__(None, None, None),
+        ])
+
+
+class TestLimitDelete(unittest2.TestCase):
+    def setUp(self):
+        self.db = memdb.MemoryRedis('test_limit_delete')
+        database.limit_update(self.db, 'limits', [
+            limits.Limit(None, uuid='uuid1', uri='/a', value=1,
+                         unit='second'),
+            limits.Limit(None, uuid='uuid2', uri='/b', value=1,
+                         unit='second'),
+        ])
+
+    def tearDown(self):
+        memdb.reset('test_limit_delete')
+
+    def test_delete(self):
+        result = database.limit_delete(self.db, 'limits', 'uuid1')
+
+        self.assertEqual(result, True)
+        self.assertEqual([msgpack.loads(lim)['uuid'] for lim in
+                          self.db.zrange('limits', 0, -1)], ['uuid2'])
+        self.assertEqual(database.parse_version(
+            self.db.get('limits:version')), (2, database.limits_checksum(
+                self.db.zrange('limits', 0, -1))))
+
+    def test_missing(self):
+        result = database.limit_delete(self.db, 'limits', 'uuid3')
+
+        self.assertEqual(result, False)
+        self.assertEqual(self.db.zcard('limits'), 2)
+        self.assertEqual(database.parse_version(
+            self.db.get('limits:version'))[0], 1)
+
+    @mock.patch('msgpack.loads', side_effect=lambda x: {'uuid': x})
+    def test_retry(self, mock_loads):
+        pipe = mock.MagicMock(**{
+            'zrange.return_value': [('uuid1', 10.0), ('uuid2', 20.0)],
+            'get.return_value': '3:sum',
+            'execute.side_effect': [redis.WatchError, None],
+        })
+        pipe.__enter__.return_value = pipe
+        pipe.__exit__.return_value = False
+        db = mock.Mock(**{'pipeline.return_value': pipe})
+
+        result = database.limit_delete(db, 'limits', 'uuid2')
+
+        self.assertEqual(result, True)
+        self.assertEqual(pipe.zrem.call_args_list, [
+            mock.call('limits', 'uuid2'),
+            mock.call('limits', 'uuid2'),
+        ])
+        self.assertEqual(pipe.execute.call_count, 2)
+        pipe.set.assert_called_with(
+            'limits:version', '4:' + database.limits_checksum(['uuid1']))
+
+
 class TestCommand(unittest2.TestCase):
     def test_command(self):
         db = mock.Mock()
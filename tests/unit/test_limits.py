@@ -13,12 +13,17 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import hashlib
+
 import mock
+import redis
 import unittest2
 
 from turnstile import limits
 from turnstile import utils
 
+from tests.unit import utils as test_utils
+
 
 class TestMakeUnits(unittest2.TestCase):
     def test_make_units(self):
@@ -79,6 +84,89 @@ class TestTimeUnit(unittest2.TestCase):
         self.assertRaises(ValueError, limits.TimeUnit, 'nosuchunit')
 
 
+class TestCompactorSettings(unittest2.TestCase):
+    def test_defaults(self):
+        result = limits.compactor_settings({})
+
+        self.assertEqual(result, (None, 600, 'compactor'))
+
+    def test_configured(self):
+        result = limits.compactor_settings(dict(
+            max_updates='10', max_age='300', compactor_key='compact'))
+
+        self.assertEqual(result, (10, 300, 'compact'))
+
+    def test_bad_values(self):
+        result = limits.compactor_settings(dict(
+            max_updates='ten', max_age='five minutes'))
+
+        self.assertEqual(result, (None, 600, 'compactor'))
+
+
+class TestRequestContext(unittest2.TestCase):
+    @mock.patch('time.time', return_value=1000000.1)
+    def test_init_basic(self, mock_time):
+        environ = dict(REQUEST_METHOD='GET')
+        ctx = limits.RequestContext(environ)
+
+        self.assertEqual(ctx.environ, environ)
+        self.assertEqual(ctx.method, 'GET')
+        self.assertEqual(ctx.time, 1000000.1)
+        self.assertEqual(ctx.compactor, (None, 600, 'compactor'))
+        self.assertEqual(ctx.metrics, limits._null_metrics)
+
+    @mock.patch('time.time', return_value=1000000.1)
+    def test_init_metrics(self, mock_time):
+        ctx = limits.RequestContext({}, metrics='metrics')
+
+        self.assertEqual(ctx.metrics, 'metrics')
+
+    @mock.patch('time.time', return_value=1000000.1)
+    def test_init_conf(self, mock_time):
+        environ = {
+            'turnstile.conf': dict(compactor=dict(max_updates='10')),
+        }
+        ctx = limits.RequestContext(environ)
+
+        self.assertEqual(ctx.method, None)
+        self.assertEqual(ctx.compactor, (10, 600, 'compactor'))
+
+    @mock.patch('time.time', return_value=1000000.1)
+    def test_init_compactor(self, mock_time):
+        environ = {
+            'turnstile.conf': dict(compactor=dict(max_updates='10')),
+        }
+        ctx = limits.RequestContext(environ, (5, 30, 'spam'))
+
+        self.assertEqual(ctx.compactor, (5, 30, 'spam'))
+
+    def test_query_keys_none(self):
+        ctx = limits.RequestContext({})
+
+        self.assertEqual(ctx.query_keys, None)
+
+    def test_query_keys(self):
+        environ = dict(QUERY_STRING='a=1&b&c=3=4')
+        ctx = limits.RequestContext(environ)
+
+        self.assertEqual(ctx.query_keys, set(['a', 'b', 'c']))
+
+        # Make sure the result is cached
+        environ['QUERY_STRING'] = 'd=5'
+        self.assertEqual(ctx.query_keys, set(['a', 'b', 'c']))
+
+    def test_pipeline(self):
+        db1 = mock.Mock(**{'pipeline.return_value': 'pipe1'})
+        db2 = mock.Mock(**{'pipeline.return_value': 'pipe2'})
+        ctx = limits.RequestContext({})
+
+        self.assertEqual(ctx.pipeline(db1), 'pipe1')
+        self.assertEqual(ctx.pipeline(db1), 'pipe1')
+        self.assertEqual(ctx.pipeline(db2), 'pipe2')
+        db1.pipeline.assert_called_once_with(transaction=False)
+        db2.pipeline.assert_called_once_with(transaction=False)
+
+
 class TestBucketKey(unittest2.TestCase):
     def test_part_encode(self):
         self.assertEqual(limits.BucketKey._encode('this is a test'),
@@ -196,6 +284,112 @@ class TestBucketKey(unittest2.TestCase):
         self.assertRaises(ValueError, limits.BucketKey.decode,
                           'bucket_v2:fake_uuid/a=1/b="2"/c')
 
+    def test_key_version3(self):
+        key = limits.BucketKey('fake_uuid', dict(a=1, b="2"), version=3)
+
+        digest = hashlib.md5('bucket_v2:fake_uuid/a=1/b="2"').digest()
+        expected = 'b3:fake_uuid/' + digest
+
+        self.assertEqual(str(key), expected)
+        self.assertEqual(key._cache, expected)
+
+    def test_decode_version3(self):
+        digest = hashlib.md5('bucket_v2:17/a=1').digest()
+        key = limits.BucketKey.decode('b3:17/' + digest)
+
+        self.assertEqual(key.uuid, '17')
+        self.assertEqual(key.params, None)
+        self.assertEqual(key.version, 3)
+        self.assertEqual(str(key), 'b3:17/' + digest)
+
+    def test_decode_version3_slashes(self):
+        digest = '/:' * 8
+        key = limits.BucketKey.decode('b3:17/' + digest)
+
+        self.assertEqual(key.uuid, '17')
+        self.assertEqual(str(key), 'b3:17/' + digest)
+
+    def test_decode_version3_baddigest(self):
+        self.assertRaises(ValueError, limits.BucketKey.decode,
+                          'b3:17/short')
+        self.assertRaises(ValueError, limits.BucketKey.decode,
+                          'b3:fake_uuid')
+
+
+class TestBucketKeyBuilder(unittest2.TestCase):
+    def test_init(self):
+        builder = limits.BucketKeyBuilder('fake_uuid', ['b', 'a', 'b'])
+
+        self.assertEqual(builder.uuid, 'fake_uuid')
+        self.assertEqual(builder.prefix, 'bucket_v2:fake_uuid')
+        self.assertEqual(builder.fields, [('a', '/a='), ('b', '/b=')])
+
+    def test_encode(self):
+        values = [
+            'this is a test', u'this is a test', "don't / your %s.",
+            'you said "hello".', 'back\\slash', 'tab\there', '\xc3\xa9',
+            u'\xe9', '', 123, -123, 123L, True, False, None, 1.5,
+            [1, 'two'], dict(a=1),
+        ]
+
+        for value in values:
+            result = limits.BucketKeyBuilder._encode(value)
+
+            self.assertEqual(result, limits.BucketKey._encode(value))
+            self.assertEqual(type(result), str)
+
+    def test_call_noparams(self):
+        builder = limits.BucketKeyBuilder('fake_uuid', [])
+
+        self.assertEqual(builder({}), 'bucket_v2:fake_uuid')
+
+    def test_call_withparams(self):
+        builder = limits.BucketKeyBuilder('fake_uuid', ['b', 'a'])
+
+        self.assertEqual(builder(dict(a=1, b="2")),
+                         'bucket_v2:fake_uuid/a=1/b="2"')
+
+    def test_init_badversion(self):
+        self.assertRaises(ValueError, limits.BucketKeyBuilder,
+                          'fake_uuid', [], version=1)
+
+    def test_call_version3(self):
+        builder = limits.BucketKeyBuilder('17', ['b', 'a'], version=3)
+        params = dict(a=1, b="2")
+
+        self.assertEqual(builder(params),
+                         str(limits.BucketKey('17', params, version=3)))
+
+    def test_call_matches_bucket_key(self):
+        builder = limits.BucketKeyBuilder('fake_uuid', ['tenant', 'id', 'x'])
+        param_sets = [
+            dict(tenant='acme', id=12345, x='a/b%c'),
+            dict(tenant=u'acme', id=u'12345', x=u'\xe9t\xe9'),
+            dict(tenant='acme', id=None, x=[1, 2]),
+        ]
+
+        for params in param_sets:
+            self.assertEqual(builder(params),
+                             str(limits.BucketKey('fake_uuid', params)))
+
+    @mock.patch.object(limits, 'BucketKey', return_value='fallback')
+    def test_call_extra_params(self, mock_BucketKey):
+        builder = limits.BucketKeyBuilder('fake_uuid', ['a'])
+        params = dict(a=1, b=2)
+
+        self.assertEqual(builder(params), 'fallback')
+        mock_BucketKey.assert_called_once_with('fake_uuid', params,
+                                               version=2)
+
+    @mock.patch.object(limits, 'BucketKey', return_value='fallback')
+    def test_call_missing_params(self, mock_BucketKey):
+        builder = limits.BucketKeyBuilder('fake_uuid', ['a', 'b'])
+        params = dict(a=1, c=2)
+
+        self.assertEqual(builder(params), 'fallback')
+        mock_BucketKey.assert_called_once_with('fake_uuid', params,
+                                               version=2)
+
 
 class TestBucketLoader(unittest2.TestCase):
     @mock.patch('msgpack.loads', side_effect=lambda x: x)
@@ -595,7 +789,8 @@ class TestLimitMeta(unittest2.TestCase):
 
     def test_attrs(self):
         base_attrs = set(['uuid', 'uri', 'value', 'unit', 'verbs',
-                          'requirements', 'queries', 'use', 'continue_scan'])
+                          'requirements', 'queries', 'use', 'continue_scan',
+                          'key_hash', 'key_id'])
 
         self.assertEqual(set(limits.Limit.attrs.keys()), base_attrs)
         self.assertEqual(set(LimitTest1.attrs.keys()), base_attrs)
@@ -670,7 +865,8 @@ class TestLimit(unittest2.TestCase):
                              use=['baz', 'quux'], continue_scan=False)
 
         self.assertEqual(repr(limit), "<turnstile.limits:Limit "
-                         "continue_scan=False queries=[] "
+                         "continue_scan=False key_hash=False key_id=None "
+                         "queries=[] "
                          "requirements={bar='.\\\\.*', foo='\\\\..*'} "
                          "unit='second' uri='uri' use=['baz', 'quux'] "
                          "uuid='fake_uuid' value=10 verbs=['GET', 'PUT'] "
@@ -728,6 +924,8 @@ class TestLimit(unittest2.TestCase):
             queries=['spam'],
             use=['baz'],
             continue_scan=False,
+            key_hash=True,
+            key_id=5,
         )
         expected = dict(limit_class='tests.unit.test_limits:LimitTest1')
         expected.update(exemplar)
@@ -879,6 +1077,23 @@ class TestLimit(unittest2.TestCase):
             limit.bucket_class, db, limit, 'parsed_key',
             ['record1', 'record2'])
 
+    @mock.patch.object(limits, 'BucketLoader',
+                       return_value=mock.Mock(bucket='v3 bucket'))
+    def test_load_string_v3_key_id(self, mock_BucketLoader):
+        db = mock.Mock(**{
+            'lrange.return_value': ['record1', 'record2'],
+        })
+        limit = limits.Limit(db, uri='uri', value=10, unit=1,
+                             key_hash=True, key_id=17)
+        key = limit.key({})
+
+        result = limit.load(key)
+
+        self.assertEqual(result, 'v3 bucket')
+        db.lrange.assert_called_once_with(key, 0, -1)
+        mock_BucketLoader.assert_called_once_with(
+            limit.bucket_class, db, limit, key, ['record1', 'record2'])
+
     @mock.patch('msgpack.loads', side_effect=lambda x: x)
     @mock.patch.object(limits.BucketKey, 'decode',
                        return_value=mock.MagicMock(**{
@@ -946,6 +1161,13 @@ class TestLimit(unittest2.TestCase):
         self.assertRaises(ValueError, limit.decode, key)
         mock_decode.assert_called_once_with(key)
 
+    def test_decode_hashed(self):
+        limit = limits.Limit('db', uri='uri', value=10, unit=1,
+                             key_hash=True, key_id=17)
+        key = limit.key({})
+
+        self.assertRaises(ValueError, limit.decode, key)
+
     @mock.patch.object(limits, 'BucketKey', return_value=1234)
     def test_key(self, mock_BucketKey):
         limit = limits.Limit('db', uri='uri', value=10, unit=1)
@@ -954,7 +1176,72 @@ class TestLimit(unittest2.TestCase):
         key = limit.key(params)
 
         self.assertEqual(key, "1234")
-        mock_BucketKey.assert_called_once_with('fake_uuid', params)
+        mock_BucketKey.assert_called_once_with('fake_uuid', params,
+                                               version=2)
+
+    def test_key_builder(self):
+        limit = limits.Limit('db', uri='uri', value=10, unit=1,
+                             uuid='fake_uuid', use=['b', 'a'])
+
+        self.assertEqual(limit._key_builder.uuid, 'fake_uuid')
+        self.assertEqual(limit._key_builder.fields,
+                         [('a', '/a='), ('b', '/b=')])
+        self.assertEqual(limit.key(dict(a=1, b='2')),
+                         'bucket_v2:fake_uuid/a=1/b="2"')
+
+    def test_key_builder_hashed(self):
+        limit = limits.Limit('db', uri='uri', value=10, unit=1,
+                             uuid='fake_uuid', use=['a'], key_hash=True)
+
+        self.assertEqual(limit.key_ident, 'fake_uuid')
+        self.assertEqual(limit.key(dict(a=1)),
+                         str(limits.BucketKey('fake_uuid', dict(a=1),
+                                              version=3)))
+
+    def test_key_builder_hashed_key_id(self):
+        limit = limits.Limit('db', uri='uri', value=10, unit=1,
+                             uuid='fake_uuid', use=['a'], key_hash=True,
+                             key_id=17)
+
+        self.assertEqual(limit.key_ident, '17')
+        self.assertEqual(limit.key(dict(a=1)),
+                         str(limits.BucketKey('17', dict(a=1), version=3)))
+
+    def test_key_id_unhashed(self):
+        limit = limits.Limit('db', uri='uri', value=10, unit=1,
+                             uuid='fake_uuid', use=['a'], key_id=17)
+
+        self.assertEqual(limit.key_ident, 'fake_uuid')
+        self.assertEqual(limit.key(dict(a=1)), 'bucket_v2:fake_uuid/a=1')
+
+    def test_key_id_bad(self):
+        self.assertRaises(ValueError, limits.Limit, 'db', uri='uri',
+                          value=10, unit=1, key_id=0)
+
+    def test_key_builder_recompile(self):
+        limit = limits.Limit('db', uri='uri', value=10, unit=1,
+                             uuid='fake_uuid', use=['a'])
+        limit.uuid = 'other_uuid'
+
+        self.assertEqual(limit._key_builder, None)
+
+        limit.use = ['a', 'b']
+
+        self.assertEqual(limit._key_builder, None)
+        self.assertEqual(limit.key(dict(a=1, b='2')),
+                         'bucket_v2:other_uuid/a=1/b="2"')
+        self.assertEqual(limit._key_builder.uuid, 'other_uuid')
+
+        limit.key_hash = True
+
+        self.assertEqual(limit._key_builder, None)
+
+        limit.key_id = 17
+
+        self.assertEqual(limit._key_builder, None)
+        self.assertEqual(limit.key(dict(a=1, b='2')),
+                         str(limits.BucketKey('17', dict(a=1, b='2'),
+                                              version=3)))
 
     @mock.patch('msgpack.dumps', side_effect=lambda x: x)
     @mock.patch('time.time', return_value=1000000.0)
@@ -969,15 +1256,17 @@ class TestLimit(unittest2.TestCase):
             bucket=mock.Mock(expire=1000010),
         )
         db = mock.Mock(**{
-            'lrange.return_value': ['record1', 'record2'],
+            'pipeline.return_value.execute.return_value': [
+                1, 1, ['record1', 'record2']],
         })
+        pipe = db.pipeline.return_value
         limit = limits.Limit(db, uri='uri', value=10, unit=1, use=['param'])
         environ = {}
         params = dict(param='test')
         result = limit._filter(environ, params)
 
         self.assertEqual(result, False)
-        mock_filter.assert_called_once_with({}, dict(param='test'), {})
+        mock_filter.assert_called_once_with(environ, dict(param='test'), {})
         mock_key.assert_called_once_with(dict(param='test'))
 
         update_record = {
@@ -988,15 +1277,19 @@ class TestLimit(unittest2.TestCase):
             },
         }
 
-        db.assert_has_calls([
+        pipe.assert_has_calls([
             mock.call.expire('bucket_key', 60),
             mock.call.rpush('bucket_key', update_record),
             mock.call.lrange('bucket_key', 0, -1),
+            mock.call.execute(),
             mock.call.expireat('bucket_key', 1000010),
+            mock.call.execute(),
         ])
-        self.assertEqual(len(db.method_calls), 4)
+        self.assertEqual(len(pipe.method_calls), 6)
         mock_BucketLoader.assert_called_once_with(
             limits.Bucket, db, limit, 'bucket_key', ['record1', 'record2'])
+        self.assertIsInstance(environ.pop('turnstile.context'),
+                              limits.RequestContext)
         self.assertEqual(environ, {})
 
     @mock.patch('msgpack.dumps', side_effect=lambda x: x)
@@ -1013,8 +1306,10 @@ class TestLimit(unittest2.TestCase):
             bucket=mock.Mock(expire=1000010),
         )
         db = mock.Mock(**{
-            'lrange.return_value': ['record1', 'record2'],
+            'pipeline.return_value.execute.return_value': [
+                1, 1, ['record1', 'record2']],
         })
+        pipe = db.pipeline.return_value
         limit = limits.Limit(db, uri='uri', value=10, unit=1, use=['param'],
                              queries=['query'])
         environ = {}
@@ -1026,6 +1321,8 @@ class TestLimit(unittest2.TestCase):
         self.assertFalse(mock_key.called)
         self.assertEqual(len(db.method_calls), 0)
         self.assertFalse(mock_BucketLoader.called)
+        self.assertIsInstance(environ.pop('turnstile.context'),
+                              limits.RequestContext)
         self.assertEqual(environ, {})
 
     @mock.patch('msgpack.dumps', side_effect=lambda x: x)
@@ -1042,8 +1339,10 @@ class TestLimit(unittest2.TestCase):
             bucket=mock.Mock(expire=1000010),
         )
         db = mock.Mock(**{
-            'lrange.return_value': ['record1', 'record2'],
+            'pipeline.return_value.execute.return_value': [
+                1, 1, ['record1', 'record2']],
         })
+        pipe = db.pipeline.return_value
         limit = limits.Limit(db, uri='uri', value=10, unit=1, use=['param'],
                              queries=['query'])
         environ = dict(QUERY_STRING='noquery=boofar')
@@ -1055,6 +1354,8 @@ class TestLimit(unittest2.TestCase):
         self.assertFalse(mock_key.called)
         self.assertEqual(len(db.method_calls), 0)
         self.assertFalse(mock_BucketLoader.called)
+        self.assertIsInstance(environ.pop('turnstile.context'),
+                              limits.RequestContext)
         self.assertEqual(environ, dict(QUERY_STRING='noquery=boofar'))
 
     @mock.patch('msgpack.dumps', side_effect=lambda x: x)
@@ -1070,8 +1371,10 @@ class TestLimit(unittest2.TestCase):
             bucket=mock.Mock(expire=1000010),
         )
         db = mock.Mock(**{
-            'lrange.return_value': ['record1', 'record2'],
+            'pipeline.return_value.execute.return_value': [
+                1, 1, ['record1', 'record2']],
         })
+        pipe = db.pipeline.return_value
         limit = limits.Limit(db, uri='uri', value=10, unit=1, use=['param'],
                              queries=['query'])
         environ = dict(QUERY_STRING='query=spam')
@@ -1079,8 +1382,7 @@ class TestLimit(unittest2.TestCase):
         result = limit._filter(environ, params)
 
         self.assertEqual(result, False)
-        mock_filter.assert_called_once_with(dict(QUERY_STRING='query=spam'),
-                                            dict(param='test'), {})
+        mock_filter.assert_called_once_with(environ, dict(param='test'), {})
         mock_key.assert_called_once_with(dict(param='test'))
 
         update_record = {
@@ -1091,15 +1393,19 @@ class TestLimit(unittest2.TestCase):
             },
         }
 
-        db.assert_has_calls([
+        pipe.assert_has_calls([
             mock.call.expire('bucket_key', 60),
             mock.call.rpush('bucket_key', update_record),
             mock.call.lrange('bucket_key', 0, -1),
+            mock.call.execute(),
             mock.call.expireat('bucket_key', 1000010),
+            mock.call.execute(),
         ])
-        self.assertEqual(len(db.method_calls), 4)
+        self.assertEqual(len(pipe.method_calls), 6)
         mock_BucketLoader.assert_called_once_with(
             limits.Bucket, db, limit, 'bucket_key', ['record1', 'record2'])
+        self.assertIsInstance(environ.pop('turnstile.context'),
+                              limits.RequestContext)
         self.assertEqual(environ, dict(QUERY_STRING='query=spam'))
 
     @mock.patch('msgpack.dumps', side_effect=lambda x: x)
@@ -1128,15 +1434,18 @@ class TestLimit(unittest2.TestCase):
             bucket=mock.Mock(expire=1000010),
         )
         db = mock.Mock(**{
-            'lrange.return_value': ['record1', 'record2'],
+            'pipeline.return_value.execute.return_value': [
+                1, 1, ['record1', 'record2']],
         })
+        pipe = db.pipeline.return_value
         limit = limits.Limit(db, uri='uri', value=10, unit=1, use=['param2'])
         environ = {}
         params = dict(param1='spam', param2='ni')
         result = limit._filter(environ, params)
 
         self.assertEqual(result, False)
-        mock_filter.assert_called_once_with({}, params, dict(param1='spam'))
+        mock_filter.assert_called_once_with(environ, params,
+                                            dict(param1='spam'))
         self.assertEqual(filter_params, dict(param2='ni'))
         mock_key.assert_called_once_with(params)
         self.assertEqual(key_params, dict(param2='ni'))
@@ -1149,15 +1458,19 @@ class TestLimit(unittest2.TestCase):
             },
         }
 
-        db.assert_has_calls([
+        pipe.assert_has_calls([
             mock.call.expire('bucket_key', 60),
             mock.call.rpush('bucket_key', update_record),
             mock.call.lrange('bucket_key', 0, -1),
+            mock.call.execute(),
             mock.call.expireat('bucket_key', 1000010),
+            mock.call.execute(),
         ])
-        self.assertEqual(len(db.method_calls), 4)
+        self.assertEqual(len(pipe.method_calls), 6)
         mock_BucketLoader.assert_called_once_with(
             limits.Bucket, db, limit, 'bucket_key', ['record1', 'record2'])
+        self.assertIsInstance(environ.pop('turnstile.context'),
+                              limits.RequestContext)
         self.assertEqual(environ, {})
 
     @mock.patch('msgpack.dumps', side_effect=lambda x: x)
@@ -1186,15 +1499,17 @@ class TestLimit(unittest2.TestCase):
             bucket=mock.Mock(expire=1000010),
         )
         db = mock.Mock(**{
-            'lrange.return_value': ['record1', 'record2'],
+            'pipeline.return_value.execute.return_value': [
+                1, 1, ['record1', 'record2']],
         })
+        pipe = db.pipeline.return_value
         limit = limits.Limit(db, uri='uri', value=10, unit=1)
         environ = {}
         params = dict(param1='spam', param2='ni')
         result = limit._filter(environ, params)
 
         self.assertEqual(result, False)
-        mock_filter.assert_called_once_with({}, params,
+        mock_filter.assert_called_once_with(environ, params,
                                             dict(param1='spam', param2='ni'))
         self.assertEqual(filter_params, {})
         mock_key.assert_called_once_with(params)
@@ -1208,15 +1523,19 @@ class TestLimit(unittest2.TestCase):
             },
         }
 
-        db.assert_has_calls([
+        pipe.assert_has_calls([
             mock.call.expire('bucket_key', 60),
             mock.call.rpush('bucket_key', update_record),
             mock.call.lrange('bucket_key', 0, -1),
+            mock.call.execute(),
             mock.call.expireat('bucket_key', 1000010),
+            mock.call.execute(),
         ])
-        self.assertEqual(len(db.method_calls), 4)
+        self.assertEqual(len(pipe.method_calls), 6)
         mock_BucketLoader.assert_called_once_with(
             limits.Bucket, db, limit, 'bucket_key', ['record1', 'record2'])
+        self.assertIsInstance(environ.pop('turnstile.context'),
+                              limits.RequestContext)
         self.assertEqual(environ, {})
 
     @mock.patch('msgpack.dumps', side_effect=lambda x: x)
@@ -1232,18 +1551,22 @@ class TestLimit(unittest2.TestCase):
             bucket=mock.Mock(expire=1000010),
         )
         db = mock.Mock(**{
-            'lrange.return_value': ['record1', 'record2'],
+            'pipeline.return_value.execute.return_value': [
+                1, 1, ['record1', 'record2']],
         })
+        pipe = db.pipeline.return_value
         limit = limits.Limit(db, uri='uri', value=10, unit=1, use=['param'])
         environ = {}
         params = dict(param='test')
         result = limit._filter(environ, params)
 
         self.assertEqual(result, False)
-        mock_filter.assert_called_once_with({}, dict(param='test'), {})
+        mock_filter.assert_called_once_with(environ, dict(param='test'), {})
         self.assertFalse(mock_key.called)
         self.assertEqual(len(db.method_calls), 0)
         self.assertFalse(mock_BucketLoader.called)
+        self.assertIsInstance(environ.pop('turnstile.context'),
+                              limits.RequestContext)
         self.assertEqual(environ, {})
 
     @mock.patch('msgpack.dumps', side_effect=lambda x: x)
@@ -1273,15 +1596,17 @@ class TestLimit(unittest2.TestCase):
             bucket=mock.Mock(expire=1000010),
         )
         db = mock.Mock(**{
-            'lrange.return_value': ['record1', 'record2'],
+            'pipeline.return_value.execute.return_value': [
+                1, 1, ['record1', 'record2']],
         })
+        pipe = db.pipeline.return_value
         limit = limits.Limit(db, uri='uri', value=10, unit=1, use=['param'])
         environ = {}
         params = dict(param='test')
         result = limit._filter(environ, params)
 
         self.assertEqual(result, False)
-        mock_filter.assert_called_once_with({}, params, {})
+        mock_filter.assert_called_once_with(environ, params, {})
         self.assertEqual(filter_params, dict(param='test'))
         mock_key.assert_called_once_with(params)
         self.assertEqual(key_params, dict(param='test', filter='add'))
@@ -1295,15 +1620,19 @@ class TestLimit(unittest2.TestCase):
             },
         }
 
-        db.assert_has_calls([
+        pipe.assert_has_calls([
             mock.call.expire('bucket_key', 60),
             mock.call.rpush('bucket_key', update_record),
             mock.call.lrange('bucket_key', 0, -1),
+            mock.call.execute(),
             mock.call.expireat('bucket_key', 1000010),
+            mock.call.execute(),
         ])
-        self.assertEqual(len(db.method_calls), 4)
+        self.assertEqual(len(pipe.method_calls), 6)
         mock_BucketLoader.assert_called_once_with(
             limits.Bucket, db, limit, 'bucket_key', ['record1', 'record2'])
+        self.assertIsInstance(environ.pop('turnstile.context'),
+                              limits.RequestContext)
         self.assertEqual(environ, {})
 
     @mock.patch('msgpack.dumps', side_effect=lambda x: x)
@@ -1319,8 +1648,10 @@ class TestLimit(unittest2.TestCase):
             bucket=mock.Mock(expire=1000010),
         )
         db = mock.Mock(**{
-            'lrange.return_value': ['record1', 'record2'],
+            'pipeline.return_value.execute.return_value': [
+                1, 1, ['record1', 'record2']],
         })
+        pipe = db.pipeline.return_value
         limit = limits.Limit(db, uri='uri', value=10, unit=1, use=['param'])
         environ = {}
         params = dict(param='test')
@@ -1338,15 +1669,19 @@ class TestLimit(unittest2.TestCase):
             },
         }
 
-        db.assert_has_calls([
+        pipe.assert_has_calls([
             mock.call.expire('bucket_key', 60),
             mock.call.rpush('bucket_key', update_record),
             mock.call.lrange('bucket_key', 0, -1),
+            mock.call.execute(),
             mock.call.expireat('bucket_key', 1000010),
+            mock.call.execute(),
         ])
-        self.assertEqual(len(db.method_calls), 4)
+        self.assertEqual(len(pipe.method_calls), 6)
         mock_BucketLoader.assert_called_once_with(
             limits.Bucket, db, limit, 'bucket_key', ['record1', 'record2'])
+        self.assertIsInstance(environ.pop('turnstile.context'),
+                              limits.RequestContext)
         self.assertEqual(environ, {
             'turnstile.delay': [
                 (10, limit, mock_BucketLoader.return_value.bucket),
@@ -1366,8 +1701,10 @@ class TestLimit(unittest2.TestCase):
             bucket=mock.Mock(expire=1000010),
         )
         db = mock.Mock(**{
-            'lrange.return_value': ['record1', 'record2'],
+            'pipeline.return_value.execute.return_value': [
+                1, 1, ['record1', 'record2']],
         })
+        pipe = db.pipeline.return_value
         limit = limits.Limit(db, uri='uri', value=10, unit=1, use=['param'])
         environ = {'turnstile.bucket_set': 'bucket_set'}
         params = dict(param='test')
@@ -1385,16 +1722,20 @@ class TestLimit(unittest2.TestCase):
             },
         }
 
-        db.assert_has_calls([
+        pipe.assert_has_calls([
             mock.call.expire('bucket_key', 60),
             mock.call.rpush('bucket_key', update_record),
             mock.call.lrange('bucket_key', 0, -1),
+            mock.call.execute(),
             mock.call.expireat('bucket_key', 1000010),
-            mock.call.zadd('bucket_set', 1000010, 'bucket_key')
+            mock.call.zadd('bucket_set', 1000010, 'bucket_key'),
+            mock.call.execute(),
         ])
-        self.assertEqual(len(db.method_calls), 5)
+        self.assertEqual(len(pipe.method_calls), 7)
         mock_BucketLoader.assert_called_once_with(
             limits.Bucket, db, limit, 'bucket_key', ['record1', 'record2'])
+        self.assertIsInstance(environ.pop('turnstile.context'),
+                              limits.RequestContext)
         self.assertEqual(environ, {'turnstile.bucket_set': 'bucket_set'})
 
     @mock.patch('msgpack.dumps', side_effect=lambda x: x)
@@ -1411,8 +1752,10 @@ class TestLimit(unittest2.TestCase):
             bucket=mock.Mock(expire=1000010),
         )
         db = mock.Mock(**{
-            'lrange.return_value': ['record1', 'record2'],
+            'pipeline.return_value.execute.return_value': [
+                1, 1, ['record1', 'record2']],
         })
+        pipe = db.pipeline.return_value
         limit = limits.Limit(db, uri='uri', value=10, unit=1, use=['param'])
         environ = {'turnstile.conf': dict(compactor={})}
         params = dict(param='test')
@@ -1430,16 +1773,20 @@ class TestLimit(unittest2.TestCase):
             },
         }
 
-        db.assert_has_calls([
+        pipe.assert_has_calls([
             mock.call.expire('bucket_key', 60),
             mock.call.rpush('bucket_key', update_record),
             mock.call.lrange('bucket_key', 0, -1),
+            mock.call.execute(),
             mock.call.expireat('bucket_key', 1000010),
+            mock.call.execute(),
         ])
-        self.assertEqual(len(db.method_calls), 4)
+        self.assertEqual(len(pipe.method_calls), 6)
         mock_BucketLoader.assert_called_once_with(
             limits.Bucket, db, limit, 'bucket_key', ['record1', 'record2'])
         self.assertFalse(mock_BucketLoader.return_value.need_summary.called)
+        self.assertIsInstance(environ.pop('turnstile.context'),
+                              limits.RequestContext)
         self.assertEqual(environ, {'turnstile.conf': dict(compactor={})})
 
     @mock.patch('msgpack.dumps', side_effect=lambda x: x)
@@ -1456,8 +1803,10 @@ class TestLimit(unittest2.TestCase):
             bucket=mock.Mock(expire=1000010),
         )
         db = mock.Mock(**{
-            'lrange.return_value': ['record1', 'record2'],
+            'pipeline.return_value.execute.return_value': [
+                1, 1, ['record1', 'record2']],
         })
+        pipe = db.pipeline.return_value
         limit = limits.Limit(db, uri='uri', value=10, unit=1, use=['param'])
         environ = {'turnstile.conf': dict(compactor=dict(max_updates='foo'))}
         params = dict(param='test')
@@ -1475,16 +1824,20 @@ class TestLimit(unittest2.TestCase):
             },
         }
 
-        db.assert_has_calls([
+        pipe.assert_has_calls([
             mock.call.expire('bucket_key', 60),
             mock.call.rpush('bucket_key', update_record),
             mock.call.lrange('bucket_key', 0, -1),
+            mock.call.execute(),
             mock.call.expireat('bucket_key', 1000010),
+            mock.call.execute(),
         ])
-        self.assertEqual(len(db.method_calls), 4)
+        self.assertEqual(len(pipe.method_calls), 6)
         mock_BucketLoader.assert_called_once_with(
             limits.Bucket, db, limit, 'bucket_key', ['record1', 'record2'])
         self.assertFalse(mock_BucketLoader.return_value.need_summary.called)
+        self.assertIsInstance(environ.pop('turnstile.context'),
+                              limits.RequestContext)
         self.assertEqual(environ, {
             'turnstile.conf': dict(compactor=dict(max_updates='foo')),
         })
@@ -1504,8 +1857,10 @@ class TestLimit(unittest2.TestCase):
             'need_summary.return_value': False,
         })
         db = mock.Mock(**{
-            'lrange.return_value': ['record1', 'record2'],
+            'pipeline.return_value.execute.return_value': [
+                1, 1, ['record1', 'record2']],
         })
+        pipe = db.pipeline.return_value
         limit = limits.Limit(db, uri='uri', value=10, unit=1, use=['param'])
         environ = {'turnstile.conf': dict(compactor=dict(max_updates='10'))}
         params = dict(param='test')
@@ -1523,17 +1878,21 @@ class TestLimit(unittest2.TestCase):
             },
         }
 
-        db.assert_has_calls([
+        pipe.assert_has_calls([
             mock.call.expire('bucket_key', 60),
             mock.call.rpush('bucket_key', update_record),
             mock.call.lrange('bucket_key', 0, -1),
+            mock.call.execute(),
             mock.call.expireat('bucket_key', 1000010),
+            mock.call.execute(),
         ])
-        self.assertEqual(len(db.method_calls), 4)
+        self.assertEqual(len(pipe.method_calls), 6)
         mock_BucketLoader.assert_called_once_with(
             limits.Bucket, db, limit, 'bucket_key', ['record1', 'record2'])
         mock_BucketLoader.return_value.need_summary.assert_called_once_with(
             1000000.0, 10, 600)
+        self.assertIsInstance(environ.pop('turnstile.context'),
+                              limits.RequestContext)
         self.assertEqual(environ, {
             'turnstile.conf': dict(compactor=dict(max_updates='10')),
         })
@@ -1553,8 +1912,10 @@ class TestLimit(unittest2.TestCase):
             'need_summary.return_value': False,
         })
         db = mock.Mock(**{
-            'lrange.return_value': ['record1', 'record2'],
+            'pipeline.return_value.execute.return_value': [
+                1, 1, ['record1', 'record2']],
         })
+        pipe = db.pipeline.return_value
         limit = limits.Limit(db, uri='uri', value=10, unit=1, use=['param'])
         environ = {'turnstile.conf': {
             'compactor': dict(max_updates='10', max_age='300'),
@@ -1574,17 +1935,21 @@ class TestLimit(unittest2.TestCase):
             },
         }
 
-        db.assert_has_calls([
+        pipe.assert_has_calls([
             mock.call.expire('bucket_key', 60),
             mock.call.rpush('bucket_key', update_record),
             mock.call.lrange('bucket_key', 0, -1),
+            mock.call.execute(),
             mock.call.expireat('bucket_key', 1000010),
+            mock.call.execute(),
         ])
-        self.assertEqual(len(db.method_calls), 4)
+        self.assertEqual(len(pipe.method_calls), 6)
         mock_BucketLoader.assert_called_once_with(
             limits.Bucket, db, limit, 'bucket_key', ['record1', 'record2'])
         mock_BucketLoader.return_value.need_summary.assert_called_once_with(
             1000000.0, 10, 300)
+        self.assertIsInstance(environ.pop('turnstile.context'),
+                              limits.RequestContext)
         self.assertEqual(environ, {
             'turnstile.conf': {
                 'compactor': dict(max_updates='10', max_age='300'),
@@ -1606,8 +1971,10 @@ class TestLimit(unittest2.TestCase):
             'need_summary.return_value': False,
         })
         db = mock.Mock(**{
-            'lrange.return_value': ['record1', 'record2'],
+            'pipeline.return_value.execute.return_value': [
+                1, 1, ['record1', 'record2']],
         })
+        pipe = db.pipeline.return_value
         limit = limits.Limit(db, uri='uri', value=10, unit=1, use=['param'])
         environ = {'turnstile.conf': {
             'compactor': dict(max_updates='10', max_age='300.0'),
@@ -1627,23 +1994,119 @@ class TestLimit(unittest2.TestCase):
             },
         }
 
-        db.assert_has_calls([
+        pipe.assert_has_calls([
             mock.call.expire('bucket_key', 60),
             mock.call.rpush('bucket_key', update_record),
             mock.call.lrange('bucket_key', 0, -1),
+            mock.call.execute(),
             mock.call.expireat('bucket_key', 1000010),
+            mock.call.execute(),
         ])
-        self.assertEqual(len(db.method_calls), 4)
+        self.assertEqual(len(pipe.method_calls), 6)
         mock_BucketLoader.assert_called_once_with(
             limits.Bucket, db, limit, 'bucket_key', ['record1', 'record2'])
         mock_BucketLoader.return_value.need_summary.assert_called_once_with(
             1000000.0, 10, 600)
+        self.assertIsInstance(environ.pop('turnstile.context'),
+                              limits.RequestContext)
         self.assertEqual(environ, {
             'turnstile.conf': {
                 'compactor': dict(max_updates='10', max_age='300.0'),
             },
         })
 
+    @mock.patch('msgpack.dumps', side_effect=lambda x: x)
+    @mock.patch('time.time', return_value=1000000.1)
+    @mock.patch('uuid.uuid4', return_value='update_uuid')
+    @mock.patch.object(limits, 'BucketLoader', return_value=mock.Mock(
+        delay=10, updates=5, bucket=mock.Mock(expire=1000010)))
+    @mock.patch.object(limits.Limit, 'filter', return_value=None)
+    @mock.patch.object(limits.Limit, 'key', return_value='bucket_key')
+    def test_filter_metrics(self, mock_key, mock_filter, mock_BucketLoader,
+                            mock_time, mock_uuid4, mock_dumps):
+        db = mock.Mock(**{
+            'pipeline.return_value.execute.return_value': [
+                1, 1, ['record1', 'record2']],
+        })
+        stats = mock.MagicMock(enabled=True)
+        limit = limits.Limit(db, uri='uri', value=10, unit=1, use=['param'],
+                             uuid='limit_uuid')
+        environ = {
+            'turnstile.context': limits.RequestContext({}, metrics=stats),
+        }
+        result = limit._filter(environ, dict(param='test'))
+
+        self.assertEqual(result, False)
+        stats.assert_has_calls([
+            mock.call.incr('limit.limit_uuid.match'),
+            mock.call.timer('redis.load'),
+            mock.call.timer('bucket.load'),
+            mock.call.histogram('bucket.updates', 5),
+            mock.call.timer('redis.update'),
+            mock.call.incr('limit.limit_uuid.reject'),
+        ], any_order=True)
+        self.assertEqual(stats.incr.call_count, 2)
+
+    @mock.patch('msgpack.dumps', side_effect=lambda x: x)
+    @mock.patch('time.time', return_value=1000000.1)
+    @mock.patch('uuid.uuid4', return_value='update_uuid')
+    @mock.patch.object(limits, 'BucketLoader', return_value=mock.Mock(
+        delay=None, updates=5, bucket=mock.Mock(expire=1000010)))
+    @mock.patch.object(limits.Limit, 'filter', return_value=None)
+    @mock.patch.object(limits.Limit, 'key', return_value='bucket_key')
+    def test_filter_metrics_error(self, mock_key, mock_filter,
+                                  mock_BucketLoader, mock_time, mock_uuid4,
+                                  mock_dumps):
+        db = mock.Mock(**{
+            'pipeline.return_value.execute.side_effect':
+            test_utils.TestException(),
+        })
+        stats = mock.MagicMock(enabled=True)
+        limit = limits.Limit(db, uri='uri', value=10, unit=1, use=['param'],
+                             uuid='limit_uuid')
+        environ = {
+            'turnstile.context': limits.RequestContext({}, metrics=stats),
+        }
+
+        self.assertRaises(test_utils.TestException, limit._filter, environ,
+                          dict(param='test'))
+        stats.incr.assert_has_calls([
+            mock.call('limit.limit_uuid.match'),
+            mock.call('limit.limit_uuid.error'),
+        ])
+        self.assertEqual(stats.incr.call_count, 2)
+        self.assertFalse(mock_BucketLoader.called)
+
+    @mock.patch('msgpack.dumps', side_effect=lambda x: x)
+    @mock.patch('time.time', return_value=1000000.1)
+    @mock.patch('uuid.uuid4', return_value='update_uuid')
+    @mock.patch.object(limits, 'BucketLoader', return_value=mock.Mock(
+        delay=None, updates=5, bucket=mock.Mock(expire=1000010)))
+    @mock.patch.object(limits.Limit, 'filter', return_value=None)
+    @mock.patch.object(limits.Limit, 'key', return_value='bucket_key')
+    def test_filter_metrics_redis_error(self, mock_key, mock_filter,
+                                        mock_BucketLoader, mock_time,
+                                        mock_uuid4, mock_dumps):
+        db = mock.Mock(**{
+            'pipeline.return_value.execute.side_effect':
+            redis.ConnectionError(),
+        })
+        stats = mock.MagicMock(enabled=True)
+        limit = limits.Limit(db, uri='uri', value=10, unit=1, use=['param'],
+                             uuid='limit_uuid')
+        environ = {
+            'turnstile.context': limits.RequestContext({}, metrics=stats),
+        }
+
+        self.assertRaises(redis.ConnectionError, limit._filter, environ,
+                          dict(param='test'))
+        stats.incr.assert_has_calls([
+            mock.call('limit.limit_uuid.match'),
+            mock.call('limit.limit_uuid.error'),
+            mock.call('redis.errors'),
+        ])
+        self.assertEqual(stats.incr.call_count, 3)
+
     @mock.patch('msgpack.dumps', side_effect=lambda x: x)
     @mock.patch('time.time', return_value=1000000.1)
     @mock.patch('uuid.uuid4', side_effect=['update_uuid', 'summarize_uuid'])
@@ -1659,8 +2122,10 @@ class TestLimit(unittest2.TestCase):
             'need_summary.return_value': True,
         })
         db = mock.Mock(**{
-            'lrange.return_value': ['record1', 'record2'],
+            'pipeline.return_value.execute.return_value': [
+                1, 1, ['record1', 'record2']],
         })
+        pipe = db.pipeline.return_value
         limit = limits.Limit(db, uri='uri', value=10, unit=1, use=['param'],
                              uuid='bucket_uuid')
         environ = {'turnstile.conf': dict(compactor=dict(max_updates='10'))}
@@ -1683,19 +2148,23 @@ class TestLimit(unittest2.TestCase):
             'summarize': 1000000.1,
         }
 
-        db.assert_has_calls([
+        pipe.assert_has_calls([
             mock.call.expire('bucket_key', 60),
             mock.call.rpush('bucket_key', update_record),
             mock.call.lrange('bucket_key', 0, -1),
+            mock.call.execute(),
             mock.call.rpush('bucket_key', summarize_record),
             mock.call.zadd('compactor', 1000001, 'bucket_key'),
             mock.call.expireat('bucket_key', 1000010),
+            mock.call.execute(),
         ])
-        self.assertEqual(len(db.method_calls), 6)
+        self.assertEqual(len(pipe.method_calls), 8)
         mock_BucketLoader.assert_called_once_with(
             limits.Bucket, db, limit, 'bucket_key', ['record1', 'record2'])
         mock_BucketLoader.return_value.need_summary.assert_called_once_with(
             1000000.1, 10, 600)
+        self.assertIsInstance(environ.pop('turnstile.context'),
+                              limits.RequestContext)
         self.assertEqual(environ, {
             'turnstile.conf': dict(compactor=dict(max_updates='10')),
         })
@@ -1715,8 +2184,10 @@ class TestLimit(unittest2.TestCase):
             'need_summary.return_value': True,
         })
         db = mock.Mock(**{
-            'lrange.return_value': ['record1', 'record2'],
+            'pipeline.return_value.execute.return_value': [
+                1, 1, ['record1', 'record2']],
         })
+        pipe = db.pipeline.return_value
         limit = limits.Limit(db, uri='uri', value=10, unit=1, use=['param'],
                              uuid='bucket_uuid')
         environ = {
@@ -1743,19 +2214,23 @@ class TestLimit(unittest2.TestCase):
             'summarize': 1000000.1,
         }
 
-        db.assert_has_calls([
+        pipe.assert_has_calls([
             mock.call.expire('bucket_key', 60),
             mock.call.rpush('bucket_key', update_record),
             mock.call.lrange('bucket_key', 0, -1),
+            mock.call.execute(),
             mock.call.rpush('bucket_key', summarize_record),
             mock.call.zadd('alt_key', 1000001, 'bucket_key'),
             mock.call.expireat('bucket_key', 1000010),
+            mock.call.execute(),
         ])
-        self.assertEqual(len(db.method_calls), 6)
+        self.assertEqual(len(pipe.method_calls), 8)
         mock_BucketLoader.assert_called_once_with(
             limits.Bucket, db, limit, 'bucket_key', ['record1', 'record2'])
         mock_BucketLoader.return_value.need_summary.assert_called_once_with(
             1000000.1, 10, 600)
+        self.assertIsInstance(environ.pop('turnstile.context'),
+                              limits.RequestContext)
         self.assertEqual(environ, {
             'turnstile.conf': {
                 'compactor': dict(max_updates='10', compactor_key='alt_key'),
@@ -0,0 +1,451 @@
+# Copyright 2013 Rackspace
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import mock
+import redis
+import unittest2
+
+from turnstile import memdb
+
+
+class TestServers(unittest2.TestCase):
+    def tearDown(self):
+        memdb.reset()
+
+    def test_get_server(self):
+        server1 = memdb.get_server('host1')
+        server2 = memdb.get_server('host1')
+        server3 = memdb.get_server('host1', 6380)
+
+        self.assertIsInstance(server1, memdb.MemoryServer)
+        self.assertIs(server1, server2)
+        self.assertIsNot(server1, server3)
+
+    def test_database(self):
+        server = memdb.MemoryServer()
+
+        db0 = server.database(0)
+        db1 = server.database(1)
+
+        self.assertEqual(db0, ({}, {}))
+        self.assertIs(server.database(0), db0)
+        self.assertIsNot(db0, db1)
+
+    def test_reset_host(self):
+        server1 = memdb.get_server('host1')
+        server2 = memdb.get_server('host2')
+
+        memdb.reset('host1')
+
+        self.assertIsNot(memdb.get_server('host1'), server1)
+        self.assertIs(memdb.get_server('host2'), server2)
+
+    def test_reset_all(self):
+        server = memdb.get_server('host1')
+
+        memdb.reset()
+
+        self.assertIsNot(memdb.get_server('host1'), server)
+
+
+class TestRange(unittest2.TestCase):
+    def test_range(self):
+        seq = [0, 1, 2, 3, 4]
+
+        self.assertEqual(memdb._range(seq, 0, -1), seq)
+        self.assertEqual(memdb._range(seq, 1, 2), [1, 2])
+        self.assertEqual(memdb._range(seq, -2, -1), [3, 4])
+        self.assertEqual(memdb._range(seq, -10, 1), [0, 1])
+        self.assertEqual(memdb._range(seq, 0, -10), [])
+        self.assertEqual(memdb._range(seq, 3, 10), [3, 4])
+        self.assertEqual(memdb._range([], 0, -1), [])
+
+
+class TestScoreBounds(unittest2.TestCase):
+    def test_score_bound(self):
+        self.assertEqual(memdb._score_bound(5), (5.0, False))
+        self.assertEqual(memdb._score_bound('-inf'), (float('-inf'), False))
+        self.assertEqual(memdb._score_bound('(5'), (5.0, True))
+
+    def test_in_bounds(self):
+        self.assertTrue(memdb._in_bounds(5, (5, False), (5, False)))
+        self.assertFalse(memdb._in_bounds(5, (5, True), (6, False)))
+        self.assertFalse(memdb._in_bounds(6, (5, False), (6, True)))
+        self.assertFalse(memdb._in_bounds(4, (5, False), (6, False)))
+        self.assertFalse(memdb._in_bounds(7, (5, False), (6, False)))
+
+
+class MemoryTestCase(unittest2.TestCase):
+    def setUp(self):
+        self.db = memdb.MemoryRedis('test_host')
+
+    def tearDown(self):
+        memdb.reset()
+
+
+class TestMemoryRedis(MemoryTestCase):
+    def test_shared(self):
+        db1 = memdb.MemoryRedis('test_host', '6379', db='0')
+        db2 = memdb.MemoryRedis('test_host', db=1)
+
+        self.db.set('key', 'value')
+
+        self.assertEqual(db1.get('key'), 'value')
+        self.assertEqual(db2.get('key'), None)
+
+    def test_strings(self):
+        self.assertEqual(self.db.get('key'), None)
+        self.assertEqual(self.db.set('key', 5), True)
+        self.assertEqual(self.db.get('key'), '5')
+        self.assertEqual(self.db.set('key', 6, nx=True), None)
+        self.assertEqual(self.db.set('other', 6, xx=True), None)
+        self.assertEqual(self.db.get('key'), '5')
+        self.assertEqual(self.db.exists('key'), True)
+        self.assertEqual(self.db.exists('other'), False)
+
+    def test_wrong_type(self):
+        self.db.rpush('key', 'value')
+
+        self.assertRaises(redis.ResponseError, self.db.get, 'key')
+
+    def test_delete(self):
+        self.db.set('key1', 'value')
+        self.db.set('key2', 'value')
+
+        self.assertEqual(self.db.delete('key1', 'key2', 'key3'), 2)
+        self.assertEqual(self.db.dbsize(), 0)
+
+    def test_keys(self):
+        self.db.set('key1', 'value')
+        self.db.set('key2', 'value')
+        self.db.set('other', 'value')
+
+        self.assertEqual(sorted(self.db.keys()), ['key1', 'key2', 'other'])
+        self.assertEqual(sorted(self.db.keys('key*')), ['key1', 'key2'])
+        self.assertEqual(self.db.dbsize(), 3)
+        self.assertEqual(self.db.flushdb(), True)
+        self.assertEqual(self.db.keys(), [])
+
+    @mock.patch('time.time', return_value=1000000.0)
+    def test_expire(self, mock_time):
+        self.db.set('key1', 'value')
+        self.db.set('key2', 'value', ex=10)
+        self.db.set('key3', 'value', px=20000)
+
+        self.assertEqual(self.db.expire('key1', 30), True)
+        self.assertEqual(self.db.expire('missing', 30), False)
+        self.assertEqual(self.db.ttl('key1'), 30)
+        self.assertEqual(self.db.ttl('key2'), 10)
+        self.assertEqual(self.db.ttl('key3'), 20)
+        self.assertEqual(self.db.ttl('missing'), -2)
+
+        self.db.set('key1', 'other')
+        self.assertEqual(self.db.ttl('key1'), -1)
+
+        self.assertEqual(self.db.expireat('key1', 1000005.0), True)
+        mock_time.return_value = 1000015.0
+        self.assertEqual(self.db.get('key1'), None)
+        self.assertEqual(self.db.get('key2'), None)
+        self.assertEqual(self.db.get('key3'), 'value')
+        self.assertEqual(self.db.keys(), ['key3'])
+
+    def test_lists(self):
+        self.assertEqual(self.db.rpush('key', 1, 2), 2)
+        self.assertEqual(self.db.rpush('key', 3, 4, 5), 5)
+        self.assertEqual(self.db.llen('key'), 5)
+        self.assertEqual(self.db.lrange('key', 0, -1),
+                         ['1', '2', '3', '4', '5'])
+        self.assertEqual(self.db.lrange('key', 1, 2), ['2', '3'])
+        self.assertEqual(self.db.lrange('missing', 0, -1), [])
+
+        self.assertEqual(self.db.linsert('key', 'before', 3, 'a'), 6)
+        self.assertEqual(self.db.linsert('key', 'AFTER', 3, 'b'), 7)
+        self.assertEqual(self.db.linsert('key', 'after', 9, 'c'), -1)
+        self.assertEqual(self.db.linsert('missing', 'after', 9, 'c'), 0)
+        self.assertEqual(self.db.lrange('key', 0, -1),
+                         ['1', '2', 'a', '3', 'b', '4', '5'])
+
+        self.assertEqual(self.db.ltrim('key', 2, 3), True)
+        self.assertEqual(self.db.lrange('key', 0, -1), ['a', '3'])
+        self.db.ltrim('key', 5, -1)
+        self.assertEqual(self.db.exists('key'), False)
+
+    def test_sets(self):
+        self.assertEqual(self.db.sadd('key', 'a', 'b'), 2)
+        self.assertEqual(self.db.sadd('key', 'b', 'c'), 1)
+        self.assertEqual(self.db.smembers('key'), set(['a', 'b', 'c']))
+        self.assertEqual(self.db.srem('key', 'a', 'd'), 1)
+        self.assertEqual(self.db.srem('missing', 'a'), 0)
+        self.assertEqual(self.db.smembers('missing'), set())
+        self.db.srem('key', 'b', 'c')
+        self.assertEqual(self.db.exists('key'), False)
+
+    def test_zadd(self):
+        self.assertEqual(self.db.zadd('key', 3, 'c', 1, 'a'), 2)
+        self.assertEqual(self.db.zadd('key', 2, 'a', b=1), 1)
+        self.assertEqual(self.db.zcard('key'), 3)
+        self.assertEqual(self.db.zrange('key', 0, -1), ['b', 'a', 'c'])
+        self.assertEqual(self.db.zrange('key', 0, 1, desc=True),
+                         ['c', 'a'])
+        self.assertEqual(self.db.zrange('key', 0, 0, withscores=True,
+                                        score_cast_func=int),
+                         [('b', 1)])
+        self.assertRaises(redis.RedisError, self.db.zadd, 'key', 1)
+
+    def test_zrangebyscore(self):
+        self.db.zadd('key', 1, 'a', 2, 'b', 3, 'c', 4, 'd')
+
+        self.assertEqual(self.db.zrangebyscore('key', 2, 3), ['b', 'c'])
+        self.assertEqual(self.db.zrangebyscore('key', '(2', '+inf'),
+                         ['c', 'd'])
+        self.assertEqual(self.db.zrangebyscore('key', '-inf', '+inf',
+                                               start=1, num=2,
+                                               withscores=True),
+                         [('b', 2.0), ('c', 3.0)])
+
+    def test_zrem(self):
+        self.db.zadd('key', 1, 'a', 2, 'b', 3, 'c', 4, 'd')
+
+        self.assertEqual(self.db.zrem('key', 'a', 'e'), 1)
+        self.assertEqual(self.db.zrem('missing', 'a'), 0)
+        self.assertEqual(self.db.zremrangebyscore('key', 0, 2), 1)
+        self.assertEqual(self.db.zremrangebyscore('key', 10, 20), 0)
+        self.assertEqual(self.db.zrange('key', 0, -1), ['c', 'd'])
+        self.db.zremrangebyscore('key', '-inf', '+inf')
+        self.assertEqual(self.db.exists('key'), False)
+
+    def test_info(self):
+        self.db.set('key', 'value')
+        self.db.rpush('list', 'a', 'bc')
+        self.db.expire('list', 30)
+
+        result = self.db.info()
+
+        self.assertEqual(result, {
+            'used_memory': 15,
+            'db0': {'keys': 2, 'expires': 1},
+        })
+
+    def test_publish(self):
+        pubsub1 = self.db.pubsub()
+        pubsub2 = memdb.MemoryRedis('test_host', db=1).pubsub()
+        pubsub1.subscribe('chan1')
+        pubsub2.subscribe('chan1', 'chan2')
+
+        self.assertEqual(self.db.publish('chan1', 'msg1'), 2)
+        self.assertEqual(self.db.publish('chan2', 2), 1)
+        self.assertEqual(self.db.publish('chan3', 'msg3'), 0)
+
+        self.assertEqual(pubsub1.get_message(), {
+            'type': 'subscribe',
+            'pattern': None,
+            'channel': 'chan1',
+            'data': 1,
+        })
+        self.assertEqual(pubsub1.get_message(), {
+            'type': 'message',
+            'pattern': None,
+            'channel': 'chan1',
+            'data': 'msg1',
+        })
+        self.assertEqual(pubsub1.get_message(), None)
+        self.assertEqual([m['data'] for m in iter(pubsub2.get_message, None)],
+                         [1, 2, 'msg1', '2'])
+
+
+class TestMemoryPipeline(MemoryTestCase):
+    def test_queued(self):
+        with self.db.pipeline() as pipe:
+            self.assertIs(pipe.rpush('key', 'a'), pipe)
+            pipe.lrange('key', 0, -1)
+            self.assertEqual(len(pipe), 2)
+            self.assertEqual(self.db.exists('key'), False)
+
+            self.assertEqual(pipe.execute(), [1, ['a']])
+            self.assertEqual(len(pipe), 0)
+
+        self.assertEqual(self.db.lrange('key', 0, -1), ['a'])
+
+    def test_watch(self):
+        self.db.zadd('key', 1, 'a')
+
+        with self.db.pipeline() as pipe:
+            self.assertEqual(pipe.watch('key'), True)
+            self.assertEqual(pipe.zrange('key', 0, -1), ['a'])
+            pipe.multi()
+            pipe.zadd('key', 2, 'b')
+            self.assertEqual(self.db.zcard('key'), 1)
+            self.assertEqual(pipe.execute(), [1])
+            self.assertFalse(pipe.watching)
+
+        self.assertEqual(self.db.zcard('key'), 2)
+
+    def test_unwatch_reset(self):
+        pipe = self.db.pipeline()
+        pipe.watch('key')
+        pipe.unwatch()
+        pipe.set('key', 'value')
+        pipe.reset()
+
+        self.assertEqual(pipe.execute(), [])
+        self.assertEqual(self.db.exists('key'), False)
+
+    def test_execute_errors(self):
+        pipe = self.db.pipeline()
+        pipe.set('key', 'value')
+        pipe.rpush('key', 'a')
+        pipe.get('key')
+
+        result = pipe.execute(raise_on_error=False)
+
+        self.assertEqual(result[0], True)
+        self.assertIsInstance(result[1], redis.ResponseError)
+        self.assertEqual(result[2], 'value')
+
+        pipe.rpush('key', 'a')
+        self.assertRaises(redis.ResponseError, pipe.execute)
+
+    def test_excluded(self):
+        pipe = self.db.pipeline()
+
+        self.assertRaises(AttributeError, getattr, pipe, 'pubsub')
+        self.assertRaises(AttributeError, getattr, pipe, '_get')
+
+
+class TestMemoryPubSub(MemoryTestCase):
+    def test_unsubscribe(self):
+        pubsub = self.db.pubsub()
+        pubsub.subscribe('chan1', 'chan2')
+        pubsub.unsubscribe('chan1')
+
+        self.assertEqual(self.db.publish('chan1', 'msg'), 0)
+        self.assertEqual(self.db.publish('chan2', 'msg'), 1)
+
+        pubsub.unsubscribe()
+
+        self.assertEqual(self.db.publish('chan2', 'msg'), 0)
+        self.assertEqual([(m['type'], m['channel'], m['data'])
+                          for m in pubsub.listen()], [
+            ('subscribe', 'chan1', 1),
+            ('subscribe', 'chan2', 2),
+            ('unsubscribe', 'chan1', 1),
+            ('message', 'chan2', 'msg'),
+            ('unsubscribe', 'chan2', 0),
+        ])
+
+    def test_close(self):
+        pubsub = self.db.pubsub()
+        pubsub.subscribe('chan1')
+        pubsub.close()
+
+        self.assertEqual(self.db.publish('chan1', 'msg'), 0)
+        self.assertEqual(pubsub.channels, set())
+
+
+class TestCountingDatabase(unittest2.TestCase):
+    def tearDown(self):
+        memdb.reset()
+
+    def test_init(self):
+        counter = memdb.CountingDatabase('db')
+
+        self.assertEqual(counter.db, 'db')
+        self.assertEqual(counter.commands, 0)
+        self.assertEqual(counter.round_trips, 0)
+
+    def test_commands(self):
+        counter = memdb.CountingDatabase(memdb.MemoryRedis('test'))
+
+        counter.set('key', 'value')
+        self.assertEqual(counter.get('key'), 'value')
+
+        self.assertEqual(counter.commands, 2)
+        self.assertEqual(counter.round_trips, 2)
+
+    def test_uncounted(self):
+        db = mock.Mock(attr='value')
+        counter = memdb.CountingDatabase(db)
+
+        self.assertEqual(counter.pubsub, db.pubsub)
+        self.assertEqual(counter.attr, 'value')
+        self.assertEqual(counter._private, db._private)
+        self.assertEqual(counter.commands, 0)
+        self.assertEqual(counter.round_trips, 0)
+
+    def test_pipeline(self):
+        counter = memdb.CountingDatabase(memdb.MemoryRedis('test'))
+
+        with counter.pipeline(transaction=False) as pipe:
+            self.assertIsInstance(pipe, memdb.CountingPipeline)
+            self.assertIs(pipe.rpush('key', 'a'), pipe)
+            pipe.lrange('key', 0, -1)
+            self.assertEqual(len(pipe), 2)
+            self.assertEqual(pipe.execute(), [1, ['a']])
+
+            # Executing an empty pipeline is not a round trip
+            self.assertEqual(pipe.execute(), [])
+
+        self.assertEqual(counter.commands, 2)
+        self.assertEqual(counter.round_trips, 1)
+
+    def test_pipeline_watch(self):
+        counter = memdb.CountingDatabase(memdb.MemoryRedis('test'))
+
+        with counter.pipeline() as pipe:
+            pipe.watch('key')
+            pipe.zrange('key', 0, -1)
+            pipe.multi()
+            pipe.zadd('key', 1, 'a')
+            pipe.zadd('key', 2, 'b')
+            pipe.execute()
+
+        self.assertEqual(counter.commands, 4)
+        self.assertEqual(counter.round_trips, 3)
+
+    def test_reset_counts(self):
+        counter = memdb.CountingDatabase('db')
+        counter.commands = 5
+        counter.round_trips = 3
+
+        counter.reset_counts()
+
+        self.assertEqual(counter.commands, 0)
+        self.assertEqual(counter.round_trips, 0)
+
+
+class TestCountingClient(unittest2.TestCase):
+    def tearDown(self):
+        memdb.reset()
+
+    @mock.patch.object(redis, 'StrictRedis')
+    def test_default(self, mock_StrictRedis):
+        result = memdb.counting_client(host='example.com', port=6380)
+
+        self.assertIsInstance(result, memdb.CountingDatabase)
+        self.assertEqual(result.db, mock_StrictRedis.return_value)
+        mock_StrictRedis.assert_called_once_with(host='example.com',
+                                                 port=6380)
+
+    def test_counted_client(self):
+        result = memdb.counting_client(
+            counted_client='turnstile.memdb:MemoryRedis', host='test')
+
+        self.assertIsInstance(result, memdb.CountingDatabase)
+        self.assertIsInstance(result.db, memdb.MemoryRedis)
+        self.assertEqual(result.db.server, memdb.get_server('test'))
+
+    def test_counted_client_missing(self):
+        self.assertRaises(ImportError, memdb.counting_client,
+                          counted_client='turnstile.memdb:NoSuchClient')
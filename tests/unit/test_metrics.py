@@ -0,0 +1,632 @@
+# Copyright 2013 Rackspace
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import socket
+
+import mock
+import unittest2
+
+from turnstile import config
+from turnstile import metrics
+
+from tests.unit import utils as test_utils
+
+
+class TestPercentile(unittest2.TestCase):
+    def test_empty(self):
+        self.assertEqual(metrics.percentile([], 50), None)
+
+    def test_percentile(self):
+        values = range(1, 101)
+
+        self.assertEqual(metrics.percentile(values, 0), 1)
+        self.assertEqual(metrics.percentile(values, 50), 51)
+        self.assertEqual(metrics.percentile(values, 99), 100)
+        self.assertEqual(metrics.percentile(values, 100), 100)
+        self.assertEqual(metrics.percentile([5], 99), 5)
+
+
+class TestTimer(unittest2.TestCase):
+    @mock.patch('time.time', side_effect=[1000000.0, 1000000.25])
+    def test_timer(self, mock_time):
+        stats = mock.Mock()
+
+        with metrics._Timer(stats, 'name'):
+            pass
+
+        stats.timing.assert_called_once_with('name', 250.0)
+
+    @mock.patch('time.time', side_effect=[1000000.0, 1000000.25])
+    def test_timer_exception(self, mock_time):
+        stats = mock.Mock()
+
+        def test_func():
+            with metrics._Timer(stats, 'name'):
+                raise test_utils.TestException()
+
+        self.assertRaises(test_utils.TestException, test_func)
+        stats.timing.assert_called_once_with('name', 250.0)
+
+
+class TestMetrics(unittest2.TestCase):
+    def test_null(self):
+        stats = metrics.Metrics()
+
+        self.assertFalse(stats.enabled)
+        stats.incr('counter')
+        stats.timing('timing', 10)
+        self.assertEqual(stats.timer('timer'), metrics._null_timer)
+        with stats.timer('timer'):
+            pass
+        stats.flush()
+        self.assertEqual(stats.expose(), '')
+        self.assertEqual(stats.summary(), {})
+
+
+class TestStatsdMetrics(unittest2.TestCase):
+    @mock.patch('socket.socket')
+    @mock.patch('time.time', return_value=1000000.0)
+    def test_init_basic(self, mock_time, mock_socket):
+        stats = metrics.StatsdMetrics('statsd')
+
+        self.assertTrue(stats.enabled)
+        self.assertEqual(stats.address, ('statsd', 8125))
+        self.assertEqual(stats.prefix, 'turnstile.')
+        self.assertEqual(stats.flush_interval, 1.0)
+        self.assertEqual(stats.max_packet, 512)
+        self.assertEqual(stats.sock, mock_socket.return_value)
+        self.assertEqual(stats.counters, {})
+        self.assertEqual(stats.timings, {})
+        self.assertEqual(stats.histograms, {})
+        self.assertEqual(stats.gauges, {})
+        self.assertEqual(stats.last_flush, 1000000.0)
+        mock_socket.assert_called_once_with(socket.AF_INET,
+                                            socket.SOCK_DGRAM)
+
+    @mock.patch('socket.socket')
+    @mock.patch('time.time', return_value=1000000.0)
+    def test_init_noprefix(self, mock_time, mock_socket):
+        stats = metrics.StatsdMetrics('statsd', 1234, '', 5.0, 1024)
+
+        self.assertEqual(stats.address, ('statsd', 1234))
+        self.assertEqual(stats.prefix, '')
+        self.assertEqual(stats.flush_interval, 5.0)
+        self.assertEqual(stats.max_packet, 1024)
+
+    @mock.patch('socket.socket')
+    @mock.patch.object(metrics.StatsdMetrics, '_check_flush')
+    def test_incr(self, mock_check_flush, mock_socket):
+        stats = metrics.StatsdMetrics('statsd')
+
+        stats.incr('counter')
+        stats.incr('counter', 5)
+        stats.incr('other')
+
+        self.assertEqual(stats.counters, dict(counter=6, other=1))
+        self.assertEqual(mock_check_flush.call_count, 3)
+
+    @mock.patch('socket.socket')
+    @mock.patch.object(metrics.StatsdMetrics, '_check_flush')
+    def test_timing(self, mock_check_flush, mock_socket):
+        stats = metrics.StatsdMetrics('statsd')
+
+        stats.timing('timing', 10)
+        stats.timing('timing', 20)
+        stats.timing('other', 1.5)
+
+        self.assertEqual(stats.timings, dict(timing=[10, 20], other=[1.5]))
+        self.assertEqual(mock_check_flush.call_count, 3)
+
+    @mock.patch('socket.socket')
+    @mock.patch.object(metrics.StatsdMetrics, '_check_flush')
+    def test_histogram(self, mock_check_flush, mock_socket):
+        stats = metrics.StatsdMetrics('statsd')
+
+        stats.histogram('hist', 10)
+        stats.histogram('hist', 20)
+
+        self.assertEqual(stats.histograms, dict(hist=[10, 20]))
+        self.assertEqual(mock_check_flush.call_count, 2)
+
+    @mock.patch('socket.socket')
+    @mock.patch.object(metrics.StatsdMetrics, '_check_flush')
+    def test_gauge(self, mock_check_flush, mock_socket):
+        stats = metrics.StatsdMetrics('statsd')
+
+        stats.gauge('gauge', 10)
+        stats.gauge('gauge', 20)
+
+        self.assertEqual(stats.gauges, dict(gauge=20))
+        self.assertEqual(mock_check_flush.call_count, 2)
+
+    @mock.patch('socket.socket')
+    def test_timer(self, mock_socket):
+        stats = metrics.StatsdMetrics('statsd')
+
+        result = stats.timer('timer')
+
+        self.assertIsInstance(result, metrics._Timer)
+        self.assertEqual(result.metrics, stats)
+        self.assertEqual(result.name, 'timer')
+
+    @mock.patch('socket.socket')
+    @mock.patch('time.time', return_value=1000000.0)
+    @mock.patch.object(metrics.StatsdMetrics, 'flush')
+    def test_check_flush_unneeded(self, mock_flush, mock_time, mock_socket):
+        stats = metrics.StatsdMetrics('statsd')
+        mock_time.return_value = 1000000.5
+
+        stats._check_flush()
+
+        self.assertFalse(mock_flush.called)
+
+    @mock.patch('socket.socket')
+    @mock.patch('time.time', return_value=1000000.0)
+    @mock.patch.object(metrics.StatsdMetrics, 'flush')
+    def test_check_flush_needed(self, mock_flush, mock_time, mock_socket):
+        stats = metrics.StatsdMetrics('statsd')
+        mock_time.return_value = 1000001.0
+
+        stats._check_flush()
+
+        mock_flush.assert_called_once_with()
+
+    @mock.patch('socket.socket')
+    @mock.patch('time.time', return_value=1000000.0)
+    @mock.patch.object(metrics.StatsdMetrics, '_send')
+    def test_flush_empty(self, mock_send, mock_time, mock_socket):
+        stats = metrics.StatsdMetrics('statsd')
+
+        stats.flush()
+
+        self.assertFalse(mock_send.called)
+
+    @mock.patch('socket.socket')
+    @mock.patch('time.time', return_value=1000000.0)
+    @mock.patch.object(metrics.StatsdMetrics, '_send')
+    def test_flush(self, mock_send, mock_time, mock_socket):
+        stats = metrics.StatsdMetrics('statsd')
+        stats.counters = dict(spam=3, ham=1)
+        stats.timings = dict(timing=[10, 2.5])
+        stats.histograms = dict(hist=[5])
+        stats.gauges = dict(gauge=7)
+        mock_time.return_value = 1000002.0
+
+        stats.flush()
+
+        mock_send.assert_called_once_with(
+            'turnstile.ham:1|c\n'
+            'turnstile.spam:3|c\n'
+            'turnstile.timing:10|ms\n'
+            'turnstile.timing:2.5|ms\n'
+            'turnstile.hist:5|ms\n'
+            'turnstile.gauge:7|g')
+        self.assertEqual(stats.counters, {})
+        self.assertEqual(stats.timings, {})
+        self.assertEqual(stats.histograms, {})
+        self.assertEqual(stats.gauges, {})
+        self.assertEqual(stats.last_flush, 1000002.0)
+
+    @mock.patch('socket.socket')
+    @mock.patch.object(metrics.StatsdMetrics, '_send')
+    def test_flush_split(self, mock_send, mock_socket):
+        stats = metrics.StatsdMetrics('statsd', prefix='', max_packet=12)
+        stats.counters = dict(aaaa=1, bbbb=2, cccc=3)
+
+        stats.flush()
+
+        mock_send.assert_has_calls([
+            mock.call('aaaa:1|c'),
+            mock.call('bbbb:2|c'),
+            mock.call('cccc:3|c'),
+        ])
+
+    @mock.patch('socket.socket')
+    @mock.patch.object(metrics.StatsdMetrics, '_send')
+    def test_flush_pack(self, mock_send, mock_socket):
+        stats = metrics.StatsdMetrics('statsd', prefix='', max_packet=18)
+        stats.counters = dict(aaaa=1, bbbb=2, cccc=3)
+
+        stats.flush()
+
+        mock_send.assert_has_calls([
+            mock.call('aaaa:1|c\nbbbb:2|c'),
+            mock.call('cccc:3|c'),
+        ])
+
+    @mock.patch('socket.socket')
+    @mock.patch.object(metrics.LOG, 'exception')
+    def test_send(self, mock_exception, mock_socket):
+        stats = metrics.StatsdMetrics('statsd')
+
+        stats._send('data')
+
+        stats.sock.sendto.assert_called_once_with('data', ('statsd', 8125))
+        self.assertFalse(mock_exception.called)
+
+    @mock.patch('socket.socket')
+    @mock.patch.object(metrics.LOG, 'exception')
+    def test_send_error(self, mock_exception, mock_socket):
+        stats = metrics.StatsdMetrics('statsd')
+        stats.sock.sendto.side_effect = socket.error()
+
+        stats._send('data')
+
+        mock_exception.assert_called_once_with(
+            "Failed to send metrics to statsd:8125")
+
+
+class TestHistogram(unittest2.TestCase):
+    def test_observe(self):
+        hist = metrics._Histogram((1, 5, 10))
+
+        for value in (0.5, 1, 3, 7, 10, 20):
+            hist.observe(value)
+
+        self.assertEqual(hist.counts, [2, 1, 2])
+        self.assertEqual(hist.total, 41.5)
+        self.assertEqual(hist.count, 6)
+
+    def test_render(self):
+        hist = metrics._Histogram((0.5, 1))
+        hist.observe(0.25)
+        hist.observe(2)
+
+        self.assertEqual(hist.render('name', ''), [
+            'name_bucket{le="0.5"} 1',
+            'name_bucket{le="1"} 1',
+            'name_bucket{le="+Inf"} 2',
+            'name_sum 2.25',
+            'name_count 2',
+        ])
+
+    def test_render_labels(self):
+        hist = metrics._Histogram((1,))
+        hist.observe(1)
+
+        self.assertEqual(hist.render('name', 'a="b"'), [
+            'name_bucket{a="b",le="1"} 1',
+            'name_bucket{a="b",le="+Inf"} 1',
+            'name_sum{a="b"} 1.0',
+            'name_count{a="b"} 1',
+        ])
+
+
+class TestFormatLabels(unittest2.TestCase):
+    def test_format_labels(self):
+        result = metrics._format_labels(dict(b='x"y', a='1\\2\n3'))
+
+        self.assertEqual(result, r'a="1\\2\n3",b="x\"y"')
+
+
+class TestPrometheusMetrics(unittest2.TestCase):
+    def test_init(self):
+        stats = metrics.PrometheusMetrics()
+
+        self.assertTrue(stats.enabled)
+        self.assertEqual(stats.prefix, 'turnstile_')
+        self.assertEqual(stats.counters, {})
+        self.assertEqual(stats.histograms, {})
+        self.assertEqual(stats.gauges, {})
+        self.assertEqual(stats.infos, {})
+
+    def test_init_prefix(self):
+        self.assertEqual(metrics.PrometheusMetrics('my.app').prefix,
+                         'my_app_')
+        self.assertEqual(metrics.PrometheusMetrics('').prefix, '')
+
+    def test_series(self):
+        stats = metrics.PrometheusMetrics()
+
+        self.assertEqual(stats._series('route_match'),
+                         ('turnstile_route_match', ''))
+        self.assertEqual(stats._series('redis.errors'),
+                         ('turnstile_redis_errors', ''))
+        self.assertEqual(stats._series('limit.some-uuid.match'),
+                         ('turnstile_limit_match', 'limit="some-uuid"'))
+        self.assertIn('redis.errors', stats._names)
+
+    def test_incr(self):
+        stats = metrics.PrometheusMetrics()
+
+        stats.incr('limit.uuid1.match')
+        stats.incr('limit.uuid1.match', 2)
+        stats.incr('limit.uuid2.match')
+        stats.incr('reload')
+
+        self.assertEqual(stats.counters, {
+            'turnstile_limit_match': {
+                'limit="uuid1"': 3,
+                'limit="uuid2"': 1,
+            },
+            'turnstile_reload': {'': 1},
+        })
+
+    def test_timing(self):
+        stats = metrics.PrometheusMetrics()
+
+        stats.timing('route_match', 2.0)
+
+        hist = stats.histograms['turnstile_route_match_seconds']['']
+        self.assertEqual(hist.bounds, metrics.TIME_BUCKETS)
+        self.assertEqual(hist.total, 0.002)
+        self.assertEqual(hist.count, 1)
+
+    def test_histogram(self):
+        stats = metrics.PrometheusMetrics()
+
+        stats.histogram('bucket.updates', 3)
+        stats.histogram('bucket.updates', 4)
+
+        hist = stats.histograms['turnstile_bucket_updates']['']
+        self.assertEqual(hist.bounds, metrics.VALUE_BUCKETS)
+        self.assertEqual(hist.total, 7)
+        self.assertEqual(hist.count, 2)
+
+    def test_gauge(self):
+        stats = metrics.PrometheusMetrics()
+
+        stats.gauge('limits', 3)
+        stats.gauge('limits', 5)
+
+        self.assertEqual(stats.gauges, {'turnstile_limits': {'': 5}})
+
+    def test_info(self):
+        stats = metrics.PrometheusMetrics()
+
+        stats.info('limits', checksum='abc')
+
+        self.assertEqual(stats.infos, {
+            'turnstile_limits_info': 'checksum="abc"',
+        })
+
+    def test_timer(self):
+        stats = metrics.PrometheusMetrics()
+
+        result = stats.timer('timer')
+
+        self.assertIsInstance(result, metrics._Timer)
+        self.assertEqual(result.metrics, stats)
+
+    def test_expose_empty(self):
+        stats = metrics.PrometheusMetrics()
+
+        self.assertEqual(stats.expose(), '')
+
+    def test_expose(self):
+        stats = metrics.PrometheusMetrics()
+        stats.incr('limit.uuid1.reject')
+        stats.incr('reload', 2)
+        stats.gauge('limits', 5)
+        stats.info('limits', checksum='abc')
+        stats.histogram('bucket.updates', 3)
+
+        self.assertEqual(stats.expose().split('\n'), [
+            '# TYPE turnstile_limit_reject_total counter',
+            'turnstile_limit_reject_total{limit="uuid1"} 1',
+            '# TYPE turnstile_reload_total counter',
+            'turnstile_reload_total 2',
+            '# TYPE turnstile_limits gauge',
+            'turnstile_limits 5',
+            '# TYPE turnstile_limits_info gauge',
+            'turnstile_limits_info{checksum="abc"} 1',
+            '# TYPE turnstile_bucket_updates histogram',
+            'turnstile_bucket_updates_bucket{le="1"} 0',
+            'turnstile_bucket_updates_bucket{le="2"} 0',
+            'turnstile_bucket_updates_bucket{le="5"} 1',
+            'turnstile_bucket_updates_bucket{le="10"} 1',
+            'turnstile_bucket_updates_bucket{le="20"} 1',
+            'turnstile_bucket_updates_bucket{le="50"} 1',
+            'turnstile_bucket_updates_bucket{le="100"} 1',
+            'turnstile_bucket_updates_bucket{le="200"} 1',
+            'turnstile_bucket_updates_bucket{le="500"} 1',
+            'turnstile_bucket_updates_bucket{le="1000"} 1',
+            'turnstile_bucket_updates_bucket{le="+Inf"} 1',
+            'turnstile_bucket_updates_sum 3.0',
+            'turnstile_bucket_updates_count 1',
+            '',
+        ])
+
+
+class TestSummaryMetrics(unittest2.TestCase):
+    def test_init(self):
+        stats = metrics.SummaryMetrics(window=5, samples=10)
+
+        self.assertTrue(stats.enabled)
+        self.assertEqual(stats.window, 5)
+        self.assertEqual(stats.counters, {})
+        self.assertEqual(stats.overhead.maxlen, 10)
+        self.assertEqual(stats.slots, [[0, 0, 0]] * 5)
+
+    @mock.patch('time.time', return_value=1000002.5)
+    def test_incr(self, mock_time):
+        stats = metrics.SummaryMetrics(window=5)
+        stats.slots[2] = [999997, 10, 10]
+
+        stats.incr('requests')
+        stats.incr('requests', 2)
+        stats.incr('rejects')
+        stats.incr('redis.errors')
+
+        self.assertEqual(stats.counters, {
+            'requests': 3,
+            'rejects': 1,
+            'redis.errors': 1,
+        })
+        self.assertEqual(stats.slots[2], [1000002, 3, 1])
+
+    def test_timing(self):
+        stats = metrics.SummaryMetrics()
+
+        stats.timing('route_match', 1.5)
+        stats.timing('redis.load', 2.5)
+
+        self.assertEqual(list(stats.overhead), [1.5])
+
+    def test_timer(self):
+        stats = metrics.SummaryMetrics()
+
+        result = stats.timer('timer')
+
+        self.assertIsInstance(result, metrics._Timer)
+        self.assertEqual(result.metrics, stats)
+
+    @mock.patch('time.time', return_value=1000002.5)
+    def test_summary_empty(self, mock_time):
+        stats = metrics.SummaryMetrics(window=5)
+
+        self.assertEqual(stats.summary(), {
+            'request_rate': 0.0,
+            'reject_rate': 0.0,
+            'p50': None,
+            'p99': None,
+            'redis_errors': 0,
+        })
+
+    @mock.patch('time.time', return_value=1000002.5)
+    def test_summary(self, mock_time):
+        stats = metrics.SummaryMetrics(window=5)
+        stats.slots = [
+            [1000000, 5, 1],
+            [1000001, 5, 0],
+            [1000002, 5, 1],
+            [999998, 5, 2],
+            [999994, 100, 100],
+        ]
+        stats.overhead.extend(range(100, 0, -1))
+        stats.counters['redis.errors'] = 3
+
+        self.assertEqual(stats.summary(), {
+            'request_rate': 4.0,
+            'reject_rate': 0.8,
+            'p50': 51,
+            'p99': 100,
+            'redis_errors': 3,
+        })
+
+
+class TestMultiMetrics(unittest2.TestCase):
+    def test_fanout(self):
+        emitters = [mock.Mock(**{'expose.return_value': 'page1\n',
+                                 'summary.return_value': dict(a=1)}),
+                    mock.Mock(**{'expose.return_value': 'page2\n',
+                                 'summary.return_value': dict(b=2)})]
+        stats = metrics.MultiMetrics(emitters)
+
+        self.assertTrue(stats.enabled)
+        stats.incr('counter', 2)
+        stats.timing('timing', 10)
+        stats.histogram('hist', 3)
+        stats.gauge('gauge', 4)
+        stats.info('info', spam='ham')
+        stats.flush()
+        self.assertEqual(stats.expose(), 'page1\npage2\n')
+        self.assertEqual(stats.summary(), dict(a=1, b=2))
+
+        for emitter in emitters:
+            emitter.assert_has_calls([
+                mock.call.incr('counter', 2),
+                mock.call.timing('timing', 10),
+                mock.call.histogram('hist', 3),
+                mock.call.gauge('gauge', 4),
+                mock.call.info('info', spam='ham'),
+                mock.call.flush(),
+                mock.call.expose(),
+            ])
+
+    def test_timer(self):
+        stats = metrics.MultiMetrics([])
+
+        result = stats.timer('timer')
+
+        self.assertIsInstance(result, metrics._Timer)
+        self.assertEqual(result.metrics, stats)
+
+
+class TestGetMetrics(unittest2.TestCase):
+    def test_disabled(self):
+        conf = config.Config(conf_dict={})
+
+        result = metrics.get_metrics(conf)
+
+        self.assertIsInstance(result, metrics.Metrics)
+        self.assertFalse(result.enabled)
+
+    @mock.patch.object(metrics, 'StatsdMetrics', return_value='statsd')
+    def test_statsd_defaults(self, mock_StatsdMetrics):
+        conf = config.Config(conf_dict={
+            'metrics.statsd_host': 'statsd',
+        })
+
+        result = metrics.get_metrics(conf)
+
+        self.assertEqual(result, 'statsd')
+        mock_StatsdMetrics.assert_called_once_with(
+            'statsd', port=8125, prefix='turnstile', flush_interval=1.0,
+            max_packet=512)
+
+    @mock.patch.object(metrics, 'StatsdMetrics', return_value='statsd')
+    def test_statsd_configured(self, mock_StatsdMetrics):
+        conf = config.Config(conf_dict={
+            'metrics.statsd_host': 'statsd',
+            'metrics.statsd_port': '1234',
+            'metrics.prefix': 'limits',
+            'metrics.flush_interval': '0.5',
+            'metrics.max_packet': '1400',
+        })
+
+        result = metrics.get_metrics(conf)
+
+        self.assertEqual(result, 'statsd')
+        mock_StatsdMetrics.assert_called_once_with(
+            'statsd', port=1234, prefix='limits', flush_interval=0.5,
+            max_packet=1400)
+
+    @mock.patch.object(metrics, 'PrometheusMetrics', return_value='prom')
+    def test_prometheus(self, mock_PrometheusMetrics):
+        conf = config.Config(conf_dict={
+            'metrics.path': '/_turnstile/metrics',
+        })
+
+        result = metrics.get_metrics(conf)
+
+        self.assertEqual(result, 'prom')
+        mock_PrometheusMetrics.assert_called_once_with(prefix='turnstile')
+
+    @mock.patch.object(metrics, 'StatsdMetrics', return_value='statsd')
+    @mock.patch.object(metrics, 'PrometheusMetrics', return_value='prom')
+    def test_both(self, mock_PrometheusMetrics, mock_StatsdMetrics):
+        conf = config.Config(conf_dict={
+            'metrics.statsd_host': 'statsd',
+            'metrics.path': '/_turnstile/metrics',
+        })
+
+        result = metrics.get_metrics(conf)
+
+        self.assertIsInstance(result, metrics.MultiMetrics)
+        self.assertEqual(result.emitters, ['statsd', 'prom'])
+
+    @mock.patch.object(metrics, 'SummaryMetrics', return_value='summary')
+    def test_summary(self, mock_SummaryMetrics):
+        conf = config.Config(conf_dict={
+            'metrics.summary': 'on',
+            'metrics.summary_window': '30',
+            'metrics.summary_samples': '500',
+        })
+
+        result = metrics.get_metrics(conf)
+
+        self.assertEqual(result, 'summary')
+        mock_SummaryMetrics.assert_called_once_with(window=30, samples=500)
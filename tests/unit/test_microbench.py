@@ -0,0 +1,171 @@
+# Copyright 2013 Rackspace
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import mock
+import unittest2
+
+from turnstile import limits
+from turnstile import microbench
+
+
+class TestBenchmark(unittest2.TestCase):
+    @mock.patch.object(microbench, '_benchmarks', [])
+    def test_decorator(self):
+        @microbench.benchmark('test')
+        def test_func():
+            pass
+
+        self.assertEqual(microbench._benchmarks, [('test', test_func)])
+
+
+class TestMeasure(unittest2.TestCase):
+    @mock.patch('time.time')
+    def test_measure(self, mock_time):
+        # Each call takes 0.1 second
+        clock = [0.0]
+
+        def fake_time():
+            return clock[0]
+        mock_time.side_effect = fake_time
+
+        def func():
+            clock[0] += 0.1
+
+        result = microbench.measure(func, repeat=3, min_time=0.35)
+
+        self.assertEqual(result['loops'], 4)
+        self.assertEqual(result['repeat'], 3)
+        self.assertAlmostEqual(result['best'], 0.1)
+        self.assertAlmostEqual(result['median'], 0.1)
+
+
+class TestRunBenchmarks(unittest2.TestCase):
+    @mock.patch.object(microbench, '_benchmarks', [
+        ('bench.one', mock.Mock(return_value='func1')),
+        ('bench.two', mock.Mock(return_value='func2')),
+        ('other', mock.Mock(return_value='func3')),
+    ])
+    @mock.patch.object(microbench, 'measure',
+                       side_effect=lambda f, r, t: 'measure:%s' % f)
+    @mock.patch('time.time', return_value=1000000.0)
+    @mock.patch('platform.python_version', return_value='2.7')
+    @mock.patch('platform.platform', return_value='Linux')
+    def test_run(self, mock_platform, mock_python_version, mock_time,
+                 mock_measure):
+        result = microbench.run_benchmarks('bench.*', 3, 0.1, 'label')
+
+        self.assertEqual(result, {
+            'label': 'label',
+            'timestamp': 1000000.0,
+            'python': '2.7',
+            'platform': 'Linux',
+            'benchmarks': {
+                'bench.one': 'measure:func1',
+                'bench.two': 'measure:func2',
+            },
+        })
+        mock_measure.assert_has_calls([
+            mock.call('func1', 3, 0.1),
+            mock.call('func2', 3, 0.1),
+        ])
+        self.assertFalse(microbench._benchmarks[2][1].called)
+
+    def test_registered(self):
+        # Make sure each of the registered benchmarks actually works
+        names = set()
+        for name, setup in microbench._benchmarks:
+            names.add(name)
+            func = setup()
+            func()
+
+        self.assertEqual(names, set([
+            'bucket_key.str',
+            'bucket_key.str.v3',
+            'bucket_key.builder',
+            'bucket_key.builder.v3',
+            'bucket_key.decode',
+            'bucket_loader.1',
+            'bucket_loader.10',
+            'bucket_loader.100',
+            'bucket_loader.1000',
+            'bucket.delay',
+            'limit.hydrate',
+            'limit.dehydrate',
+            'limit_data.set_limits.10000',
+            'remote.connection.send',
+            'remote.connection.recv',
+            'remote.connection.send.v2',
+            'remote.connection.recv.v2',
+            'remote.rpc.ping.tcp',
+            'remote.rpc.ping.unix',
+            'tools.parse_limit_node',
+        ]))
+
+    def test_bucket_loader(self):
+        setup = dict(microbench._benchmarks)['bucket_loader.10']
+
+        loader = setup()()
+
+        self.assertIsInstance(loader, limits.BucketLoader)
+        self.assertEqual(loader.updates, 9)
+
+    def test_connection_recv(self):
+        setup = dict(microbench._benchmarks)['remote.connection.recv']
+
+        self.assertEqual(setup()(), ('get_limits', ['checksum', []]))
+
+    def test_rpc_ping_unix(self):
+        setup = dict(microbench._benchmarks)['remote.rpc.ping.unix']
+
+        ping = setup()
+
+        self.assertGreaterEqual(ping(), 0.0)
+        self.assertGreaterEqual(ping(), 0.0)
+
+    def test_connection_recv_v2(self):
+        setup = dict(microbench._benchmarks)['remote.connection.recv.v2']
+
+        self.assertEqual(setup()(), ('get_limits', ['checksum', []]))
+
+
+class TestCompare(unittest2.TestCase):
+    def test_compare(self):
+        old = {'benchmarks': {
+            'a': {'median': 2.0},
+            'b': {'median': 0.0},
+            'c': {'median': 1.0},
+        }}
+        new = {'benchmarks': {
+            'a': {'median': 1.0},
+            'b': {'median': 1.0},
+            'd': {'median': 1.0},
+        }}
+
+        result = microbench.compare(old, new)
+
+        self.assertEqual(result, [
+            ('a', 2.0, 1.0, 0.5),
+            ('b', 0.0, 1.0, None),
+        ])
+
+
+class TestFakeSocket(unittest2.TestCase):
+    def test_socket(self):
+        sock = microbench._FakeSocket('data')
+
+        sock.sendall('sent')
+        self.assertEqual(sock.recv(4096), 'data')
+        self.assertEqual(sock.recv(4096), 'data')
+        sock.close()
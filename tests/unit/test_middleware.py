@@ -17,9 +17,9 @@ import eventlet.semaphore
 import mock
 import unittest2
 
-from turnstile import config
 from turnstile import control
-from turnstile import database
+from turnstile import limits
+from turnstile import metrics
 from turnstile import middleware
 from turnstile import remote
 from turnstile import utils
@@ -162,6 +162,30 @@ class TestTurnstileFilter(unittest2.TestCase):
         self.assertEqual(midware, 'middleware')
 
 
+class TestForkHooks(unittest2.TestCase):
+    @mock.patch.object(middleware, '_prefork_middleware', set())
+    def test_pre_fork(self):
+        midwares = [mock.Mock(), mock.Mock()]
+        middleware._prefork_middleware.update(midwares)
+
+        middleware.pre_fork()
+
+        for midware in midwares:
+            midware.pre_fork.assert_called_once_with()
+            self.assertFalse(midware.post_fork.called)
+
+    @mock.patch.object(middleware, '_prefork_middleware', set())
+    def test_post_fork(self):
+        midwares = [mock.Mock(), mock.Mock()]
+        middleware._prefork_middleware.update(midwares)
+
+        middleware.post_fork()
+
+        for midware in midwares:
+            midware.post_fork.assert_called_once_with()
+            self.assertFalse(midware.pre_fork.called)
+
+
 class TestTurnstileMiddleware(unittest2.TestCase):
     @mock.patch.object(utils, 'find_entrypoint')
     @mock.patch.object(control, 'ControlDaemon')
@@ -184,6 +208,10 @@ class TestTurnstileMiddleware(unittest2.TestCase):
         self.assertEqual(midware.preprocessors, [])
         self.assertEqual(midware.postprocessors, [])
         self.assertEqual(midware.formatter, midware.format_delay)
+        self.assertEqual(midware.compactor, (None, 600, 'compactor'))
+        self.assertIsInstance(midware.metrics, metrics.Metrics)
+        self.assertFalse(midware.metrics.enabled)
+        self.assertEqual(midware.metrics_path, None)
         self.assertFalse(mock_RemoteControlDaemon.called)
         mock_ControlDaemon.assert_has_calls([
             mock.call(midware, midware.conf),
@@ -229,6 +257,73 @@ class TestTurnstileMiddleware(unittest2.TestCase):
             '413 Request Entity Too Large', 'delay', 'limit', 'bucket',
             'environ', 'start')
 
+    @mock.patch.object(middleware, '_prefork_middleware', set())
+    @mock.patch.object(utils, 'find_entrypoint')
+    @mock.patch.object(control, 'ControlDaemon')
+    @mock.patch.object(remote, 'RemoteControlDaemon')
+    @mock.patch.object(middleware.LOG, 'info')
+    def test_init_prefork(self, mock_info, mock_RemoteControlDaemon,
+                          mock_ControlDaemon, mock_find_entrypoint):
+        midware = middleware.TurnstileMiddleware('app', {
+            'control.prefork': 'yes',
+        })
+
+        mock_ControlDaemon.assert_called_once_with(midware, midware.conf)
+        self.assertFalse(mock_ControlDaemon.return_value.start.called)
+        self.assertEqual(middleware._prefork_middleware, set([midware]))
+        mock_info.assert_called_once_with("Turnstile middleware initialized")
+
+    @mock.patch.object(control, 'ControlDaemon')
+    @mock.patch.object(middleware.LOG, 'info')
+    @mock.patch.object(middleware.TurnstileMiddleware, 'recheck_limits')
+    def test_init_cache_file(self, mock_recheck_limits, mock_info,
+                             mock_ControlDaemon):
+        midware = middleware.TurnstileMiddleware('app', {
+            'control.cache_file': '/path/cache',
+        })
+
+        mock_ControlDaemon.assert_has_calls([
+            mock.call(midware, midware.conf),
+            mock.call().start(),
+        ])
+        mock_recheck_limits.assert_called_once_with()
+
+    @mock.patch.object(control, 'ControlDaemon')
+    @mock.patch.object(middleware.LOG, 'info')
+    @mock.patch.object(middleware.TurnstileMiddleware, 'recheck_limits')
+    def test_pre_fork(self, mock_recheck_limits, mock_info,
+                      mock_ControlDaemon):
+        midware = middleware.TurnstileMiddleware('app', {})
+        mock_ControlDaemon.return_value.reset_mock()
+
+        midware.pre_fork()
+
+        mock_ControlDaemon.return_value.assert_has_calls([
+            mock.call.preload(),
+        ])
+        self.assertFalse(mock_ControlDaemon.return_value.start.called)
+        mock_recheck_limits.assert_called_once_with()
+
+    @mock.patch.object(control, 'ControlDaemon')
+    @mock.patch.object(middleware.LOG, 'info')
+    def test_post_fork(self, mock_info, mock_ControlDaemon):
+        midware = middleware.TurnstileMiddleware('app', {})
+        mock_ControlDaemon.return_value.reset_mock()
+        mock_ControlDaemon.return_value.get_database.return_value = 'new_db'
+        midware._db = 'old_db'
+        midware.limits = [mock.Mock(db='old_db'), mock.Mock(db='old_db')]
+
+        midware.post_fork()
+
+        self.assertEqual(midware._db, 'new_db')
+        for lim in midware.limits:
+            self.assertEqual(lim.db, 'new_db')
+        mock_ControlDaemon.return_value.assert_has_calls([
+            mock.call.reset(),
+            mock.call.get_database(),
+            mock.call.start(),
+        ])
+
     @mock.patch.object(utils, 'find_entrypoint')
     @mock.patch.object(control, 'ControlDaemon')
     @mock.patch.object(remote, 'RemoteControlDaemon')
@@ -384,15 +479,14 @@ class TestTurnstileMiddleware(unittest2.TestCase):
     @mock.patch.object(control, 'ControlDaemon')
     @mock.patch.object(middleware.LOG, 'info')
     @mock.patch.object(middleware.LOG, 'exception')
-    @mock.patch.object(database, 'limits_hydrate', return_value=[
-        mock.Mock(),
-        mock.Mock(),
-    ])
-    @mock.patch('routes.Mapper', return_value='mapper')
-    def test_recheck_limits_basic(self, mock_Mapper, mock_limits_hydrate,
+    @mock.patch.object(middleware.TurnstileMiddleware, '_reuse_limits',
+                       return_value=[mock.Mock(), mock.Mock()])
+    @mock.patch('routes.Mapper')
+    def test_recheck_limits_basic(self, mock_Mapper, mock_reuse_limits,
                                   mock_exception, mock_info,
                                   mock_ControlDaemon, mock_format_exc):
         limit_data = mock.Mock(**{
+            'get_changes.return_value': ('new_sum', None),
             'get_limits.return_value': ('new_sum', ['limit1', 'limit2']),
         })
         mock_ControlDaemon.return_value = mock.Mock(**{
@@ -403,37 +497,188 @@ class TestTurnstileMiddleware(unittest2.TestCase):
         midware.limit_sum = 'old_sum'
         midware.mapper = 'old_mapper'
         midware._db = mock.Mock()
+        midware.metrics = mock.MagicMock()
+
+        mapper = mock_Mapper.return_value
 
         midware.recheck_limits()
 
         mock_ControlDaemon.return_value.get_limits.assert_called_once_with()
+        limit_data.get_changes.assert_called_once_with('old_sum')
         limit_data.get_limits.assert_called_once_with('old_sum')
-        mock_limits_hydrate.assert_called_once_with(midware._db,
-                                                    ['limit1', 'limit2'])
+        midware.metrics.assert_has_calls([
+            mock.call.timer('reload'),
+            mock.call.incr('reload'),
+            mock.call.gauge('limits', 2),
+            mock.call.info('limits', checksum='new_sum'),
+        ], any_order=True)
+        mock_reuse_limits.assert_called_once_with(['limit1', 'limit2'])
         mock_Mapper.assert_called_once_with(register=False)
-        for lim in mock_limits_hydrate.return_value:
-            lim._route.assert_called_once_with('mapper')
-        self.assertEqual(midware.limits, mock_limits_hydrate.return_value)
+        for lim in mock_reuse_limits.return_value:
+            lim._route.assert_called_once_with(mapper)
+        self.assertEqual(midware.limits, mock_reuse_limits.return_value)
         self.assertEqual(midware.limit_sum, 'new_sum')
-        self.assertEqual(midware.mapper, 'mapper')
+        self.assertEqual(midware.mapper, mapper)
+        mapper.create_regs.assert_called_once_with()
         self.assertFalse(mock_exception.called)
         self.assertFalse(mock_format_exc.called)
         self.assertEqual(len(midware._db.method_calls), 0)
 
+    @mock.patch.object(control, 'ControlDaemon')
+    @mock.patch.object(middleware.LOG, 'info')
+    @mock.patch.object(middleware.TurnstileMiddleware, '_reuse_limits')
+    @mock.patch.object(middleware.TurnstileMiddleware, '_apply_changes',
+                       return_value=[mock.Mock(), mock.Mock()])
+    @mock.patch('routes.Mapper')
+    def test_recheck_limits_changes(self, mock_Mapper, mock_apply_changes,
+                                    mock_reuse_limits, mock_info,
+                                    mock_ControlDaemon):
+        limit_data = mock.Mock(**{
+            'get_changes.return_value': ('new_sum', ['change1', 'change2']),
+        })
+        mock_ControlDaemon.return_value = mock.Mock(**{
+            'get_limits.return_value': limit_data,
+        })
+        midware = middleware.TurnstileMiddleware('app', {})
+        midware.limits = ['old_limit1', 'old_limit2']
+        midware.limit_sum = 'old_sum'
+        midware.mapper = 'old_mapper'
+        midware._db = mock.Mock()
+        midware.metrics = mock.MagicMock()
+
+        mapper = mock_Mapper.return_value
+
+        midware.recheck_limits()
+
+        limit_data.get_changes.assert_called_once_with('old_sum')
+        self.assertFalse(limit_data.get_limits.called)
+        self.assertFalse(mock_reuse_limits.called)
+        mock_apply_changes.assert_called_once_with(['change1', 'change2'])
+        midware.metrics.assert_has_calls([
+            mock.call.incr('reload.changes', 2),
+            mock.call.incr('reload'),
+            mock.call.gauge('limits', 2),
+        ], any_order=True)
+        for lim in mock_apply_changes.return_value:
+            lim._route.assert_called_once_with(mapper)
+        self.assertEqual(midware.limits, mock_apply_changes.return_value)
+        self.assertEqual(midware.limit_sum, 'new_sum')
+        self.assertEqual(midware.mapper, mapper)
+        mapper.create_regs.assert_called_once_with()
+        self.assertEqual(len(midware._db.method_calls), 0)
+
+    @mock.patch.object(control, 'ControlDaemon')
+    @mock.patch.object(middleware.LOG, 'info')
+    @mock.patch.object(limits.Limit, 'hydrate',
+                       side_effect=lambda db, lim: mock.Mock(**lim))
+    def test_apply_changes(self, mock_hydrate, mock_info,
+                           mock_ControlDaemon):
+        midware = middleware.TurnstileMiddleware('app', {})
+        midware.limits = [mock.Mock(uuid='uuid1'), mock.Mock(uuid='uuid2'),
+                          mock.Mock(uuid='uuid3')]
+        midware._db = 'db'
+        new2 = {'uuid': 'uuid2', 'value': 5}
+        new4 = {'uuid': 'uuid4', 'value': 10}
+
+        result = midware._apply_changes([
+            ('uuid1', None, None),
+            ('uuid2', 0, new2),
+            ('uuid4', 1, new4),
+        ])
+
+        self.assertEqual([lim.uuid for lim in result],
+                         ['uuid2', 'uuid4', 'uuid3'])
+        self.assertIs(result[2], midware.limits[2])
+        self.assertEqual(result[0].value, 5)
+        mock_hydrate.assert_has_calls([
+            mock.call('db', new2),
+            mock.call('db', new4),
+        ])
+        self.assertIsNot(mock_hydrate.call_args_list[0][0][1], new2)
+        self.assertEqual(len(midware.limits), 3)
+        self.assertEqual(midware.limit_src, {
+            'uuid2': (new2, result[0]),
+            'uuid4': (new4, result[1]),
+        })
+
+    @mock.patch.object(control, 'ControlDaemon')
+    @mock.patch.object(middleware.LOG, 'info')
+    @mock.patch.object(limits.Limit, 'hydrate',
+                       side_effect=lambda db, lim: mock.Mock(**lim))
+    def test_hydrate_limit(self, mock_hydrate, mock_info,
+                           mock_ControlDaemon):
+        midware = middleware.TurnstileMiddleware('app', {})
+        midware._db = 'db'
+        midware.metrics = mock.Mock()
+        limit = {'uuid': 'uuid1', 'value': 5}
+
+        result = midware._hydrate_limit(limit)
+
+        mock_hydrate.assert_called_once_with('db', limit)
+        self.assertIsNot(mock_hydrate.call_args[0][1], limit)
+        self.assertEqual(result.uuid, 'uuid1')
+        self.assertEqual(result.value, 5)
+        self.assertEqual(midware.limit_src, {'uuid1': (limit, result)})
+        midware.metrics.incr.assert_called_once_with('reload.hydrated')
+
+    @mock.patch.object(control, 'ControlDaemon')
+    @mock.patch.object(middleware.LOG, 'info')
+    @mock.patch.object(limits.Limit, 'hydrate',
+                       side_effect=lambda db, lim: mock.Mock(**lim))
+    def test_reuse_limits(self, mock_hydrate, mock_info,
+                          mock_ControlDaemon):
+        midware = middleware.TurnstileMiddleware('app', {})
+        midware._db = 'db'
+        midware.metrics = mock.Mock()
+        old1 = mock.Mock(uuid='uuid1')
+        old2 = mock.Mock(uuid='uuid2')
+        old3 = mock.Mock(uuid='uuid3')
+        midware.limit_src = {
+            'uuid1': ({'uuid': 'uuid1', 'value': 1}, old1),
+            'uuid2': ({'uuid': 'uuid2', 'value': 2}, old2),
+            'uuid3': ({'uuid': 'uuid3', 'value': 3}, old3),
+        }
+        new_limits = [
+            {'uuid': 'uuid3', 'value': 3},
+            {'uuid': 'uuid4', 'value': 4},
+            {'uuid': 'uuid1', 'value': 10},
+        ]
+
+        result = midware._reuse_limits(new_limits)
+
+        self.assertEqual([lim.uuid for lim in result],
+                         ['uuid3', 'uuid4', 'uuid1'])
+        self.assertIs(result[0], old3)
+        self.assertIsNot(result[2], old1)
+        self.assertEqual(result[1].value, 4)
+        self.assertEqual(result[2].value, 10)
+        mock_hydrate.assert_has_calls([
+            mock.call('db', new_limits[1]),
+            mock.call('db', new_limits[2]),
+        ])
+        self.assertEqual(mock_hydrate.call_count, 2)
+        self.assertEqual(midware.limit_src, {
+            'uuid3': ({'uuid': 'uuid3', 'value': 3}, old3),
+            'uuid4': (new_limits[1], result[1]),
+            'uuid1': (new_limits[2], result[2]),
+        })
+        midware.metrics.incr.assert_has_calls([
+            mock.call('reload.hydrated'),
+            mock.call('reload.hydrated'),
+        ])
+
     @mock.patch('traceback.format_exc', return_value='<traceback>')
     @mock.patch.object(control, 'ControlDaemon')
     @mock.patch.object(middleware.LOG, 'info')
     @mock.patch.object(middleware.LOG, 'exception')
-    @mock.patch.object(database, 'limits_hydrate', return_value=[
-        mock.Mock(),
-        mock.Mock(),
-    ])
+    @mock.patch.object(middleware.TurnstileMiddleware, '_reuse_limits',
+                       return_value=[mock.Mock(), mock.Mock()])
     @mock.patch('routes.Mapper', return_value='mapper')
-    def test_recheck_limits_unchanged(self, mock_Mapper, mock_limits_hydrate,
+    def test_recheck_limits_unchanged(self, mock_Mapper, mock_reuse_limits,
                                       mock_exception, mock_info,
                                       mock_ControlDaemon, mock_format_exc):
         limit_data = mock.Mock(**{
-            'get_limits.side_effect': control.NoChangeException,
+            'get_changes.side_effect': control.NoChangeException,
         })
         mock_ControlDaemon.return_value = mock.Mock(**{
             'get_limits.return_value': limit_data,
@@ -447,10 +692,11 @@ class TestTurnstileMiddleware(unittest2.TestCase):
         midware.recheck_limits()
 
         mock_ControlDaemon.return_value.get_limits.assert_called_once_with()
-        limit_data.get_limits.assert_called_once_with('old_sum')
-        self.assertFalse(mock_limits_hydrate.called)
+        limit_data.get_changes.assert_called_once_with('old_sum')
+        self.assertFalse(limit_data.get_limits.called)
+        self.assertFalse(mock_reuse_limits.called)
         self.assertFalse(mock_Mapper.called)
-        for lim in mock_limits_hydrate.return_value:
+        for lim in mock_reuse_limits.return_value:
             self.assertFalse(lim._route.called)
         self.assertEqual(midware.limits, ['old_limit1', 'old_limit2'])
         self.assertEqual(midware.limit_sum, 'old_sum')
@@ -463,16 +709,14 @@ class TestTurnstileMiddleware(unittest2.TestCase):
     @mock.patch.object(control, 'ControlDaemon')
     @mock.patch.object(middleware.LOG, 'info')
     @mock.patch.object(middleware.LOG, 'exception')
-    @mock.patch.object(database, 'limits_hydrate', return_value=[
-        mock.Mock(),
-        mock.Mock(),
-    ])
+    @mock.patch.object(middleware.TurnstileMiddleware, '_reuse_limits',
+                       return_value=[mock.Mock(), mock.Mock()])
     @mock.patch('routes.Mapper', return_value='mapper')
-    def test_recheck_limits_exception(self, mock_Mapper, mock_limits_hydrate,
+    def test_recheck_limits_exception(self, mock_Mapper, mock_reuse_limits,
                                       mock_exception, mock_info,
                                       mock_ControlDaemon, mock_format_exc):
         limit_data = mock.Mock(**{
-            'get_limits.side_effect': test_utils.TestException,
+            'get_changes.side_effect': test_utils.TestException,
         })
         mock_ControlDaemon.return_value = mock.Mock(**{
             'get_limits.return_value': limit_data,
@@ -482,14 +726,18 @@ class TestTurnstileMiddleware(unittest2.TestCase):
         midware.limit_sum = 'old_sum'
         midware.mapper = 'old_mapper'
         midware._db = mock.Mock()
+        midware.metrics = mock.MagicMock()
 
         midware.recheck_limits()
 
+        midware.metrics.incr.assert_called_once_with('reload.errors')
+
         mock_ControlDaemon.return_value.get_limits.assert_called_once_with()
-        limit_data.get_limits.assert_called_once_with('old_sum')
-        self.assertFalse(mock_limits_hydrate.called)
+        limit_data.get_changes.assert_called_once_with('old_sum')
+        self.assertFalse(limit_data.get_limits.called)
+        self.assertFalse(mock_reuse_limits.called)
         self.assertFalse(mock_Mapper.called)
-        for lim in mock_limits_hydrate.return_value:
+        for lim in mock_reuse_limits.return_value:
             self.assertFalse(lim._route.called)
         self.assertEqual(midware.limits, ['old_limit1', 'old_limit2'])
         self.assertEqual(midware.limit_sum, 'old_sum')
@@ -505,18 +753,16 @@ class TestTurnstileMiddleware(unittest2.TestCase):
     @mock.patch.object(control, 'ControlDaemon')
     @mock.patch.object(middleware.LOG, 'info')
     @mock.patch.object(middleware.LOG, 'exception')
-    @mock.patch.object(database, 'limits_hydrate', return_value=[
-        mock.Mock(),
-        mock.Mock(),
-    ])
+    @mock.patch.object(middleware.TurnstileMiddleware, '_reuse_limits',
+                       return_value=[mock.Mock(), mock.Mock()])
     @mock.patch('routes.Mapper', return_value='mapper')
     def test_recheck_limits_exception_altkeys(self, mock_Mapper,
-                                              mock_limits_hydrate,
+                                              mock_reuse_limits,
                                               mock_exception, mock_info,
                                               mock_ControlDaemon,
                                               mock_format_exc):
         limit_data = mock.Mock(**{
-            'get_limits.side_effect': test_utils.TestException,
+            'get_changes.side_effect': test_utils.TestException,
         })
         mock_ControlDaemon.return_value = mock.Mock(**{
             'get_limits.return_value': limit_data,
@@ -533,10 +779,11 @@ class TestTurnstileMiddleware(unittest2.TestCase):
         midware.recheck_limits()
 
         mock_ControlDaemon.return_value.get_limits.assert_called_once_with()
-        limit_data.get_limits.assert_called_once_with('old_sum')
-        self.assertFalse(mock_limits_hydrate.called)
+        limit_data.get_changes.assert_called_once_with('old_sum')
+        self.assertFalse(limit_data.get_limits.called)
+        self.assertFalse(mock_reuse_limits.called)
         self.assertFalse(mock_Mapper.called)
-        for lim in mock_limits_hydrate.return_value:
+        for lim in mock_reuse_limits.return_value:
             self.assertFalse(lim._route.called)
         self.assertEqual(midware.limits, ['old_limit1', 'old_limit2'])
         self.assertEqual(midware.limit_sum, 'old_sum')
@@ -550,11 +797,12 @@ class TestTurnstileMiddleware(unittest2.TestCase):
 
     @mock.patch.object(control, 'ControlDaemon')
     @mock.patch.object(middleware.LOG, 'info')
+    @mock.patch.object(limits, 'RequestContext', return_value='context')
     @mock.patch.object(middleware.TurnstileMiddleware, 'recheck_limits')
     @mock.patch.object(middleware.TurnstileMiddleware, 'format_delay',
                        return_value='formatted delay')
     def test_call_basic(self, mock_format_delay, mock_recheck_limits,
-                        mock_info, mock_ControlDaemon):
+                        mock_RequestContext, mock_info, mock_ControlDaemon):
         app = mock.Mock(return_value='app response')
         midware = middleware.TurnstileMiddleware(app, {})
         midware.mapper = mock.Mock()
@@ -564,20 +812,25 @@ class TestTurnstileMiddleware(unittest2.TestCase):
 
         self.assertEqual(result, 'app response')
         mock_recheck_limits.assert_called_once_with()
+        mock_RequestContext.assert_called_once_with(
+            environ, midware.compactor, midware.metrics)
         midware.mapper.routematch.assert_called_once_with(environ=environ)
         self.assertFalse(mock_format_delay.called)
         app.assert_called_once_with(environ, 'start_response')
         self.assertEqual(environ, {
             'turnstile.conf': midware.conf,
+            'turnstile.context': 'context',
         })
 
     @mock.patch.object(control, 'ControlDaemon')
     @mock.patch.object(middleware.LOG, 'info')
+    @mock.patch.object(limits, 'RequestContext', return_value='context')
     @mock.patch.object(middleware.TurnstileMiddleware, 'recheck_limits')
     @mock.patch.object(middleware.TurnstileMiddleware, 'format_delay',
                        return_value='formatted delay')
     def test_call_processors(self, mock_format_delay, mock_recheck_limits,
-                             mock_info, mock_ControlDaemon):
+                             mock_RequestContext, mock_info,
+                             mock_ControlDaemon):
         app = mock.Mock(return_value='app response')
         midware = middleware.TurnstileMiddleware(app, {})
         midware.mapper = mock.Mock()
@@ -598,15 +851,17 @@ class TestTurnstileMiddleware(unittest2.TestCase):
         app.assert_called_once_with(environ, 'start_response')
         self.assertEqual(environ, {
             'turnstile.conf': midware.conf,
+            'turnstile.context': 'context',
         })
 
     @mock.patch.object(control, 'ControlDaemon')
     @mock.patch.object(middleware.LOG, 'info')
+    @mock.patch.object(limits, 'RequestContext', return_value='context')
     @mock.patch.object(middleware.TurnstileMiddleware, 'recheck_limits')
     @mock.patch.object(middleware.TurnstileMiddleware, 'format_delay',
                        return_value='formatted delay')
     def test_call_delay(self, mock_format_delay, mock_recheck_limits,
-                        mock_info, mock_ControlDaemon):
+                        mock_RequestContext, mock_info, mock_ControlDaemon):
         app = mock.Mock(return_value='app response')
         midware = middleware.TurnstileMiddleware(app, {})
         midware.mapper = mock.Mock()
@@ -641,7 +896,102 @@ class TestTurnstileMiddleware(unittest2.TestCase):
                 (10, 'limit4', 'bucket4'),
             ],
             'turnstile.conf': midware.conf,
+            'turnstile.context': 'context',
+        })
+
+    @mock.patch.object(control, 'ControlDaemon')
+    @mock.patch.object(middleware.LOG, 'info')
+    @mock.patch.object(limits, 'RequestContext', return_value='context')
+    @mock.patch.object(middleware.TurnstileMiddleware, 'recheck_limits')
+    @mock.patch.object(middleware.TurnstileMiddleware, 'format_delay',
+                       return_value='formatted delay')
+    def test_call_metrics(self, mock_format_delay, mock_recheck_limits,
+                          mock_RequestContext, mock_info, mock_ControlDaemon):
+        app = mock.Mock(return_value='app response')
+        midware = middleware.TurnstileMiddleware(app, {})
+        midware.mapper = mock.Mock()
+        midware.metrics = mock.MagicMock()
+        environ = {
+            'turnstile.delay': [(30, 'limit1', 'bucket1')],
+        }
+
+        result = midware(environ, 'start_response')
+
+        self.assertEqual(result, 'formatted delay')
+        midware.metrics.timer.assert_has_calls([
+            mock.call('route_match'),
+            mock.call('format'),
+        ], any_order=True)
+        self.assertEqual(midware.metrics.timer.call_count, 2)
+        midware.metrics.incr.assert_has_calls([
+            mock.call('requests'),
+            mock.call('rejects'),
+        ])
+
+    @mock.patch.object(control, 'ControlDaemon')
+    @mock.patch.object(middleware.LOG, 'info')
+    @mock.patch.object(middleware.TurnstileMiddleware, 'recheck_limits')
+    @mock.patch.object(middleware.TurnstileMiddleware, 'format_metrics',
+                       return_value='metrics page')
+    def test_call_metrics_page(self, mock_format_metrics,
+                               mock_recheck_limits, mock_info,
+                               mock_ControlDaemon):
+        app = mock.Mock(return_value='app response')
+        midware = middleware.TurnstileMiddleware(app, {
+            'metrics.path': '/_turnstile/metrics',
         })
+        midware.mapper = mock.Mock()
+        environ = dict(PATH_INFO='/_turnstile/metrics')
+
+        result = midware(environ, 'start_response')
+
+        self.assertEqual(result, 'metrics page')
+        mock_format_metrics.assert_called_once_with(environ,
+                                                    'start_response')
+        self.assertFalse(mock_recheck_limits.called)
+        self.assertFalse(midware.mapper.routematch.called)
+        self.assertFalse(app.called)
+        self.assertEqual(environ, dict(PATH_INFO='/_turnstile/metrics'))
+
+    @mock.patch.object(control, 'ControlDaemon')
+    @mock.patch.object(middleware.LOG, 'info')
+    @mock.patch.object(limits, 'RequestContext', return_value='context')
+    @mock.patch.object(middleware.TurnstileMiddleware, 'recheck_limits')
+    @mock.patch.object(middleware.TurnstileMiddleware, 'format_metrics',
+                       return_value='metrics page')
+    def test_call_metrics_other_path(self, mock_format_metrics,
+                                     mock_recheck_limits, mock_RequestContext,
+                                     mock_info, mock_ControlDaemon):
+        app = mock.Mock(return_value='app response')
+        midware = middleware.TurnstileMiddleware(app, {
+            'metrics.path': '/_turnstile/metrics',
+        })
+        midware.mapper = mock.Mock()
+        environ = dict(PATH_INFO='/spam')
+
+        result = midware(environ, 'start_response')
+
+        self.assertEqual(result, 'app response')
+        self.assertFalse(mock_format_metrics.called)
+        mock_recheck_limits.assert_called_once_with()
+        app.assert_called_once_with(environ, 'start_response')
+
+    @mock.patch.object(control, 'ControlDaemon')
+    @mock.patch.object(middleware.LOG, 'info')
+    def test_format_metrics(self, mock_info, mock_ControlDaemon):
+        midware = middleware.TurnstileMiddleware('app', {})
+        midware.metrics = mock.Mock(**{
+            'expose.return_value': 'metric 1\n',
+        })
+        start_response = mock.Mock()
+
+        result = midware.format_metrics({}, start_response)
+
+        self.assertEqual(result, ['metric 1\n'])
+        start_response.assert_called_once_with('200 OK', [
+            ('Content-Type', 'text/plain; version=0.0.4'),
+            ('Content-Length', '9'),
+        ])
 
     @mock.patch.object(control, 'ControlDaemon')
     @mock.patch.object(middleware.LOG, 'info')
@@ -695,9 +1045,10 @@ class TestTurnstileMiddleware(unittest2.TestCase):
 
     @mock.patch.object(control, 'ControlDaemon')
     @mock.patch.object(middleware.LOG, 'info')
-    @mock.patch.object(config.Config, 'get_database', return_value='database')
-    def test_db(self, mock_get_database, mock_info, mock_ControlDaemon):
+    def test_db(self, mock_info, mock_ControlDaemon):
         midware = middleware.TurnstileMiddleware('app', {})
+        mock_get_database = mock_ControlDaemon.return_value.get_database
+        mock_get_database.return_value = 'database'
 
         db = midware.db
 
@@ -706,12 +1057,11 @@ class TestTurnstileMiddleware(unittest2.TestCase):
 
     @mock.patch.object(control, 'ControlDaemon')
     @mock.patch.object(middleware.LOG, 'info')
-    @mock.patch.object(config.Config, 'get_database', return_value='database')
-    def test_db_cached(self, mock_get_database, mock_info, mock_ControlDaemon):
+    def test_db_cached(self, mock_info, mock_ControlDaemon):
         midware = middleware.TurnstileMiddleware('app', {})
         midware._db = 'cached'
 
         db = midware.db
 
         self.assertEqual(db, 'cached')
-        self.assertFalse(mock_get_database.called)
+        self.assertFalse(mock_ControlDaemon.return_value.get_database.called)
@@ -0,0 +1,189 @@
+# Copyright 2013 Rackspace
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import signal
+import threading
+
+import mock
+import unittest2
+
+from turnstile import profiler
+
+
+class FakeCode(object):
+    def __init__(self, filename, name):
+        self.co_filename = filename
+        self.co_name = name
+
+
+class FakeFrame(object):
+    def __init__(self, filename, name, back=None):
+        self.f_code = FakeCode(filename, name)
+        self.f_back = back
+
+
+class TestSamplingProfiler(unittest2.TestCase):
+    def test_init(self):
+        prof = profiler.SamplingProfiler()
+
+        self.assertEqual(prof.interval, 0.005)
+        self.assertEqual(prof.stacks, {})
+        self.assertEqual(prof.samples, 0)
+        self.assertEqual(prof._old_handler, None)
+        self.assertEqual(prof.extension, 'collapsed')
+
+    @mock.patch('signal.signal', return_value='old_handler')
+    @mock.patch('signal.siginterrupt')
+    @mock.patch('signal.setitimer')
+    def test_start(self, mock_setitimer, mock_siginterrupt, mock_signal):
+        prof = profiler.SamplingProfiler(0.01)
+
+        prof.start()
+
+        mock_signal.assert_called_once_with(signal.SIGPROF, prof._sample)
+        mock_siginterrupt.assert_called_once_with(signal.SIGPROF, False)
+        mock_setitimer.assert_called_once_with(signal.ITIMER_PROF,
+                                               0.01, 0.01)
+        self.assertEqual(prof._old_handler, 'old_handler')
+
+    @mock.patch('signal.signal', return_value='old_handler')
+    @mock.patch('signal.siginterrupt')
+    @mock.patch('signal.setitimer', side_effect=signal.ItimerError)
+    def test_start_failed(self, mock_setitimer, mock_siginterrupt,
+                          mock_signal):
+        prof = profiler.SamplingProfiler(0.01)
+
+        self.assertRaises(signal.ItimerError, prof.start)
+        mock_signal.assert_has_calls([
+            mock.call(signal.SIGPROF, prof._sample),
+            mock.call(signal.SIGPROF, 'old_handler'),
+        ])
+        self.assertEqual(prof._old_handler, None)
+
+    def test_start_thread(self):
+        prof = profiler.SamplingProfiler()
+        errors = []
+
+        def start():
+            try:
+                prof.start()
+            except ValueError as exc:
+                errors.append(exc)
+        thread = threading.Thread(target=start)
+        thread.start()
+        thread.join()
+
+        self.assertEqual(len(errors), 1)
+        self.assertEqual(signal.getsignal(signal.SIGPROF), signal.SIG_DFL)
+
+    @mock.patch('signal.signal')
+    @mock.patch('signal.setitimer')
+    def test_stop(self, mock_setitimer, mock_signal):
+        prof = profiler.SamplingProfiler()
+        prof._old_handler = 'old_handler'
+
+        prof.stop()
+
+        mock_setitimer.assert_called_once_with(signal.ITIMER_PROF, 0, 0)
+        mock_signal.assert_called_once_with(signal.SIGPROF, 'old_handler')
+        self.assertEqual(prof._old_handler, None)
+
+    @mock.patch('signal.signal')
+    @mock.patch('signal.setitimer')
+    def test_stop_no_handler(self, mock_setitimer, mock_signal):
+        prof = profiler.SamplingProfiler()
+
+        prof.stop()
+
+        mock_signal.assert_called_once_with(signal.SIGPROF, signal.SIG_DFL)
+
+    def test_sample(self):
+        prof = profiler.SamplingProfiler()
+        outer = FakeFrame('/path/to/outer.py', 'main')
+        frame1 = FakeFrame('/path/to/inner.py', 'func1', outer)
+        frame2 = FakeFrame('/path/to/inner.py', 'func2', outer)
+
+        prof._sample(signal.SIGPROF, frame1)
+        prof._sample(signal.SIGPROF, frame2)
+        prof._sample(signal.SIGPROF, frame1)
+
+        self.assertEqual(prof.stacks, {
+            'outer.py:main;inner.py:func1': 2,
+            'outer.py:main;inner.py:func2': 1,
+        })
+        self.assertEqual(prof.samples, 3)
+
+    def test_save(self):
+        prof = profiler.SamplingProfiler()
+        prof.stacks = {
+            'b;c': 1,
+            'a;b': 2,
+        }
+
+        with mock.patch('__builtin__.open', mock.mock_open()) as mock_open:
+            prof.save('filename')
+
+        mock_open.assert_called_once_with('filename', 'w')
+        handle = mock_open.return_value
+        self.assertEqual(''.join(c[0][0] for c in handle.write.call_args_list),
+                         'a;b 2\nb;c 1\n')
+
+    def test_summary_empty(self):
+        prof = profiler.SamplingProfiler()
+
+        self.assertEqual(prof.summary(), '0 samples')
+
+    def test_summary(self):
+        prof = profiler.SamplingProfiler()
+        prof.stacks = {
+            'a;b': 2,
+            'a;c': 1,
+            'd;b': 1,
+        }
+        prof.samples = 4
+
+        self.assertEqual(prof.summary(), '4 samples, top b (75%)')
+
+
+class TestDeterministicProfiler(unittest2.TestCase):
+    @mock.patch('cProfile.Profile')
+    def test_init(self, mock_Profile):
+        prof = profiler.DeterministicProfiler()
+
+        self.assertEqual(prof.profile, mock_Profile.return_value)
+        self.assertEqual(prof.extension, 'pstats')
+
+    @mock.patch('cProfile.Profile')
+    def test_start_stop_save(self, mock_Profile):
+        prof = profiler.DeterministicProfiler()
+
+        prof.start()
+        prof.stop()
+        prof.save('filename')
+
+        mock_Profile.return_value.assert_has_calls([
+            mock.call.enable(),
+            mock.call.disable(),
+            mock.call.dump_stats('filename'),
+        ])
+
+    @mock.patch('cProfile.Profile')
+    @mock.patch('pstats.Stats', return_value=mock.Mock(total_calls=10,
+                                                       total_tt=1.5))
+    def test_summary(self, mock_Stats, mock_Profile):
+        prof = profiler.DeterministicProfiler()
+
+        self.assertEqual(prof.summary(), '10 calls in 1.500 seconds')
+        mock_Stats.assert_called_once_with(mock_Profile.return_value)
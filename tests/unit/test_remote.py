@@ -13,15 +13,26 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import collections
+import errno
 import json
+import os
+import shutil
 import socket
+import stat
+import tempfile
+import threading
 
+import eventlet
+from eventlet.green import socket as green_socket
 import eventlet.semaphore
 import mock
+import msgpack
 import unittest2
 
 from turnstile import config
 from turnstile import control
+from turnstile import memdb
 from turnstile import remote
 from turnstile import utils
 
@@ -33,8 +44,37 @@ class TestConnection(unittest2.TestCase):
         conn = remote.Connection('socket')
 
         self.assertEqual(conn._sock, 'socket')
-        self.assertEqual(conn._recvbuf, [])
+        self.assertEqual(list(conn._recvbuf), [])
         self.assertEqual(conn._recvbuf_partial, '')
+        self.assertEqual(conn._frame_buf, None)
+        self.assertEqual(conn.protocol, 1)
+
+    def test_init_protocol(self):
+        conn = remote.Connection('socket', 2)
+
+        self.assertEqual(conn.protocol, 2)
+        self.assertEqual(len(conn._frame_buf), conn.frame_bufsize)
+        self.assertEqual(conn._frame_start, 0)
+        self.assertEqual(conn._frame_end, 0)
+
+    def test_set_protocol_bad(self):
+        conn = remote.Connection('socket')
+
+        self.assertRaises(ValueError, conn.set_protocol,
+                          remote.PROTOCOL_VERSION + 1)
+        self.assertEqual(conn.protocol, 1)
+
+    def test_set_protocol_partial(self):
+        conn = remote.Connection('socket')
+        conn._recvbuf_partial = 'partial'
+
+        conn.set_protocol(2)
+
+        self.assertEqual(conn.protocol, 2)
+        self.assertEqual(conn._recvbuf_partial, '')
+        self.assertEqual(str(conn._frame_buf[:7]), 'partial')
+        self.assertEqual(conn._frame_start, 0)
+        self.assertEqual(conn._frame_end, 7)
 
     def test_close(self):
         sock = mock.Mock()
@@ -46,12 +86,35 @@ class TestConnection(unittest2.TestCase):
 
         sock.close.assert_called_once_with()
         self.assertEqual(conn._sock, None)
-        self.assertEqual(conn._recvbuf, [])
+        self.assertEqual(list(conn._recvbuf), [])
         self.assertEqual(conn._recvbuf_partial, '')
 
         # Make sure this doesn't raise an error
         conn.close()
 
+    def test_readable(self):
+        client_sock, server_sock = socket.socketpair()
+        client = remote.Connection(client_sock)
+        server = remote.Connection(server_sock)
+
+        try:
+            self.assertFalse(server.readable())
+            client.send('cmd1')
+            client.send('cmd2')
+            self.assertTrue(server.readable())
+            self.assertEqual(server.recv(), ('cmd1', []))
+            self.assertTrue(server.readable())
+            self.assertEqual(server.recv(), ('cmd2', []))
+            self.assertFalse(server.readable())
+        finally:
+            client.close()
+            server.close()
+
+    def test_readable_closed(self):
+        conn = remote.Connection(None)
+
+        self.assertRaises(remote.ConnectionClosed, conn.readable)
+
     @mock.patch.object(remote.Connection, 'close')
     def test_send_closed(self, mock_close):
         conn = remote.Connection(None)
@@ -108,13 +171,25 @@ class TestConnection(unittest2.TestCase):
             "{'cmd': 'cmd', 'payload': ['arg1', 'arg2']}\n")
         mock_close.assert_called_once_with()
 
+    @mock.patch.object(remote.Connection, 'close')
+    def test_send_protocol2(self, mock_close):
+        sock = mock.Mock()
+        conn = remote.Connection(sock, 2)
+
+        conn.send('cmd', 'arg1', 'arg2')
+
+        data = msgpack.dumps(['cmd', ('arg1', 'arg2')])
+        sock.sendall.assert_called_once_with(
+            '\x00\x00\x00%c%s' % (len(data), data))
+        self.assertFalse(mock_close.called)
+
     def test_recvbuf_pop(self):
         conn = remote.Connection(None)
-        conn._recvbuf = [
+        conn._recvbuf = collections.deque([
             dict(cmd='cmd1', payload='payload1'),
             test_utils.TestException('testing exception'),
             dict(cmd='cmd2', payload='payload2'),
-        ]
+        ])
 
         self.assertEqual(conn._recvbuf_pop(), ('cmd1', 'payload1'))
         self.assertRaises(test_utils.TestException, conn._recvbuf_pop)
@@ -123,9 +198,9 @@ class TestConnection(unittest2.TestCase):
     @mock.patch.object(remote.Connection, 'close')
     def test_recv_buffered(self, mock_close):
         conn = remote.Connection(None)
-        conn._recvbuf = [
+        conn._recvbuf = collections.deque([
             dict(cmd='cmd', payload='payload'),
-        ]
+        ])
 
         result = conn.recv()
 
@@ -178,7 +253,7 @@ class TestConnection(unittest2.TestCase):
         result = conn.recv()
 
         self.assertEqual(result, ('cmd1', 'payload1'))
-        self.assertEqual(conn._recvbuf, [
+        self.assertEqual(list(conn._recvbuf), [
             dict(cmd='cmd2', payload='payload2'),
             dict(cmd='cmd3', payload='payload3'),
         ])
@@ -200,7 +275,7 @@ class TestConnection(unittest2.TestCase):
         result = conn.recv()
 
         self.assertEqual(result, ('cmd', 'payload'))
-        self.assertEqual(conn._recvbuf, [expected])
+        self.assertEqual(list(conn._recvbuf), [expected])
         self.assertEqual(conn._recvbuf_partial, '')
         self.assertFalse(mock_close.called)
 
@@ -217,16 +292,120 @@ class TestConnection(unittest2.TestCase):
         result = conn.recv()
 
         self.assertEqual(result, ('cmd', 'payload'))
-        self.assertEqual(conn._recvbuf, [])
+        self.assertEqual(list(conn._recvbuf), [])
         self.assertEqual(conn._recvbuf_partial, '')
         self.assertFalse(mock_close.called)
 
+    def test_protocol2_roundtrip(self):
+        client_sock, server_sock = socket.socketpair()
+        client = remote.Connection(client_sock, 2)
+        server = remote.Connection(server_sock, 2)
+
+        try:
+            client.send('cmd1', 'payload1', {'key': [1, 2]})
+            client.send('cmd2')
+
+            self.assertEqual(server.recv(),
+                             ('cmd1', ['payload1', {'key': [1, 2]}]))
+            self.assertEqual(server.recv(), ('cmd2', []))
+            self.assertEqual(server._frame_start, 0)
+            self.assertEqual(server._frame_end, 0)
+        finally:
+            client.close()
+            server.close()
+
+    def test_protocol2_recv_split(self):
+        frames = []
+        for i in range(3):
+            data = msgpack.dumps(['cmd%d' % i, ['payload%d' % i]])
+            frames.append(remote._FRAME_HEADER.pack(len(data)) + data)
+        stream = ''.join(frames)
+        chunks = [stream[:2], stream[2:len(frames[0]) + 3],
+                  stream[len(frames[0]) + 3:]]
+
+        def fake_recv_into(buf):
+            chunk = chunks.pop(0)
+            buf[:len(chunk)] = chunk
+            return len(chunk)
+        sock = mock.Mock(**{'recv_into.side_effect': fake_recv_into})
+        conn = remote.Connection(sock, 2)
+
+        self.assertEqual(conn.recv(), ('cmd0', ['payload0']))
+        self.assertEqual(list(conn._recvbuf), [])
+        self.assertEqual(conn.recv(), ('cmd1', ['payload1']))
+        self.assertEqual(list(conn._recvbuf), [
+            dict(cmd='cmd2', payload=['payload2']),
+        ])
+        self.assertEqual(sock.recv_into.call_count, 3)
+
+    def test_protocol2_recv_grow(self):
+        data = msgpack.dumps(['cmd', ['x' * 100]])
+        frame = remote._FRAME_HEADER.pack(len(data)) + data
+        chunks = [frame[:10], frame[10:]]
+
+        def fake_recv_into(buf):
+            chunk = chunks.pop(0)[:len(buf)]
+            buf[:len(chunk)] = chunk
+            return len(chunk)
+        sock = mock.Mock(**{'recv_into.side_effect': fake_recv_into})
+        conn = remote.Connection(sock)
+        conn.frame_bufsize = 16
+        conn.set_protocol(2)
+
+        self.assertEqual(conn.recv(), ('cmd', ['x' * 100]))
+        self.assertEqual(len(conn._frame_buf), len(frame))
+
+    def test_protocol2_recv_compact(self):
+        first = msgpack.dumps(['cmd1', []])
+        second = msgpack.dumps(['cmd2', []])
+        stream = (remote._FRAME_HEADER.pack(len(first)) + first +
+                  remote._FRAME_HEADER.pack(len(second)) + second)
+        bufsize = len(first) + 8
+        chunks = [stream[:bufsize], stream[bufsize:]]
+
+        def fake_recv_into(buf):
+            chunk = chunks.pop(0)
+            buf[:len(chunk)] = chunk
+            return len(chunk)
+        sock = mock.Mock(**{'recv_into.side_effect': fake_recv_into})
+        conn = remote.Connection(sock)
+        conn.frame_bufsize = bufsize
+        conn.set_protocol(2)
+
+        self.assertEqual(conn.recv(), ('cmd1', []))
+        self.assertEqual(conn.recv(), ('cmd2', []))
+        self.assertEqual(len(conn._frame_buf), bufsize)
+
+    def test_protocol2_recv_bad(self):
+        data = '\xc1'
+        frame = remote._FRAME_HEADER.pack(len(data)) + data
+
+        def fake_recv_into(buf):
+            buf[:len(frame)] = frame
+            return len(frame)
+        sock = mock.Mock(**{'recv_into.side_effect': fake_recv_into})
+        conn = remote.Connection(sock, 2)
+
+        self.assertRaises(ValueError, conn.recv)
+        self.assertEqual(conn._frame_end, 0)
+
+    @mock.patch.object(remote.Connection, 'close')
+    def test_protocol2_recv_closed(self, mock_close):
+        sock = mock.Mock(**{'recv_into.return_value': 0})
+        conn = remote.Connection(sock, 2)
+
+        self.assertRaises(remote.ConnectionClosed, conn.recv)
+        mock_close.assert_called_once_with()
+
 
 class RemoteTester(object):
+    multiplexed = False
+
     def __init__(self, mode=None, conn=None, post_conn=None):
         self.mode = mode
         self.conn = conn
         self.post_conn = post_conn
+        self._notes = collections.deque()
 
     def connect(self):
         self.conn = self.post_conn
@@ -273,6 +452,22 @@ class TestRemote(unittest2.TestCase):
         ])
         self.assertEqual(len(conn.method_calls), 3)
 
+    def test_note_before_result(self):
+        conn = mock.Mock(**{
+            'recv.side_effect': [
+                ('NOTE', ['sum1']),
+                ('NOTE', ['sum2']),
+                ('RES', ['result']),
+            ],
+        })
+        rt = RemoteTester(conn=conn)
+
+        result = rt.func(1)
+
+        self.assertEqual(result, 'result')
+        self.assertEqual(list(rt._notes), [['sum1'], ['sum2']])
+        self.assertFalse(conn.close.called)
+
     def test_error(self):
         conn = mock.Mock(**{
             'recv.return_value': ('ERR', ['test error']),
@@ -415,6 +610,71 @@ class TestCreateServer(unittest2.TestCase):
         self.assertEqual(len(sockets[2].method_calls), 0)
 
 
+class TestCreateUnixServer(unittest2.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'rpc.sock')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_create(self):
+        sock = remote._create_unix_server(self.path, 0640)
+
+        try:
+            self.assertEqual(sock.family, socket.AF_UNIX)
+            st = os.stat(self.path)
+            self.assertTrue(stat.S_ISSOCK(st.st_mode))
+            self.assertEqual(stat.S_IMODE(st.st_mode), 0640)
+        finally:
+            sock.close()
+
+    def test_stale(self):
+        stale = remote._create_unix_server(self.path, 0600)
+        stale.close()
+
+        sock = remote._create_unix_server(self.path, 0600)
+        sock.close()
+
+    def test_listening(self):
+        live = remote._create_unix_server(self.path, 0600)
+
+        try:
+            with self.assertRaises(socket.error) as cm:
+                remote._create_unix_server(self.path, 0600)
+            self.assertEqual(cm.exception.errno, errno.EADDRINUSE)
+
+            # The live server still receives connections
+            client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            client.connect(self.path)
+            client.close()
+        finally:
+            live.close()
+
+    def test_probe_error(self):
+        stale = remote._create_unix_server(self.path, 0600)
+        stale.close()
+
+        with mock.patch.object(socket, 'socket') as mock_socket:
+            mock_socket.return_value.connect.side_effect = socket.error(
+                errno.EACCES, 'Permission denied')
+
+            self.assertRaises(socket.error, remote._create_unix_server,
+                              self.path, 0600)
+
+        self.assertTrue(os.path.exists(self.path))
+        mock_socket.return_value.close.assert_called_once_with()
+
+    def test_not_socket(self):
+        with open(self.path, 'w') as f:
+            f.write('data')
+
+        self.assertRaises(socket.error, remote._create_unix_server,
+                          self.path, 0600)
+        with open(self.path) as f:
+            self.assertEqual(f.read(), 'data')
+
+
 class TestSimpleRPC(unittest2.TestCase):
     def test_init(self):
         rpc = remote.SimpleRPC('host', 'port', 'authkey')
@@ -422,10 +682,35 @@ class TestSimpleRPC(unittest2.TestCase):
         self.assertEqual(rpc.host, 'host')
         self.assertEqual(rpc.port, 'port')
         self.assertEqual(rpc.authkey, 'authkey')
+        self.assertEqual(rpc.path, None)
+        self.assertEqual(rpc.sock_mode, 0600)
         self.assertEqual(rpc.mode, None)
         self.assertEqual(rpc.conn, None)
         self.assertEqual(rpc.connection_class, remote.Connection)
 
+    def test_unix_roundtrip(self):
+        tmpdir = tempfile.mkdtemp()
+        path = os.path.join(tmpdir, 'rpc.sock')
+        server = remote.SimpleRPC(None, None, 'authkey', path=path)
+        client = remote.SimpleRPC(None, None, 'authkey', path=path)
+        serv = remote._create_unix_server(path, 0600)
+
+        def serve():
+            sock, addr = serv.accept()
+            server.serve(remote.Connection(sock), (path, sock.fileno()))
+        server_thread = threading.Thread(target=serve)
+        server_thread.daemon = True
+        server_thread.start()
+
+        try:
+            self.assertGreaterEqual(client.ping(), 0.0)
+            self.assertEqual(client.conn.protocol, remote.PROTOCOL_VERSION)
+        finally:
+            client.close()
+            server_thread.join(5)
+            serv.close()
+            shutil.rmtree(tmpdir)
+
     def test_close(self):
         conn = mock.Mock()
         rpc = remote.SimpleRPC('host', 'port', 'authkey')
@@ -436,6 +721,54 @@ class TestSimpleRPC(unittest2.TestCase):
         self.assertEqual(rpc.conn, None)
         conn.close.assert_called_once_with()
 
+    def test_notifications(self):
+        conn = mock.Mock(**{
+            'readable.side_effect': [True, True, True, False],
+            'recv.side_effect': [
+                ('NOTE', ['sum1']),
+                ('PONG', [1.0]),
+                ('NOTE', ['sum2']),
+            ],
+        })
+        rpc = remote.SimpleRPC('host', 'port', 'authkey')
+        rpc.conn = conn
+
+        result = rpc.notifications()
+
+        self.assertEqual(result, [['sum1'], ['sum2']])
+        self.assertFalse(conn.close.called)
+
+    def test_notifications_saved(self):
+        conn = mock.Mock(**{
+            'readable.side_effect': [True, False],
+            'recv.return_value': ('NOTE', ['sum2']),
+        })
+        rpc = remote.SimpleRPC('host', 'port', 'authkey')
+        rpc.conn = conn
+        rpc._notes.append(['sum1'])
+
+        result = rpc.notifications()
+
+        self.assertEqual(result, [['sum1'], ['sum2']])
+        self.assertEqual(len(rpc._notes), 0)
+
+    def test_notifications_unconnected(self):
+        rpc = remote.SimpleRPC('host', 'port', 'authkey')
+
+        self.assertRaises(remote.ConnectionClosed, rpc.notifications)
+
+    def test_notifications_closed(self):
+        conn = mock.Mock(**{
+            'readable.return_value': True,
+            'recv.side_effect': remote.ConnectionClosed,
+        })
+        rpc = remote.SimpleRPC('host', 'port', 'authkey')
+        rpc.conn = conn
+
+        self.assertRaises(remote.ConnectionClosed, rpc.notifications)
+        conn.close.assert_called_once_with()
+        self.assertEqual(rpc.conn, None)
+
         # Just check to see if it raises an error
         rpc.close()
 
@@ -524,10 +857,52 @@ class TestSimpleRPC(unittest2.TestCase):
         mock_create_connection.assert_called_once_with(('host', 'port'))
         mock_connection_class.assert_called_once_with('connection')
         self.assertEqual(rpc.conn, conn)
+        conn.send.assert_called_once_with('AUTH', 'authkey',
+                                          remote.PROTOCOL_VERSION)
+        self.assertFalse(conn.set_protocol.called)
+        self.assertFalse(mock_close.called)
+        self.assertFalse(mock_error.called)
+        self.assertFalse(mock_exception.called)
+
+    @mock.patch.object(socket, 'create_connection', return_value='connection')
+    @mock.patch.object(remote.SimpleRPC, 'connection_class',
+                       return_value=mock.Mock())
+    @mock.patch.object(remote.SimpleRPC, 'close')
+    @mock.patch.object(remote.LOG, 'error')
+    @mock.patch.object(remote.LOG, 'exception')
+    def test_connect_protocol(self, mock_exception, mock_error, mock_close,
+                              mock_connection_class, mock_create_connection):
+        conn = mock_connection_class.return_value
+        conn.recv.return_value = ('OK', [2])
+        rpc = remote.SimpleRPC('host', 'port', 'authkey')
+
+        rpc.connect()
+
+        self.assertEqual(rpc.conn, conn)
+        conn.send.assert_called_once_with('AUTH', 'authkey',
+                                          remote.PROTOCOL_VERSION)
+        conn.set_protocol.assert_called_once_with(2)
+        self.assertFalse(rpc.multiplexed)
         self.assertFalse(mock_close.called)
         self.assertFalse(mock_error.called)
         self.assertFalse(mock_exception.called)
 
+    @mock.patch.object(socket, 'create_connection', return_value='connection')
+    @mock.patch.object(remote.SimpleRPC, 'connection_class',
+                       return_value=mock.Mock())
+    @mock.patch.object(remote.SimpleRPC, 'close')
+    def test_connect_multiplexed(self, mock_close, mock_connection_class,
+                                 mock_create_connection):
+        conn = mock_connection_class.return_value
+        conn.recv.return_value = ('OK', [3])
+        rpc = remote.SimpleRPC('host', 'port', 'authkey')
+
+        rpc.connect()
+
+        conn.set_protocol.assert_called_once_with(3)
+        self.assertTrue(rpc.multiplexed)
+        self.assertFalse(mock_close.called)
+
     @mock.patch.object(socket, 'create_connection', return_value='connection')
     @mock.patch.object(remote.SimpleRPC, 'connection_class',
                        return_value=mock.Mock())
@@ -702,6 +1077,53 @@ class TestSimpleRPC(unittest2.TestCase):
             mock.call(rpc.serve, 'con:sock1', ('127.0.0.2', 4321)),
         ])
 
+    @mock.patch.object(remote.SimpleRPC, 'connection_class',
+                       side_effect=lambda x: 'con:%s' % x.fd)
+    @mock.patch.object(remote, '_create_unix_server', return_value=mock.Mock())
+    @mock.patch.object(remote.LOG, 'info')
+    @mock.patch.object(remote.LOG, 'exception')
+    @mock.patch('eventlet.spawn_n')
+    @mock.patch('os.unlink')
+    def test_listen_unix(self, mock_unlink, mock_spawn_n, mock_exception,
+                         mock_info, mock_create_unix_server,
+                         mock_connection_class):
+        serv = mock_create_unix_server.return_value
+        sock = mock.Mock(fd=5, **{'fileno.return_value': 5})
+        serv.accept.side_effect = [
+            (sock, ''),
+            test_utils.Halt,
+        ]
+        rpc = remote.SimpleRPC(None, None, 'authkey', path='/sock', mode=0660)
+
+        with utils.ignore_except():
+            rpc.listen()
+
+        mock_create_unix_server.assert_called_once_with('/sock', 0660)
+        mock_info.assert_called_once_with(
+            'Accepted connection from /sock port 5')
+        mock_spawn_n.assert_called_once_with(rpc.serve, 'con:5',
+                                             ('/sock', 5))
+        self.assertFalse(mock_unlink.called)
+
+    @mock.patch.object(socket, 'socket')
+    @mock.patch.object(socket, 'create_connection')
+    @mock.patch.object(remote.SimpleRPC, 'connection_class',
+                       return_value=mock.Mock())
+    def test_connect_unix(self, mock_connection_class,
+                          mock_create_connection, mock_socket):
+        conn = mock_connection_class.return_value
+        conn.recv.return_value = ('OK', [])
+        rpc = remote.SimpleRPC(None, None, 'authkey', path='/sock')
+
+        rpc.connect()
+
+        mock_socket.assert_called_once_with(socket.AF_UNIX,
+                                            socket.SOCK_STREAM)
+        mock_socket.return_value.connect.assert_called_once_with('/sock')
+        self.assertFalse(mock_create_connection.called)
+        mock_connection_class.assert_called_once_with(
+            mock_socket.return_value)
+
     @mock.patch.object(remote.SimpleRPC, 'connection_class',
                        side_effect=lambda x: 'con:%s' % x)
     @mock.patch.object(remote.SimpleRPC, 'max_err_thresh', 3)
@@ -971,6 +1393,69 @@ class TestSimpleRPC(unittest2.TestCase):
         ])
         self.assertEqual(len(mock_LOG.method_calls), 2)
 
+    @mock.patch.object(remote, 'LOG')
+    def test_serve_auth_protocol(self, mock_LOG):
+        conn = mock.Mock(**{
+            'recv.side_effect': [
+                ('AUTH', ['authkey', 5]),
+                remote.ConnectionClosed,
+            ],
+        })
+        rpc = remote.SimpleRPC('host', 'port', 'authkey')
+
+        rpc.serve(conn, ('127.0.0.1', 1234))
+
+        conn.assert_has_calls([
+            mock.call.recv(),
+            mock.call.send('OK', remote.PROTOCOL_VERSION),
+            mock.call.set_protocol(remote.PROTOCOL_VERSION),
+            mock.call.recv(),
+            mock.call.close(),
+        ])
+        self.assertEqual(len(conn.method_calls), 5)
+
+    @mock.patch.object(remote, 'LOG')
+    def test_serve_auth_protocol_limited(self, mock_LOG):
+        conn = mock.Mock(**{
+            'recv.side_effect': [
+                ('AUTH', ['authkey', 2]),
+                remote.ConnectionClosed,
+            ],
+        })
+        rpc = remote.SimpleRPC('host', 'port', 'authkey', protocol=1)
+
+        rpc.serve(conn, ('127.0.0.1', 1234))
+
+        conn.assert_has_calls([
+            mock.call.recv(),
+            mock.call.send('OK', 1),
+            mock.call.set_protocol(1),
+            mock.call.recv(),
+            mock.call.close(),
+        ])
+        self.assertEqual(len(conn.method_calls), 5)
+
+    @mock.patch.object(remote, 'LOG')
+    def test_serve_auth_protocol_bogus(self, mock_LOG):
+        conn = mock.Mock(**{
+            'recv.side_effect': [
+                ('AUTH', ['authkey', 'bogus']),
+                remote.ConnectionClosed,
+            ],
+        })
+        rpc = remote.SimpleRPC('host', 'port', 'authkey')
+
+        rpc.serve(conn, ('127.0.0.1', 1234))
+
+        conn.assert_has_calls([
+            mock.call.recv(),
+            mock.call.send('OK', 1),
+            mock.call.set_protocol(1),
+            mock.call.recv(),
+            mock.call.close(),
+        ])
+        self.assertEqual(len(conn.method_calls), 5)
+
     @mock.patch.object(remote, 'LOG')
     def test_serve_ping_unauthed(self, mock_LOG):
         conn = mock.Mock(**{
@@ -1168,43 +1653,371 @@ class TestSimpleRPC(unittest2.TestCase):
         self.assertEqual(len(mock_LOG.method_calls), 2)
         method.assert_called_once_with(1, 2, 3, a=4)
 
+    @mock.patch.object(remote, 'LOG')
+    @mock.patch('eventlet.spawn_n')
+    def test_serve_mcall(self, mock_spawn_n, mock_LOG):
+        conn = mock.Mock(protocol=3, **{
+            'recv.side_effect': [
+                ('MCALL', [5, 'funcname', (1, 2, 3), dict(a=4)]),
+                ('MCALL', [6, 'funcname']),
+                remote.ConnectionClosed,
+            ],
+        })
+        rpc = remote.SimpleRPC('host', 'port', 'authkey')
 
-class TestControlDaemon(unittest2.TestCase):
-    def test_init(self):
-        cd_rpc = remote.ControlDaemonRPC('host', 'port', 'authkey', 'daemon')
+        rpc.serve(conn, ('127.0.0.1', 1234), True)
 
-        self.assertEqual(cd_rpc.daemon, 'daemon')
+        mock_spawn_n.assert_called_once_with(
+            rpc._serve_mcall, conn, ('127.0.0.1', 1234), 5, 'funcname',
+            (1, 2, 3), dict(a=4))
+        conn.assert_has_calls([
+            mock.call.recv(),
+            mock.call.recv(),
+            mock.call.send('ERR', "Invalid payload for 'MCALL' command: "
+                           "need more than 2 values to unpack"),
+            mock.call.recv(),
+            mock.call.close(),
+        ])
 
-    def test_get_limits(self):
-        daemon = mock.Mock(limits=mock.Mock(**{
-            'get_limits.return_value': 'limits',
-        }))
-        cd_rpc = remote.ControlDaemonRPC('host', 'port', 'authkey', daemon)
-        cd_rpc.mode = 'server'
+    @mock.patch.object(remote, 'LOG')
+    @mock.patch('eventlet.spawn_n')
+    def test_serve_mcall_unsupported(self, mock_spawn_n, mock_LOG):
+        conn = mock.Mock(protocol=2, **{
+            'recv.side_effect': [
+                ('MCALL', [5, 'funcname', (1, 2, 3), dict(a=4)]),
+                remote.ConnectionClosed,
+            ],
+        })
+        rpc = remote.SimpleRPC('host', 'port', 'authkey')
 
-        result = cd_rpc.get_limits('sum')
+        rpc.serve(conn, ('127.0.0.1', 1234), True)
 
-        self.assertEqual(result, 'limits')
-        daemon.limits.get_limits.assert_called_once_with('sum')
+        self.assertFalse(mock_spawn_n.called)
+        conn.send.assert_called_once_with('ERR',
+                                          "Unrecognized command 'MCALL'")
 
+    @mock.patch.object(remote.SimpleRPC, '_get_remote_method',
+                       return_value=mock.Mock(return_value='result'))
+    def test_serve_mcall_result(self, mock_get_remote_method):
+        conn = mock.Mock()
+        rpc = remote.SimpleRPC('host', 'port', 'authkey')
 
-class TestRemoteLimitData(unittest2.TestCase):
-    def test_init(self):
-        rld = remote.RemoteLimitData('rpc')
+        rpc._serve_mcall(conn, ('127.0.0.1', 1234), 5, 'funcname',
+                         (1, 2, 3), dict(a=4))
 
-        self.assertEqual(rld.limit_rpc, 'rpc')
-        self.assertIsInstance(rld.limit_lock, eventlet.semaphore.Semaphore)
+        mock_get_remote_method.assert_called_once_with('funcname')
+        mock_get_remote_method.return_value.assert_called_once_with(
+            1, 2, 3, a=4)
+        conn.send.assert_called_once_with('MRES', 5, 'result')
 
-    def test_set_limits(self):
-        rld = remote.RemoteLimitData('rpc')
+    @mock.patch.object(remote.SimpleRPC, '_get_remote_method',
+                       return_value=mock.Mock(
+                           side_effect=test_utils.TestException('spam')))
+    def test_serve_mcall_exception(self, mock_get_remote_method):
+        conn = mock.Mock()
+        rpc = remote.SimpleRPC('host', 'port', 'authkey')
 
-        self.assertRaises(ValueError, rld.set_limits, 'limits')
+        rpc._serve_mcall(conn, ('127.0.0.1', 1234), 5, 'funcname', (), {})
 
-    @mock.patch.object(eventlet.semaphore, 'Semaphore',
-                       return_value=mock.MagicMock())
-    def test_get_limits_newlimits(self, mock_Semaphore):
-        rpc = mock.Mock(**{
-            'get_limits.return_value': 'new limits',
+        conn.send.assert_called_once_with(
+            'MEXC', 5, 'tests.unit.utils:TestException', 'spam')
+
+    @mock.patch.object(remote, 'LOG')
+    @mock.patch.object(remote.SimpleRPC, '_get_remote_method',
+                       return_value=mock.Mock(return_value='result'))
+    def test_serve_mcall_closed(self, mock_get_remote_method, mock_LOG):
+        conn = mock.Mock(**{'send.side_effect': remote.ConnectionClosed})
+        rpc = remote.SimpleRPC('host', 'port', 'authkey')
+
+        rpc._serve_mcall(conn, ('127.0.0.1', 1234), 5, 'funcname', (), {})
+
+        self.assertFalse(mock_LOG.exception.called)
+
+
+class SlowRPC(remote.SimpleRPC):
+    @remote.remote
+    def wait(self, delay, value):
+        eventlet.sleep(delay)
+        if value == 'raise':
+            raise test_utils.TestException('raised')
+        return value
+
+
+class TestMultiplexedCalls(unittest2.TestCase):
+    def setUp(self):
+        client_sock, server_sock = green_socket.socketpair()
+
+        self.server = SlowRPC(None, None, 'authkey')
+        self.server.mode = 'server'
+        self.server_thread = eventlet.spawn(
+            self.server.serve, remote.Connection(server_sock),
+            ('test', 0))
+
+        self.client = SlowRPC(None, None, 'authkey')
+        self.client.mode = 'client'
+        self.client.conn = remote.Connection(client_sock)
+        self.client.conn.send('AUTH', 'authkey', remote.PROTOCOL_VERSION)
+        self.assertEqual(self.client.conn.recv(), ('OK', [3]))
+        self.client.conn.set_protocol(3)
+        self.client.multiplexed = True
+
+    def tearDown(self):
+        self.client.close()
+        self.server_thread.kill()
+
+    def test_concurrent(self):
+        results = []
+
+        def call(delay, value):
+            results.append(self.client.wait(delay, value))
+
+        threads = [eventlet.spawn(call, 0.05, 'slow'),
+                   eventlet.spawn(call, 0.01, 'medium'),
+                   eventlet.spawn(call, 0.0, 'fast')]
+        for thread in threads:
+            thread.wait()
+
+        self.assertEqual(results, ['fast', 'medium', 'slow'])
+        self.assertEqual(self.client._pending, {})
+
+    def test_exception(self):
+        self.assertRaises(test_utils.TestException, self.client.wait,
+                          0.0, 'raise')
+        self.assertEqual(self.client.wait(0.0, 'value'), 'value')
+
+    def test_connection_lost(self):
+        outcomes = []
+
+        # Catch the exceptions in the greenthreads, so that eventlet
+        # doesn't report them as unhandled
+        def call():
+            try:
+                outcomes.append(self.client.wait(0.05, 'value'))
+            except Exception as exc:
+                outcomes.append(exc)
+
+        threads = [eventlet.spawn(call), eventlet.spawn(call)]
+        eventlet.sleep(0.01)
+        self.server_thread.kill()
+
+        for thread in threads:
+            thread.wait()
+        self.assertEqual(len(outcomes), 2)
+        for outcome in outcomes:
+            self.assertIsInstance(outcome, remote.ConnectionClosed)
+        self.assertEqual(self.client.conn, None)
+        self.assertFalse(self.client.multiplexed)
+
+    def test_unknown_id(self):
+        conn = mock.Mock(**{'recv.return_value': ('MRES', [42, 'result'])})
+        responses = eventlet.queue.LightQueue()
+        self.client._pending[1] = responses
+
+        self.client._recv_response(conn)
+
+        self.assertTrue(responses.empty())
+        self.assertFalse(conn.close.called)
+
+    def test_note(self):
+        conn = mock.Mock(**{'recv.return_value': ('NOTE', ['sum'])})
+        responses = eventlet.queue.LightQueue()
+        self.client._pending[1] = responses
+
+        self.client._recv_response(conn)
+
+        self.assertTrue(responses.empty())
+        self.assertEqual(list(self.client._notes), [['sum']])
+        self.assertFalse(conn.close.called)
+
+    def test_err(self):
+        conn = mock.Mock(**{'recv.return_value': ('ERR', ['oops'])})
+        self.client.conn.close()
+        self.client.conn = conn
+        self.client._reader = 1
+        responses = eventlet.queue.LightQueue()
+        self.client._pending[1] = responses
+
+        self.client._recv_response(conn)
+
+        exc = responses.get()
+        self.assertEqual(str(exc), "Catastrophic error from server: oops")
+        conn.close.assert_called_once_with()
+        self.assertEqual(self.client.conn, None)
+        self.assertEqual(self.client._reader, None)
+
+    def test_invalid(self):
+        conn = mock.Mock(**{'recv.return_value': ('BOGUS', [])})
+        other = self.client.conn
+        responses = eventlet.queue.LightQueue()
+        self.client._pending[1] = responses
+
+        self.client._recv_response(conn)
+
+        exc = responses.get()
+        self.assertEqual(str(exc), "Invalid command response from server: "
+                         "BOGUS")
+        conn.close.assert_called_once_with()
+        self.assertEqual(self.client.conn, other)
+
+
+class TestControlDaemon(unittest2.TestCase):
+    def test_init(self):
+        cd_rpc = remote.ControlDaemonRPC('host', 'port', 'authkey', 'daemon')
+
+        self.assertEqual(cd_rpc.daemon, 'daemon')
+        self.assertEqual(cd_rpc.subscribers, set())
+
+    def test_subscribe(self):
+        daemon = mock.Mock(limits=mock.Mock(limit_sum='sum'))
+        cd_rpc = remote.ControlDaemonRPC('host', 'port', 'authkey', daemon)
+        cd_rpc.mode = 'server'
+        cd_rpc.local.conn = 'conn'
+
+        result = cd_rpc.subscribe()
+
+        self.assertEqual(result, 'sum')
+        self.assertEqual(cd_rpc.subscribers, set(['conn']))
+
+    def test_notify(self):
+        conns = [
+            mock.Mock(),
+            mock.Mock(**{'send.side_effect': remote.ConnectionClosed}),
+            mock.Mock(),
+        ]
+        cd_rpc = remote.ControlDaemonRPC('host', 'port', 'authkey', 'daemon')
+        cd_rpc.subscribers = set(conns)
+
+        cd_rpc.notify('sum')
+
+        for conn in conns:
+            conn.send.assert_called_once_with('NOTE', 'sum')
+        self.assertEqual(cd_rpc.subscribers, set([conns[0], conns[2]]))
+
+    def test_subscribe_roundtrip(self):
+        client_sock, server_sock = green_socket.socketpair()
+        daemon = mock.Mock(limits=mock.Mock(limit_sum='sum1'))
+        server = remote.ControlDaemonRPC(None, None, 'authkey', daemon)
+        server.mode = 'server'
+        server_thread = eventlet.spawn(
+            server.serve, remote.Connection(server_sock), ('test', 0), True)
+        client = remote.ControlDaemonRPC(None, None, 'authkey', None)
+        client.mode = 'client'
+        client.conn = remote.Connection(client_sock)
+
+        try:
+            self.assertEqual(client.subscribe(), 'sum1')
+            self.assertEqual(client.notifications(), [])
+
+            server.notify('sum2')
+            server.notify('sum3')
+            eventlet.sleep(0.01)
+
+            self.assertEqual(client.notifications(), [['sum2'], ['sum3']])
+        finally:
+            client.close()
+            server_thread.kill()
+
+    def check_note_before_response(self, protocol):
+        client_sock, server_sock = green_socket.socketpair()
+        server = remote.ControlDaemonRPC(None, None, 'authkey', None)
+        server.mode = 'server'
+
+        # The limits change after the subscription is registered,
+        # but before the response is sent
+        class Limits(object):
+            @property
+            def limit_sum(self):
+                server.notify('sum2')
+                return 'sum2'
+        server.daemon = mock.Mock(limits=Limits())
+
+        server_thread = eventlet.spawn(
+            server.serve, remote.Connection(server_sock, protocol),
+            ('test', 0), True)
+        client = remote.ControlDaemonRPC(None, None, 'authkey', None)
+        client.mode = 'client'
+        client.conn = remote.Connection(client_sock, protocol)
+        client.multiplexed = protocol >= 3
+
+        try:
+            self.assertEqual(client.subscribe(), 'sum2')
+            self.assertNotEqual(client.conn, None)
+            self.assertEqual(client.notifications(), [['sum2']])
+            self.assertEqual(len(server.subscribers), 1)
+        finally:
+            client.close()
+            server_thread.kill()
+
+    def test_note_before_response(self):
+        self.check_note_before_response(1)
+
+    def test_note_before_response_multiplexed(self):
+        self.check_note_before_response(3)
+
+    def test_get_limits(self):
+        daemon = mock.Mock(limits=mock.Mock(**{
+            'get_limits.return_value': 'limits',
+        }))
+        cd_rpc = remote.ControlDaemonRPC('host', 'port', 'authkey', daemon)
+        cd_rpc.mode = 'server'
+
+        result = cd_rpc.get_limits('sum')
+
+        self.assertEqual(result, 'limits')
+        daemon.limits.get_limits.assert_called_once_with('sum')
+
+    def test_get_changes(self):
+        daemon = mock.Mock(limits=mock.Mock(**{
+            'get_changes.return_value': 'changes',
+        }))
+        cd_rpc = remote.ControlDaemonRPC('host', 'port', 'authkey', daemon)
+        cd_rpc.mode = 'server'
+
+        result = cd_rpc.get_changes('sum')
+
+        self.assertEqual(result, 'changes')
+        daemon.limits.get_changes.assert_called_once_with('sum')
+
+    def test_execute_commands(self):
+        daemon = mock.Mock(remote_proxy=True, **{
+            'get_bucket_proxy.return_value.execute.return_value': 'results',
+        })
+        cd_rpc = remote.ControlDaemonRPC('host', 'port', 'authkey', daemon)
+        cd_rpc.mode = 'server'
+
+        result = cd_rpc.execute_commands('commands', True)
+
+        self.assertEqual(result, 'results')
+        daemon.get_bucket_proxy.return_value.execute.assert_called_once_with(
+            'commands', True)
+
+    def test_execute_commands_disabled(self):
+        daemon = mock.Mock(remote_proxy=False)
+        cd_rpc = remote.ControlDaemonRPC('host', 'port', 'authkey', daemon)
+        cd_rpc.mode = 'server'
+
+        self.assertRaises(ValueError, cd_rpc.execute_commands,
+                          [('flushall', (), {})])
+        self.assertFalse(daemon.get_bucket_proxy.called)
+
+
+class TestRemoteLimitData(unittest2.TestCase):
+    def test_init(self):
+        rld = remote.RemoteLimitData('rpc')
+
+        self.assertEqual(rld.limit_rpc, 'rpc')
+        self.assertIsInstance(rld.limit_lock, eventlet.semaphore.Semaphore)
+
+    def test_set_limits(self):
+        rld = remote.RemoteLimitData('rpc')
+
+        self.assertRaises(ValueError, rld.set_limits, 'limits')
+
+    @mock.patch.object(eventlet.semaphore, 'Semaphore',
+                       return_value=mock.MagicMock())
+    def test_get_limits_newlimits(self, mock_Semaphore):
+        rpc = mock.Mock(multiplexed=False, **{
+            'get_limits.return_value': 'new limits',
         })
         rld = remote.RemoteLimitData(rpc)
 
@@ -1220,7 +2033,7 @@ class TestRemoteLimitData(unittest2.TestCase):
     @mock.patch.object(eventlet.semaphore, 'Semaphore',
                        return_value=mock.MagicMock())
     def test_get_limits_nochange(self, mock_Semaphore):
-        rpc = mock.Mock(**{
+        rpc = mock.Mock(multiplexed=False, **{
             'get_limits.side_effect': control.NoChangeException,
         })
         rld = remote.RemoteLimitData(rpc)
@@ -1236,7 +2049,7 @@ class TestRemoteLimitData(unittest2.TestCase):
     @mock.patch.object(eventlet.semaphore, 'Semaphore',
                        return_value=mock.MagicMock())
     def test_get_limits_exception(self, mock_Semaphore):
-        rpc = mock.Mock(**{
+        rpc = mock.Mock(multiplexed=False, **{
             'get_limits.side_effect': test_utils.TestException,
         })
         rld = remote.RemoteLimitData(rpc)
@@ -1245,10 +2058,693 @@ class TestRemoteLimitData(unittest2.TestCase):
 
         mock_Semaphore.return_value.assert_has_calls([
             mock.call.__enter__(),
-            mock.call.__exit__(control.NoChangeException, mock.ANY, mock.ANY),
+            mock.call.__exit__(test_utils.TestException, mock.ANY,
+                               mock.ANY),
         ])
         rpc.get_limits.assert_called_once_with('sum')
 
+    @mock.patch.object(eventlet.semaphore, 'Semaphore',
+                       return_value=mock.MagicMock())
+    def test_get_limits_multiplexed(self, mock_Semaphore):
+        rpc = mock.Mock(multiplexed=True, **{
+            'get_limits.return_value': 'new limits',
+        })
+        rld = remote.RemoteLimitData(rpc)
+
+        result = rld.get_limits('sum')
+
+        self.assertEqual(result, 'new limits')
+        self.assertFalse(mock_Semaphore.return_value.__enter__.called)
+        rpc.get_limits.assert_called_once_with('sum')
+
+    def test_get_limits_pool(self):
+        rpcs = [mock.Mock(multiplexed=True, **{
+            'get_limits.return_value': 'limits%d' % i,
+        }) for i in range(3)]
+        rld = remote.RemoteLimitData(rpcs[0], rpcs[1:])
+
+        result = [rld.get_limits('sum') for _i in range(4)]
+
+        self.assertEqual(result, ['limits0', 'limits1', 'limits2',
+                                  'limits0'])
+
+    def test_get_changes_subscribed(self):
+        rpc = mock.Mock()
+        subscription = mock.Mock(**{
+            'subscribe.return_value': 'sum1',
+            'notifications.side_effect': [[], [['sum2']]],
+        })
+        rld = remote.RemoteLimitData(rpc, subscription=subscription)
+
+        # Subscribes, then knows the limits haven't changed
+        self.assertRaises(control.NoChangeException, rld.get_changes, 'sum1')
+        self.assertTrue(rld.subscribed)
+        self.assertEqual(rld.remote_sum, 'sum1')
+
+        # No notifications, so no change
+        self.assertRaises(control.NoChangeException, rld.get_changes, 'sum1')
+
+        # Notified of a change, so ask for the changes
+        result = rld.get_changes('sum1')
+
+        self.assertEqual(result, rpc.get_changes.return_value)
+        self.assertEqual(rld.remote_sum, 'sum2')
+        subscription.subscribe.assert_called_once_with()
+        rpc.get_changes.assert_called_once_with('sum1')
+
+    def test_get_changes_subscribed_nosum(self):
+        rpc = mock.Mock()
+        subscription = mock.Mock()
+        rld = remote.RemoteLimitData(rpc, subscription=subscription)
+
+        result = rld.get_changes()
+
+        self.assertEqual(result, rpc.get_changes.return_value)
+        self.assertFalse(subscription.subscribe.called)
+
+    @mock.patch.object(remote, 'LOG')
+    @mock.patch('time.time', return_value=1000000.0)
+    def test_get_changes_subscribe_failed(self, mock_time, mock_LOG):
+        rpc = mock.Mock()
+        subscription = mock.Mock(**{
+            'subscribe.side_effect': test_utils.TestException('failed'),
+        })
+        rld = remote.RemoteLimitData(rpc, subscription=subscription)
+
+        result = rld.get_changes('sum')
+
+        self.assertEqual(result, rpc.get_changes.return_value)
+        self.assertFalse(rld.subscribed)
+        self.assertEqual(rld.subscribe_retry,
+                         1000000.0 + rld.resubscribe_delay)
+        subscription.close.assert_called_once_with()
+        mock_LOG.warning.assert_called_once_with(
+            "Lost subscription to limit changes: failed")
+
+        # Doesn't try again until the delay has passed
+        rld.get_changes('sum')
+        self.assertEqual(subscription.subscribe.call_count, 1)
+
+        mock_time.return_value += rld.resubscribe_delay
+        rld.get_changes('sum')
+        self.assertEqual(subscription.subscribe.call_count, 2)
+
+    @mock.patch.object(remote, 'LOG')
+    def test_get_changes_notifications_failed(self, mock_LOG):
+        rpc = mock.Mock()
+        subscription = mock.Mock(**{
+            'notifications.side_effect': remote.ConnectionClosed('closed'),
+        })
+        rld = remote.RemoteLimitData(rpc, subscription=subscription)
+        rld.subscribed = True
+        rld.remote_sum = 'sum'
+
+        result = rld.get_changes('sum')
+
+        self.assertEqual(result, rpc.get_changes.return_value)
+        self.assertFalse(rld.subscribed)
+        self.assertEqual(rld.remote_sum, None)
+
+    def test_close(self):
+        rpcs = [mock.Mock(), mock.Mock()]
+        subscription = mock.Mock()
+        rld = remote.RemoteLimitData(rpcs[0], rpcs[1:], subscription)
+        rld.subscribed = True
+        rld.remote_sum = 'sum'
+
+        rld.close()
+
+        for rpc in rpcs + [subscription]:
+            rpc.close.assert_called_once_with()
+        self.assertFalse(rld.subscribed)
+        self.assertEqual(rld.remote_sum, None)
+
+    def test_get_changes(self):
+        rpc = mock.Mock(**{
+            'get_changes.return_value': 'changes',
+        })
+        rld = remote.RemoteLimitData(rpc)
+
+        result = rld.get_changes('sum')
+
+        self.assertEqual(result, 'changes')
+        rpc.get_changes.assert_called_once_with('sum')
+
+    def test_get_changes_nochange(self):
+        rpc = mock.Mock(**{
+            'get_changes.side_effect': control.NoChangeException,
+        })
+        rld = remote.RemoteLimitData(rpc)
+
+        self.assertRaises(control.NoChangeException, rld.get_changes, 'sum')
+        rpc.get_changes.assert_called_once_with('sum')
+
+    def test_get_changes_exception(self):
+        rpc = mock.Mock(**{
+            'get_changes.side_effect': test_utils.TestException,
+        })
+        rld = remote.RemoteLimitData(rpc)
+
+        self.assertRaises(control.NoChangeException, rld.get_changes, 'sum')
+        rpc.get_changes.assert_called_once_with('sum')
+
+
+class SnapshotTestCase(unittest2.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'snapshot')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def read_header(self):
+        with open(self.path, 'rb') as f:
+            return remote._SNAPSHOT_HEADER.unpack(f.read())
+
+
+class TestLimitSnapshot(SnapshotTestCase):
+    def test_init(self):
+        snap = remote.LimitSnapshot(self.path)
+
+        self.assertEqual(snap.path, self.path)
+        self.assertEqual(snap.limit_sum, None)
+        self.assertEqual(snap.generation, 0)
+        self.assertEqual(self.read_header(), ('TSLS', 0))
+        self.assertFalse(os.path.exists(self.path + '.data'))
+
+    def test_init_existing(self):
+        with open(self.path, 'wb') as f:
+            f.write(remote._SNAPSHOT_HEADER.pack('TSLS', 5))
+
+        snap = remote.LimitSnapshot(self.path)
+
+        self.assertEqual(snap.generation, 5)
+
+    def test_init_invalid(self):
+        with open(self.path, 'wb') as f:
+            f.write('garbage')
+
+        snap = remote.LimitSnapshot(self.path)
+
+        self.assertEqual(snap.generation, 0)
+        self.assertEqual(self.read_header(), ('TSLS', 0))
+
+    def test_publish(self):
+        snap = remote.LimitSnapshot(self.path)
+
+        snap.publish('sum', [{'uuid': 'limit1'}])
+
+        self.assertEqual(snap.limit_sum, 'sum')
+        self.assertEqual(snap.generation, 1)
+        self.assertEqual(self.read_header(), ('TSLS', 1))
+        with open(self.path + '.data', 'rb') as f:
+            self.assertEqual(msgpack.loads(f.read()), {
+                'generation': 1,
+                'limit_sum': 'sum',
+                'limits': [{'uuid': 'limit1'}],
+            })
+        self.assertEqual(sorted(os.listdir(self.tmpdir)),
+                         ['snapshot', 'snapshot.data'])
+
+    def test_publish_unchanged(self):
+        snap = remote.LimitSnapshot(self.path)
+        snap.publish('sum', [{'uuid': 'limit1'}])
+
+        snap.publish('sum', [{'uuid': 'limit1'}])
+
+        self.assertEqual(snap.generation, 1)
+
+
+class TestSnapshotLimitData(SnapshotTestCase):
+    def test_init(self):
+        ld = remote.SnapshotLimitData(self.path)
+
+        self.assertEqual(ld.path, self.path)
+        self.assertEqual(ld.header, None)
+        self.assertEqual(ld.generation, None)
+        self.assertEqual(ld.limit_sum, None)
+        self.assertEqual(ld.limit_data, [])
+
+    def test_set_limits(self):
+        ld = remote.SnapshotLimitData(self.path)
+
+        self.assertRaises(ValueError, ld.set_limits, 'limits')
+
+    @mock.patch.object(remote.LOG, 'exception')
+    def test_get_limits_unpublished(self, mock_exception):
+        ld = remote.SnapshotLimitData(self.path)
+
+        self.assertRaises(control.NoChangeException, ld.get_limits)
+        self.assertFalse(mock_exception.called)
+
+    def test_get_limits(self):
+        snap = remote.LimitSnapshot(self.path)
+        snap.publish('sum', [{'uuid': 'limit1'}])
+        ld = remote.SnapshotLimitData(self.path)
+
+        result = ld.get_limits('old_sum')
+
+        self.assertEqual(result, ('sum', [{'uuid': 'limit1'}]))
+        self.assertEqual(ld.generation, 1)
+
+    def test_get_limits_nochange(self):
+        snap = remote.LimitSnapshot(self.path)
+        snap.publish('sum', [{'uuid': 'limit1'}])
+        ld = remote.SnapshotLimitData(self.path)
+
+        self.assertRaises(control.NoChangeException, ld.get_limits, 'sum')
+
+    def test_get_limits_generation(self):
+        snap = remote.LimitSnapshot(self.path)
+        snap.publish('sum1', [{'uuid': 'limit1'}])
+        ld = remote.SnapshotLimitData(self.path)
+        ld.get_limits()
+
+        # The data is only loaded when the generation changes
+        with mock.patch.object(msgpack, 'loads') as mock_loads:
+            self.assertEqual(ld.get_limits(), ('sum1', [{'uuid': 'limit1'}]))
+            self.assertFalse(mock_loads.called)
+
+        snap.publish('sum2', [{'uuid': 'limit2'}])
+
+        self.assertEqual(ld.get_limits('sum1'),
+                         ('sum2', [{'uuid': 'limit2'}]))
+        self.assertEqual(ld.generation, 2)
+
+    @mock.patch.object(remote.LOG, 'exception')
+    def test_get_limits_error(self, mock_exception):
+        snap = remote.LimitSnapshot(self.path)
+        snap.publish('sum1', [{'uuid': 'limit1'}])
+        ld = remote.SnapshotLimitData(self.path)
+        ld.get_limits()
+        snap.publish('sum2', [{'uuid': 'limit2'}])
+        os.unlink(self.path + '.data')
+
+        self.assertRaises(control.NoChangeException, ld.get_limits, 'sum1')
+        mock_exception.assert_called_once_with(
+            "Could not load limit snapshot %r" % self.path)
+        self.assertEqual(ld.limit_sum, 'sum1')
+        self.assertEqual(ld.generation, 1)
+
+    def test_get_changes(self):
+        snap = remote.LimitSnapshot(self.path)
+        snap.publish('sum', [{'uuid': 'limit1'}])
+        ld = remote.SnapshotLimitData(self.path)
+
+        self.assertEqual(ld.get_changes('old_sum'), ('sum', None))
+        self.assertRaises(control.NoChangeException, ld.get_changes, 'sum')
+
+
+class TestBucketProxy(unittest2.TestCase):
+    def make_proxy(self, results=None):
+        pipes = []
+
+        def pipeline(transaction=True):
+            pipe = mock.Mock(transaction=transaction, commands=[])
+
+            def command(name):
+                return lambda *args, **kwargs: pipe.commands.append(
+                    (name, args, kwargs))
+            pipe.expire.side_effect = command('expire')
+            pipe.lrange.side_effect = command('lrange')
+            pipe.rpush.side_effect = command('rpush')
+            if results is not None:
+                pipe.execute.side_effect = lambda **kw: results.pop()
+            else:
+                pipe.execute.side_effect = lambda **kw: [
+                    '%s:%s' % (name, args[0])
+                    for name, args, kwargs in pipe.commands]
+            pipes.append(pipe)
+            return pipe
+
+        daemon = mock.Mock(**{'db.pipeline.side_effect': pipeline})
+        return remote.BucketProxy(daemon), pipes
+
+    def execute(self, proxy, commands):
+        # Return exceptions rather than raising them, so that eventlet
+        # doesn't report them as unhandled
+        try:
+            return proxy.execute(commands)
+        except Exception as exc:
+            return exc
+
+    def test_init(self):
+        proxy = remote.BucketProxy('daemon')
+
+        self.assertEqual(proxy.daemon, 'daemon')
+        self.assertEqual(proxy.queue, [])
+        self.assertEqual(proxy.flushing, False)
+
+    def test_execute_invalid(self):
+        proxy, pipes = self.make_proxy()
+
+        for name in ('_private', 'pipeline', 'execute', 'watch',
+                     'flushall', 'config_set', 'delete', 'shutdown'):
+            self.assertRaises(ValueError, proxy.execute,
+                              [('expire', ('key', 60), {}),
+                               (name, (), {})])
+        self.assertEqual(pipes, [])
+
+    def test_execute(self):
+        proxy, pipes = self.make_proxy()
+
+        result = proxy.execute([
+            ('expire', ('key', 60), {}),
+            ('lrange', ('key', 0, -1), {}),
+        ])
+
+        self.assertEqual(result, ['expire:key', 'lrange:key'])
+        self.assertEqual(len(pipes), 1)
+        self.assertEqual(pipes[0].transaction, False)
+        self.assertEqual(pipes[0].commands, [
+            ('expire', ('key', 60), {}),
+            ('lrange', ('key', 0, -1), {}),
+        ])
+        pipes[0].execute.assert_called_once_with(raise_on_error=False)
+        self.assertEqual(proxy.queue, [])
+        self.assertEqual(proxy.flushing, False)
+
+    def test_execute_transaction(self):
+        proxy, pipes = self.make_proxy()
+
+        result = proxy.execute([('rpush', ('key', 'value'), {})], True)
+
+        self.assertEqual(result, ['rpush:key'])
+        self.assertEqual(len(pipes), 1)
+        self.assertEqual(pipes[0].transaction, True)
+        pipes[0].execute.assert_called_once_with()
+
+    def test_execute_merged(self):
+        proxy, pipes = self.make_proxy()
+
+        threads = [eventlet.spawn(proxy.execute,
+                                  [('expire', ('key%d' % i, 60), {}),
+                                   ('lrange', ('key%d' % i, 0, -1), {})])
+                   for i in range(3)]
+        results = [thread.wait() for thread in threads]
+
+        self.assertEqual(results, [
+            ['expire:key%d' % i, 'lrange:key%d' % i] for i in range(3)
+        ])
+        self.assertEqual(len(pipes), 1)
+        self.assertEqual(len(pipes[0].commands), 6)
+
+    def test_execute_error(self):
+        proxy, pipes = self.make_proxy([
+            [1, test_utils.TestException('bad'), 'ok:key2'],
+        ])
+
+        threads = [
+            eventlet.spawn(self.execute, proxy,
+                           [('expire', ('key1', 60), {}),
+                            ('rpush', ('key1', 'v'), {})]),
+            eventlet.spawn(self.execute, proxy,
+                           [('lrange', ('key2', 0, -1), {})]),
+        ]
+
+        self.assertIsInstance(threads[0].wait(), test_utils.TestException)
+        self.assertEqual(threads[1].wait(), ['ok:key2'])
+        self.assertEqual(len(pipes), 1)
+
+    def test_execute_failure(self):
+        proxy, pipes = self.make_proxy([])
+
+        threads = [eventlet.spawn(self.execute, proxy,
+                                  [('expire', ('key%d' % i, 60), {})])
+                   for i in range(2)]
+
+        for thread in threads:
+            self.assertIsInstance(thread.wait(), IndexError)
+        self.assertEqual(proxy.flushing, False)
+
+
+class TestProxyPipeline(unittest2.TestCase):
+    def test_init(self):
+        pipe = remote.ProxyPipeline('db', False)
+
+        self.assertEqual(pipe.db, 'db')
+        self.assertEqual(pipe.transaction, False)
+        self.assertEqual(pipe.command_stack, [])
+
+    def test_context_manager(self):
+        pipe = remote.ProxyPipeline('db')
+
+        with pipe as result:
+            pipe.expire('key', 60)
+            self.assertEqual(len(pipe), 1)
+
+        self.assertEqual(result, pipe)
+        self.assertEqual(pipe.command_stack, [])
+
+    def test_getattr(self):
+        pipe = remote.ProxyPipeline('db')
+
+        result = pipe.expire('key', 60).zadd('set', 1, 'key', extra=True)
+
+        self.assertEqual(result, pipe)
+        self.assertEqual(pipe.command_stack, [
+            ('expire', ('key', 60), {}),
+            ('zadd', ('set', 1, 'key'), {'extra': True}),
+        ])
+
+    def test_getattr_excluded(self):
+        pipe = remote.ProxyPipeline('db')
+
+        self.assertRaises(AttributeError, getattr, pipe, '_private')
+        self.assertRaises(AttributeError, getattr, pipe, 'watch')
+        self.assertRaises(AttributeError, getattr, pipe, 'flushall')
+
+    def test_execute(self):
+        db = mock.Mock(**{'execute_commands.return_value': 'results'})
+        pipe = remote.ProxyPipeline(db, False)
+        pipe.expire('key', 60)
+
+        result = pipe.execute()
+
+        self.assertEqual(result, 'results')
+        db.execute_commands.assert_called_once_with(
+            [('expire', ('key', 60), {})], False)
+        self.assertEqual(pipe.command_stack, [])
+
+    def test_execute_empty(self):
+        db = mock.Mock()
+        pipe = remote.ProxyPipeline(db)
+
+        self.assertEqual(pipe.execute(), [])
+        self.assertFalse(db.execute_commands.called)
+
+    def test_execute_error(self):
+        db = mock.Mock(**{
+            'execute_commands.side_effect': test_utils.TestException,
+        })
+        pipe = remote.ProxyPipeline(db)
+        pipe.expire('key', 60)
+
+        self.assertRaises(test_utils.TestException, pipe.execute)
+        self.assertEqual(pipe.command_stack, [])
+
+
+class TestProxyDatabase(unittest2.TestCase):
+    def make_rpc(self, multiplexed=False, protocol=3):
+        return mock.Mock(multiplexed=multiplexed,
+                         conn=mock.Mock(protocol=protocol), **{
+                             'execute_commands.return_value': ['result'],
+                         })
+
+    def make_fallback(self):
+        return mock.Mock(**{
+            'pipeline.return_value.execute.return_value': ['direct'],
+        })
+
+    def test_init(self):
+        db = remote.ProxyDatabase('rpc0', ['rpc1', 'rpc2'])
+
+        self.assertEqual(db.proxy_rpcs, ['rpc0', 'rpc1', 'rpc2'])
+        self.assertEqual(db.fallback, None)
+        self.assertEqual(db.proxy_retry, 0.0)
+
+    def test_init_fallback(self):
+        db = remote.ProxyDatabase('rpc0', fallback='db')
+
+        self.assertEqual(db.proxy_rpcs, ['rpc0'])
+        self.assertEqual(db.fallback, 'db')
+
+    def test_getattr(self):
+        rpc = self.make_rpc()
+        db = remote.ProxyDatabase(rpc)
+
+        result = db.get('key')
+
+        self.assertEqual(result, 'result')
+        rpc.execute_commands.assert_called_once_with(
+            [('get', ('key',), {})], False)
+
+    def test_getattr_excluded(self):
+        db = remote.ProxyDatabase('rpc')
+
+        self.assertRaises(AttributeError, getattr, db, '_private')
+        self.assertRaises(AttributeError, getattr, db, 'pubsub')
+        self.assertRaises(AttributeError, getattr, db, 'flushall')
+
+    def test_pipeline(self):
+        db = remote.ProxyDatabase('rpc')
+
+        pipe = db.pipeline(transaction=False)
+
+        self.assertIsInstance(pipe, remote.ProxyPipeline)
+        self.assertEqual(pipe.db, db)
+        self.assertEqual(pipe.transaction, False)
+
+    @mock.patch.object(eventlet.semaphore, 'Semaphore',
+                       side_effect=lambda: mock.MagicMock())
+    def test_execute_commands_pool(self, mock_Semaphore):
+        rpcs = [self.make_rpc(), self.make_rpc(True), self.make_rpc()]
+        db = remote.ProxyDatabase(rpcs[0], rpcs[1:])
+        locks = [lock for _rpc, lock in [db._clients.next()
+                                         for _i in range(3)]]
+
+        for i in range(3):
+            self.assertEqual(db.execute_commands('commands'), ['result'])
+
+        for rpc in rpcs:
+            rpc.execute_commands.assert_called_once_with('commands', False)
+        self.assertEqual(locks[0].__enter__.call_count, 2)
+        self.assertEqual(locks[1].__enter__.call_count, 1)
+        self.assertEqual(locks[2].__enter__.call_count, 2)
+
+    def test_execute_commands_connect(self):
+        rpc = self.make_rpc()
+        rpc.conn = None
+        rpc.connect.side_effect = lambda: setattr(rpc, 'conn',
+                                                  mock.Mock(protocol=2))
+        db = remote.ProxyDatabase(rpc, fallback=self.make_fallback())
+
+        self.assertEqual(db.execute_commands('commands'), ['result'])
+        self.assertEqual(db.execute_commands('commands'), ['result'])
+
+        rpc.connect.assert_called_once_with()
+        self.assertEqual(rpc.execute_commands.call_count, 2)
+        self.assertFalse(db.fallback.pipeline.called)
+
+    @mock.patch('time.time', return_value=1000000.0)
+    @mock.patch.object(remote.LOG, 'warning')
+    def test_execute_commands_unavailable(self, mock_warning, mock_time):
+        rpc = self.make_rpc()
+        rpc.conn = None
+        rpc.connect.side_effect = socket.error('Connection refused')
+        fallback = self.make_fallback()
+        pipe = fallback.pipeline.return_value
+        db = remote.ProxyDatabase(rpc, fallback=fallback)
+
+        result = db.execute_commands([
+            ('rpush', ('key', 'value'), {}),
+            ('expire', ('key', 10), {}),
+        ], True)
+
+        self.assertEqual(result, ['direct'])
+        self.assertEqual(db.proxy_retry, 1000010.0)
+        mock_warning.assert_called_once_with(
+            "Bucket proxy unavailable; accessing the database directly "
+            "for 10.0 seconds: Connection refused")
+        fallback.pipeline.assert_called_once_with(transaction=True)
+        pipe.rpush.assert_called_once_with('key', 'value')
+        pipe.expire.assert_called_once_with('key', 10)
+        pipe.execute.assert_called_once_with()
+        self.assertFalse(rpc.execute_commands.called)
+
+        # The proxy isn't tried again until the delay has passed
+        mock_time.return_value = 1000005.0
+        self.assertEqual(db.execute_commands([('get', ('key',), {})]),
+                         ['direct'])
+        rpc.connect.assert_called_once_with()
+
+        # Once the remote daemon is back, the proxy is used again
+        mock_time.return_value = 1000010.0
+        rpc.connect.side_effect = lambda: setattr(rpc, 'conn',
+                                                  mock.Mock(protocol=3))
+        self.assertEqual(db.execute_commands([('get', ('key',), {})]),
+                         ['result'])
+        self.assertEqual(rpc.connect.call_count, 2)
+        rpc.execute_commands.assert_called_once_with(
+            [('get', ('key',), {})], False)
+
+    @mock.patch.object(remote.LOG, 'warning')
+    def test_execute_commands_unauthenticated(self, mock_warning):
+        rpc = self.make_rpc()
+        rpc.conn = None
+        db = remote.ProxyDatabase(rpc, fallback=self.make_fallback())
+
+        self.assertEqual(db.execute_commands([('get', ('key',), {})]),
+                         ['direct'])
+        rpc.connect.assert_called_once_with()
+        self.assertFalse(rpc.execute_commands.called)
+        mock_warning.assert_called_once_with(
+            "Bucket proxy unavailable; accessing the database directly "
+            "for 10.0 seconds: Failed to authenticate to the remote daemon")
+
+    @mock.patch.object(remote.LOG, 'warning')
+    def test_execute_commands_protocol1(self, mock_warning):
+        rpc = self.make_rpc(protocol=1)
+        db = remote.ProxyDatabase(rpc, fallback=self.make_fallback())
+
+        self.assertEqual(db.execute_commands([('get', ('key',), {})]),
+                         ['direct'])
+        rpc.close.assert_called_once_with()
+        self.assertFalse(rpc.execute_commands.called)
+        mock_warning.assert_called_once_with(
+            "Bucket proxy unavailable; accessing the database directly "
+            "for 10.0 seconds: Bucket proxy requires version 2 of the RPC "
+            "protocol, but the connection to the remote daemon uses "
+            "version 1")
+
+    def test_execute_commands_no_fallback(self):
+        rpc = self.make_rpc()
+        rpc.conn = None
+        rpc.connect.side_effect = socket.error('Connection refused')
+        db = remote.ProxyDatabase(rpc)
+
+        self.assertRaises(socket.error, db.execute_commands,
+                          [('get', ('key',), {})])
+        self.assertEqual(db.proxy_retry, 0.0)
+
+    def test_close(self):
+        rpcs = [mock.Mock(), mock.Mock()]
+        db = remote.ProxyDatabase(rpcs[0], rpcs[1:])
+
+        db.close()
+
+        for rpc in rpcs:
+            rpc.close.assert_called_once_with()
+
+
+class TestProxyRoundtrip(unittest2.TestCase):
+    def test_roundtrip(self):
+        client_sock, server_sock = green_socket.socketpair()
+        daemon = mock.Mock(db=memdb.MemoryRedis('proxy-roundtrip'),
+                           remote_proxy=True)
+        daemon.get_bucket_proxy.return_value = remote.BucketProxy(daemon)
+        server = remote.ControlDaemonRPC(None, None, 'authkey', daemon)
+        server.mode = 'server'
+        server_thread = eventlet.spawn(
+            server.serve, remote.Connection(server_sock, 2), ('test', 0),
+            True)
+        client = remote.ControlDaemonRPC(None, None, 'authkey', None)
+        client.mode = 'client'
+        client.conn = remote.Connection(client_sock, 2)
+        db = remote.ProxyDatabase(client)
+
+        try:
+            pipe = db.pipeline(transaction=False)
+            pipe.rpush('key', '\xff\x00binary')
+            pipe.lrange('key', 0, -1)
+
+            self.assertEqual(pipe.execute(), [1, ['\xff\x00binary']])
+            self.assertEqual(db.lrange('key', 0, -1), ['\xff\x00binary'])
+        finally:
+            client.close()
+            server_thread.kill()
+            daemon.db.flushdb()
+
 
 class TestRemoteControlDaemon(unittest2.TestCase):
     @mock.patch('warnings.warn')
@@ -1325,6 +2821,37 @@ class TestRemoteControlDaemon(unittest2.TestCase):
             daemon=rcd, host='host', port=1234, authkey='authkey')
         self.assertEqual(rcd.remote, 'rpc')
         self.assertEqual(rcd.remote_limits, None)
+        self.assertEqual(rcd.snapshot_path, None)
+        self.assertEqual(rcd.snapshot, None)
+
+    @mock.patch('warnings.warn')
+    @mock.patch.object(remote, 'ControlDaemonRPC', return_value='rpc')
+    def test_init_path(self, mock_ControlDaemonRPC, mock_warn):
+        conf = dict(control={
+            'remote.path': '/path/to/sock',
+            'remote.mode': '0660',
+            'remote.authkey': 'authkey',
+        })
+
+        rcd = remote.RemoteControlDaemon('middleware', conf)
+
+        mock_ControlDaemonRPC.assert_called_once_with(
+            daemon=rcd, host=None, port=None, authkey='authkey',
+            path='/path/to/sock', mode=0660)
+        self.assertFalse(mock_warn.called)
+
+    @mock.patch('warnings.warn')
+    @mock.patch.object(remote, 'ControlDaemonRPC', return_value='rpc')
+    def test_init_path_invalid_mode(self, mock_ControlDaemonRPC, mock_warn):
+        conf = dict(control={
+            'remote.path': '/path/to/sock',
+            'remote.mode': 'rw-rw----',
+            'remote.authkey': 'authkey',
+        })
+
+        self.assertRaises(ValueError, remote.RemoteControlDaemon,
+                          'middleware', conf)
+        self.assertFalse(mock_ControlDaemonRPC.called)
 
     @mock.patch('warnings.warn')
     @mock.patch.object(remote, 'ControlDaemonRPC', return_value='rpc')
@@ -1359,21 +2886,337 @@ class TestRemoteControlDaemon(unittest2.TestCase):
         result = rcd.get_limits()
 
         self.assertEqual(result, 'limits')
-        mock_RemoteLimitData.assert_called_once_with('rpc')
+        self.assertTrue(rcd.remote_subscribe)
+        mock_RemoteLimitData.assert_called_once_with('rpc', [], 'rpc')
+
+    @mock.patch('warnings.warn')
+    @mock.patch.object(remote, 'ControlDaemonRPC', return_value='rpc')
+    @mock.patch.object(remote, 'RemoteLimitData', return_value='limits')
+    def test_get_limits_nosubscribe(self, mock_RemoteLimitData,
+                                    mock_ControlDaemonRPC, mock_warn):
+        conf = dict(control={
+            'remote.host': 'host',
+            'remote.port': '1234',
+            'remote.authkey': 'authkey',
+            'remote.subscribe': 'no',
+        })
+        rcd = remote.RemoteControlDaemon('middleware', conf)
+
+        result = rcd.get_limits()
+
+        self.assertEqual(result, 'limits')
+        self.assertFalse(rcd.remote_subscribe)
+        mock_RemoteLimitData.assert_called_once_with('rpc', [], None)
+        self.assertEqual(mock_ControlDaemonRPC.call_count, 1)
+
+    @mock.patch('warnings.warn')
+    @mock.patch.object(remote, 'ControlDaemonRPC',
+                       side_effect=['rpc0', 'rpc1', 'rpc2', 'sub'])
+    @mock.patch.object(remote, 'RemoteLimitData', return_value='limits')
+    def test_get_limits_pool(self, mock_RemoteLimitData,
+                             mock_ControlDaemonRPC, mock_warn):
+        conf = dict(control={
+            'remote.host': 'host',
+            'remote.port': '1234',
+            'remote.authkey': 'authkey',
+            'remote.connections': '3',
+        })
+        rcd = remote.RemoteControlDaemon('middleware', conf)
+
+        result = rcd.get_limits()
+
+        self.assertEqual(result, 'limits')
+        self.assertEqual(rcd.remote_connections, 3)
+        mock_RemoteLimitData.assert_called_once_with('rpc0',
+                                                     ['rpc1', 'rpc2'], 'sub')
+        mock_ControlDaemonRPC.assert_has_calls([
+            mock.call(daemon=rcd, host='host', port=1234,
+                      authkey='authkey'),
+        ] * 4)
+
+    @mock.patch('warnings.warn')
+    @mock.patch.object(remote, 'ControlDaemonRPC', return_value='rpc')
+    @mock.patch.object(remote, 'RemoteLimitData', return_value='limits')
+    @mock.patch.object(remote, 'SnapshotLimitData', return_value='snapshot')
+    def test_get_limits_snapshot(self, mock_SnapshotLimitData,
+                                 mock_RemoteLimitData,
+                                 mock_ControlDaemonRPC, mock_warn):
+        conf = dict(control={
+            'remote.host': 'host',
+            'remote.port': '1234',
+            'remote.authkey': 'authkey',
+            'remote.snapshot': '/path/snapshot',
+        })
+        rcd = remote.RemoteControlDaemon('middleware', conf)
+
+        result = rcd.get_limits()
+
+        self.assertEqual(result, 'snapshot')
+        mock_SnapshotLimitData.assert_called_once_with('/path/snapshot')
+        self.assertFalse(mock_RemoteLimitData.called)
+
+    @mock.patch('warnings.warn')
+    @mock.patch.object(remote, 'ControlDaemonRPC', return_value=mock.Mock())
+    def test_reset(self, mock_ControlDaemonRPC, mock_warn):
+        conf = dict(control={
+            'remote.host': 'host',
+            'remote.port': '1234',
+            'remote.authkey': 'authkey',
+        })
+        rcd = remote.RemoteControlDaemon('middleware', conf)
+        rcd._db = 'db'
+
+        rcd.reset()
+
+        self.assertEqual(rcd._db, None)
+        mock_ControlDaemonRPC.return_value.close.assert_called_once_with()
+
+    @mock.patch('warnings.warn')
+    @mock.patch.object(remote, 'ControlDaemonRPC', return_value=mock.Mock())
+    def test_reset_remote_limits(self, mock_ControlDaemonRPC, mock_warn):
+        conf = dict(control={
+            'remote.host': 'host',
+            'remote.port': '1234',
+            'remote.authkey': 'authkey',
+        })
+        rcd = remote.RemoteControlDaemon('middleware', conf)
+        remote_limits = mock.Mock()
+        rcd.remote_limits = remote_limits
+
+        rcd.reset()
+
+        remote_limits.close.assert_called_once_with()
+        self.assertEqual(rcd.remote_limits, None)
 
     @mock.patch('warnings.warn')
     @mock.patch.object(remote, 'ControlDaemonRPC', return_value=mock.Mock())
+    def test_reset_proxy_db(self, mock_ControlDaemonRPC, mock_warn):
+        conf = dict(control={
+            'remote.host': 'host',
+            'remote.port': '1234',
+            'remote.authkey': 'authkey',
+        })
+        rcd = remote.RemoteControlDaemon('middleware', conf)
+        proxy_db = mock.Mock()
+        rcd.proxy_db = proxy_db
+
+        rcd.reset()
+
+        proxy_db.close.assert_called_once_with()
+        self.assertEqual(rcd.proxy_db, None)
+
+    @mock.patch('warnings.warn')
+    @mock.patch.object(remote, 'ControlDaemonRPC', return_value='rpc')
+    @mock.patch.object(remote, 'ProxyDatabase', return_value='proxy')
+    def test_get_database_noproxy(self, mock_ProxyDatabase,
+                                  mock_ControlDaemonRPC, mock_warn):
+        conf = mock.MagicMock(**{'get_database.return_value': 'database'})
+        conf.__getitem__.return_value = {
+            'remote.host': 'host',
+            'remote.port': '1234',
+            'remote.authkey': 'authkey',
+        }
+        rcd = remote.RemoteControlDaemon('middleware', conf)
+
+        result = rcd.get_database()
+
+        self.assertEqual(result, 'database')
+        self.assertFalse(rcd.remote_proxy)
+        self.assertFalse(mock_ProxyDatabase.called)
+
+    @mock.patch('warnings.warn')
+    @mock.patch.object(remote, 'ControlDaemonRPC')
+    @mock.patch.object(remote, 'ProxyDatabase', return_value='proxy')
+    def test_get_database_proxy(self, mock_ProxyDatabase,
+                                mock_ControlDaemonRPC, mock_warn):
+        rpcs = [mock.Mock(), mock.Mock(), mock.Mock()]
+        mock_ControlDaemonRPC.side_effect = rpcs
+        conf = mock.MagicMock(**{'get_database.return_value': 'database'})
+        conf.__getitem__.return_value = {
+            'remote.host': 'host',
+            'remote.port': '1234',
+            'remote.authkey': 'authkey',
+            'remote.connections': '2',
+            'remote.proxy': 'yes',
+        }
+        rcd = remote.RemoteControlDaemon('middleware', conf)
+
+        result = rcd.get_database()
+
+        self.assertEqual(result, 'proxy')
+        self.assertEqual(rcd.proxy_db, 'proxy')
+        self.assertFalse(rpcs[1].connect.called)
+        mock_ProxyDatabase.assert_called_once_with(rpcs[1], [rpcs[2]],
+                                                   'database')
+
+        # A second call returns the same object
+        self.assertEqual(rcd.get_database(), 'proxy')
+        self.assertEqual(mock_ProxyDatabase.call_count, 1)
+
+    @mock.patch('warnings.warn')
+    @mock.patch.object(remote, 'ControlDaemonRPC')
+    @mock.patch.object(remote.LOG, 'warning')
+    def test_get_database_proxy_unavailable(self, mock_warning,
+                                            mock_ControlDaemonRPC, mock_warn):
+        mock_ControlDaemonRPC.side_effect = lambda **kw: mock.Mock(**{
+            'conn': None,
+            'connect.side_effect': socket.error('Connection refused'),
+        })
+        db = memdb.MemoryRedis('proxy-unavailable')
+        db.set('key', 'value')
+        self.addCleanup(memdb.reset, 'proxy-unavailable')
+        conf = mock.MagicMock(**{'get_database.return_value': db})
+        conf.__getitem__.return_value = {
+            'remote.host': 'host',
+            'remote.port': '1234',
+            'remote.authkey': 'authkey',
+            'remote.proxy': 'yes',
+        }
+        rcd = remote.RemoteControlDaemon('middleware', conf)
+
+        # The remote daemon is down, so the database is used directly
+        proxy_db = rcd.get_database()
+
+        self.assertIsInstance(proxy_db, remote.ProxyDatabase)
+        self.assertEqual(proxy_db.get('key'), 'value')
+        self.assertTrue(mock_warning.called)
+
+    @mock.patch('warnings.warn')
+    @mock.patch.object(remote, 'ControlDaemonRPC', return_value='rpc')
+    @mock.patch.object(remote, 'BucketProxy', return_value='bucket_proxy')
+    def test_get_bucket_proxy(self, mock_BucketProxy, mock_ControlDaemonRPC,
+                              mock_warn):
+        conf = dict(control={
+            'remote.host': 'host',
+            'remote.port': '1234',
+            'remote.authkey': 'authkey',
+        })
+        rcd = remote.RemoteControlDaemon('middleware', conf)
+
+        self.assertEqual(rcd.get_bucket_proxy(), 'bucket_proxy')
+        self.assertEqual(rcd.get_bucket_proxy(), 'bucket_proxy')
+        mock_BucketProxy.assert_called_once_with(rcd)
+
+    @mock.patch('warnings.warn')
+    @mock.patch.object(remote, 'ControlDaemonRPC', return_value='rpc')
+    def test_publish_snapshot_unset(self, mock_ControlDaemonRPC, mock_warn):
+        conf = dict(control={
+            'remote.host': 'host',
+            'remote.port': '1234',
+            'remote.authkey': 'authkey',
+        })
+        rcd = remote.RemoteControlDaemon('middleware', conf)
+        rcd.limits = mock.Mock()
+
+        rcd._publish_snapshot()
+
+        self.assertEqual(len(rcd.limits.method_calls), 0)
+
+    @mock.patch('warnings.warn')
+    @mock.patch.object(remote, 'ControlDaemonRPC', return_value='rpc')
+    @mock.patch.object(remote.LOG, 'exception')
+    def test_publish_snapshot(self, mock_exception, mock_ControlDaemonRPC,
+                              mock_warn):
+        conf = dict(control={
+            'remote.host': 'host',
+            'remote.port': '1234',
+            'remote.authkey': 'authkey',
+        })
+        rcd = remote.RemoteControlDaemon('middleware', conf)
+        rcd.limits = mock.Mock(limit_sum='sum', limit_data=['limit1'],
+                               limit_lock=mock.MagicMock())
+        rcd.snapshot = mock.Mock()
+
+        rcd._publish_snapshot()
+
+        rcd.snapshot.publish.assert_called_once_with('sum', ['limit1'])
+        rcd.limits.limit_lock.__enter__.assert_called_once_with()
+        self.assertFalse(mock_exception.called)
+
+    @mock.patch('warnings.warn')
+    @mock.patch.object(remote, 'ControlDaemonRPC', return_value='rpc')
+    @mock.patch.object(remote.LOG, 'exception')
+    def test_publish_snapshot_error(self, mock_exception,
+                                    mock_ControlDaemonRPC, mock_warn):
+        conf = dict(control={
+            'remote.host': 'host',
+            'remote.port': '1234',
+            'remote.authkey': 'authkey',
+            'remote.snapshot': '/path/snapshot',
+        })
+        rcd = remote.RemoteControlDaemon('middleware', conf)
+        rcd.limits = mock.Mock(limit_sum='sum', limit_data=['limit1'],
+                               limit_lock=mock.MagicMock())
+        rcd.snapshot = mock.Mock(**{
+            'publish.side_effect': test_utils.TestException,
+        })
+
+        rcd._publish_snapshot()
+
+        mock_exception.assert_called_once_with(
+            "Could not publish limit snapshot '/path/snapshot'")
+
+    @mock.patch('warnings.warn')
+    @mock.patch.object(remote, 'ControlDaemonRPC', return_value=mock.Mock())
+    @mock.patch.object(control.ControlDaemon, '_limits_changed')
+    @mock.patch.object(remote.RemoteControlDaemon, '_publish_snapshot')
+    def test_limits_changed(self, mock_publish_snapshot,
+                            mock_limits_changed, mock_ControlDaemonRPC,
+                            mock_warn):
+        conf = dict(control={
+            'remote.host': 'host',
+            'remote.port': '1234',
+            'remote.authkey': 'authkey',
+        })
+        rcd = remote.RemoteControlDaemon('middleware', conf)
+
+        rcd.limits = mock.Mock(limit_sum='sum')
+
+        rcd._limits_changed()
+
+        mock_limits_changed.assert_called_once_with()
+        mock_publish_snapshot.assert_called_once_with()
+        mock_ControlDaemonRPC.return_value.notify.assert_called_once_with(
+            'sum')
+
+    @mock.patch('warnings.warn')
+    @mock.patch.object(remote, 'ControlDaemonRPC', return_value=mock.Mock())
+    @mock.patch.object(remote, 'LimitSnapshot', return_value='snapshot')
+    @mock.patch.object(control.ControlDaemon, 'start')
+    def test_serve(self, mock_start, mock_LimitSnapshot,
+                   mock_ControlDaemonRPC, mock_warn):
+        conf = dict(control={
+            'remote.host': 'host',
+            'remote.port': '1234',
+            'remote.authkey': 'authkey',
+        })
+        rcd = remote.RemoteControlDaemon('middleware', conf)
+
+        rcd.serve()
+
+        self.assertFalse(mock_LimitSnapshot.called)
+        self.assertEqual(rcd.snapshot, None)
+        mock_start.assert_called_once_with()
+        mock_ControlDaemonRPC.return_value.listen.assert_called_once_with()
+
+    @mock.patch('warnings.warn')
+    @mock.patch.object(remote, 'ControlDaemonRPC', return_value=mock.Mock())
+    @mock.patch.object(remote, 'LimitSnapshot', return_value='snapshot')
     @mock.patch.object(control.ControlDaemon, 'start')
-    def test_serve(self, mock_start, mock_ControlDaemonRPC, mock_warn):
+    def test_serve_snapshot(self, mock_start, mock_LimitSnapshot,
+                            mock_ControlDaemonRPC, mock_warn):
         conf = dict(control={
             'remote.host': 'host',
             'remote.port': '1234',
             'remote.authkey': 'authkey',
+            'remote.snapshot': '/path/snapshot',
         })
         rcd = remote.RemoteControlDaemon('middleware', conf)
 
         rcd.serve()
 
+        mock_LimitSnapshot.assert_called_once_with('/path/snapshot')
+        self.assertEqual(rcd.snapshot, 'snapshot')
         mock_start.assert_called_once_with()
         mock_ControlDaemonRPC.return_value.listen.assert_called_once_with()
 
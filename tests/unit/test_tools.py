@@ -15,17 +15,21 @@
 
 import argparse
 import inspect
+import random
 import StringIO
 import sys
 
 from lxml import etree
 import mock
+import msgpack
 import unittest2
 
 from turnstile import compactor
 from turnstile import config
 from turnstile import database
 from turnstile import limits
+from turnstile import memdb
+from turnstile import microbench
 from turnstile import remote
 from turnstile import tools
 from turnstile import utils
@@ -885,6 +889,171 @@ class TestConsoleScripts(unittest2.TestCase):
         self.assertIsInstance(tools.compactor_daemon, tools.ScriptAdaptor)
         self.assertGreater(len(tools.compactor_daemon._arguments), 0)
 
+    def test_turnstile_bench(self):
+        self.assertIsInstance(tools.turnstile_bench, tools.ScriptAdaptor)
+        self.assertGreater(len(tools.turnstile_bench._arguments), 0)
+
+    def test_turnstile_replay(self):
+        self.assertIsInstance(tools.turnstile_replay, tools.ScriptAdaptor)
+        self.assertGreater(len(tools.turnstile_replay._arguments), 0)
+
+    def test_turnstile_microbench(self):
+        self.assertIsInstance(tools.turnstile_microbench,
+                              tools.ScriptAdaptor)
+        self.assertGreater(len(tools.turnstile_microbench._arguments), 0)
+
+
+class TestLimitDeltas(unittest2.TestCase):
+    def make_limit(self, uuid, value=1):
+        return limits.Limit(None, uuid=uuid, uri='/%s' % uuid, value=value,
+                            unit='second')
+
+    def make_existing(self, *uuids):
+        return [msgpack.dumps(self.make_limit(uuid).dehydrate())
+                for uuid in uuids]
+
+    def test_unchanged(self):
+        lims = [self.make_limit('uuid1'), self.make_limit('uuid2')]
+
+        result = tools.limit_deltas(self.make_existing('uuid1', 'uuid2'),
+                                    lims)
+
+        self.assertEqual(result, [])
+
+    def test_changes(self):
+        lims = [self.make_limit('uuid1', 5), self.make_limit('uuid3'),
+                self.make_limit('uuid4')]
+
+        result = tools.limit_deltas(
+            self.make_existing('uuid1', 'uuid2', 'uuid3'), lims)
+
+        self.assertEqual(result, [
+            ('delete', 'uuid2'),
+            ('set', lims[0]),
+            ('set', lims[2]),
+        ])
+
+    def test_reordered(self):
+        lims = [self.make_limit('uuid2'), self.make_limit('uuid1')]
+
+        result = tools.limit_deltas(self.make_existing('uuid1', 'uuid2'),
+                                    lims)
+
+        self.assertEqual(result, None)
+
+    def test_inserted(self):
+        lims = [self.make_limit('uuid1'), self.make_limit('uuid3'),
+                self.make_limit('uuid2')]
+
+        result = tools.limit_deltas(self.make_existing('uuid1', 'uuid2'),
+                                    lims)
+
+        self.assertEqual(result, None)
+
+
+class TestSetupLimitsDelta(unittest2.TestCase):
+    def setUp(self):
+        self.db = memdb.MemoryRedis('test_setup_limits')
+        self.lims = [
+            limits.Limit(None, uuid='uuid%d' % i, uri='/%d' % i, value=1,
+                         unit='second')
+            for i in range(6)
+        ]
+        database.limit_update(self.db, 'limits', self.lims)
+
+    def tearDown(self):
+        memdb.reset('test_setup_limits')
+
+    def setup_limits(self, lims, *args, **kwargs):
+        conf = config.Config(conf_dict={
+            'redis.redis_client': 'turnstile.memdb:MemoryRedis',
+            'redis.host': 'test_setup_limits',
+        })
+        pubsub = self.db.pubsub()
+        pubsub.subscribe('control')
+        pubsub.get_message()
+
+        with mock.patch.object(config, 'Config', return_value=conf):
+            with mock.patch.object(tools, 'parse_limits_file',
+                                   return_value=lims):
+                tools.setup_limits('conf_file', 'limits_file', *args,
+                                   **kwargs)
+
+        commands = []
+        while True:
+            msg = pubsub.get_message()
+            if not msg:
+                return commands
+            commands.append(msg['data'])
+
+    def get_uuids(self):
+        return [msgpack.loads(lim)['uuid']
+                for lim in self.db.zrange('limits', 0, -1)]
+
+    @mock.patch.object(sys, 'stderr', StringIO.StringIO())
+    def test_delta(self):
+        new = limits.Limit(None, uuid='uuid1', uri='/1', value=5,
+                           unit='second')
+
+        result = self.setup_limits([self.lims[0], new] + self.lims[3:],
+                                   delta=True)
+
+        self.assertEqual(result, ['limit_delete:uuid2',
+                                  'limit_set:20.0:uuid1'])
+        self.assertEqual(self.get_uuids(),
+                         ['uuid0', 'uuid1', 'uuid3', 'uuid4', 'uuid5'])
+        self.assertEqual(msgpack.loads(self.db.zrange('limits', 1, 1)[0])
+                         ['value'], 5)
+        self.assertEqual(sys.stderr.getvalue(), '')
+
+    @mock.patch.object(sys, 'stderr', StringIO.StringIO())
+    def test_delta_noreload(self):
+        result = self.setup_limits(self.lims[:5], False, delta=True)
+
+        self.assertEqual(result, [])
+        self.assertEqual(self.get_uuids(),
+                         ['uuid0', 'uuid1', 'uuid2', 'uuid3', 'uuid4'])
+
+    @mock.patch.object(sys, 'stderr', StringIO.StringIO())
+    def test_delta_dryrun(self):
+        result = self.setup_limits(self.lims[:5], dry_run=True, delta=True)
+
+        self.assertEqual(result, [])
+        self.assertEqual(len(self.get_uuids()), 6)
+        self.assertEqual(sys.stderr.getvalue(), 'Removing limit uuid5\n')
+
+    @mock.patch.object(sys, 'stderr', StringIO.StringIO())
+    def test_delta_debug(self):
+        result = self.setup_limits(self.lims[:5], debug=True, delta=True)
+
+        self.assertEqual(result, ['limit_delete:uuid5'])
+        self.assertEqual(sys.stderr.getvalue(),
+                         'Removing limit uuid5\n'
+                         'Issuing command: limit_delete uuid5\n')
+
+    @mock.patch.object(sys, 'stderr', StringIO.StringIO())
+    def test_delta_fallback(self):
+        lims = list(reversed(self.lims))
+
+        result = self.setup_limits(lims, delta=True)
+
+        self.assertEqual(result, ['reload:versioned'])
+        self.assertEqual(self.get_uuids(), ['uuid5', 'uuid4', 'uuid3',
+                                            'uuid2', 'uuid1', 'uuid0'])
+
+    @mock.patch.object(sys, 'stderr', StringIO.StringIO())
+    def test_delta_too_many(self):
+        lims = [limits.Limit(None, uuid='new%d' % i, uri='/%d' % i,
+                             value=1, unit='second')
+                for i in range(6)]
+
+        result = self.setup_limits(lims, debug=True, delta=True)
+
+        self.assertEqual(result, ['reload:versioned'])
+        self.assertEqual(self.get_uuids(), ['new%d' % i for i in range(6)])
+        self.assertTrue(sys.stderr.getvalue().startswith(
+            'Unable to apply changes individually\n'))
+
 
 class TestSetupLimits(unittest2.TestCase):
     @mock.patch.object(sys, 'stderr', StringIO.StringIO())
@@ -929,7 +1098,8 @@ class TestSetupLimits(unittest2.TestCase):
         ])
         mock_limit_update.assert_called_once_with(
             'db', 'limits', ['limit%d:%d' % (i, i) for i in range(6)])
-        mock_command.assert_called_once_with('db', 'control', 'reload')
+        mock_command.assert_called_once_with('db', 'control', 'reload',
+                                             'versioned')
         self.assertEqual(sys.stderr.getvalue(), '')
 
     @mock.patch.object(sys, 'stderr', StringIO.StringIO())
@@ -977,9 +1147,45 @@ class TestSetupLimits(unittest2.TestCase):
         ])
         mock_limit_update.assert_called_once_with(
             'db', 'alt_lims', ['limit%d:%d' % (i, i) for i in range(6)])
-        mock_command.assert_called_once_with('db', 'alt_chan', 'reload')
+        mock_command.assert_called_once_with('db', 'alt_chan', 'reload',
+                                             'versioned')
         self.assertEqual(sys.stderr.getvalue(), '')
 
+    @mock.patch.object(sys, 'stderr', StringIO.StringIO())
+    @mock.patch('lxml.etree.parse', return_value=mock.Mock(**{
+        'getroot.return_value': [
+            mock.Mock(tag='limit', idx=0),
+            mock.Mock(tag='limit', idx=1),
+            mock.Mock(tag='limit', idx=2),
+            mock.Mock(tag='limit', idx=3),
+        ]
+    }))
+    @mock.patch('warnings.warn')
+    @mock.patch.object(config, 'Config', return_value=mock.MagicMock(**{
+        'get_database.return_value': 'db',
+    }))
+    @mock.patch.object(database, 'command')
+    @mock.patch.object(database, 'limit_update')
+    @mock.patch.object(tools, 'parse_limit_node')
+    def test_duplicate_key_id(self, mock_parse_limit_node, mock_limit_update,
+                              mock_command, mock_Config, mock_warn,
+                              mock_etree_parse):
+        lims = [
+            mock.Mock(key_id=None),
+            mock.Mock(key_id=1),
+            mock.Mock(key_id=None),
+            mock.Mock(key_id=1),
+        ]
+        mock_parse_limit_node.side_effect = lims
+        conf = mock_Config.return_value
+        conf.__getitem__.return_value = {}
+
+        tools.setup_limits('conf_file', 'limits_file')
+
+        mock_warn.assert_called_once_with(
+            "Duplicate key ID 1 for limit at index 3; ignoring limit...")
+        mock_limit_update.assert_called_once_with('db', 'limits', lims[:3])
+
     @mock.patch.object(sys, 'stderr', StringIO.StringIO())
     @mock.patch('lxml.etree.parse', return_value=mock.Mock(**{
         'getroot.return_value': [
@@ -1012,7 +1218,8 @@ class TestSetupLimits(unittest2.TestCase):
             mock.call("Couldn't understand limit at index 1: spam"),
         ])
         mock_limit_update.assert_called_once_with('db', 'limits', [])
-        mock_command.assert_called_once_with('db', 'control', 'reload')
+        mock_command.assert_called_once_with('db', 'control', 'reload',
+                                             'versioned')
         self.assertEqual(sys.stderr.getvalue(), '')
 
     @mock.patch.object(sys, 'stderr', StringIO.StringIO())
@@ -1049,12 +1256,13 @@ class TestSetupLimits(unittest2.TestCase):
         ])
         mock_limit_update.assert_called_once_with(
             'db', 'limits', ['limit%d:%d' % (i, i) for i in range(2)])
-        mock_command.assert_called_once_with('db', 'control', 'reload')
+        mock_command.assert_called_once_with('db', 'control', 'reload',
+                                             'versioned')
         self.assertEqual(sys.stderr.getvalue(),
                          'Installing the following limits:\n'
                          "  'limit0:0'\n"
                          "  'limit1:1'\n"
-                         'Issuing command: reload\n')
+                         'Issuing command: reload versioned\n')
 
     @mock.patch.object(sys, 'stderr', StringIO.StringIO())
     @mock.patch('lxml.etree.parse', return_value=mock.Mock(**{
@@ -1094,7 +1302,7 @@ class TestSetupLimits(unittest2.TestCase):
                          'Installing the following limits:\n'
                          "  'limit0:0'\n"
                          "  'limit1:1'\n"
-                         'Issuing command: reload\n')
+                         'Issuing command: reload versioned\n')
 
     @mock.patch.object(sys, 'stderr', StringIO.StringIO())
     @mock.patch('lxml.etree.parse', return_value=mock.Mock(**{
@@ -1185,7 +1393,7 @@ class TestSetupLimits(unittest2.TestCase):
         mock_limit_update.assert_called_once_with(
             'db', 'limits', ['limit%d:%d' % (i, i) for i in range(6)])
         mock_command.assert_called_once_with(
-            'db', 'control', 'reload', 'spread', 42)
+            'db', 'control', 'reload', 'spread', 42, 'versioned')
         self.assertEqual(sys.stderr.getvalue(), '')
 
     @mock.patch.object(sys, 'stderr', StringIO.StringIO())
@@ -1232,7 +1440,7 @@ class TestSetupLimits(unittest2.TestCase):
         mock_limit_update.assert_called_once_with(
             'db', 'limits', ['limit%d:%d' % (i, i) for i in range(6)])
         mock_command.assert_called_once_with(
-            'db', 'control', 'reload', 'spread', '42')
+            'db', 'control', 'reload', 'spread', '42', 'versioned')
         self.assertEqual(sys.stderr.getvalue(), '')
 
     @mock.patch.object(sys, 'stderr', StringIO.StringIO())
@@ -1279,7 +1487,7 @@ class TestSetupLimits(unittest2.TestCase):
         mock_limit_update.assert_called_once_with(
             'db', 'limits', ['limit%d:%d' % (i, i) for i in range(6)])
         mock_command.assert_called_once_with(
-            'db', 'control', 'reload', 'immediate')
+            'db', 'control', 'reload', 'immediate', 'versioned')
         self.assertEqual(sys.stderr.getvalue(), '')
 
 
@@ -1503,6 +1711,95 @@ class TestRemoteDaemon(unittest2.TestCase):
         mock_RemoteControlDaemon.return_value.serve.assert_called_once_with()
 
 
+class TestFormatStats(unittest2.TestCase):
+    def test_full(self):
+        result = tools._format_stats({
+            'node': 'node1',
+            'pid': 1234,
+            'request_rate': 10.25,
+            'reject_rate': 1.0,
+            'p50': 0.5,
+            'p99': 2.125,
+            'redis_errors': 3,
+            'limit_sum': '0123456789abcdef',
+            'reloads': 2,
+            'reloads_requested': 12,
+            'reloads_coalesced': 10,
+            'cache_hit_rate': 95.0,
+        })
+
+        self.assertEqual(result, tools._STATS_FORMAT % (
+            'node1', '1234', '10.2', '1.0', '0.50', '2.12', '3',
+            '01234567', '2/12', '95%'))
+
+    def test_missing(self):
+        result = tools._format_stats({'node': 'node1', 'p50': None})
+
+        self.assertEqual(result, tools._STATS_FORMAT % (
+            'node1', '-', '-', '-', '-', '-', '-', '-', '-', '-'))
+
+
+class TestAggregateStats(unittest2.TestCase):
+    def test_aggregate(self):
+        result = tools._aggregate_stats([
+            dict(node='node1', request_rate=30.0, reject_rate=1.0, p50=1.0,
+                 p99=5.0, redis_errors=1, limit_sum='sum',
+                 cache_hit_rate=None),
+            dict(node='node2', request_rate=10.0, reject_rate=2.0, p50=3.0,
+                 p99=4.0, redis_errors=2, limit_sum='sum',
+                 cache_hit_rate=None),
+        ])
+
+        self.assertEqual(result, {
+            'node': 'FLEET (2)',
+            'request_rate': 40.0,
+            'reject_rate': 3.0,
+            'redis_errors': 3,
+            'p50': 1.5,
+            'p99': 5.0,
+            'limit_sum': 'sum',
+        })
+
+    def test_aggregate_reloads(self):
+        result = tools._aggregate_stats([
+            dict(node='node1', reloads=1, reloads_requested=5,
+                 reloads_coalesced=4),
+            dict(node='node2', reloads=2, reloads_requested=3,
+                 reloads_coalesced=1),
+            dict(node='node3'),
+        ])
+
+        self.assertEqual(result, {
+            'node': 'FLEET (3)',
+            'request_rate': 0,
+            'reject_rate': 0,
+            'redis_errors': 0,
+            'p99': None,
+            'reloads': 3,
+            'reloads_requested': 8,
+            'reloads_coalesced': 5,
+        })
+
+    def test_aggregate_sparse(self):
+        result = tools._aggregate_stats([
+            dict(node='node1', limit_sum='sum1', cache_hit_rate=90.0),
+            dict(node='node2', limit_sum='sum2', cache_hit_rate=80.0,
+                 request_rate=0.0, p50=2.0, p99=3.0),
+            dict(node='node3', p50=4.0),
+        ])
+
+        self.assertEqual(result, {
+            'node': 'FLEET (3)',
+            'request_rate': 0.0,
+            'reject_rate': 0,
+            'redis_errors': 0,
+            'p50': 3.0,
+            'p99': 3.0,
+            'limit_sum': 'MIXED',
+            'cache_hit_rate': 85.0,
+        })
+
+
 class TestTurnstileCommand(unittest2.TestCase):
     @mock.patch.object(sys, 'stderr', StringIO.StringIO())
     @mock.patch.object(sys, 'stdout', StringIO.StringIO())
@@ -1898,6 +2195,79 @@ class TestTurnstileCommand(unittest2.TestCase):
                          'Response     3: pong  1000000.0\n'
                          'Response     4: pong node 1000000.0\n')
 
+    @mock.patch.object(sys, 'stderr', StringIO.StringIO())
+    @mock.patch.object(sys, 'stdout', StringIO.StringIO())
+    @mock.patch('uuid.uuid4', return_value='random_string')
+    @mock.patch.object(config, 'Config', return_value=mock.MagicMock(**{
+        'get_database.return_value': mock.Mock(**{
+            'pubsub.return_value': mock.Mock(**{
+                'listen.return_value': [{
+                    'type': 'message',
+                    'channel': 'random_string',
+                    'data': 'stats:' + msgpack.dumps(dict(node='node1')),
+                }, {
+                    'type': 'message',
+                    'channel': 'random_string',
+                    'data': 'stats:bad\xc1',
+                }, {
+                    'type': 'message',
+                    'channel': 'random_string',
+                    'data': 'stats:' + msgpack.dumps(dict(node='node2')),
+                }],
+            }),
+        })}))
+    @mock.patch.object(database, 'command')
+    @mock.patch.object(tools, '_format_stats',
+                       side_effect=lambda x: 'row %s' % x['node'])
+    @mock.patch.object(tools, '_aggregate_stats',
+                       return_value=dict(node='fleet'))
+    def test_stats(self, mock_aggregate_stats, mock_format_stats,
+                   mock_command, mock_Config, mock_uuid4):
+        conf = mock_Config.return_value
+        conf.__getitem__.return_value = {}
+        db = conf.get_database.return_value
+        pubsub = db.pubsub.return_value
+
+        tools.turnstile_command('conf_file', 'stats')
+
+        mock_command.assert_called_once_with(db, 'control', 'stats',
+                                             'random_string')
+        pubsub.subscribe.assert_called_once_with('random_string')
+        mock_aggregate_stats.assert_called_once_with([
+            dict(node='node1'),
+            dict(node='node2'),
+        ])
+        self.assertEqual(sys.stderr.getvalue(),
+                         "Invalid stats reply: 'stats:bad\\xc1'\n")
+        self.assertEqual(sys.stdout.getvalue(),
+                         tools._STATS_HEADER + '\n'
+                         'row node1\n'
+                         'row node2\n'
+                         'row fleet\n')
+
+    @mock.patch.object(sys, 'stderr', StringIO.StringIO())
+    @mock.patch.object(sys, 'stdout', StringIO.StringIO())
+    @mock.patch('uuid.uuid4', return_value='random_string')
+    @mock.patch.object(config, 'Config', return_value=mock.MagicMock(**{
+        'get_database.return_value': mock.Mock(**{
+            'pubsub.return_value': mock.Mock(**{
+                'listen.return_value': [],
+            }),
+        })}))
+    @mock.patch.object(database, 'command')
+    def test_stats_channel(self, mock_command, mock_Config, mock_uuid4):
+        conf = mock_Config.return_value
+        conf.__getitem__.return_value = {}
+        db = conf.get_database.return_value
+        pubsub = db.pubsub.return_value
+
+        tools.turnstile_command('conf_file', 'stats', ['chan', 'extra'])
+
+        self.assertFalse(mock_uuid4.called)
+        mock_command.assert_called_once_with(db, 'control', 'stats', 'chan')
+        pubsub.subscribe.assert_called_once_with('chan')
+        self.assertEqual(sys.stdout.getvalue(), '')
+
 
 class TestCompactorDaemon(unittest2.TestCase):
     @mock.patch('eventlet.monkey_patch')
@@ -1909,3 +2279,694 @@ class TestCompactorDaemon(unittest2.TestCase):
         mock_monkey_patch.assert_called_once_with()
         mock_Config.assert_called_once_with(conf_file='conf_file')
         mock_compactor.assert_called_once_with(mock_Config.return_value)
+
+
+class TestBenchConfig(unittest2.TestCase):
+    def test_memory(self):
+        result = tools._bench_config()
+
+        self.assertEqual(result, {
+            'control.channel': 'turnstile_bench:control',
+            'control.limits_key': 'turnstile_bench:limits',
+            'control.errors_key': 'turnstile_bench:errors',
+            'control.errors_channel': 'turnstile_bench:errors',
+            'redis.redis_client': 'turnstile.memdb:counting_client',
+            'redis.counted_client': 'turnstile.memdb:MemoryRedis',
+            'redis.host': 'turnstile_bench',
+        })
+
+    def test_redis(self):
+        result = tools._bench_config('redis.example.com')
+
+        self.assertEqual(result['redis.host'], 'redis.example.com')
+        self.assertFalse('redis.port' in result)
+        self.assertEqual(result['redis.redis_client'],
+                         'turnstile.memdb:counting_client')
+        self.assertFalse('redis.counted_client' in result)
+
+    def test_redis_port(self):
+        result = tools._bench_config('redis.example.com:6380')
+
+        self.assertEqual(result['redis.host'], 'redis.example.com')
+        self.assertEqual(result['redis.port'], '6380')
+
+
+class TestBenchMiddleware(unittest2.TestCase):
+    def tearDown(self):
+        memdb.reset()
+
+    def test_memory(self):
+        stale = memdb.MemoryRedis('turnstile_bench')
+        stale.set('stale', 'value')
+        lims = tools._synthetic_limits(2, 5)
+
+        midware, counter = tools._bench_middleware(lims, options={
+            'status': '429 Too Many Requests',
+            'redis.host': 'ignored',
+        })
+
+        self.assertEqual(midware.conf.status, '429 Too Many Requests')
+        self.assertIs(midware.db, counter)
+        self.assertIsInstance(counter.db, memdb.MemoryRedis)
+        self.assertEqual(counter.db.get('stale'), None)
+        self.assertEqual(counter.db.zcard('turnstile_bench:limits'), 2)
+        self.assertEqual(len(midware.limits), 2)
+        self.assertEqual(counter.commands, 0)
+
+    @mock.patch('eventlet.monkey_patch')
+    @mock.patch.object(tools.config, 'Config')
+    @mock.patch.object(tools.database, 'limit_update')
+    @mock.patch.object(tools.middleware, 'TurnstileMiddleware')
+    @mock.patch.object(tools.memdb, 'reset')
+    def test_redis(self, mock_reset, mock_TurnstileMiddleware,
+                   mock_limit_update, mock_Config, mock_monkey_patch):
+        midware = mock_TurnstileMiddleware.return_value
+
+        result = tools._bench_middleware(['lim'], 'localhost:6380')
+
+        conf = tools._bench_config('localhost:6380')
+        mock_monkey_patch.assert_called_once_with()
+        self.assertFalse(mock_reset.called)
+        mock_Config.assert_called_once_with(conf_dict=conf)
+        mock_limit_update.assert_called_once_with(
+            mock_Config.return_value.get_database.return_value,
+            'turnstile_bench:limits', ['lim'])
+        mock_TurnstileMiddleware.assert_called_once_with(tools._bench_app,
+                                                         conf)
+        self.assertEqual(result, (midware, midware.db))
+        midware.db.reset_counts.assert_called_once_with()
+        self.assertEqual(midware.call_count, 1)
+
+
+class TestBenchApp(unittest2.TestCase):
+    def test_app(self):
+        start_response = mock.Mock()
+
+        result = tools._bench_app({}, start_response)
+
+        self.assertEqual(result, ['OK'])
+        start_response.assert_called_once_with(
+            '200 OK', [('Content-Type', 'text/plain')])
+
+
+class TestMakeEnviron(unittest2.TestCase):
+    def test_environ(self):
+        result = tools._make_environ('POST', '/some/path', 'a=1')
+
+        self.assertEqual(result['REQUEST_METHOD'], 'POST')
+        self.assertEqual(result['PATH_INFO'], '/some/path')
+        self.assertEqual(result['QUERY_STRING'], 'a=1')
+        self.assertEqual(result['SCRIPT_NAME'], '')
+        self.assertEqual(result['wsgi.url_scheme'], 'http')
+        self.assertFalse('REMOTE_ADDR' in result)
+
+    def test_headers(self):
+        result = tools._make_environ('GET', '/', headers={
+            'X-Auth-Token': 'token',
+            'Content-Type': 'text/plain',
+            'content-length': '5',
+        }, remote_addr='10.0.0.1')
+
+        self.assertEqual(result['HTTP_X_AUTH_TOKEN'], 'token')
+        self.assertEqual(result['CONTENT_TYPE'], 'text/plain')
+        self.assertEqual(result['CONTENT_LENGTH'], '5')
+        self.assertEqual(result['REMOTE_ADDR'], '10.0.0.1')
+
+
+class TestSyntheticLimits(unittest2.TestCase):
+    def test_limits(self):
+        result = tools._synthetic_limits(3, 50)
+
+        self.assertEqual(len(result), 3)
+        for idx, lim in enumerate(result):
+            self.assertIsInstance(lim, limits.Limit)
+            self.assertEqual(lim.uri, '/bench/%d/{key}' % idx)
+            self.assertEqual(lim.value, 50)
+            self.assertEqual(lim.unit, 'minute')
+            self.assertEqual(lim.use, ['key'])
+
+
+class TestBenchRequests(unittest2.TestCase):
+    def test_hits(self):
+        lims = [
+            mock.Mock(uri='/a/{key}', verbs=[], queries=[]),
+            mock.Mock(uri='/b/{x}/{key}', verbs=['POST'], queries=['q']),
+        ]
+
+        result = tools._bench_requests(lims, 50, 5, 1.0, random.Random(1))
+
+        self.assertEqual(len(result), 50)
+        for environ in result:
+            path = environ['PATH_INFO']
+            if path.startswith('/a/'):
+                self.assertRegexpMatches(path, r'^/a/key[0-4]$')
+                self.assertEqual(environ['REQUEST_METHOD'], 'GET')
+                self.assertEqual(environ['QUERY_STRING'], '')
+            else:
+                self.assertRegexpMatches(path, r'^/b/(key[0-4])/\1$')
+                self.assertEqual(environ['REQUEST_METHOD'], 'POST')
+                self.assertEqual(environ['QUERY_STRING'], 'q=1')
+
+    def test_misses(self):
+        lims = [mock.Mock(uri='/a/{key}', verbs=[], queries=[])]
+
+        result = tools._bench_requests(lims, 20, 5, 0.0, random.Random(1))
+
+        self.assertEqual(len(result), 20)
+        for environ in result:
+            self.assertRegexpMatches(environ['PATH_INFO'],
+                                     r'^/miss/key[0-4]$')
+
+    def test_repeatable(self):
+        lims = [mock.Mock(uri='/a/{key}', verbs=[], queries=[])]
+
+        result1 = tools._bench_requests(lims, 20, 100, 0.5,
+                                        random.Random(42))
+        result2 = tools._bench_requests(lims, 20, 100, 0.5,
+                                        random.Random(42))
+
+        self.assertEqual(result1, result2)
+
+
+class TestBenchRun(unittest2.TestCase):
+    def tearDown(self):
+        memdb.reset()
+
+    def test_memory(self):
+        lims = tools._synthetic_limits(2, 5)
+        params = {
+            'limits': [lim.dehydrate() for lim in lims],
+            'redis_host': None,
+            'requests': 40,
+            'concurrency': 4,
+            'keys': 2,
+            'hit_ratio': 1.0,
+            'seed': 1,
+        }
+
+        result = tools._bench_run(params)
+
+        self.assertEqual(result['requests'], 40)
+        self.assertEqual(len(result['latencies']), 40)
+        # 2 limits with 2 keys each permit 5 requests per minute
+        self.assertEqual(result['rejected'], 20)
+        self.assertGreater(result['commands'], result['round_trips'])
+        self.assertGreaterEqual(result['round_trips'], 80)
+
+        # Make sure the limits were installed
+        db = memdb.MemoryRedis('turnstile_bench')
+        self.assertEqual(db.zcard('turnstile_bench:limits'), 2)
+
+    @mock.patch.object(tools, '_bench_middleware')
+    def test_redis(self, mock_bench_middleware):
+        midware = mock.Mock()
+        counter = mock.Mock(commands=20, round_trips=10)
+        mock_bench_middleware.return_value = (midware, counter)
+
+        def fake_call(environ, start_response):
+            start_response('200 OK', [])
+            return ['OK']
+        midware.side_effect = fake_call
+
+        params = {
+            'limits': [tools._synthetic_limits(1, 5)[0].dehydrate()],
+            'redis_host': 'localhost',
+            'requests': 10,
+            'concurrency': 2,
+            'keys': 2,
+            'hit_ratio': 1.0,
+            'seed': 1,
+        }
+
+        result = tools._bench_run(params)
+
+        self.assertEqual(mock_bench_middleware.call_count, 1)
+        lims, redis_host = mock_bench_middleware.call_args[0]
+        self.assertEqual(len(lims), 1)
+        self.assertIsInstance(lims[0], limits.Limit)
+        self.assertEqual(redis_host, 'localhost')
+        self.assertEqual(result['requests'], 10)
+        self.assertEqual(result['rejected'], 0)
+        self.assertEqual(result['commands'], 20)
+        self.assertEqual(result['round_trips'], 10)
+        self.assertEqual(midware.call_count, 10)
+
+
+class TestFormatBench(unittest2.TestCase):
+    def test_format(self):
+        results = [
+            {
+                'requests': 50,
+                'rejected': 5,
+                'elapsed': 0.5,
+                'latencies': [i / 1000.0 for i in range(1, 51)],
+                'commands': 200,
+                'round_trips': 100,
+            },
+            {
+                'requests': 50,
+                'rejected': 5,
+                'elapsed': 1.0,
+                'latencies': [i / 1000.0 for i in range(51, 101)],
+                'commands': 200,
+                'round_trips': 100,
+            },
+        ]
+
+        result = tools._format_bench(results)
+
+        self.assertEqual(result.split('\n'), [
+            "Requests:        100",
+            "Rejected:        10 (10.0%)",
+            "Elapsed:         1.000 s",
+            "Throughput:      100.0 requests/s",
+            "Latency (ms):    p50 51.000, p90 91.000, p99 100.000, "
+            "max 100.000",
+            "Redis commands:  4.00 per request (2.00 round trips)",
+        ])
+
+    def test_format_empty(self):
+        results = [{
+            'requests': 0,
+            'rejected': 0,
+            'elapsed': 0.0,
+            'latencies': [],
+            'commands': 0,
+            'round_trips': 0,
+        }]
+
+        result = tools._format_bench(results)
+
+        self.assertEqual(result.split('\n'), [
+            "Requests:        0",
+            "Rejected:        0 (0.0%)",
+            "Elapsed:         0.000 s",
+            "Throughput:      0.0 requests/s",
+            "Latency (ms):    p50 0.000, p90 0.000, p99 0.000, max 0.000",
+            "Redis commands:  0.00 per request (0.00 round trips)",
+        ])
+
+
+class TestTurnstileBench(unittest2.TestCase):
+    @mock.patch.object(sys, 'stdout', StringIO.StringIO())
+    @mock.patch.object(tools, '_synthetic_limits', return_value=[
+        mock.Mock(**{'dehydrate.return_value': {'lim': 1}}),
+    ])
+    @mock.patch.object(tools, 'parse_limits_file')
+    @mock.patch.object(tools, '_bench_run', return_value='result')
+    @mock.patch.object(tools, '_format_bench', return_value='formatted')
+    @mock.patch('multiprocessing.Pool')
+    def test_basic(self, mock_Pool, mock_format_bench, mock_bench_run,
+                   mock_parse_limits_file, mock_synthetic_limits):
+        tools.turnstile_bench()
+
+        mock_synthetic_limits.assert_called_once_with(10, 100)
+        self.assertFalse(mock_parse_limits_file.called)
+        self.assertFalse(mock_Pool.called)
+        mock_bench_run.assert_called_once_with({
+            'limits': [{'lim': 1}],
+            'redis_host': None,
+            'requests': 10000,
+            'concurrency': 10,
+            'keys': 100,
+            'hit_ratio': 1.0,
+            'seed': None,
+        })
+        mock_format_bench.assert_called_once_with(['result'])
+        self.assertEqual(sys.stdout.getvalue(), 'formatted\n')
+
+    @mock.patch.object(sys, 'stdout', StringIO.StringIO())
+    @mock.patch.object(sys, 'stderr', StringIO.StringIO())
+    @mock.patch.object(tools, '_synthetic_limits')
+    @mock.patch.object(tools, 'parse_limits_file', return_value=[
+        mock.Mock(**{
+            'dehydrate.return_value': {'lim': 1},
+            '__repr__': lambda self: '<limit>',
+        }),
+    ])
+    @mock.patch.object(tools, '_bench_run')
+    @mock.patch.object(tools, '_format_bench', return_value='formatted')
+    @mock.patch('multiprocessing.Pool', return_value=mock.Mock(**{
+        'map.return_value': ['result1', 'result2', 'result3'],
+    }))
+    def test_processes(self, mock_Pool, mock_format_bench, mock_bench_run,
+                       mock_parse_limits_file, mock_synthetic_limits):
+        tools.turnstile_bench('limits.xml', 'localhost', requests=10,
+                              concurrency=5, processes=3, keys=20,
+                              hit_ratio=0.5, seed=7, debug=True)
+
+        self.assertFalse(mock_synthetic_limits.called)
+        mock_parse_limits_file.assert_called_once_with(None, 'limits.xml')
+        mock_Pool.assert_called_once_with(3)
+        params = [{
+            'limits': [{'lim': 1}],
+            'redis_host': 'localhost',
+            'requests': requests,
+            'concurrency': 5,
+            'keys': 20,
+            'hit_ratio': 0.5,
+            'seed': seed,
+        } for requests, seed in ((4, 7), (3, 8), (3, 9))]
+        mock_Pool.return_value.assert_has_calls([
+            mock.call.map(mock_bench_run, params),
+            mock.call.close(),
+            mock.call.join(),
+        ])
+        mock_format_bench.assert_called_once_with(
+            ['result1', 'result2', 'result3'])
+        self.assertEqual(sys.stderr.getvalue(),
+                         'Benchmarking the following limits:\n'
+                         '  <limit>\n')
+        self.assertEqual(sys.stdout.getvalue(), 'formatted\n')
+
+
+class TestFormatCompare(unittest2.TestCase):
+    def test_format(self):
+        result = tools._format_compare([
+            ('bench.one', 0.000002, 0.000001, 0.5),
+            ('bench.two', 0.0, 0.000001, None),
+        ])
+
+        self.assertEqual(result.split('\n'), [
+            'Benchmark                            Old (us)     New (us)'
+            '   Change',
+            'bench.one                                2.00         1.00'
+            '   -50.0%',
+            'bench.two                                0.00         1.00'
+            '        -',
+        ])
+
+
+class TestTurnstileMicrobench(unittest2.TestCase):
+    @mock.patch.object(sys, 'stdout', StringIO.StringIO())
+    @mock.patch.object(sys, 'stderr', StringIO.StringIO())
+    @mock.patch.object(microbench, 'run_benchmarks', return_value={
+        'benchmarks': {'a': 1},
+    })
+    @mock.patch.object(microbench, 'compare')
+    def test_basic(self, mock_compare, mock_run_benchmarks):
+        tools.turnstile_microbench()
+
+        mock_run_benchmarks.assert_called_once_with(None, 5, 0.2, None)
+        self.assertFalse(mock_compare.called)
+        self.assertEqual(sys.stdout.getvalue(),
+                         '{\n  "benchmarks": {\n    "a": 1\n  }\n}\n')
+        self.assertEqual(sys.stderr.getvalue(), '')
+
+    @mock.patch.object(sys, 'stdout', StringIO.StringIO())
+    @mock.patch.object(sys, 'stderr', StringIO.StringIO())
+    @mock.patch.object(microbench, 'run_benchmarks', return_value={
+        'benchmarks': {'a': 1},
+    })
+    @mock.patch.object(microbench, 'compare', return_value='comparison')
+    @mock.patch.object(tools, '_format_compare', return_value='formatted')
+    def test_output_compare(self, mock_format_compare, mock_compare,
+                            mock_run_benchmarks):
+        files = {
+            'old.json': mock.MagicMock(),
+            'new.json': mock.MagicMock(),
+        }
+        handles = {
+            'old.json': StringIO.StringIO('{"benchmarks": {"a": 2}}'),
+            'new.json': StringIO.StringIO(),
+        }
+        for name, fobj in files.items():
+            fobj.__enter__.return_value = handles[name]
+
+        with mock.patch('__builtin__.open',
+                        side_effect=lambda n, m='r': files[n]):
+            tools.turnstile_microbench('new.json', 'old.json', 'a*', 3,
+                                       0.1, 'label', True)
+
+        mock_run_benchmarks.assert_called_once_with('a*', 3, 0.1, 'label')
+        mock_compare.assert_called_once_with(
+            {'benchmarks': {'a': 2}}, {'benchmarks': {'a': 1}})
+        mock_format_compare.assert_called_once_with('comparison')
+        self.assertEqual(handles['new.json'].getvalue(),
+                         '{\n  "benchmarks": {\n    "a": 1\n  }\n}\n')
+        self.assertEqual(sys.stdout.getvalue(), '')
+        self.assertEqual(sys.stderr.getvalue(),
+                         'Ran 1 benchmarks\nformatted\n')
+
+
+class TestToStr(unittest2.TestCase):
+    def test_to_str(self):
+        self.assertEqual(tools._to_str(u'caf\xe9'), 'caf\xc3\xa9')
+        self.assertEqual(tools._to_str('str'), 'str')
+        self.assertEqual(tools._to_str(5), '5')
+
+
+class TestParseClfTime(unittest2.TestCase):
+    def test_utc(self):
+        self.assertEqual(tools._parse_clf_time('10/Oct/2000:13:55:36 +0000'),
+                         971186136.0)
+
+    def test_offset(self):
+        self.assertEqual(tools._parse_clf_time('10/Oct/2000:13:55:36 -0700'),
+                         971211336.0)
+        self.assertEqual(tools._parse_clf_time('10/Oct/2000:13:55:36 +0130'),
+                         971180736.0)
+
+    def test_no_offset(self):
+        self.assertEqual(tools._parse_clf_time('10/Oct/2000:13:55:36'),
+                         971186136.0)
+
+
+class TestParseLogLine(unittest2.TestCase):
+    def test_blank(self):
+        self.assertEqual(tools._parse_log_line('  \n'), None)
+
+    def test_common(self):
+        result = tools._parse_log_line(
+            '127.0.0.1 - frank [10/Oct/2000:13:55:36 +0000] '
+            '"GET /apache_pb.gif?a=1 HTTP/1.0" 200 2326\n')
+
+        self.assertEqual(result[0], 971186136.0)
+        self.assertEqual(result[1], tools._make_environ(
+            'GET', '/apache_pb.gif', 'a=1', {}, '127.0.0.1'))
+
+    def test_combined(self):
+        result = tools._parse_log_line(
+            '127.0.0.1 - - [10/Oct/2000:13:55:36 +0000] '
+            '"POST /path HTTP/1.1" 413 - "http://example.com/" '
+            '"Mozilla/4.08"\n')
+
+        self.assertEqual(result[1], tools._make_environ(
+            'POST', '/path', '', {
+                'Referer': 'http://example.com/',
+                'User-Agent': 'Mozilla/4.08',
+            }, '127.0.0.1'))
+
+    def test_combined_empty_headers(self):
+        result = tools._parse_log_line(
+            '127.0.0.1 - - [10/Oct/2000:13:55:36 +0000] '
+            '"GET /path HTTP/1.1" 200 5 "-" "-"\n')
+
+        self.assertFalse('HTTP_REFERER' in result[1])
+        self.assertFalse('HTTP_USER_AGENT' in result[1])
+
+    def test_bad_line(self):
+        self.assertEqual(tools._parse_log_line('garbage\n'), None)
+
+    def test_bad_time(self):
+        self.assertEqual(tools._parse_log_line(
+            '127.0.0.1 - - [yesterday] "GET /path HTTP/1.1" 200 5\n'), None)
+
+    def test_json(self):
+        result = tools._parse_log_line(
+            '{"time": 1000.5, "method": "PUT", "path": "/path", '
+            '"query": "a=1", "headers": {"X-Auth-Token": "token"}, '
+            '"remote_addr": "10.0.0.1"}\n')
+
+        self.assertEqual(result, (1000.5, tools._make_environ(
+            'PUT', '/path', 'a=1', {'X-Auth-Token': 'token'}, '10.0.0.1')))
+
+    def test_json_minimal(self):
+        result = tools._parse_log_line('{"time": 1000, "path": "/path"}')
+
+        self.assertEqual(result, (1000.0, tools._make_environ('GET',
+                                                              '/path')))
+
+    def test_json_bad(self):
+        self.assertEqual(tools._parse_log_line('{"time": 1000'), None)
+        self.assertEqual(tools._parse_log_line('{"time": 1000}'), None)
+        self.assertEqual(tools._parse_log_line('{"time": "x", "path": "/"}'),
+                         None)
+
+
+class TestReadLog(unittest2.TestCase):
+    @mock.patch.object(tools, '_parse_log_line',
+                       side_effect=lambda l: None if l == 'bad\n' else l)
+    def test_read(self, mock_parse_log_line):
+        log = mock.MagicMock()
+        log.__enter__.return_value = ['line1\n', '\n', 'bad\n', 'line2\n']
+
+        with mock.patch('__builtin__.open', return_value=log) as mock_open:
+            result = tools._read_log('access.log')
+
+        mock_open.assert_called_once_with('access.log')
+        self.assertEqual(result, (['line1\n', 'line2\n'], 1))
+
+
+class TestReplay(unittest2.TestCase):
+    def make_midware(self, delays):
+        def fake_call(environ, start_response):
+            delay = delays.get(environ['PATH_INFO'])
+            if delay:
+                environ['turnstile.delay'] = delay
+                start_response('413 Request Entity Too Large', [])
+            else:
+                start_response('200 OK', [])
+            return []
+
+        return mock.Mock(side_effect=fake_call)
+
+    @mock.patch('eventlet.sleep')
+    def test_fast(self, mock_sleep):
+        lim1 = mock.Mock()
+        lim2 = mock.Mock()
+        midware = self.make_midware({
+            '/a': [(1, lim1, 'bucket'), (2, lim2, 'bucket')],
+            '/b': [(1, lim1, 'bucket')],
+        })
+        entries = [
+            (1000.0, {'PATH_INFO': '/a'}),
+            (1010.0, {'PATH_INFO': '/b'}),
+            (1020.0, {'PATH_INFO': '/c'}),
+            (1030.0, {'PATH_INFO': '/b'}),
+        ]
+
+        result = tools._replay(midware, entries, speed=0)
+
+        self.assertFalse(mock_sleep.called)
+        self.assertEqual(midware.call_count, 4)
+        self.assertEqual(result['requests'], 4)
+        self.assertEqual(result['rejected'], 3)
+        self.assertEqual(result['duration'], 30.0)
+        self.assertEqual(len(result['latencies']), 4)
+        self.assertEqual(result['fired'], {lim1: 3, lim2: 1})
+
+    @mock.patch('eventlet.sleep')
+    @mock.patch('time.time', return_value=1000000.0)
+    def test_timed(self, mock_time, mock_sleep):
+        midware = self.make_midware({})
+        entries = [
+            (1000.0, {'PATH_INFO': '/a'}),
+            (1000.0, {'PATH_INFO': '/b'}),
+            (1010.0, {'PATH_INFO': '/c'}),
+            (1030.0, {'PATH_INFO': '/b'}),
+        ]
+
+        result = tools._replay(midware, entries, speed=2.0)
+
+        mock_sleep.assert_has_calls([mock.call(5.0), mock.call(15.0)])
+        self.assertEqual(mock_sleep.call_count, 2)
+        self.assertEqual(result['requests'], 4)
+        self.assertEqual(result['rejected'], 0)
+        self.assertEqual(result['fired'], {})
+
+    def test_empty(self):
+        result = tools._replay(mock.Mock(), [])
+
+        self.assertEqual(result['requests'], 0)
+        self.assertEqual(result['duration'], 0.0)
+
+
+class TestFormatReplay(unittest2.TestCase):
+    def test_format(self):
+        lim1 = mock.Mock(uri='/a', value=10, unit='minute', uuid='uuid1')
+        lim2 = mock.Mock(uri='/b', value=5, unit='second', uuid='uuid2')
+        result = tools._format_replay({
+            'requests': 100,
+            'rejected': 25,
+            'elapsed': 10.0,
+            'duration': 20.0,
+            'latencies': [i / 1000.0 for i in range(1, 101)],
+            'fired': {lim1: 5, lim2: 20},
+            'skipped': 2,
+            'commands': 400,
+            'round_trips': 200,
+            'keys': 12,
+            'memory': 1024,
+        })
+
+        self.assertEqual(result.split('\n'), [
+            "Requests:        100 (2 lines skipped)",
+            "Rejected:        25 (25.0%)",
+            "Log duration:    20.000 s",
+            "Elapsed:         10.000 s",
+            "Overhead (ms):   p50 51.000, p90 91.000, p99 100.000, "
+            "max 100.000",
+            "Redis commands:  4.00 per request (2.00 round trips)",
+            "Redis keys:      12",
+            "Redis memory:    1024 bytes",
+            "Limits fired:",
+            "        20  /b (5/second) uuid2",
+            "         5  /a (10/minute) uuid1",
+        ])
+
+    def test_format_none(self):
+        result = tools._format_replay({
+            'requests': 0,
+            'rejected': 0,
+            'elapsed': 0.0,
+            'duration': 0.0,
+            'latencies': [],
+            'fired': {},
+            'skipped': 0,
+            'commands': 0,
+            'round_trips': 0,
+            'keys': 0,
+            'memory': None,
+        })
+
+        self.assertEqual(result.split('\n')[-3:], [
+            "Redis memory:    None bytes",
+            "Limits fired:",
+            "  (none)",
+        ])
+
+
+class TestTurnstileReplay(unittest2.TestCase):
+    @mock.patch.object(sys, 'stdout', StringIO.StringIO())
+    @mock.patch.object(sys, 'stderr', StringIO.StringIO())
+    @mock.patch.object(tools, 'parse_limits_file', return_value=['lim'])
+    @mock.patch.object(tools, '_read_log', return_value=(['entry'], 3))
+    @mock.patch.object(tools, '_bench_middleware')
+    @mock.patch.object(tools, '_replay', return_value={'requests': 1})
+    @mock.patch.object(tools, '_format_replay', return_value='formatted')
+    def test_replay(self, mock_format_replay, mock_replay,
+                    mock_bench_middleware, mock_read_log,
+                    mock_parse_limits_file):
+        counter = mock.Mock(commands=4, round_trips=2, **{
+            'db.dbsize.return_value': 7,
+            'db.info.return_value': {'used_memory': 2048},
+        })
+        mock_bench_middleware.return_value = ('midware', counter)
+
+        tools.turnstile_replay('limits.xml', 'access.log', 'localhost',
+                               2.0, 50, ['enable=preproc', 'a.b=c=d'],
+                               True)
+
+        mock_parse_limits_file.assert_called_once_with(None, 'limits.xml')
+        mock_read_log.assert_called_once_with('access.log')
+        mock_bench_middleware.assert_called_once_with(
+            ['lim'], 'localhost', {'enable': 'preproc', 'a.b': 'c=d'})
+        mock_replay.assert_called_once_with('midware', ['entry'], 2.0, 50)
+        mock_format_replay.assert_called_once_with({
+            'requests': 1,
+            'skipped': 3,
+            'commands': 4,
+            'round_trips': 2,
+            'keys': 7,
+            'memory': 2048,
+        })
+        self.assertEqual(sys.stdout.getvalue(), 'formatted\n')
+        self.assertEqual(sys.stderr.getvalue(),
+                         'Replaying 1 requests (3 lines skipped)\n')
+
+    @mock.patch.object(tools, 'parse_limits_file')
+    def test_bad_option(self, mock_parse_limits_file):
+        self.assertRaises(ValueError, tools.turnstile_replay,
+                          'limits.xml', 'access.log', options=['bad'])
+        self.assertFalse(mock_parse_limits_file.called)
@@ -23,6 +23,7 @@ import msgpack
 from turnstile import control
 from turnstile import database
 from turnstile import limits
+from turnstile import metrics
 from turnstile import remote
 from turnstile import utils
 
@@ -311,11 +312,17 @@ class LimitContainer(object):
         self.limit_map = {}
         self.limit_sum = None
 
+        # The compactor serves no requests, so it collects no request
+        # metrics; the control daemon's "stats" command still expects
+        # an emitter, so provide the null one
+        self.metrics = metrics.Metrics()
+
         # Initialize the control daemon
         if conf.to_bool(conf['control'].get('remote', 'no'), False):
-            self.control_daemon = remote.RemoteControlDaemon(self, conf)
+            klass = remote.RemoteControlDaemon
         else:
-            self.control_daemon = control.ControlDaemon(self, conf)
+            klass = control.ControlDaemon
+        self.control_daemon = control.get_daemon(klass, self, conf)
 
         # Now start the control daemon
         self.control_daemon.start()
@@ -345,9 +352,16 @@ class LimitContainer(object):
             # Convert the limits list into a list of objects
             lims = database.limits_hydrate(self.db, new_limits)
 
+            # Build the map; hashed bucket keys may identify the
+            # limit by its key ID instead of its UUID
+            limit_map = {}
+            for lim in lims:
+                limit_map[lim.uuid] = lim
+                limit_map[lim.key_ident] = lim
+
             # Save the new data
             self.limits = lims
-            self.limit_map = dict((lim.uuid, lim) for lim in lims)
+            self.limit_map = limit_map
             self.limit_sum = new_sum
         except control.NoChangeException:
             # No changes to process; just keep going...
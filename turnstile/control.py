@@ -13,14 +13,19 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
-import hashlib
+import bisect
 import logging
+import os
 import random
+import socket
+import time
 import traceback
 
 import eventlet
 import msgpack
 
+from turnstile import database
+from turnstile import profiler
 from turnstile import utils
 
 
@@ -41,44 +46,189 @@ class LimitData(object):
     Stores limit data.  Provides a common depot between the
     ControlDaemon and the middleware which contains the raw limit data
     (as msgpack'd strings).
+
+    Changes to individual limits, applied with set_limit() and
+    delete_limit(), are also recorded in a journal, so that the
+    middleware can apply just the changes, rather than reloading all
+    the limits; see get_changes().
     """
 
+    # The maximum number of changes to keep in the journal
+    max_changes = 100
+
     def __init__(self):
         """
         Initialize the LimitData.  The limit data is initialized to
         the empty list.
         """
 
-        # Build up a sum for the empty list
-        chksum = hashlib.md5()
-        chksum.update('')
-
         self.limit_data = []
-        self.limit_sum = chksum.hexdigest()
+        self.limit_raw = []
+        self.limit_scores = []
+        self.limit_sum = database.limits_checksum([])
+        self.limit_changes = []
         self.limit_lock = eventlet.semaphore.Semaphore()
 
-    def set_limits(self, limits):
+    def set_limits(self, limits, scores=None):
         """
         Set the limit data to the given list of limits.  Limits are
         specified as the raw msgpack string representing the limit.
         Computes the checksum of the limits; if the checksum is
         identical to the current one, no action is taken.
+
+        :param limits: A list of the raw msgpack strings representing
+                       the limits.
+        :param scores: An optional list of the scores of the limits
+                       in the database.  The scores are required to
+                       apply changes to individual limits with
+                       set_limit().
         """
 
         # First task, build the checksum of the new limits
-        chksum = hashlib.md5()  # sufficient for our purposes
-        for lim in limits:
-            chksum.update(lim)
-        new_sum = chksum.hexdigest()
+        new_sum = database.limits_checksum(limits)
 
         # Now install it
         with self.limit_lock:
+            self.limit_scores = list(scores) if scores is not None else None
             if self.limit_sum == new_sum:
                 # No changes
                 return
             self.limit_data = [msgpack.loads(lim) for lim in limits]
+            self.limit_raw = list(limits)
             self.limit_sum = new_sum
 
+            # The journal can't describe a wholesale replacement
+            self.limit_changes = []
+
+    def _index(self, uuid):
+        """
+        Find the index of the limit with the given UUID.  Must be
+        called with the limit_lock held.
+
+        :param uuid: The UUID of the limit.
+
+        :returns: The index of the limit, or None if it is not
+                  present.
+        """
+
+        for idx, lim in enumerate(self.limit_data):
+            if lim.get('uuid') == uuid:
+                return idx
+
+        return None
+
+    def _change(self, uuid, index, lim, raw, score):
+        """
+        Apply a change to a single limit and record it in the
+        journal.  Must be called with the limit_lock held.
+
+        :param uuid: The UUID of the limit to change.
+        :param index: The index at which to insert the new version of
+                      the limit, after any old version has been
+                      removed.  Ignored if lim is None.
+        :param lim: The limit data, or None to remove the limit.
+        :param raw: The raw msgpack string representing the limit.
+        :param score: The score of the limit in the database.
+        """
+
+        # Remove the old version of the limit; the scores may not be
+        # known, in which case only limits can be removed
+        old = self._index(uuid)
+        if old is not None:
+            del self.limit_data[old]
+            del self.limit_raw[old]
+            if self.limit_scores is not None:
+                del self.limit_scores[old]
+
+        # Insert the new version
+        if lim is not None:
+            self.limit_data.insert(index, lim)
+            self.limit_raw.insert(index, raw)
+            self.limit_scores.insert(index, score)
+
+        # Compute the new checksum
+        old_sum = self.limit_sum
+        self.limit_sum = database.limits_checksum(self.limit_raw)
+
+        # Record the change in the journal
+        self.limit_changes.append((old_sum, self.limit_sum,
+                                   (uuid, index, lim)))
+        del self.limit_changes[:-self.max_changes]
+
+    def set_limit(self, limit, score):
+        """
+        Add or update a single limit.  The limit is identified by its
+        UUID.
+
+        :param limit: The raw msgpack string representing the limit.
+        :param score: The score of the limit in the database, which
+                      determines its position in the list of limits.
+
+        :returns: True if the change was applied, or False if the
+                  change could not be applied because the scores of
+                  the limits are not known.
+        """
+
+        lim = msgpack.loads(limit)
+
+        with self.limit_lock:
+            if self.limit_scores is None:
+                return False
+
+            # Find where the limit goes, ignoring any old version of
+            # the limit
+            old = self._index(lim.get('uuid'))
+            scores = [s for i, s in enumerate(self.limit_scores)
+                      if i != old]
+            index = bisect.bisect_right(scores, score)
+
+            # Do nothing if nothing's changed
+            if old == index and self.limit_raw[old] == limit:
+                return True
+
+            self._change(lim.get('uuid'), index, lim, limit, score)
+
+        return True
+
+    def delete_limit(self, uuid):
+        """
+        Remove a single limit.
+
+        :param uuid: The UUID of the limit to remove.
+        """
+
+        with self.limit_lock:
+            if self._index(uuid) is not None:
+                self._change(uuid, None, None, None, None)
+
+    def get_changes(self, limit_sum=None):
+        """
+        Gets the changes needed to bring the limit data indicated by
+        limit_sum up to date.  Raises a NoChangeException if the
+        limit_sum represents no change.  Otherwise, returns a tuple
+        consisting of the current limit_sum and a list of the changes
+        to apply, in order.  Each change is a tuple of the UUID of a
+        limit, the index at which to insert the new version of the
+        limit after removing the old version, and the limit data, or
+        None if the limit has been removed.  If the changes are not
+        available, e.g., because the limit data was reloaded, the
+        list of changes will be None, and get_limits() must be used.
+        """
+
+        with self.limit_lock:
+            # Any changes?
+            if limit_sum and self.limit_sum == limit_sum:
+                raise NoChangeException()
+
+            # Search the journal for the starting point
+            for idx in range(len(self.limit_changes) - 1, -1, -1):
+                if self.limit_changes[idx][0] == limit_sum:
+                    return (self.limit_sum,
+                            [change for _old, _new, change in
+                             self.limit_changes[idx:]])
+
+            return (self.limit_sum, None)
+
     def get_limits(self, limit_sum=None):
         """
         Gets the current limit data if it is different from the data
@@ -106,6 +256,10 @@ class ControlDaemon(object):
 
     _commands = {}
 
+    # Whether the middleware in the process running the control
+    # daemon serves the requests; if not, its metrics are meaningless
+    serves_requests = True
+
     @classmethod
     def _register(cls, name, func):
         """
@@ -130,21 +284,164 @@ class ControlDaemon(object):
         # Need a semaphore to cover reloads in action
         self.pending = eventlet.semaphore.Semaphore()
 
-        # Initialize the listening thread
+        # The queued reload, if any, the time it is due, and whether
+        # it must fetch the limits; see schedule_reload()
+        self.reload_queued = None
+        self.reload_deadline = None
+        self.reload_full = False
+
+        # Count the reloads requested, coalesced, and performed
+        self.reload_counts = dict(requested=0, coalesced=0, performed=0)
+
+        # The checksum of the limits last saved to the cache file
+        self.cache_sum = None
+
+        # Profiling state; see the 'profile_start' command
+        self.profiling = None
+
+        # Initialize the listening and polling threads
         self.listen_thread = None
+        self.poll_thread = None
+
+    def _get_interval(self, key, default=None):
+        """
+        Retrieve a time interval from the control configuration.
+
+        :param key: The name of the configuration option, within the
+                    'control' section.
+        :param default: The value to return if the option is not set
+                        or is not a valid, positive number.
+
+        :returns: The interval, in seconds.
+        """
+
+        try:
+            value = float(self.config['control'][key])
+        except (TypeError, ValueError, KeyError):
+            return default
+
+        return value if value > 0 else default
 
     def start(self):
         """
         Starts the ControlDaemon by launching the listening thread and
-        triggering the initial limits load.
+        triggering the initial limits load.  If the
+        'control.poll_interval' configuration is set, also launches a
+        thread which periodically checks whether the limits have
+        changed.  If the 'control.cache_file' configuration is set and
+        the cache file can be loaded, the limits are loaded from it,
+        and the initial load from the database is performed in the
+        background.
         """
 
+        # A shared daemon may already have been started
+        if self.listen_thread is not None:
+            return
+
         # Spawn the listening thread
         self.listen_thread = eventlet.spawn_n(self.listen)
 
-        # Now do the initial load
+        # Spawn the polling thread
+        interval = self._get_interval('poll_interval')
+        if interval:
+            self.poll_thread = eventlet.spawn_n(self.poll, interval)
+
+        # Now do the initial load; if we have cached limits, we can
+        # revalidate them in the background
+        if self._load_cache():
+            self.schedule_reload()
+        else:
+            self.reload()
+
+    def _load_cache(self):
+        """
+        Load the limits from the file specified by the
+        'control.cache_file' configuration, if set.
+
+        :returns: True if the limits were loaded, False otherwise.
+        """
+
+        path = self.config['control'].get('cache_file')
+        if not path:
+            return False
+
+        try:
+            with open(path, 'rb') as f:
+                cache = msgpack.loads(f.read())
+
+            # Make sure the cache is intact
+            if database.limits_checksum(cache['limits']) != cache['limit_sum']:
+                raise ValueError("Checksum mismatch")
+
+            self.limits.set_limits(cache['limits'], cache['scores'])
+        except Exception as exc:
+            LOG.warning("Could not load limits cache %r: %s" % (path, exc))
+            return False
+
+        self.cache_sum = cache['limit_sum']
+        self._limits_changed()
+
+        LOG.info("Loaded %d limits from cache %r" %
+                 (len(cache['limits']), path))
+        return True
+
+    def _save_cache(self):
+        """
+        Save the limits to the file specified by the
+        'control.cache_file' configuration, if set and if the limits
+        have changed since they were last saved.
+        """
+
+        path = self.config['control'].get('cache_file')
+        if not path or self.limits.limit_sum == self.cache_sum:
+            return
+
+        try:
+            with self.limits.limit_lock:
+                limit_sum = self.limits.limit_sum
+                data = msgpack.dumps({
+                    'limit_sum': limit_sum,
+                    'limits': self.limits.limit_raw,
+                    'scores': self.limits.limit_scores,
+                })
+
+            # Write to a temporary file, then atomically rename it
+            # into place, so a partially written cache is never read
+            tmp_path = '%s.%d.tmp' % (path, os.getpid())
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.rename(tmp_path, path)
+        except Exception:
+            LOG.exception("Could not save limits cache %r" % path)
+            return
+
+        self.cache_sum = limit_sum
+
+    def _limits_changed(self):
+        """
+        Called after the limits have been changed.  Saves the limits
+        to the cache file, if one is configured.
+        """
+
+        self._save_cache()
+
+    def preload(self):
+        """
+        Loads the limits without starting the listening thread.  Used
+        to load the limits in the master process of a pre-forking
+        server; see turnstile.middleware:pre_fork().
+        """
+
         self.reload()
 
+    def reset(self):
+        """
+        Discards the database handle, so that a process forked after
+        the handle was opened uses its own connections.
+        """
+
+        self._db = None
+
     def listen(self):
         """
         Listen for incoming control messages.
@@ -154,62 +451,131 @@ class ControlDaemon(object):
         subscription.  The control channel to subscribe to is
         specified by the 'redis.control_channel' configuration
         ('control' by default).
+
+        If the connection to the database is lost, the listener
+        reconnects, waiting 'control.reconnect_delay' seconds (1 by
+        default) before the first attempt, and doubling the delay
+        after each failed attempt, up to 'control.reconnect_max_delay'
+        seconds (60 by default).  Since control messages may have been
+        missed while disconnected, a reload is triggered once the
+        listener has reconnected.
         """
 
-        # Use a specific database handle, with override.  This allows
-        # the long-lived listen thread to be configured to use a
-        # different database or different database options.
-        db = self.config.get_database('control')
-
-        # Need a pub-sub object
-        kwargs = {}
-        if 'shard_hint' in self.config['control']:
-            kwargs['shard_hint'] = self.config['control']['shard_hint']
-        pubsub = db.pubsub(**kwargs)
-
-        # Subscribe to the right channel(s)...
-        channel = self.config['control'].get('channel', 'control')
-        pubsub.subscribe(channel)
-
-        # Now we listen...
-        for msg in pubsub.listen():
-            # Only interested in messages to our reload channel
-            if (msg['type'] in ('pmessage', 'message') and
-                    msg['channel'] == channel):
-                # Figure out what kind of message this is
-                command, _sep, args = msg['data'].partition(':')
-
-                # We must have some command...
-                if not command:
-                    continue
-
-                # Don't do anything with internal commands
-                if command[0] == '_':
-                    LOG.error("Cannot call internal command %r" % command)
-                    continue
-
-                # Look up the command
-                if command in self._commands:
-                    func = self._commands[command]
-                else:
-                    # Try an entrypoint
-                    func = utils.find_entrypoint('turnstile.command', command,
-                                                 compat=False)
-                    self._commands[command] = func
-
-                # Don't do anything with missing commands
-                if not func:
-                    LOG.error("No such command %r" % command)
-                    continue
-
-                # Execute the desired command
-                arglist = args.split(':') if args else []
-                try:
-                    func(self, *arglist)
-                except Exception:
-                    LOG.exception("Failed to execute command %r arguments %r" %
-                                  (command, arglist))
-                    continue
+        # Get the reconnection delays
+        min_delay = self._get_interval('reconnect_delay', 1.0)
+        max_delay = max(self._get_interval('reconnect_max_delay', 60.0),
+                        min_delay)
+
+        delay = min_delay
+        reconnecting = False
+        while True:
+            pubsub = None
+            try:
+                # Use a specific database handle, with override.  This
+                # allows the long-lived listen thread to be configured
+                # to use a different database or different database
+                # options.
+                db = self.config.get_database('control')
+
+                # Need a pub-sub object
+                kwargs = {}
+                if 'shard_hint' in self.config['control']:
+                    kwargs['shard_hint'] = \
+                        self.config['control']['shard_hint']
+                pubsub = db.pubsub(**kwargs)
+
+                # Subscribe to the right channel(s)...
+                channel = self.config['control'].get('channel', 'control')
+                pubsub.subscribe(channel)
+
+                # Catch up on anything we missed while disconnected
+                if reconnecting:
+                    LOG.info("Control listener reconnected")
+                    reload(self)
+                delay = min_delay
+                reconnecting = False
+
+                # Now we listen...
+                for msg in pubsub.listen():
+                    self._dispatch(channel, msg)
+            except Exception:
+                LOG.exception("Control listener lost its connection; "
+                              "reconnecting in %s seconds" % delay)
+
+                # Release the failed subscription's connection
+                if pubsub is not None:
+                    with utils.ignore_except():
+                        pubsub.close()
+
+                eventlet.sleep(delay)
+                delay = min(delay * 2, max_delay)
+                reconnecting = True
+                continue
+
+            # The subscription was closed; we're done
+            return
+
+    def _dispatch(self, channel, msg):
+        """
+        Process an incoming control message.
+
+        :param channel: The control channel.
+        :param msg: The message, as returned by the listen() method
+                    of the pub-sub object.
+        """
+
+        # Only interested in messages to our reload channel
+        if (msg['type'] not in ('pmessage', 'message') or
+                msg['channel'] != channel):
+            return
+
+        # Figure out what kind of message this is
+        command, _sep, args = msg['data'].partition(':')
+
+        # We must have some command...
+        if not command:
+            return
+
+        # Don't do anything with internal commands
+        if command[0] == '_':
+            LOG.error("Cannot call internal command %r" % command)
+            return
+
+        # Look up the command
+        if command in self._commands:
+            func = self._commands[command]
+        else:
+            # Try an entrypoint
+            func = utils.find_entrypoint('turnstile.command', command,
+                                         compat=False)
+            self._commands[command] = func
+
+        # Don't do anything with missing commands
+        if not func:
+            LOG.error("No such command %r" % command)
+            return
+
+        # Execute the desired command
+        arglist = args.split(':') if args else []
+        try:
+            func(self, *arglist)
+        except Exception:
+            LOG.exception("Failed to execute command %r arguments %r" %
+                          (command, arglist))
+
+    def poll(self, interval):
+        """
+        Periodically check whether the limits have changed, as a
+        safety net in case control messages are lost.  Thanks to the
+        limits version key, a check costs a single database command
+        when the limits have not changed.
+
+        :param interval: The number of seconds between checks.
+        """
+
+        while True:
+            eventlet.sleep(interval)
+            self.schedule_reload()
 
     def get_limits(self):
         """
@@ -222,6 +588,17 @@ class ControlDaemon(object):
 
         return self.limits
 
+    def get_database(self):
+        """
+        Retrieve the database handle the middleware will use for
+        updating the buckets.  This is broken out into a function so
+        that it can be overridden in multi-process configurations to
+        return an object which sends the database commands to the
+        ControlDaemon process.
+        """
+
+        return self.config.get_database()
+
     def reload(self):
         """
         Reloads the limits configuration from the database.
@@ -241,34 +618,180 @@ class ControlDaemon(object):
 
         # Do the remaining steps in a try/finally block so we make
         # sure to release the semaphore
+        try:
+            self._reload()
+        finally:
+            self.pending.release()
+
+    def _reload(self, full=False):
+        """
+        Performs the actual reload of the limits configuration.  The
+        caller must hold the pending semaphore.
+
+        :param full: If True, the limits are always fetched, even if
+                     the version key indicates they are unchanged.
+        """
+
+        self.reload_counts['performed'] += 1
+
         control_args = self.config['control']
         try:
-            # Load all the limits
+            # If the limits are versioned, we need only look at the
+            # version to see if they've changed.  Versions of
+            # setup_limits and turnstile_command which predate the
+            # version key don't update it, so it cannot be trusted
+            # when such a tool explicitly asks for a reload
             key = control_args.get('limits_key', 'limits')
-            self.limits.set_limits(self.db.zrange(key, 0, -1))
+            if not full:
+                _generation, chksum = database.parse_version(
+                    self.db.get(database.version_key(key)))
+                if chksum is not None and chksum == self.limits.limit_sum:
+                    return
+
+            # Load all the limits
+            items = self.db.zrange(key, 0, -1, withscores=True)
+            self.limits.set_limits([lim for lim, _score in items],
+                                   [score for _lim, score in items])
         except Exception:
-            # Log an error
-            LOG.exception("Could not load limits")
-
-            # Get our error set and publish channel
-            error_key = control_args.get('errors_key', 'errors')
-            error_channel = control_args.get('errors_channel', 'errors')
-
-            # Get an informative message
-            msg = "Failed to load limits: " + traceback.format_exc()
-
-            # Store the message into the error set.  We use a set here
-            # because it's likely that more than one node will
-            # generate the same message if there is an error, and this
-            # avoids an explosion in the size of the set.
-            with utils.ignore_except():
-                self.db.sadd(error_key, msg)
-
-            # Publish the message to a channel
-            with utils.ignore_except():
-                self.db.publish(error_channel, msg)
-        finally:
-            self.pending.release()
+            self._load_error()
+            return
+
+        self._limits_changed()
+
+    def schedule_reload(self, delay=0.0, full=False):
+        """
+        Schedules a reload of the limits configuration.  Bursts of
+        reload requests are coalesced: at most one reload is queued
+        at any time, in addition to any reload in progress.  If a
+        reload is already queued, the request is folded into it; if
+        the new request is due sooner than the queued reload, the
+        queued reload is rescheduled for the earlier time.
+
+        :param delay: The number of seconds to wait before
+                      reloading.
+        :param full: If True, the reload fetches the limits even if
+                     the version key indicates they are unchanged;
+                     see _reload().
+        """
+
+        self.reload_counts['requested'] += 1
+        self.reload_full = self.reload_full or full
+        deadline = time.time() + delay
+
+        if self.reload_queued is not None:
+            # A reload is already queued; it will pick up whatever
+            # changes prompted this request
+            self.reload_counts['coalesced'] += 1
+            if deadline >= self.reload_deadline:
+                return
+
+            # The new request is due sooner; reschedule the queued
+            # reload
+            self.reload_queued.cancel()
+
+        self.reload_deadline = deadline
+        self.reload_queued = eventlet.spawn_after(delay, self._queued_reload)
+
+    def _queued_reload(self):
+        """
+        Performs a reload queued by schedule_reload().  Waits for any
+        reload in progress to complete, so that changes made while
+        that reload was running are not missed.
+        """
+
+        # The queued reload is now due; later requests will be
+        # coalesced into it, but must not reschedule it
+        self.reload_deadline = time.time()
+
+        with self.pending:
+            # Once we're running, the next request must queue a
+            # new reload
+            self.reload_queued = None
+            self.reload_deadline = None
+            full = self.reload_full
+            self.reload_full = False
+
+            self._reload(full)
+
+    def reload_limit(self, uuid, score):
+        """
+        Reloads a single limit from the database.  If the limit
+        cannot be found with the given score, e.g., because it has
+        since been changed again, or if the change cannot be applied,
+        a full reload is performed instead.
+
+        :param uuid: The UUID of the limit.
+        :param score: The score of the limit in the database.
+        """
+
+        # Wait for any reload in progress, so that its results don't
+        # overwrite the change
+        with self.pending:
+            try:
+                # Look up the limit
+                key = self.config['control'].get('limits_key', 'limits')
+                for lim in self.db.zrangebyscore(key, score, score):
+                    if msgpack.loads(lim).get('uuid') == uuid:
+                        break
+                else:
+                    lim = None
+
+                # Apply the change
+                if lim is not None and self.limits.set_limit(lim, score):
+                    self._limits_changed()
+                    return
+            except Exception:
+                self._load_error()
+                return
+
+        # Fall back to a full reload
+        self.reload()
+
+    def remove_limit(self, uuid):
+        """
+        Removes a single limit.
+
+        :param uuid: The UUID of the limit.
+        """
+
+        # Wait for any reload in progress, so that its results don't
+        # overwrite the change
+        with self.pending:
+            self.limits.delete_limit(uuid)
+            self._limits_changed()
+
+    def _load_error(self):
+        """
+        Report an error loading the limits.  An error-level log
+        message will be emitted, and the error message will be added
+        to the set specified by the 'redis.errors_key' configuration
+        ('errors' by default) and sent to the publishing channel
+        specified by the 'redis.errors_channel' configuration
+        ('errors' by default).  Must be called from an exception
+        handler.
+        """
+
+        # Log an error
+        LOG.exception("Could not load limits")
+
+        # Get our error set and publish channel
+        control_args = self.config['control']
+        error_key = control_args.get('errors_key', 'errors')
+        error_channel = control_args.get('errors_channel', 'errors')
+
+        # Get an informative message
+        msg = "Failed to load limits: " + traceback.format_exc()
+
+        # Store the message into the error set.  We use a set here
+        # because it's likely that more than one node will generate
+        # the same message if there is an error, and this avoids an
+        # explosion in the size of the set.
+        with utils.ignore_except():
+            self.db.sadd(error_key, msg)
+
+        # Publish the message to a channel
+        with utils.ignore_except():
+            self.db.publish(error_channel, msg)
 
     @property
     def db(self):
@@ -285,6 +808,46 @@ class ControlDaemon(object):
         return self._db
 
 
+# The shared control daemons, keyed by the daemon class and the
+# configuration; see get_daemon()
+_daemons = {}
+
+
+def get_daemon(klass, middleware, conf):
+    """
+    Obtain a control daemon.  If the 'control.shared' configuration is
+    enabled, a single control daemon is shared by all the middleware
+    in the process with identical configuration, i.e., with the same
+    contents of the '[redis]' and '[control]' configuration sections;
+    the daemon then has a single subscription to the control channel
+    and a single copy of the limit data.  Otherwise, a new control
+    daemon is created.
+
+    :param klass: The control daemon class, e.g., ControlDaemon.
+    :param middleware: The middleware, or other object providing the
+                       database handle, which will use the daemon.
+                       The database handle of a shared daemon is
+                       provided by the first such object.
+    :param conf: A turnstile.config.Config instance containing the
+                 configuration.
+
+    :returns: The control daemon.  Note that the daemon's start()
+              method must still be called; it does nothing if the
+              daemon has already been started.
+    """
+
+    if not conf.to_bool(conf['control'].get('shared', 'no'), False):
+        return klass(middleware, conf)
+
+    key = (klass,
+           tuple(sorted(conf['redis'].items())),
+           tuple(sorted(conf['control'].items())))
+    if key not in _daemons:
+        _daemons[key] = klass(middleware, conf)
+
+    return _daemons[key]
+
+
 def register(name, func=None):
     """
     Function or decorator which registers a given function as a
@@ -340,8 +903,64 @@ def ping(daemon, channel, data=None):
         daemon.db.publish(channel, ':'.join(reply))
 
 
+@register('stats')
+def stats(daemon, channel):
+    """
+    Process the 'stats' control message.
+
+    :param daemon: The control daemon; used to get at the
+                   configuration, the database, and the middleware.
+    :param channel: The publish channel to which to send the
+                    response.
+
+    Responds to the named channel with "stats:" followed by a
+    msgpack'd dictionary summarizing the performance of this node.
+    The dictionary contains the node name ("node", defaulting to the
+    host name), the process ID ("pid"), the checksum of the limits
+    currently in use ("limit_sum"), the numbers of reloads requested
+    ("reloads_requested"), coalesced into an already queued reload
+    ("reloads_coalesced"), and performed ("reloads"), and the bucket
+    cache hit rate ("cache_hit_rate", or None if not applicable).  If
+    the "metrics.summary" configuration option is enabled, it also
+    contains the request and reject rates, the limiter overhead
+    percentiles, and the Redis error count; see
+    turnstile.metrics:SummaryMetrics.summary() for details.
+
+    If "control.remote" is enabled, the command is processed by the
+    remote_daemon process, whose middleware serves no requests; the
+    middleware's metrics are then omitted, rather than reported as
+    zeros.
+    """
+
+    if not channel:
+        # No place to reply to
+        return
+
+    summary = {
+        'node': (daemon.config['control'].get('node_name') or
+                 socket.gethostname()),
+        'pid': os.getpid(),
+        'limit_sum': daemon.limits.limit_sum,
+        'reloads_requested': daemon.reload_counts['requested'],
+        'reloads_coalesced': daemon.reload_counts['coalesced'],
+        'reloads': daemon.reload_counts['performed'],
+        'cache_hit_rate': None,
+    }
+
+    # Fold in the middleware's metrics, if we have a middleware
+    # which is actually serving requests
+    middleware = daemon.middleware
+    if middleware is not None and daemon.serves_requests:
+        summary['limit_sum'] = middleware.limit_sum or summary['limit_sum']
+        summary.update(middleware.metrics.summary())
+
+    # And send it
+    with utils.ignore_except():
+        daemon.db.publish(channel, 'stats:' + msgpack.dumps(summary))
+
+
 @register('reload')
-def reload(daemon, load_type=None, spread=None):
+def reload(daemon, load_type=None, spread=None, *flags):
     """
     Process the 'reload' control message.
 
@@ -359,6 +978,13 @@ def reload(daemon, load_type=None, spread=None):
                    should be scheduled.  If not provided, falls
                    back to configuration.
 
+    The arguments may be followed by the marker 'versioned', which
+    tools that maintain the limits version key add to their reload
+    commands.  Such a reload retrieves the limits only if the version
+    key shows they have changed; reload commands without the marker
+    may come from older tools, which change the limits without
+    updating the version key, so they always retrieve the limits.
+
     If a recognized load_type is not given, or is given as
     'spread' but the spread parameter is not a valid float, the
     configuration will be checked for the 'redis.reload_spread'
@@ -367,6 +993,13 @@ def reload(daemon, load_type=None, spread=None):
     redis.reload_spread).
     """
 
+    # Strip off the version marker
+    args = [arg for arg in (load_type, spread) + flags if arg is not None]
+    versioned = bool(args) and args[-1] == 'versioned'
+    if versioned:
+        args.pop()
+    load_type, spread = (args + [None, None])[:2]
+
     # Figure out what type of reload this needs to be
     if load_type == 'immediate':
         spread = None
@@ -388,9 +1021,189 @@ def reload(daemon, load_type=None, spread=None):
             # No valid configuration
             spread = None
 
+    # Unless the reload came from a tool which maintains the version
+    # key, always fetch the limits
     if spread:
         # Apply a randomization to spread the load around
-        eventlet.spawn_after(random.random() * spread, daemon.reload)
+        daemon.schedule_reload(random.random() * spread,
+                               full=not versioned)
+    else:
+        # Schedule in immediate mode
+        daemon.schedule_reload(full=not versioned)
+
+
+def _profile_reply(daemon, channel, status, message):
+    """
+    Send a reply to one of the profiling commands.
+
+    :param daemon: The control daemon; used to get at the
+                   configuration and the database.
+    :param channel: The publish channel to which to send the
+                    response.  If empty, no reply is sent.
+    :param status: The status of the profiler, e.g., "started",
+                   "saved", or "error".
+    :param message: A message describing the status.
+    """
+
+    if not channel:
+        # No place to reply to
+        return
+
+    # Get our configured node name
+    node_name = daemon.config['control'].get('node_name', '')
+
+    # And send the reply
+    with utils.ignore_except():
+        daemon.db.publish(channel, ':'.join(['profile', node_name,
+                                             status, message]))
+
+
+def _profile_finish(daemon, channel=None):
+    """
+    Stop the running profiler, save the results, and send a summary
+    of the profile to the reply channels.
+
+    :param daemon: The control daemon.
+    :param channel: An additional channel to send the summary to.
+    """
+
+    prof, filename, start_channel, _timer = daemon.profiling
+    daemon.profiling = None
+    prof.stop()
+
+    try:
+        prof.save(filename)
+    except Exception as exc:
+        LOG.exception("Failed to save profile to %r" % filename)
+        status, message = 'error', 'failed to save %s: %s' % (filename, exc)
     else:
-        # Spawn in immediate mode
-        eventlet.spawn_n(daemon.reload)
+        status, message = 'saved', '%s (%s)' % (filename, prof.summary())
+
+    for chan in set([start_channel, channel]):
+        _profile_reply(daemon, chan, status, message)
+
+
+@register('limit_set')
+def limit_set(daemon, score, uuid):
+    """
+    Process the 'limit_set' control message, issued when a single
+    limit has been added or updated using
+    turnstile.database:limit_set().
+
+    :param daemon: The control daemon; used to reload the limit.
+    :param score: The score of the limit in the database.
+    :param uuid: The UUID of the limit.
+    """
+
+    daemon.reload_limit(uuid, float(score))
+
+
+@register('limit_delete')
+def limit_delete(daemon, uuid):
+    """
+    Process the 'limit_delete' control message, issued when a single
+    limit has been removed using turnstile.database:limit_delete().
+
+    :param daemon: The control daemon; used to remove the limit.
+    :param uuid: The UUID of the limit.
+    """
+
+    daemon.remove_limit(uuid)
+
+
+@register('profile_start')
+def profile_start(daemon, channel, duration=None, mode='sample'):
+    """
+    Process the 'profile_start' control message.
+
+    :param daemon: The control daemon; used to get at the
+                   configuration and the database.
+    :param channel: The publish channel to which to send the
+                    responses.
+    :param duration: Optional time, in seconds, for which to run the
+                     profiler.  May not exceed the configured
+                     'control.profile_max_duration' (60 seconds by
+                     default), which is also the default.
+    :param mode: Optional profiler mode.  If 'sample' (the default),
+                 a low-overhead sampling profiler is used, and the
+                 results are saved as collapsed stacks.  If 'pstats',
+                 the deterministic cProfile profiler is used, and the
+                 results are saved in the pstats format.
+
+    Starts a profiler within the process running the control daemon.
+    The profiler is stopped when the duration expires or when a
+    'profile_stop' command is received; the results are then written
+    to the directory named by the 'control.profile_dir'
+    configuration, and a summary is sent to the named channel.
+    Profiling is disabled unless 'control.profile_dir' is configured.
+    Replies have the form "profile:<node name>:<status>:<message>".
+    """
+
+    control_args = daemon.config['control']
+
+    # Make sure profiling is enabled and not already running
+    profile_dir = control_args.get('profile_dir')
+    if not profile_dir:
+        _profile_reply(daemon, channel, 'error', 'profiling not enabled')
+        return
+    elif daemon.profiling:
+        _profile_reply(daemon, channel, 'error', 'profiler already running')
+        return
+    elif mode not in profiler.profilers:
+        _profile_reply(daemon, channel, 'error', 'unknown mode %r' % mode)
+        return
+
+    # Figure out how long to profile for
+    try:
+        max_duration = float(control_args['profile_max_duration'])
+    except (TypeError, ValueError, KeyError):
+        max_duration = 60.0
+    try:
+        duration = min(float(duration), max_duration)
+    except (TypeError, ValueError):
+        duration = max_duration
+
+    # Select a file name for the results
+    prof = profiler.profilers[mode]()
+    filename = os.path.join(profile_dir, 'turnstile-%s-%d-%d.%s' % (
+        control_args.get('node_name') or socket.gethostname(),
+        os.getpid(), int(time.time()), prof.extension))
+
+    # Start the profiler and schedule it to be stopped; the sampling
+    # profiler can only be started in the main thread
+    try:
+        prof.start()
+    except Exception as exc:
+        LOG.exception("Failed to start %s profiler" % mode)
+        _profile_reply(daemon, channel, 'error',
+                       'failed to start profiler: %s' % exc)
+        return
+    timer = eventlet.spawn_after(duration, _profile_finish, daemon)
+    daemon.profiling = (prof, filename, channel, timer)
+
+    _profile_reply(daemon, channel, 'started',
+                   '%s for %g seconds' % (mode, duration))
+
+
+@register('profile_stop')
+def profile_stop(daemon, channel=None):
+    """
+    Process the 'profile_stop' control message.
+
+    :param daemon: The control daemon; used to get at the
+                   configuration and the database.
+    :param channel: Optional publish channel to which to send the
+                    response.  The summary of the profile is also
+                    sent to the channel given to 'profile_start'.
+
+    Stops a profiler started by the 'profile_start' command before
+    its duration expires, saving the results.
+    """
+
+    if not daemon.profiling:
+        _profile_reply(daemon, channel, 'error', 'profiler not running')
+        return
+
+    # Cancel the scheduled stop and finish up now
+    daemon.profiling[3].cancel()
+    _profile_finish(daemon, channel)
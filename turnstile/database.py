@@ -13,6 +13,8 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import hashlib
+
 import msgpack
 import redis
 
@@ -120,7 +122,77 @@ def limits_hydrate(db, lims):
                  database.
     """
 
-    return [limits.Limit.hydrate(db, lim) for lim in lims]
+    # Hydration consumes the dictionary, so hydrate a copy
+    return [limits.Limit.hydrate(db, dict(lim)) for lim in lims]
+
+
+def limits_checksum(lims):
+    """
+    Compute the checksum of a list of limits.
+
+    :param lims: A list of the msgpack'd limit strings, in order.
+
+    :returns: The checksum, as a hex string.
+    """
+
+    chksum = hashlib.md5()  # sufficient for our purposes
+    for lim in lims:
+        chksum.update(lim)
+    return chksum.hexdigest()
+
+
+def version_key(key):
+    """
+    Determine the key under which the version of the limits is
+    stored.  The version is a string of the form
+    "<generation>:<checksum>", where the generation is incremented
+    each time the limits are changed, and the checksum is the
+    checksum of the limits, as computed by limits_checksum().  It is
+    updated atomically with the limits, so nodes can determine
+    whether the limits have changed by retrieving just the version.
+
+    :param key: The key the limits are stored under.
+
+    :returns: The key the version is stored under.
+    """
+
+    return '%s:version' % key
+
+
+def parse_version(version):
+    """
+    Interpret the version of the limits.
+
+    :param version: The version, as retrieved from the database.  May
+                    be None.
+
+    :returns: A tuple of the generation and the checksum.  If the
+              version is missing or cannot be interpreted, the
+              generation will be 0 and the checksum will be None.
+    """
+
+    try:
+        generation, _sep, chksum = version.partition(':')
+        return int(generation), chksum or None
+    except (AttributeError, ValueError):
+        return 0, None
+
+
+def _set_version(pipe, key, version, lims):
+    """
+    Helper function to update the version of the limits.  Must be
+    called within the transaction updating the limits.
+
+    :param pipe: The pipeline, in transaction mode.
+    :param key: The key the limits are stored under.
+    :param version: The previous version, as retrieved from the
+                    database.
+    :param lims: The new list of msgpack'd limit strings, in order.
+    """
+
+    generation, _chksum = parse_version(version)
+    pipe.set(version_key(key),
+             '%d:%s' % (generation + 1, limits_checksum(lims)))
 
 
 def limit_update(db, key, limits):
@@ -134,7 +206,8 @@ def limit_update(db, key, limits):
 
     The limits list currently in the database will be atomically
     changed to match the new list.  This is done using the pipeline()
-    method.
+    method.  The version of the limits is updated in the same
+    transaction; see version_key().
     """
 
     # Start by dehydrating all the limits
@@ -146,10 +219,11 @@ def limit_update(db, key, limits):
         while True:
             try:
                 # Watch for changes to the key
-                pipe.watch(key)
+                pipe.watch(key, version_key(key))
 
-                # Look up the existing limits
+                # Look up the existing limits and version
                 existing = set(pipe.zrange(key, 0, -1))
+                version = pipe.get(version_key(key))
 
                 # Start the transaction...
                 pipe.multi()
@@ -162,6 +236,9 @@ def limit_update(db, key, limits):
                 for idx, lim in enumerate(desired):
                     pipe.zadd(key, (idx + 1) * 10, lim)
 
+                # Update the version
+                _set_version(pipe, key, version, desired)
+
                 # Execute the transaction
                 pipe.execute()
             except redis.WatchError:
@@ -172,6 +249,127 @@ def limit_update(db, key, limits):
                 break
 
 
+def _find_limit(pipe, key, uuid):
+    """
+    Helper function to locate a limit in the database by its UUID.
+
+    :param pipe: A pipeline, which must be watching the key.
+    :param key: The key the limits are stored under.
+    :param uuid: The UUID of the limit to look for.
+
+    :returns: A tuple of the msgpack'd limit string and its score, or
+              (None, None) if the limit is not present, and the list
+              of all the limits, as tuples of the msgpack'd limit
+              string and its score.
+    """
+
+    found = None, None
+    items = pipe.zrange(key, 0, -1, withscores=True)
+    for lim, score in items:
+        if msgpack.loads(lim).get('uuid') == uuid:
+            found = lim, score
+
+    return found, items
+
+
+def limit_set(db, key, limit):
+    """
+    Safely adds or updates a single limit in the database.  The limit
+    is identified by its UUID; an existing limit with the same UUID
+    is replaced, keeping its position in the list of limits, and a
+    new limit is added to the end of the list.
+
+    :param db: The database handle.
+    :param key: The key the limits are stored under.
+    :param limit: The limit object, which must understand the
+                  dehydrate() method.
+
+    :returns: The score of the limit in the sorted set of limits.
+              Nodes must be informed of the change by issuing a
+              'limit_set' command with the score and the UUID of the
+              limit.
+    """
+
+    desired = msgpack.dumps(limit.dehydrate())
+
+    with db.pipeline() as pipe:
+        while True:
+            try:
+                # Watch for changes to the key
+                pipe.watch(key, version_key(key))
+
+                # Look for the existing limit
+                (existing, score), items = _find_limit(pipe, key,
+                                                       limit.uuid)
+                version = pipe.get(version_key(key))
+                if score is None:
+                    score = max([s for _lim, s in items] or [0]) + 10
+
+                # Compute the new list of limits
+                items = [item for item in items if item[0] != existing]
+                items.append((desired, score))
+                items.sort(key=lambda x: x[1])
+
+                # Start the transaction...
+                pipe.multi()
+
+                # Replace the limit
+                if existing is not None:
+                    pipe.zrem(key, existing)
+                pipe.zadd(key, score, desired)
+                _set_version(pipe, key, version,
+                             [lim for lim, _score in items])
+
+                # Execute the transaction
+                pipe.execute()
+            except redis.WatchError:
+                # Try again...
+                continue
+            else:
+                return score
+
+
+def limit_delete(db, key, uuid):
+    """
+    Safely removes a single limit from the database.
+
+    :param db: The database handle.
+    :param key: The key the limits are stored under.
+    :param uuid: The UUID of the limit to remove.
+
+    :returns: True if the limit was removed, False if no limit with
+              the given UUID exists.  Nodes must be informed of the
+              removal by issuing a 'limit_delete' command with the
+              UUID of the limit.
+    """
+
+    with db.pipeline() as pipe:
+        while True:
+            try:
+                # Watch for changes to the key
+                pipe.watch(key, version_key(key))
+
+                # Look for the existing limit
+                (existing, _score), items = _find_limit(pipe, key, uuid)
+                if existing is None:
+                    pipe.unwatch()
+                    return False
+                version = pipe.get(version_key(key))
+
+                # Remove it
+                pipe.multi()
+                pipe.zrem(key, existing)
+                _set_version(pipe, key, version,
+                             [lim for lim, _score in items
+                              if lim != existing])
+                pipe.execute()
+            except redis.WatchError:
+                # Try again...
+                continue
+            else:
+                return True
+
+
 def command(db, channel, command, *args):
     """
     Utility function to issue a command to all Turnstile instances.
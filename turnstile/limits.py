@@ -13,6 +13,7 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import hashlib
 import json
 import math
 import re
@@ -21,7 +22,9 @@ import uuid
 
 import metatools
 import msgpack
+import redis
 
+from turnstile import metrics
 from turnstile import utils
 
 
@@ -107,6 +110,132 @@ class TimeUnit(object):
         return self.value
 
 
+def compactor_settings(config):
+    """
+    Interpret the compactor configuration used when processing
+    requests.
+
+    :param config: The dictionary of compactor options, i.e., the
+                   "compactor" section of the Turnstile configuration.
+
+    :returns: A tuple of the maximum number of updates (None if
+              compaction is not enabled), the maximum age of a
+              "summarize" record, and the name of the sorted set used
+              to communicate with the compactor daemon.
+    """
+
+    try:
+        max_updates = int(config['max_updates'])
+    except (KeyError, ValueError):
+        max_updates = None
+    try:
+        max_age = int(config['max_age'])
+    except (KeyError, ValueError):
+        max_age = 600
+
+    return max_updates, max_age, config.get('compactor_key', 'compactor')
+
+
+# Metrics emitter used when none is configured
+_null_metrics = metrics.Metrics()
+
+
+class RequestContext(object):
+    """
+    Per-request information shared by all the limits applied to a
+    request.  The middleware builds one of these for each request and
+    stores it in the environment under the "turnstile.context" key,
+    so that the limits don't each have to recompute it.  The following
+    attributes are available:
+
+      method
+        The request method.
+
+      time
+        The time at which processing of the request began.  This is
+        used as the timestamp of the bucket updates.
+
+      compactor
+        A tuple of the compactor settings, as returned by
+        compactor_settings().
+
+      query_keys
+        A set of the names of the query arguments present in the
+        request, or None if the request has no query string.  This is
+        computed on first access.
+
+      metrics
+        The metrics emitter, a turnstile.metrics:Metrics object.
+
+    A Redis pipeline shared by the limits may be obtained using the
+    pipeline() method.
+    """
+
+    def __init__(self, environ, compactor=None, metrics=None):
+        """
+        Initialize a RequestContext.
+
+        :param environ: The WSGI environment for the request.
+        :param compactor: A tuple of the compactor settings, as
+                          returned by compactor_settings().  If not
+                          given, the settings are drawn from the
+                          configuration in the environment, if
+                          present.
+        :param metrics: The metrics emitter.  If not given, metrics
+                        are discarded.
+        """
+
+        self.environ = environ
+        self.method = environ.get('REQUEST_METHOD')
+        self.time = time.time()
+
+        # Interpret the compactor configuration, if we have to
+        if compactor is None:
+            if 'turnstile.conf' in environ:
+                compactor = compactor_settings(
+                    environ['turnstile.conf']['compactor'])
+            else:
+                compactor = (None, 600, 'compactor')
+        self.compactor = compactor
+        self.metrics = metrics or _null_metrics
+
+        self._query_keys = None
+        self._query_parsed = False
+        self._pipeline = None
+        self._pipeline_db = None
+
+    @property
+    def query_keys(self):
+        """
+        Retrieve the set of query argument names present in the
+        request, or None if the request has no query string.
+        """
+
+        if not self._query_parsed:
+            if 'QUERY_STRING' in self.environ:
+                self._query_keys = set(
+                    qstr.partition('=')[0] for qstr in
+                    self.environ['QUERY_STRING'].split('&'))
+            self._query_parsed = True
+
+        return self._query_keys
+
+    def pipeline(self, db):
+        """
+        Retrieve a non-transactional pipeline for the given database.
+        The pipeline is created on first use and reused for the
+        remainder of the request.
+
+        :param db: The database handle.
+        """
+
+        if self._pipeline is None or self._pipeline_db is not db:
+            self._pipeline = db.pipeline(transaction=False)
+            self._pipeline_db = db
+
+        return self._pipeline
+
+
 class BucketKey(object):
     """
     Represent a bucket key.  This class provides functionality to
@@ -118,26 +247,35 @@ class BucketKey(object):
     Instances of this class have three attributes:
 
       uuid
-        The UUID of the corresponding limit.
+        The UUID of the corresponding limit.  For version 3 keys, this
+        may instead be the short numeric key ID of the limit, as a
+        string.
 
       params
         A dictionary of the request parameters corresponding to the
-        bucket.
+        bucket.  Version 3 keys cannot be decoded back into their
+        parameters; for decoded version 3 keys, this will be None.
 
       version
         An integer specifying the version of the bucket key.  At
-        present, only two versions (1 and 2) are available.  Version 1
-        buckets are stored as a msgpack'd dictionary in a string field
-        in the Redis database, while version 2 buckets are stored as a
-        list of msgpack'd dictionaries.
+        present, three versions (1, 2, and 3) are available.  Version
+        1 buckets are stored as a msgpack'd dictionary in a string
+        field in the Redis database, while version 2 and 3 buckets are
+        stored as a list of msgpack'd dictionaries.  Version 3 keys
+        replace the encoded parameters of a version 2 key with a
+        fixed-length binary digest, to reduce the memory used by the
+        keys in the Redis database.
 
     To obtain the string key, use str() on instances of this class.
     """
 
     # Map prefixes to versions and vice versa
-    _prefix_to_version = dict(bucket=1, bucket_v2=2)
+    _prefix_to_version = dict(bucket=1, bucket_v2=2, b3=3)
     _version_to_prefix = dict((v, k) for k, v in _prefix_to_version.items())
 
+    # The length of the digest in a version 3 key
+    _DIGEST_LEN = 16
+
     # Regular expressions for encoding and decoding
     _ENC_RE = re.compile('[/%]')
     _DEC_RE = re.compile('%([a-fA-F0-9]{2})')
@@ -156,6 +294,15 @@ class BucketKey(object):
         value = cls._DEC_RE.sub(lambda x: '%c' % int(x.group(1), 16), value)
         return json.loads(value)
 
+    @classmethod
+    def _digest(cls, value):
+        """
+        Compute the digest used in version 3 keys from the string form
+        of the equivalent version 2 key.
+        """
+
+        return hashlib.md5(value).digest()
+
     def __init__(self, uuid, params, version=2):
         """
         Initialize a BucketKey.
@@ -186,11 +333,18 @@ class BucketKey(object):
 
         # If not cached, serialize the key
         if self._cache is None:
-            parts = ['%s:%s' % (self._version_to_prefix[self.version],
-                                self.uuid)]
-            parts.extend('%s=%s' % (k, self._encode(v)) for k, v in
-                         sorted(self.params.items(), key=lambda x: x[0]))
-            self._cache = '/'.join(parts)
+            if self.version == 3:
+                # Digest the equivalent version 2 key
+                canonical = str(self.__class__(self.uuid, self.params))
+                self._cache = '%s:%s/%s' % (self._version_to_prefix[3],
+                                            self.uuid,
+                                            self._digest(canonical))
+            else:
+                parts = ['%s:%s' % (self._version_to_prefix[self.version],
+                                    self.uuid)]
+                parts.extend('%s=%s' % (k, self._encode(v)) for k, v in
+                             sorted(self.params.items(), key=lambda x: x[0]))
+                self._cache = '/'.join(parts)
 
         return self._cache
 
@@ -211,6 +365,19 @@ class BucketKey(object):
             raise ValueError("%r is not a bucket key" % key)
         version = cls._prefix_to_version[prefix]
 
+        # Version 3 keys contain only the limit identifier and the
+        # digest; the digest may contain any byte, so don't split it
+        if version == 3:
+            uuid, sep, digest = param_str.partition('/')
+            if sep != '/' or len(digest) != cls._DIGEST_LEN:
+                raise ValueError("Cannot interpret hashed bucket key %r" %
+                                 key)
+
+            # The parameters can't be recovered, but we have the key
+            result = cls(uuid, None, version=version)
+            result._cache = key
+            return result
+
         # Take the parameters apart...
         parts = param_str.split('/')
         uuid = parts.pop(0)
@@ -229,6 +396,98 @@ class BucketKey(object):
         return cls(uuid, params, version=version)
 
 
+class BucketKeyBuilder(object):
+    """
+    Build version 2 or 3 bucket keys for a fixed set of parameter
+    names.  The key prefix and the per-parameter name fragments are
+    computed once, when the builder is created; building a key is then
+    a join over the parameter values in a fixed order.  Values which
+    are plain strings or integers are encoded without going through
+    the JSON encoder, as long as doing so is guaranteed to produce the
+    same text.  The keys built are identical to those produced by
+    str(BucketKey(uuid, params, version)).
+
+    If the parameters passed do not exactly match the parameter names
+    the builder was compiled for--as may happen if a limit's filter()
+    method adds parameters--the key is built by BucketKey instead.
+    """
+
+    # Strings consisting only of these characters encode to
+    # themselves, surrounded by double quotes; this excludes
+    # non-printable and non-ASCII characters, '"' and '\' (which
+    # json.dumps() escapes), and '%' and '/' (which _encode() escapes)
+    _SAFE_RE = re.compile(r'[ !#$&-.0-\[\]-~]*\Z')
+
+    def __init__(self, uuid, names, version=2):
+        """
+        Initialize a BucketKeyBuilder.
+
+        :param uuid: The UUID of the limit the buckets correspond to.
+                     For version 3 keys, this may be the key ID of the
+                     limit instead.
+        :param names: A sequence of the names of the request
+                      parameters which will be used to construct the
+                      bucket keys.
+        :param version: The version of the bucket keys to build.
+                        Optional; defaults to 2.  Must be 2 or 3.
+        """
+
+        if version not in (2, 3):
+            raise ValueError("Cannot build bucket key version %r" % version)
+
+        self.uuid = uuid
+        self.version = version
+        self.prefix = '%s:%s' % (BucketKey._version_to_prefix[2], uuid)
+        self.hash_prefix = '%s:%s/' % (BucketKey._version_to_prefix[3], uuid)
+
+        # Precompute the name fragment for each parameter, in the
+        # order the parameters will appear in the key
+        self.fields = [(name, '/%s=' % name) for name in sorted(set(names))]
+
+    @classmethod
+    def _encode(cls, value):
+        """
+        Encode the given value.  Equivalent to BucketKey._encode(),
+        but avoids the JSON encoder for common scalar types.
+        """
+
+        value_type = type(value)
+        if value_type is str or value_type is unicode:
+            if cls._SAFE_RE.match(value):
+                return '"%s"' % str(value)
+        elif value_type is int or value_type is long:
+            return str(value)
+
+        return BucketKey._encode(value)
+
+    def __call__(self, params):
+        """
+        Build the string form of the bucket key.
+
+        :param params: A dictionary of the request parameters
+                       corresponding to the bucket.
+        """
+
+        # Fall back to BucketKey unless the parameter names match
+        # exactly
+        if len(params) != len(self.fields):
+            return str(BucketKey(self.uuid, params, version=self.version))
+
+        parts = [self.prefix]
+        try:
+            for name, fragment in self.fields:
+                parts.append(fragment)
+                parts.append(self._encode(params[name]))
+        except KeyError:
+            return str(BucketKey(self.uuid, params, version=self.version))
+
+        # Hash the key, if requested
+        if self.version == 3:
+            return self.hash_prefix + BucketKey._digest(''.join(parts))
+
+        return ''.join(parts)
+
+
 class BucketLoader(object):
     """
     Load a bucket from its list representation.
@@ -636,6 +895,26 @@ class Limit(object):
             type=bool,
             default=True,
         ),
+        key_hash=dict(
+            desc=('A boolean which selects the form of the bucket keys.  '
+                  'If False (the default), the request parameters are '
+                  'encoded into the bucket key.  If True, the bucket key '
+                  'contains a fixed-length digest of the parameters '
+                  'instead, which uses less memory in the database.  Note '
+                  'that the parameters cannot be recovered from such a '
+                  'bucket key, and that changing this value resets all '
+                  'the buckets for the limit.'),
+            type=bool,
+            default=False,
+        ),
+        key_id=dict(
+            desc=('A short integer identifying the limit.  If provided, '
+                  'and if "key_hash" is True, this is used in place of the '
+                  'UUID in bucket keys.  Must be unique among all the '
+                  'configured limits.  Optional.'),
+            type=int,
+            default=None,
+        ),
     )
 
     bucket_class = Bucket
@@ -652,6 +931,10 @@ class Limit(object):
 
         self.db = db
 
+        # The bucket key builder is compiled once the attributes are
+        # set
+        self._key_builder = None
+
         # Save the various arguments
         missing = set()
         for attr, desc in self.attrs.items():
@@ -679,6 +962,9 @@ class Limit(object):
             raise TypeError("Missing required attributes: %s" %
                             ', '.join(sorted(missing)))
 
+        # Compile the bucket key builder
+        self._key_builder = self._compile_key()
+
     def __repr__(self):
         """
         Return a representation of the limit.
@@ -792,7 +1078,7 @@ class Limit(object):
             key = BucketKey.decode(key)
 
         # Make sure the uuids match
-        if key.uuid != self.uuid:
+        if key.uuid != self.uuid and key.uuid != self.key_ident:
             raise ValueError("%s is not a bucket corresponding to this limit" %
                              key)
 
@@ -828,10 +1114,15 @@ class Limit(object):
         key = BucketKey.decode(key)
 
         # Make sure the uuids match
-        if key.uuid != self.uuid:
+        if key.uuid != self.uuid and key.uuid != self.key_ident:
             raise ValueError("%s is not a bucket corresponding to this limit" %
                              key)
 
+        # Hashed keys can't be decoded
+        if key.params is None:
+            raise ValueError("Cannot decode parameters from hashed bucket "
+                             "key %r" % str(key))
+
         return key.params
 
     def key(self, params):
@@ -844,7 +1135,23 @@ class Limit(object):
                        from routes.
         """
 
-        return str(BucketKey(self.uuid, params))
+        # Recompile the builder if the UUID or parameters changed
+        if self._key_builder is None:
+            self._key_builder = self._compile_key()
+
+        return self._key_builder(params)
+
+    def _compile_key(self):
+        """
+        Compile the bucket key builder for this limit.
+
+        :returns: A BucketKeyBuilder instance.
+        """
+
+        if self.key_hash:
+            return BucketKeyBuilder(self.key_ident, self.use, version=3)
+
+        return BucketKeyBuilder(self.uuid, self.use)
 
     def _filter(self, environ, params):
         """
@@ -853,33 +1160,31 @@ class Limit(object):
         if the call should not be limited, or True to apply the limit.
         """
 
+        # Get the request context; if the middleware didn't set one
+        # up, build one and share it with the other limits
+        context = environ.get('turnstile.context')
+        if context is None:
+            context = RequestContext(environ)
+            environ['turnstile.context'] = context
+
         # Search for required query arguments
         if self.queries:
             # No query string available
-            if 'QUERY_STRING' not in environ:
+            available = context.query_keys
+            if available is None:
                 return False
 
-            # Extract the list of provided query arguments from the
-            # QUERY_STRING
-            available = set(qstr.partition('=')[0] for qstr in
-                            environ['QUERY_STRING'].split('&'))
-
             # Check if we have the required query arguments
-            required = set(self.queries)
-            if not required.issubset(available):
+            if not available.issuperset(self.queries):
                 return False
 
         # Use only the parameters listed in use; we'll add the others
-        # back later
+        # back later.  (keys() returns a list, so we can change the
+        # dictionary while traversing it.)
         unused = {}
-        for key, value in params.items():
+        for key in params.keys():
             if key not in self.use:
-                unused[key] = value
-
-        # Do this in a separate step so we avoid changing a
-        # dictionary during traversal
-        for key in unused:
-            del params[key]
+                unused[key] = params.pop(key)
 
         # First, we need to set up any additional params required to
         # get the bucket.  If the DeferLimit exception is thrown, no
@@ -896,14 +1201,52 @@ class Limit(object):
         params.update(unused)
         params.update(additional)
 
-        # Get the current time
-        now = time.time()
+        # Update the bucket, keeping track of the outcome
+        stats = context.metrics
+        if stats.enabled:
+            stats.incr('limit.%s.match' % self.uuid)
+        try:
+            loader = self._update_bucket(environ, context, key, params)
+        except Exception as exc:
+            if stats.enabled:
+                stats.incr('limit.%s.error' % self.uuid)
+                if isinstance(exc, redis.RedisError):
+                    stats.incr('redis.errors')
+            raise
+        if stats.enabled and loader.delay is not None:
+            stats.incr('limit.%s.reject' % self.uuid)
+
+        # Should we continue the route scan?
+        return not self.continue_scan
+
+    def _update_bucket(self, environ, context, key, params):
+        """
+        Pushes an update record for the request into the bucket, loads
+        the bucket, and applies the result.  If the request must be
+        delayed, the delay is stored in the environment.
+
+        :param environ: The WSGI environment for the request.
+        :param context: The RequestContext for the request.
+        :param key: The bucket key.
+        :param params: The parameters for the update record.
+
+        :returns: The BucketLoader used to load the bucket.
+        """
+
+        stats = context.metrics
+
+        # Get the time the request was received
+        now = context.time
+
+        # The database commands are sent in two batches, using a
+        # pipeline shared with the other limits
+        pipe = context.pipeline(self.db)
 
         # Allow up to a minute to mutate the bucket record.  If no
         # bucket exists currently, this is essentially a no-op, and
         # the bucket won't expire anyway, once the update record is
         # pushed.
-        self.db.expire(key, 60)
+        pipe.expire(key, 60)
 
         # Push an update record
         update_uuid = str(uuid.uuid4())
@@ -914,45 +1257,41 @@ class Limit(object):
                 'time': now,
             },
         }
-        self.db.rpush(key, msgpack.dumps(update))
+        pipe.rpush(key, msgpack.dumps(update))
 
         # Now suck in the bucket
-        records = self.db.lrange(key, 0, -1)
-        loader = BucketLoader(self.bucket_class, self.db, self, key, records)
+        pipe.lrange(key, 0, -1)
+        with stats.timer('redis.load'):
+            records = pipe.execute()[-1]
+        with stats.timer('bucket.load'):
+            loader = BucketLoader(self.bucket_class, self.db, self, key,
+                                  records)
+        stats.histogram('bucket.updates', loader.updates)
 
         # Determine if we should initialize the compactor algorithm on
         # this bucket
-        if 'turnstile.conf' in environ:
-            config = environ['turnstile.conf']['compactor']
-            try:
-                max_updates = int(config['max_updates'])
-            except (KeyError, ValueError):
-                max_updates = None
-            try:
-                max_age = int(config['max_age'])
-            except (KeyError, ValueError):
-                max_age = 600
-            if max_updates and loader.need_summary(now, max_updates, max_age):
-                # Add a summary record; we want to do this before
-                # instructing the compactor to compact.  If we did the
-                # compactor instruction first, and a crash occurred
-                # before adding the summarize record, the lack of
-                # quiesence could cause two compactor threads to run
-                # on the same bucket, leading to a race condition that
-                # could corrupt the bucket.  With this ordering, if a
-                # crash occurs before the compactor instruction, the
-                # maximum aging applied to summarize records will
-                # cause this logic to eventually be retriggered, which
-                # should allow the compactor instruction to be issued.
-                summarize = dict(summarize=now, uuid=str(uuid.uuid4()))
-                self.db.rpush(key, msgpack.dumps(summarize))
-
-                # Instruct the compactor to compact this record
-                compactor_key = config.get('compactor_key', 'compactor')
-                self.db.zadd(compactor_key, int(math.ceil(now)), key)
+        max_updates, max_age, compactor_key = context.compactor
+        if max_updates and loader.need_summary(now, max_updates, max_age):
+            # Add a summary record; we want to do this before
+            # instructing the compactor to compact.  If we did the
+            # compactor instruction first, and a crash occurred before
+            # adding the summarize record, the lack of quiesence could
+            # cause two compactor threads to run on the same bucket,
+            # leading to a race condition that could corrupt the
+            # bucket.  With this ordering, if a crash occurs before
+            # the compactor instruction, the maximum aging applied to
+            # summarize records will cause this logic to eventually be
+            # retriggered, which should allow the compactor
+            # instruction to be issued.  (The pipeline preserves the
+            # ordering of the commands.)
+            summarize = dict(summarize=now, uuid=str(uuid.uuid4()))
+            pipe.rpush(key, msgpack.dumps(summarize))
+
+            # Instruct the compactor to compact this record
+            pipe.zadd(compactor_key, int(math.ceil(now)), key)
 
         # Set the expire on the bucket
-        self.db.expireat(key, loader.bucket.expire)
+        pipe.expireat(key, loader.bucket.expire)
 
         # If we found a delay, store the particulars in the
         # environment; this will later be sorted and an error message
@@ -966,10 +1305,13 @@ class Limit(object):
         # database set
         set_name = environ.get('turnstile.bucket_set')
         if set_name:
-            self.db.zadd(set_name, loader.bucket.expire, key)
+            pipe.zadd(set_name, loader.bucket.expire, key)
 
-        # Should we continue the route scan?
-        return not self.continue_scan
+        # Send the second batch of commands
+        with stats.timer('redis.update'):
+            pipe.execute()
+
+        return loader
 
     def filter(self, environ, params, unused):
         """
@@ -1022,6 +1364,88 @@ class Limit(object):
 
         return status, entity
 
+    @property
+    def uuid(self):
+        """Retrieve the UUID for this limit."""
+
+        return self._uuid
+
+    @uuid.setter
+    def uuid(self, value):
+        """Change the UUID for this limit."""
+
+        self._uuid = value
+        self._key_builder = None
+
+    @property
+    def use(self):
+        """
+        Retrieve the list of parameters used to construct the bucket
+        key.
+        """
+
+        return self._use
+
+    @use.setter
+    def use(self, value):
+        """
+        Change the list of parameters used to construct the bucket
+        key.  Note that the list should be replaced, rather than
+        modified in place, so that the bucket key builder is
+        recompiled.
+        """
+
+        self._use = value
+        self._key_builder = None
+
+    @property
+    def key_hash(self):
+        """
+        Retrieve the flag indicating whether bucket keys for this
+        limit are hashed.
+        """
+
+        return self._key_hash
+
+    @key_hash.setter
+    def key_hash(self, value):
+        """
+        Change the flag indicating whether bucket keys for this limit
+        are hashed.
+        """
+
+        self._key_hash = value
+        self._key_builder = None
+
+    @property
+    def key_id(self):
+        """Retrieve the short key ID for this limit."""
+
+        return self._key_id
+
+    @key_id.setter
+    def key_id(self, value):
+        """Change the short key ID for this limit."""
+
+        if value is not None and value <= 0:
+            raise ValueError("Limit key ID must be > 0")
+
+        self._key_id = value
+        self._key_builder = None
+
+    @property
+    def key_ident(self):
+        """
+        Retrieve the identifier used for this limit in bucket keys.
+        This is the key ID, if one is set and bucket keys are hashed,
+        or the UUID otherwise.
+        """
+
+        if self.key_hash and self.key_id is not None:
+            return str(self.key_id)
+
+        return self.uuid
+
     @property
     def value(self):
         """Retrieve the value for this limit."""
@@ -0,0 +1,954 @@
+# Copyright 2013 Rackspace
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import fnmatch
+import time
+
+import eventlet.queue
+import redis
+
+from turnstile import utils
+
+
+# The in-memory servers, keyed by host and port
+_servers = {}
+
+# Methods of MemoryRedis which may not be queued in a pipeline
+_PIPELINE_EXCLUDES = set(['pipeline', 'pubsub', 'info'])
+
+# Methods of a wrapped database handle which do not issue commands;
+# see CountingDatabase
+_UNCOUNTED = set(['pubsub', 'register_script', 'lock'])
+
+
+class MemoryServer(object):
+    """
+    Represents the state of an in-memory "server."  This contains the
+    data for each of the server's databases, along with the
+    subscriptions to the server's publish-subscribe channels.
+    """
+
+    def __init__(self):
+        """
+        Initialize a MemoryServer.
+        """
+
+        self.databases = {}
+        self.subscribers = {}
+
+    def database(self, db):
+        """
+        Retrieve the data and expiration times for a database.
+
+        :param db: The database number.
+
+        :returns: A tuple of two dictionaries; the first maps keys to
+                  values, and the second maps keys to the times at
+                  which they expire.
+        """
+
+        return self.databases.setdefault(db, ({}, {}))
+
+
+def get_server(host='localhost', port=6379):
+    """
+    Retrieve the in-memory server with the given host and port,
+    creating it if necessary.
+
+    :param host: The host name of the server.
+    :param port: The port number of the server.
+
+    :returns: A MemoryServer object.
+    """
+
+    return _servers.setdefault((host, port), MemoryServer())
+
+
+def reset(host=None, port=6379):
+    """
+    Discard the state of in-memory servers.
+
+    :param host: The host name of the server to discard.  If not
+                 given, all in-memory servers are discarded.
+    :param port: The port number of the server to discard.
+    """
+
+    if host is None:
+        _servers.clear()
+    else:
+        _servers.pop((host, port), None)
+
+
+def _range(seq, start, end):
+    """
+    Select a range of a sequence, using Redis semantics: the end
+    index is inclusive, and negative indexes count from the end of
+    the sequence.
+
+    :param seq: The sequence.
+    :param start: The index of the first element to select.
+    :param end: The index of the last element to select.
+
+    :returns: A list of the selected elements.
+    """
+
+    length = len(seq)
+    if start < 0:
+        start = max(length + start, 0)
+    if end < 0:
+        end += length
+        if end < 0:
+            return []
+
+    return list(seq[start:end + 1])
+
+
+def _score_bound(value):
+    """
+    Interpret a sorted set score bound, as passed to
+    zrangebyscore().
+
+    :param value: The bound.  May be a number, or a string such as
+                  "-inf", "+inf", or "(5" (the latter indicating an
+                  exclusive bound).
+
+    :returns: A tuple of the bound as a float and a boolean
+              indicating whether the bound is exclusive.
+    """
+
+    if isinstance(value, basestring) and value.startswith('('):
+        return float(value[1:]), True
+    return float(value), False
+
+
+def _in_bounds(score, low, high):
+    """
+    Determine whether a score falls within the given bounds.
+
+    :param score: The score.
+    :param low: The lower bound, as returned by _score_bound().
+    :param high: The upper bound, as returned by _score_bound().
+
+    :returns: True if the score is within the bounds, False
+              otherwise.
+    """
+
+    if score < low[0] or (low[1] and score == low[0]):
+        return False
+    if score > high[0] or (high[1] and score == high[0]):
+        return False
+    return True
+
+
+class MemoryRedis(object):
+    """
+    An in-memory stand-in for the StrictRedis client.  This
+    implements the subset of Redis commands used by Turnstile, and is
+    intended for use in benchmarks and tests, where the cost of a
+    Redis server is unwanted.  Clients created with the same host and
+    port share the same data, just as clients of the same Redis
+    server would.  The in-memory client may be selected by setting
+    the ``redis.redis_client`` configuration option to "memory".
+
+    Note that no attempt is made to emulate the performance of a
+    Redis server; the in-memory client is very much faster, since no
+    network round trips are required.  Also note that transactions
+    are always successful, since greenthreads cannot interrupt the
+    in-memory operations.
+    """
+
+    def __init__(self, host='localhost', port=6379, db=0, **kwargs):
+        """
+        Initialize a MemoryRedis object.
+
+        :param host: The host name of the in-memory server.
+        :param port: The port number of the in-memory server.
+        :param db: The database number.
+
+        Other keyword arguments are accepted for compatibility with
+        StrictRedis, but are ignored.
+        """
+
+        self.server = get_server(host, int(port))
+        self.db = int(db)
+        self.data, self.expires = self.server.database(self.db)
+
+    def _get(self, name, type_=None, default=None):
+        """
+        Retrieve the value of a key, discarding it if it has expired.
+
+        :param name: The name of the key.
+        :param type_: If given, the type the value must have.  A
+                      ResponseError will be raised if the value has a
+                      different type.
+        :param default: If given, a callable returning a value to set
+                        the key to if it does not exist.
+
+        :returns: The value of the key, or None if the key does not
+                  exist.
+        """
+
+        # Expire the key, if necessary
+        if name in self.expires and self.expires[name] <= time.time():
+            del self.data[name]
+            del self.expires[name]
+
+        if name not in self.data:
+            if default is None:
+                return None
+            self.data[name] = default()
+
+        value = self.data[name]
+        if type_ is not None and not isinstance(value, type_):
+            raise redis.ResponseError("WRONGTYPE Operation against a key "
+                                      "holding the wrong kind of value")
+
+        return value
+
+    def _set(self, name, value):
+        """
+        Set the value of a key, discarding any expiration time.
+
+        :param name: The name of the key.
+        :param value: The new value of the key.
+        """
+
+        self.data[name] = value
+        self.expires.pop(name, None)
+
+    def _cleanup(self, name):
+        """
+        Discard a key if its value is empty, as Redis does for empty
+        lists, sets, and sorted sets.
+
+        :param name: The name of the key.
+        """
+
+        if name in self.data and not self.data[name]:
+            del self.data[name]
+            self.expires.pop(name, None)
+
+    def get(self, name):
+        """
+        Retrieve the value of a string key.
+        """
+
+        return self._get(name, str)
+
+    def set(self, name, value, ex=None, px=None, nx=False, xx=False):
+        """
+        Set the value of a string key.
+        """
+
+        exists = self._get(name) is not None
+        if (nx and exists) or (xx and not exists):
+            return None
+
+        self._set(name, str(value))
+        if ex is not None:
+            self.expires[name] = time.time() + ex
+        elif px is not None:
+            self.expires[name] = time.time() + px / 1000.0
+
+        return True
+
+    def delete(self, *names):
+        """
+        Delete keys.
+        """
+
+        count = 0
+        for name in names:
+            if self._get(name) is not None:
+                del self.data[name]
+                self.expires.pop(name, None)
+                count += 1
+
+        return count
+
+    def exists(self, name):
+        """
+        Determine whether a key exists.
+        """
+
+        return self._get(name) is not None
+
+    def keys(self, pattern='*'):
+        """
+        List the keys matching a pattern.
+        """
+
+        return [name for name in list(self.data)
+                if fnmatch.fnmatchcase(name, pattern) and
+                self._get(name) is not None]
+
+    def dbsize(self):
+        """
+        Count the keys in the database.
+        """
+
+        return len(self.keys())
+
+    def flushdb(self):
+        """
+        Delete all keys in the database.
+        """
+
+        self.data.clear()
+        self.expires.clear()
+        return True
+
+    def expire(self, name, time_):
+        """
+        Set a key to expire after the given number of seconds.
+        """
+
+        return self.expireat(name, time.time() + time_)
+
+    def expireat(self, name, when):
+        """
+        Set a key to expire at the given time.
+        """
+
+        if self._get(name) is None:
+            return False
+
+        self.expires[name] = when
+        return True
+
+    def ttl(self, name):
+        """
+        Determine the number of seconds until a key expires.
+        """
+
+        if self._get(name) is None:
+            return -2
+        elif name not in self.expires:
+            return -1
+
+        return int(round(self.expires[name] - time.time()))
+
+    def rpush(self, name, *values):
+        """
+        Append values to a list.
+        """
+
+        lst = self._get(name, list, list)
+        lst.extend(str(v) for v in values)
+        return len(lst)
+
+    def llen(self, name):
+        """
+        Determine the length of a list.
+        """
+
+        return len(self._get(name, list) or [])
+
+    def lrange(self, name, start, end):
+        """
+        Retrieve a range of elements from a list.
+        """
+
+        return _range(self._get(name, list) or [], start, end)
+
+    def ltrim(self, name, start, end):
+        """
+        Trim a list to the specified range.
+        """
+
+        lst = self._get(name, list)
+        if lst is not None:
+            lst[:] = _range(lst, start, end)
+            self._cleanup(name)
+
+        return True
+
+    def linsert(self, name, where, refvalue, value):
+        """
+        Insert a value into a list, before or after a reference
+        value.
+        """
+
+        lst = self._get(name, list)
+        if lst is None:
+            return 0
+
+        try:
+            idx = lst.index(str(refvalue))
+        except ValueError:
+            return -1
+
+        if where.lower() == 'after':
+            idx += 1
+        lst.insert(idx, str(value))
+
+        return len(lst)
+
+    def sadd(self, name, *values):
+        """
+        Add values to a set.
+        """
+
+        members = self._get(name, set, set)
+        before = len(members)
+        members.update(str(v) for v in values)
+        return len(members) - before
+
+    def srem(self, name, *values):
+        """
+        Remove values from a set.
+        """
+
+        members = self._get(name, set)
+        if members is None:
+            return 0
+
+        before = len(members)
+        members.difference_update(str(v) for v in values)
+        self._cleanup(name)
+
+        return before - len(members)
+
+    def smembers(self, name):
+        """
+        Retrieve the members of a set.
+        """
+
+        return set(self._get(name, set) or ())
+
+    def zadd(self, name, *args, **kwargs):
+        """
+        Add values to a sorted set.  As with StrictRedis, the
+        positional arguments alternate between scores and values, and
+        keyword arguments map values to scores.
+        """
+
+        if len(args) % 2:
+            raise redis.RedisError("ZADD requires an equal number of "
+                                   "values and scores")
+
+        pairs = zip(args[1::2], args[::2]) + kwargs.items()
+        zset = self._get(name, dict, dict)
+        count = 0
+        for value, score in pairs:
+            value = str(value)
+            if value not in zset:
+                count += 1
+            zset[value] = float(score)
+
+        return count
+
+    def zcard(self, name):
+        """
+        Count the values in a sorted set.
+        """
+
+        return len(self._get(name, dict) or {})
+
+    def _zsorted(self, name, desc=False):
+        """
+        Retrieve the contents of a sorted set, in order.
+
+        :param name: The name of the key.
+        :param desc: If True, the contents are returned in descending
+                     order.
+
+        :returns: A list of tuples of value and score.
+        """
+
+        zset = self._get(name, dict) or {}
+        return sorted(zset.items(), key=lambda x: (x[1], x[0]),
+                      reverse=desc)
+
+    def zrange(self, name, start, end, desc=False, withscores=False,
+               score_cast_func=float):
+        """
+        Retrieve a range of values from a sorted set, by index.
+        """
+
+        items = _range(self._zsorted(name, desc), start, end)
+        if withscores:
+            return [(v, score_cast_func(s)) for v, s in items]
+        return [v for v, s in items]
+
+    def zrangebyscore(self, name, min, max, start=None, num=None,
+                      withscores=False, score_cast_func=float):
+        """
+        Retrieve a range of values from a sorted set, by score.
+        """
+
+        low, high = _score_bound(min), _score_bound(max)
+        items = [(v, s) for v, s in self._zsorted(name)
+                 if _in_bounds(s, low, high)]
+        if start is not None and num is not None:
+            items = items[start:start + num]
+
+        if withscores:
+            return [(v, score_cast_func(s)) for v, s in items]
+        return [v for v, s in items]
+
+    def zrem(self, name, *values):
+        """
+        Remove values from a sorted set.
+        """
+
+        zset = self._get(name, dict)
+        if zset is None:
+            return 0
+
+        count = 0
+        for value in values:
+            if zset.pop(str(value), None) is not None:
+                count += 1
+        self._cleanup(name)
+
+        return count
+
+    def zremrangebyscore(self, name, min, max):
+        """
+        Remove values from a sorted set, by score.
+        """
+
+        values = self.zrangebyscore(name, min, max)
+        return self.zrem(name, *values) if values else 0
+
+    def publish(self, channel, message):
+        """
+        Publish a message to a channel.
+        """
+
+        subscribers = list(self.server.subscribers.get(channel, ()))
+        for pubsub in subscribers:
+            pubsub._deliver({
+                'type': 'message',
+                'pattern': None,
+                'channel': channel,
+                'data': str(message),
+            })
+
+        return len(subscribers)
+
+    def pubsub(self, **kwargs):
+        """
+        Retrieve a publish-subscribe object.
+        """
+
+        return MemoryPubSub(self.server)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        """
+        Retrieve a pipeline object.
+        """
+
+        return MemoryPipeline(self, transaction)
+
+    def info(self, section=None):
+        """
+        Retrieve information about the server.  Only the key count
+        and an estimate of the memory used by the keys and values are
+        reported.
+        """
+
+        used = 0
+        for name in self.keys():
+            value = self.data[name]
+            used += len(name)
+            if isinstance(value, str):
+                used += len(value)
+            else:
+                used += sum(len(v) for v in value)
+
+        return {
+            'used_memory': used,
+            'db%d' % self.db: {
+                'keys': len(self.data),
+                'expires': len(self.expires),
+            },
+        }
+
+
+class MemoryPipeline(object):
+    """
+    A pipeline for the in-memory client.  Commands are queued until
+    execute() is called.  As with the StrictRedis pipeline, commands
+    issued after watch() and before multi() are executed
+    immediately.
+    """
+
+    def __init__(self, db, transaction=True):
+        """
+        Initialize a MemoryPipeline.
+
+        :param db: The MemoryRedis object the pipeline belongs to.
+        :param transaction: Accepted for compatibility with
+                            StrictRedis; ignored.
+        """
+
+        self.db = db
+        self.transaction = transaction
+        self.command_stack = []
+        self.watching = False
+        self.explicit_transaction = False
+
+    def __enter__(self):
+        """
+        Allow the pipeline to be used as a context manager.
+        """
+
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        """
+        Reset the pipeline when the context manager exits.
+        """
+
+        self.reset()
+
+    def __len__(self):
+        """
+        Return the number of queued commands.
+        """
+
+        return len(self.command_stack)
+
+    def __getattr__(self, name):
+        """
+        Retrieve a command.  Calling the command queues it for
+        execution, unless the pipeline is in immediate mode.
+        """
+
+        if name.startswith('_') or name in _PIPELINE_EXCLUDES:
+            raise AttributeError(name)
+        func = getattr(self.db, name)
+
+        def command(*args, **kwargs):
+            # Execute immediately after a watch()
+            if self.watching and not self.explicit_transaction:
+                return func(*args, **kwargs)
+
+            self.command_stack.append((func, args, kwargs))
+            return self
+
+        return command
+
+    def watch(self, *names):
+        """
+        Watch keys.  Subsequent commands are executed immediately,
+        until multi() is called.
+        """
+
+        self.watching = True
+        return True
+
+    def unwatch(self):
+        """
+        Stop watching keys.
+        """
+
+        self.watching = False
+        return True
+
+    def multi(self):
+        """
+        Start queuing commands for a transaction.
+        """
+
+        self.explicit_transaction = True
+
+    def reset(self):
+        """
+        Discard the queued commands and reset the pipeline state.
+        """
+
+        self.command_stack = []
+        self.watching = False
+        self.explicit_transaction = False
+
+    def execute(self, raise_on_error=True):
+        """
+        Execute the queued commands.
+
+        :param raise_on_error: If True (the default), the first error
+                               raised by a command is raised.  If
+                               False, the exceptions are returned in
+                               place of the results of the failed
+                               commands, as with StrictRedis.
+
+        :returns: A list of the results of the commands.
+        """
+
+        try:
+            results = []
+            for func, args, kwargs in self.command_stack:
+                try:
+                    results.append(func(*args, **kwargs))
+                except Exception as exc:
+                    if raise_on_error:
+                        raise
+                    results.append(exc)
+            return results
+        finally:
+            self.reset()
+
+
+class MemoryPubSub(object):
+    """
+    A publish-subscribe object for the in-memory client.  Messages
+    are delivered through a queue, so listen() blocks the calling
+    greenthread until a message is published.
+    """
+
+    def __init__(self, server):
+        """
+        Initialize a MemoryPubSub.
+
+        :param server: The MemoryServer whose channels may be
+                       subscribed to.
+        """
+
+        self.server = server
+        self.channels = set()
+        self.queue = eventlet.queue.LightQueue()
+
+    def _deliver(self, message):
+        """
+        Deliver a message to the subscriber.
+
+        :param message: The message dictionary.
+        """
+
+        self.queue.put(message)
+
+    def subscribe(self, *channels):
+        """
+        Subscribe to channels.
+        """
+
+        for channel in channels:
+            self.server.subscribers.setdefault(channel, set()).add(self)
+            self.channels.add(channel)
+            self._deliver({
+                'type': 'subscribe',
+                'pattern': None,
+                'channel': channel,
+                'data': len(self.channels),
+            })
+
+    def unsubscribe(self, *channels):
+        """
+        Unsubscribe from channels.  If no channels are specified, all
+        channels are unsubscribed from.
+        """
+
+        for channel in (channels or list(self.channels)):
+            self.server.subscribers.get(channel, set()).discard(self)
+            self.channels.discard(channel)
+            self._deliver({
+                'type': 'unsubscribe',
+                'pattern': None,
+                'channel': channel,
+                'data': len(self.channels),
+            })
+
+    def close(self):
+        """
+        Close the publish-subscribe object, unsubscribing from all
+        channels.
+        """
+
+        for channel in self.channels:
+            self.server.subscribers.get(channel, set()).discard(self)
+        self.channels.clear()
+
+    def get_message(self):
+        """
+        Retrieve the next message, if one is available.
+
+        :returns: The message dictionary, or None if no message is
+                  available.
+        """
+
+        try:
+            return self.queue.get_nowait()
+        except eventlet.queue.Empty:
+            return None
+
+    def listen(self):
+        """
+        Listen for messages.  This is a generator, which yields
+        message dictionaries until all channels have been
+        unsubscribed from.
+        """
+
+        while self.channels or self.queue.qsize():
+            yield self.queue.get()
+
+
+class CountingDatabase(object):
+    """
+    A wrapper for a database handle which counts the Redis commands
+    issued through it, along with the number of network round trips
+    they require.  Each command issued directly is one round trip;
+    commands issued through a pipeline are counted individually, but
+    the pipeline execution counts as a single round trip.  This is
+    used to measure how much work Turnstile asks of the Redis server.
+    """
+
+    def __init__(self, db):
+        """
+        Initialize a CountingDatabase.
+
+        :param db: The database handle to wrap.
+        """
+
+        self.db = db
+        self.commands = 0
+        self.round_trips = 0
+
+    def __getattr__(self, name):
+        """
+        Retrieve an attribute of the wrapped database handle.  Methods
+        which issue commands are wrapped so that the commands are
+        counted.
+        """
+
+        attr = getattr(self.db, name)
+        if name.startswith('_') or name in _UNCOUNTED or not callable(attr):
+            return attr
+
+        def wrapper(*args, **kwargs):
+            self.commands += 1
+            self.round_trips += 1
+            return attr(*args, **kwargs)
+
+        return wrapper
+
+    def pipeline(self, *args, **kwargs):
+        """
+        Retrieve a pipeline object.  The pipeline is wrapped so that
+        its commands and executions are counted.
+        """
+
+        return CountingPipeline(self, self.db.pipeline(*args, **kwargs))
+
+    def reset_counts(self):
+        """
+        Reset the command and round trip counts.
+        """
+
+        self.commands = 0
+        self.round_trips = 0
+
+
+class CountingPipeline(object):
+    """
+    A wrapper for a pipeline object, which counts the commands issued
+    through it on behalf of a CountingDatabase.
+    """
+
+    def __init__(self, counter, pipe):
+        """
+        Initialize a CountingPipeline.
+
+        :param counter: The CountingDatabase to count the commands
+                        against.
+        :param pipe: The pipeline object to wrap.
+        """
+
+        self.counter = counter
+        self.pipe = pipe
+
+    def __enter__(self):
+        """
+        Allow the pipeline to be used as a context manager.
+        """
+
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        """
+        Reset the pipeline when the context manager exits.
+        """
+
+        self.pipe.reset()
+
+    def __len__(self):
+        """
+        Return the number of queued commands.
+        """
+
+        return len(self.pipe)
+
+    def __getattr__(self, name):
+        """
+        Retrieve an attribute of the wrapped pipeline.  Methods which
+        issue commands are wrapped so that the commands are counted.
+        """
+
+        attr = getattr(self.pipe, name)
+        if (name.startswith('_') or name in ('multi', 'reset') or
+                not callable(attr)):
+            return attr
+
+        def wrapper(*args, **kwargs):
+            # Commands issued after a watch() are sent immediately
+            immediate = name in ('watch', 'unwatch') or (
+                getattr(self.pipe, 'watching', False) and
+                not getattr(self.pipe, 'explicit_transaction', False))
+
+            self.counter.commands += 1
+            if immediate:
+                self.counter.round_trips += 1
+
+            result = attr(*args, **kwargs)
+            return self if result is self.pipe else result
+
+        return wrapper
+
+    def execute(self, *args, **kwargs):
+        """
+        Execute the queued commands.  This counts as a single round
+        trip, unless no commands are queued.
+        """
+
+        if len(self.pipe):
+            self.counter.round_trips += 1
+
+        return self.pipe.execute(*args, **kwargs)
+
+
+def counting_client(counted_client=None, **kwargs):
+    """
+    A Redis client which counts the Redis commands issued through it.
+    This may be selected by setting the ``redis.redis_client``
+    configuration option to "counting"; the client class to wrap may
+    be selected with the ``redis.counted_client`` option, which is
+    interpreted like ``redis.redis_client``, and defaults to
+    ``redis.StrictRedis``.
+
+    :param counted_client: The name of the client class to wrap.
+
+    Other keyword arguments are passed to the client class.
+
+    :returns: A CountingDatabase wrapping the client.
+    """
+
+    if counted_client:
+        client = utils.find_entrypoint('turnstile.redis_client',
+                                       counted_client, required=True)
+    else:
+        client = redis.StrictRedis
+
+    return CountingDatabase(client(**kwargs))
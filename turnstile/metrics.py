@@ -0,0 +1,912 @@
+# Copyright 2013 Rackspace
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import bisect
+import collections
+import logging
+import re
+import socket
+import time
+
+
+LOG = logging.getLogger('turnstile')
+
+
+def percentile(values, pct):
+    """
+    Select a percentile from a sorted list of values.
+
+    :param values: A sorted list of values.
+    :param pct: The desired percentile, from 0 to 100.
+
+    :returns: The value at the given percentile, or None if the list
+              is empty.
+    """
+
+    if not values:
+        return None
+
+    return values[min(len(values) * pct // 100, len(values) - 1)]
+
+
+class _NullTimer(object):
+    """
+    A timer context manager which does nothing.  A single instance is
+    shared by all users of the null metrics, so that timing costs
+    nothing when metrics are disabled.
+    """
+
+    def __enter__(self):
+        """Entry does nothing."""
+
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        """Exit does nothing."""
+
+        pass
+
+
+_null_timer = _NullTimer()
+
+
+class _Timer(object):
+    """
+    A timer context manager.  Records the time elapsed between entry
+    and exit, in milliseconds, as a timing metric.
+    """
+
+    def __init__(self, metrics, name):
+        """
+        Initialize a _Timer.
+
+        :param metrics: The metrics object to report the timing to.
+        :param name: The name of the timing metric.
+        """
+
+        self.metrics = metrics
+        self.name = name
+        self.start = None
+
+    def __enter__(self):
+        """Start the timer."""
+
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        """Stop the timer and record the elapsed time."""
+
+        self.metrics.timing(self.name,
+                            (time.time() - self.start) * 1000.0)
+
+
+class Metrics(object):
+    """
+    The null metrics emitter.  All metrics reported to an instance of
+    this class are discarded; it is used when metrics collection has
+    not been enabled.  Subclasses override the recording methods to
+    actually record the metrics.
+    """
+
+    enabled = False
+
+    def incr(self, name, count=1):
+        """
+        Increment a counter.
+
+        :param name: The name of the counter.
+        :param count: The amount to increment the counter by.
+                      Defaults to 1.
+        """
+
+        pass
+
+    def timing(self, name, value):
+        """
+        Record a timing.
+
+        :param name: The name of the timing metric.
+        :param value: The time to record, in milliseconds.
+        """
+
+        pass
+
+    def histogram(self, name, value):
+        """
+        Record a value for which a distribution is desired, such as
+        the number of records in a bucket.
+
+        :param name: The name of the histogram metric.
+        :param value: The value to record.
+        """
+
+        pass
+
+    def gauge(self, name, value):
+        """
+        Set the current value of a gauge.
+
+        :param name: The name of the gauge.
+        :param value: The current value.
+        """
+
+        pass
+
+    def info(self, name, **labels):
+        """
+        Set descriptive information which is not numeric, such as the
+        checksum of the current limits.  Emitters which cannot
+        represent such information ignore it.
+
+        :param name: The name of the information metric.
+        :param labels: The information, as keyword arguments.
+        """
+
+        pass
+
+    def timer(self, name):
+        """
+        Obtain a context manager which times the enclosed block.
+
+        :param name: The name of the timing metric.
+
+        :returns: A context manager.
+        """
+
+        return _null_timer
+
+    def flush(self):
+        """
+        Emit any metrics that have been aggregated but not yet sent.
+        """
+
+        pass
+
+    def expose(self):
+        """
+        Render the metrics collected in-process for scraping.
+
+        :returns: The metrics page, in the Prometheus text exposition
+                  format.  Emitters which do not collect metrics
+                  in-process return an empty string.
+        """
+
+        return ''
+
+    def summary(self):
+        """
+        Summarize recent request processing, for the "stats" control
+        command.
+
+        :returns: A dictionary summarizing recent request processing.
+                  Emitters which do not keep such a summary return an
+                  empty dictionary.
+        """
+
+        return {}
+
+
+class StatsdMetrics(Metrics):
+    """
+    A metrics emitter which sends metrics to a statsd server over UDP.
+    Counters and timings are aggregated in memory and sent as
+    multi-metric packets at most once every flush interval, which
+    keeps the cost of reporting a metric down to a dictionary update.
+    """
+
+    enabled = True
+
+    def __init__(self, host, port=8125, prefix='turnstile',
+                 flush_interval=1.0, max_packet=512):
+        """
+        Initialize a StatsdMetrics object.
+
+        :param host: The host name or address of the statsd server.
+        :param port: The UDP port the statsd server listens on.
+                     Defaults to 8125.
+        :param prefix: A prefix for the names of all metrics.  If
+                       empty, no prefix is applied.  Defaults to
+                       "turnstile".
+        :param flush_interval: The maximum time, in seconds, metrics
+                               are aggregated before being sent.
+                               Defaults to 1 second.
+        :param max_packet: The maximum size, in bytes, of the packets
+                           sent to the statsd server.  Defaults to
+                           512.
+        """
+
+        self.address = (host, port)
+        self.prefix = '%s.' % prefix if prefix else ''
+        self.flush_interval = flush_interval
+        self.max_packet = max_packet
+
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+        self.counters = {}
+        self.timings = {}
+        self.histograms = {}
+        self.gauges = {}
+        self.last_flush = time.time()
+
+    def incr(self, name, count=1):
+        """
+        Increment a counter.
+
+        :param name: The name of the counter.
+        :param count: The amount to increment the counter by.
+                      Defaults to 1.
+        """
+
+        self.counters[name] = self.counters.get(name, 0) + count
+        self._check_flush()
+
+    def timing(self, name, value):
+        """
+        Record a timing.
+
+        :param name: The name of the timing metric.
+        :param value: The time to record, in milliseconds.
+        """
+
+        self.timings.setdefault(name, []).append(value)
+        self._check_flush()
+
+    def histogram(self, name, value):
+        """
+        Record a value for which a distribution is desired, such as
+        the number of records in a bucket.
+
+        :param name: The name of the histogram metric.
+        :param value: The value to record.
+        """
+
+        self.histograms.setdefault(name, []).append(value)
+        self._check_flush()
+
+    def gauge(self, name, value):
+        """
+        Set the current value of a gauge.
+
+        :param name: The name of the gauge.
+        :param value: The current value.
+        """
+
+        self.gauges[name] = value
+        self._check_flush()
+
+    def timer(self, name):
+        """
+        Obtain a context manager which times the enclosed block.
+
+        :param name: The name of the timing metric.
+
+        :returns: A context manager.
+        """
+
+        return _Timer(self, name)
+
+    def _check_flush(self):
+        """
+        Flush the aggregated metrics if the flush interval has
+        elapsed.
+        """
+
+        if time.time() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        """
+        Emit any metrics that have been aggregated but not yet sent.
+        """
+
+        # Grab the aggregated metrics and start over
+        counters, self.counters = self.counters, {}
+        timings, self.timings = self.timings, {}
+        histograms, self.histograms = self.histograms, {}
+        gauges, self.gauges = self.gauges, {}
+        self.last_flush = time.time()
+
+        # Format the statsd lines
+        lines = ['%s%s:%d|c' % (self.prefix, name, count)
+                 for name, count in sorted(counters.items())]
+        for name, values in sorted(timings.items()):
+            lines.extend('%s%s:%g|ms' % (self.prefix, name, value)
+                         for value in values)
+        # Histograms are sent as timings, since statsd servers such
+        # as Etsy's don't understand the "h" type, and would treat
+        # the values as counts; as timings, their distribution is
+        # computed
+        for name, values in sorted(histograms.items()):
+            lines.extend('%s%s:%g|ms' % (self.prefix, name, value)
+                         for value in values)
+        lines.extend('%s%s:%g|g' % (self.prefix, name, value)
+                     for name, value in sorted(gauges.items()))
+
+        # Pack the lines into packets and send them
+        packet = []
+        size = 0
+        for line in lines:
+            if packet and size + len(line) + 1 > self.max_packet:
+                self._send('\n'.join(packet))
+                packet = []
+                size = 0
+            packet.append(line)
+            size += len(line) + 1
+        if packet:
+            self._send('\n'.join(packet))
+
+    def _send(self, data):
+        """
+        Send a packet to the statsd server.  Errors are logged and
+        otherwise ignored; metrics must never interfere with request
+        processing.
+
+        :param data: The packet to send.
+        """
+
+        try:
+            self.sock.sendto(data, self.address)
+        except Exception:
+            LOG.exception("Failed to send metrics to %s:%s" % self.address)
+
+
+# Histogram buckets for timings, in seconds, and for other values
+TIME_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                0.25, 0.5, 1.0, 2.5)
+VALUE_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+
+class _Histogram(object):
+    """
+    Accumulate observations into histogram buckets.
+    """
+
+    def __init__(self, bounds):
+        """
+        Initialize a _Histogram.
+
+        :param bounds: A sorted sequence of the upper bounds of the
+                       buckets.  An implicit "+Inf" bucket is always
+                       present.
+        """
+
+        self.bounds = bounds
+        self.counts = [0] * len(bounds)
+        self.total = 0
+        self.count = 0
+
+    def observe(self, value):
+        """
+        Record an observation.
+
+        :param value: The observed value.
+        """
+
+        idx = bisect.bisect_left(self.bounds, value)
+        if idx < len(self.counts):
+            self.counts[idx] += 1
+        self.total += value
+        self.count += 1
+
+    def render(self, name, labels):
+        """
+        Render the histogram in the Prometheus text format.
+
+        :param name: The name of the histogram.
+        :param labels: The formatted labels of the histogram, without
+                       the enclosing braces; may be empty.
+
+        :returns: A list of lines.
+        """
+
+        sep = ',' if labels else ''
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.bounds, self.counts):
+            cumulative += count
+            lines.append('%s_bucket{%s%sle="%s"} %d' %
+                         (name, labels, sep, '%g' % bound, cumulative))
+        lines.append('%s_bucket{%s%sle="+Inf"} %d' %
+                     (name, labels, sep, self.count))
+        lines.append('%s_sum%s %s' % (name, _braces(labels),
+                                      repr(float(self.total))))
+        lines.append('%s_count%s %d' % (name, _braces(labels), self.count))
+
+        return lines
+
+
+def _braces(labels):
+    """
+    Enclose formatted labels in braces, if there are any.
+
+    :param labels: The formatted labels.
+
+    :returns: The labels enclosed in braces, or an empty string if
+              there are no labels.
+    """
+
+    return '{%s}' % labels if labels else ''
+
+
+def _format_labels(labels):
+    """
+    Format a dictionary of labels for the Prometheus text format.
+
+    :param labels: A dictionary of label names and values.
+
+    :returns: The formatted labels, without the enclosing braces.
+    """
+
+    return ','.join('%s="%s"' % (key, str(value).replace('\\', r'\\')
+                                 .replace('"', r'\"').replace('\n', r'\n'))
+                    for key, value in sorted(labels.items()))
+
+
+class PrometheusMetrics(Metrics):
+    """
+    A metrics emitter which collects metrics in-process, so that they
+    may be scraped in the Prometheus text exposition format.  Metric
+    names are translated by replacing dots with underscores; the
+    per-limit metrics, named "limit.<uuid>.<event>", become the metric
+    "limit_<event>" with a "limit" label containing the limit UUID.
+    Timings are exposed as histograms in seconds.
+    """
+
+    enabled = True
+
+    _limit_re = re.compile(r'^limit\.(?P<limit>[^.]+)\.(?P<event>[^.]+)$')
+    _invalid_re = re.compile(r'[^a-zA-Z0-9_]')
+
+    def __init__(self, prefix='turnstile'):
+        """
+        Initialize a PrometheusMetrics object.
+
+        :param prefix: A prefix for the names of all metrics.  If
+                       empty, no prefix is applied.  Defaults to
+                       "turnstile".
+        """
+
+        self.prefix = ('%s_' % self._invalid_re.sub('_', prefix)
+                       if prefix else '')
+
+        self.counters = {}
+        self.histograms = {}
+        self.gauges = {}
+        self.infos = {}
+
+        # Cache of translated metric names
+        self._names = {}
+
+    def _series(self, name):
+        """
+        Translate a metric name into a Prometheus metric name and
+        formatted labels.
+
+        :param name: The metric name.
+
+        :returns: A tuple of the metric name and the formatted labels.
+        """
+
+        try:
+            return self._names[name]
+        except KeyError:
+            pass
+
+        match = self._limit_re.match(name)
+        if match:
+            series = ('limit_%s' % match.group('event'),
+                      _format_labels(dict(limit=match.group('limit'))))
+        else:
+            series = (name, '')
+        series = (self.prefix + self._invalid_re.sub('_', series[0]),
+                  series[1])
+
+        self._names[name] = series
+        return series
+
+    def incr(self, name, count=1):
+        """
+        Increment a counter.
+
+        :param name: The name of the counter.
+        :param count: The amount to increment the counter by.
+                      Defaults to 1.
+        """
+
+        family, labels = self._series(name)
+        values = self.counters.setdefault(family, {})
+        values[labels] = values.get(labels, 0) + count
+
+    def _observe(self, family, labels, bounds, value):
+        """
+        Record an observation in a histogram.
+
+        :param family: The name of the histogram.
+        :param labels: The formatted labels of the histogram.
+        :param bounds: The bucket bounds to use if the histogram must
+                       be created.
+        :param value: The observed value.
+        """
+
+        hists = self.histograms.setdefault(family, {})
+        if labels not in hists:
+            hists[labels] = _Histogram(bounds)
+        hists[labels].observe(value)
+
+    def timing(self, name, value):
+        """
+        Record a timing.
+
+        :param name: The name of the timing metric.
+        :param value: The time to record, in milliseconds.
+        """
+
+        family, labels = self._series(name)
+        self._observe(family + '_seconds', labels, TIME_BUCKETS,
+                      value / 1000.0)
+
+    def histogram(self, name, value):
+        """
+        Record a value for which a distribution is desired, such as
+        the number of records in a bucket.
+
+        :param name: The name of the histogram metric.
+        :param value: The value to record.
+        """
+
+        family, labels = self._series(name)
+        self._observe(family, labels, VALUE_BUCKETS, value)
+
+    def gauge(self, name, value):
+        """
+        Set the current value of a gauge.
+
+        :param name: The name of the gauge.
+        :param value: The current value.
+        """
+
+        family, labels = self._series(name)
+        self.gauges.setdefault(family, {})[labels] = value
+
+    def info(self, name, **labels):
+        """
+        Set descriptive information which is not numeric, such as the
+        checksum of the current limits.  This is exposed as a gauge
+        named "<name>_info" with a value of 1 and the information as
+        labels.
+
+        :param name: The name of the information metric.
+        :param labels: The information, as keyword arguments.
+        """
+
+        family, _labels = self._series(name)
+        self.infos[family + '_info'] = _format_labels(labels)
+
+    def timer(self, name):
+        """
+        Obtain a context manager which times the enclosed block.
+
+        :param name: The name of the timing metric.
+
+        :returns: A context manager.
+        """
+
+        return _Timer(self, name)
+
+    def expose(self):
+        """
+        Render the metrics collected in-process for scraping.
+
+        :returns: The metrics page, in the Prometheus text exposition
+                  format.
+        """
+
+        lines = []
+        for family, values in sorted(self.counters.items()):
+            lines.append('# TYPE %s_total counter' % family)
+            lines.extend('%s_total%s %d' % (family, _braces(labels), value)
+                         for labels, value in sorted(values.items()))
+        for family, values in sorted(self.gauges.items()):
+            lines.append('# TYPE %s gauge' % family)
+            lines.extend('%s%s %s' % (family, _braces(labels), '%g' % value)
+                         for labels, value in sorted(values.items()))
+        for family, labels in sorted(self.infos.items()):
+            lines.append('# TYPE %s gauge' % family)
+            lines.append('%s%s 1' % (family, _braces(labels)))
+        for family, hists in sorted(self.histograms.items()):
+            lines.append('# TYPE %s histogram' % family)
+            for labels, hist in sorted(hists.items()):
+                lines.extend(hist.render(family, labels))
+
+        return ''.join('%s\n' % line for line in lines)
+
+
+class SummaryMetrics(Metrics):
+    """
+    A metrics emitter which keeps a compact summary of recent request
+    processing in-process, for reporting by the "stats" control
+    command.  The request and reject rates are computed over a
+    sliding window of per-second counts, and the limiter overhead
+    percentiles are computed from a bounded sample of the most recent
+    "route_match" timings.
+    """
+
+    enabled = True
+
+    def __init__(self, window=60, samples=1000):
+        """
+        Initialize a SummaryMetrics object.
+
+        :param window: The length of the window, in seconds, over
+                       which request and reject rates are computed.
+                       Defaults to 60.
+        :param samples: The number of recent timings from which the
+                        overhead percentiles are computed.  Defaults
+                        to 1000.
+        """
+
+        self.window = window
+        self.counters = {}
+        self.overhead = collections.deque(maxlen=samples)
+
+        # Each slot contains the second it counts for, the number of
+        # requests, and the number of rejected requests
+        self.slots = [[0, 0, 0] for _i in range(window)]
+
+    def _tick(self, idx, count):
+        """
+        Count requests or rejected requests in the current slot.
+
+        :param idx: The index of the count within the slot; 1 for
+                    requests, 2 for rejected requests.
+        :param count: The number to add.
+        """
+
+        now = int(time.time())
+        slot = self.slots[now % self.window]
+        if slot[0] != now:
+            slot[:] = [now, 0, 0]
+        slot[idx] += count
+
+    def incr(self, name, count=1):
+        """
+        Increment a counter.
+
+        :param name: The name of the counter.
+        :param count: The amount to increment the counter by.
+                      Defaults to 1.
+        """
+
+        self.counters[name] = self.counters.get(name, 0) + count
+        if name == 'requests':
+            self._tick(1, count)
+        elif name == 'rejects':
+            self._tick(2, count)
+
+    def timing(self, name, value):
+        """
+        Record a timing.
+
+        :param name: The name of the timing metric.
+        :param value: The time to record, in milliseconds.
+        """
+
+        if name == 'route_match':
+            self.overhead.append(value)
+
+    def timer(self, name):
+        """
+        Obtain a context manager which times the enclosed block.
+
+        :param name: The name of the timing metric.
+
+        :returns: A context manager.
+        """
+
+        return _Timer(self, name)
+
+    def summary(self):
+        """
+        Summarize recent request processing, for the "stats" control
+        command.
+
+        :returns: A dictionary containing the request and reject
+                  rates, per second ("request_rate" and
+                  "reject_rate"); the 50th and 99th percentile
+                  limiter overhead, in milliseconds ("p50" and "p99",
+                  or None if no requests have been processed); and
+                  the total number of Redis errors ("redis_errors").
+        """
+
+        # Add up the slots within the window
+        cutoff = int(time.time()) - self.window
+        requests = rejects = 0
+        for second, req_count, rej_count in self.slots:
+            if second > cutoff:
+                requests += req_count
+                rejects += rej_count
+
+        # Compute the percentiles
+        overhead = sorted(self.overhead)
+
+        return {
+            'request_rate': float(requests) / self.window,
+            'reject_rate': float(rejects) / self.window,
+            'p50': percentile(overhead, 50),
+            'p99': percentile(overhead, 99),
+            'redis_errors': self.counters.get('redis.errors', 0),
+        }
+
+
+class MultiMetrics(Metrics):
+    """
+    A metrics emitter which passes all metrics on to several other
+    emitters.  This allows, for instance, metrics to be both sent to
+    a statsd server and exposed for scraping.
+    """
+
+    enabled = True
+
+    def __init__(self, emitters):
+        """
+        Initialize a MultiMetrics object.
+
+        :param emitters: A list of the metrics emitters to pass the
+                         metrics on to.
+        """
+
+        self.emitters = emitters
+
+    def incr(self, name, count=1):
+        """
+        Increment a counter.
+
+        :param name: The name of the counter.
+        :param count: The amount to increment the counter by.
+                      Defaults to 1.
+        """
+
+        for emitter in self.emitters:
+            emitter.incr(name, count)
+
+    def timing(self, name, value):
+        """
+        Record a timing.
+
+        :param name: The name of the timing metric.
+        :param value: The time to record, in milliseconds.
+        """
+
+        for emitter in self.emitters:
+            emitter.timing(name, value)
+
+    def histogram(self, name, value):
+        """
+        Record a value for which a distribution is desired, such as
+        the number of records in a bucket.
+
+        :param name: The name of the histogram metric.
+        :param value: The value to record.
+        """
+
+        for emitter in self.emitters:
+            emitter.histogram(name, value)
+
+    def gauge(self, name, value):
+        """
+        Set the current value of a gauge.
+
+        :param name: The name of the gauge.
+        :param value: The current value.
+        """
+
+        for emitter in self.emitters:
+            emitter.gauge(name, value)
+
+    def info(self, name, **labels):
+        """
+        Set descriptive information which is not numeric.
+
+        :param name: The name of the information metric.
+        :param labels: The information, as keyword arguments.
+        """
+
+        for emitter in self.emitters:
+            emitter.info(name, **labels)
+
+    def timer(self, name):
+        """
+        Obtain a context manager which times the enclosed block.
+
+        :param name: The name of the timing metric.
+
+        :returns: A context manager.
+        """
+
+        return _Timer(self, name)
+
+    def flush(self):
+        """
+        Emit any metrics that have been aggregated but not yet sent.
+        """
+
+        for emitter in self.emitters:
+            emitter.flush()
+
+    def expose(self):
+        """
+        Render the metrics collected in-process for scraping.
+
+        :returns: The metrics page, in the Prometheus text exposition
+                  format.
+        """
+
+        return ''.join(emitter.expose() for emitter in self.emitters)
+
+    def summary(self):
+        """
+        Summarize recent request processing, for the "stats" control
+        command.
+
+        :returns: A dictionary summarizing recent request processing.
+        """
+
+        result = {}
+        for emitter in self.emitters:
+            result.update(emitter.summary())
+        return result
+
+
+def get_metrics(conf):
+    """
+    Construct the metrics emitter described by the configuration.
+
+    :param conf: The Turnstile configuration, a
+                 turnstile.config:Config object.  The options in the
+                 "metrics" section are used.
+
+    :returns: A Metrics object.  If neither a statsd host nor a
+              metrics path is configured, and the summary is not
+              enabled, this will be a null emitter, which discards
+              all metrics.
+    """
+
+    metrics_conf = conf['metrics']
+    prefix = metrics_conf.get('prefix', 'turnstile')
+
+    emitters = []
+    if 'statsd_host' in metrics_conf:
+        emitters.append(StatsdMetrics(
+            metrics_conf['statsd_host'],
+            port=int(metrics_conf.get('statsd_port', 8125)),
+            prefix=prefix,
+            flush_interval=float(metrics_conf.get('flush_interval', 1.0)),
+            max_packet=int(metrics_conf.get('max_packet', 512)),
+        ))
+    if metrics_conf.get('path'):
+        emitters.append(PrometheusMetrics(prefix=prefix))
+    if conf.to_bool(metrics_conf.get('summary', 'no'), False):
+        emitters.append(SummaryMetrics(
+            window=int(metrics_conf.get('summary_window', 60)),
+            samples=int(metrics_conf.get('summary_samples', 1000)),
+        ))
+
+    if not emitters:
+        return Metrics()
+    elif len(emitters) == 1:
+        return emitters[0]
+
+    return MultiMetrics(emitters)
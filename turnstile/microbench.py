@@ -0,0 +1,385 @@
+# Copyright 2013 Rackspace
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import atexit
+import fnmatch
+import functools
+import os
+import platform
+import shutil
+import tempfile
+import threading
+import time
+
+from lxml import etree
+import msgpack
+
+from turnstile import control
+from turnstile import limits
+from turnstile import remote
+
+
+# The registered benchmarks, in order of registration
+_benchmarks = []
+
+
+def benchmark(name):
+    """
+    Decorator which registers a benchmark.  The decorated function
+    performs any necessary setup, and returns a callable taking no
+    arguments, which is the operation to be timed.
+
+    :param name: The name of the benchmark.
+    """
+
+    def decorator(func):
+        _benchmarks.append((name, func))
+        return func
+    return decorator
+
+
+def measure(func, repeat=5, min_time=0.2):
+    """
+    Measure the time taken by a callable.  The number of calls needed
+    for a run to take at least min_time seconds is determined first;
+    then that many calls are timed, repeat times over.
+
+    :param func: The callable to measure.
+    :param repeat: The number of timed runs.
+    :param min_time: The minimum duration of a timed run, in seconds.
+
+    :returns: A dictionary containing the number of calls in each run
+              ("loops"), the number of runs ("repeat"), and the best
+              and median time per call, in seconds ("best" and
+              "median").
+    """
+
+    def run(loops):
+        start = time.time()
+        for _i in xrange(loops):
+            func()
+        return time.time() - start
+
+    # Figure out how many loops we need
+    loops = 1
+    while run(loops) < min_time:
+        loops *= 2
+
+    # Now, time the runs
+    times = sorted(run(loops) / loops for _i in range(repeat))
+
+    return {
+        'loops': loops,
+        'repeat': repeat,
+        'best': times[0],
+        'median': times[len(times) // 2],
+    }
+
+
+def run_benchmarks(pattern=None, repeat=5, min_time=0.2, label=None):
+    """
+    Run the registered benchmarks.
+
+    :param pattern: If given, a shell-style wildcard pattern.  Only
+                    benchmarks with names matching the pattern are
+                    run.
+    :param repeat: The number of timed runs of each benchmark.
+    :param min_time: The minimum duration of a timed run, in seconds.
+    :param label: An optional label identifying the run, such as the
+                  revision of the code being measured.
+
+    :returns: A dictionary describing the results, suitable for
+              serializing as JSON.  The "benchmarks" key maps the
+              benchmark names to the dictionaries returned by
+              measure().
+    """
+
+    results = {}
+    for name, setup in _benchmarks:
+        if pattern and not fnmatch.fnmatchcase(name, pattern):
+            continue
+
+        results[name] = measure(setup(), repeat, min_time)
+
+    return {
+        'label': label,
+        'timestamp': time.time(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'benchmarks': results,
+    }
+
+
+def compare(old, new):
+    """
+    Compare the results of two benchmark runs.
+
+    :param old: The results of the earlier run, as returned by
+                run_benchmarks().
+    :param new: The results of the later run, as returned by
+                run_benchmarks().
+
+    :returns: A list of tuples of the benchmark name, the old and new
+              median times per call, and the ratio of the new time to
+              the old time.  Only benchmarks present in both runs are
+              included.
+    """
+
+    result = []
+    for name in sorted(new['benchmarks']):
+        if name not in old['benchmarks']:
+            continue
+
+        old_time = old['benchmarks'][name]['median']
+        new_time = new['benchmarks'][name]['median']
+        result.append((name, old_time, new_time,
+                       new_time / old_time if old_time else None))
+
+    return result
+
+
+class _FakeSocket(object):
+    """
+    A stand-in for a socket, for benchmarking the framing performed
+    by remote.Connection.  Sent data is discarded, and reads always
+    return the same data.
+    """
+
+    def __init__(self, data=''):
+        """
+        Initialize a _FakeSocket.
+
+        :param data: The data to return from recv() and recv_into().
+        """
+
+        self.data = data
+
+    def sendall(self, data):
+        """
+        Discard sent data.
+        """
+
+        pass
+
+    def recv(self, size):
+        """
+        Return the canned data.
+        """
+
+        return self.data
+
+    def recv_into(self, buf):
+        """
+        Copy the canned data into the buffer.
+        """
+
+        buf[:len(self.data)] = self.data
+        return len(self.data)
+
+    def close(self):
+        """
+        Closing does nothing.
+        """
+
+        pass
+
+
+def _make_limit(**kwargs):
+    """
+    Construct a limit for benchmarking.
+
+    :returns: A Limit object.
+    """
+
+    attrs = dict(uuid='c3cd7e8a-9c3c-4fb9-8cf6-6d1c7be02d5f',
+                 uri='/resource/{tenant}/{id}', value=100, unit='minute',
+                 verbs=['GET', 'POST'], use=['tenant'])
+    attrs.update(kwargs)
+    return limits.Limit(None, **attrs)
+
+
+# Parameters used for the bucket key benchmarks
+_KEY_PARAMS = {'tenant': 'a1b2c3/d4', 'id': 12345, 'region': 'ORD'}
+
+
+@benchmark('bucket_key.str')
+def _bench_bucket_key_str():
+    return lambda: str(limits.BucketKey('uuid', _KEY_PARAMS))
+
+
+@benchmark('bucket_key.str.v3')
+def _bench_bucket_key_str_v3():
+    return lambda: str(limits.BucketKey('uuid', _KEY_PARAMS, version=3))
+
+
+@benchmark('bucket_key.builder')
+def _bench_bucket_key_builder():
+    builder = limits.BucketKeyBuilder('uuid', sorted(_KEY_PARAMS))
+    return lambda: builder(_KEY_PARAMS)
+
+
+@benchmark('bucket_key.builder.v3')
+def _bench_bucket_key_builder_v3():
+    builder = limits.BucketKeyBuilder('uuid', sorted(_KEY_PARAMS), version=3)
+    return lambda: builder(_KEY_PARAMS)
+
+
+@benchmark('bucket_key.decode')
+def _bench_bucket_key_decode():
+    key = str(limits.BucketKey('uuid', _KEY_PARAMS))
+    return lambda: limits.BucketKey.decode(key)
+
+
+def _bench_bucket_loader(count):
+    """
+    Set up a BucketLoader benchmark.
+
+    :param count: The number of records the bucket list contains.
+    """
+
+    limit = _make_limit()
+    now = 1000000.0
+    records = [msgpack.dumps({'bucket': {'last': now, 'next': now,
+                                         'level': 0.0}})]
+    records.extend(msgpack.dumps({'update': {'params': {'tenant': 't'},
+                                             'time': now + i * 0.01},
+                                  'uuid': 'update-%d' % i})
+                   for i in range(count - 1))
+
+    return lambda: limits.BucketLoader(limits.Bucket, None, limit, 'key',
+                                       records)
+
+
+for _count in (1, 10, 100, 1000):
+    benchmark('bucket_loader.%d' % _count)(
+        functools.partial(_bench_bucket_loader, _count))
+
+
+@benchmark('bucket.delay')
+def _bench_bucket_delay():
+    limit = _make_limit()
+    now = 1000000.0
+    return lambda: limits.Bucket(None, limit, 'key', last=now - 1.0,
+                                 level=0.5).delay({}, now)
+
+
+@benchmark('limit.hydrate')
+def _bench_limit_hydrate():
+    lim = _make_limit().dehydrate()
+    return lambda: limits.Limit.hydrate(None, dict(lim))
+
+
+@benchmark('limit.dehydrate')
+def _bench_limit_dehydrate():
+    return _make_limit().dehydrate
+
+
+@benchmark('limit_data.set_limits.10000')
+def _bench_limit_data_set_limits():
+    lims = [msgpack.dumps(_make_limit(uuid='limit-%d' % i,
+                                      uri='/resource/%d/{id}' % i).dehydrate())
+            for i in range(10000)]
+
+    # Use a fresh LimitData each time, since an unchanged checksum
+    # short-circuits the update
+    return lambda: control.LimitData().set_limits(lims)
+
+
+@benchmark('remote.connection.send')
+def _bench_connection_send():
+    conn = remote.Connection(_FakeSocket())
+    payload = ('checksum', [{'limit': 1}, {'limit': 2}])
+    return lambda: conn.send('get_limits', *payload)
+
+
+@benchmark('remote.connection.recv')
+def _bench_connection_recv():
+    conn = remote.Connection(_FakeSocket(
+        '{"cmd": "get_limits", "payload": ["checksum", []]}\n'))
+    return conn.recv
+
+
+@benchmark('remote.connection.send.v2')
+def _bench_connection_send_v2():
+    conn = remote.Connection(_FakeSocket(), 2)
+    payload = ('checksum', [{'limit': 1}, {'limit': 2}])
+    return lambda: conn.send('get_limits', *payload)
+
+
+@benchmark('remote.connection.recv.v2')
+def _bench_connection_recv_v2():
+    data = msgpack.dumps(['get_limits', ['checksum', []]])
+    conn = remote.Connection(_FakeSocket(
+        remote._FRAME_HEADER.pack(len(data)) + data), 2)
+    return conn.recv
+
+
+def _bench_rpc_ping(transport):
+    """
+    Set up an RPC round trip benchmark.  A SimpleRPC server is run in
+    a background thread, and the benchmark times a PING sent to it by
+    a client.
+
+    :param transport: The transport to use; either "tcp", for a
+                      loopback TCP connection, or "unix", for a Unix
+                      domain socket.
+    """
+
+    if transport == 'unix':
+        tmpdir = tempfile.mkdtemp()
+        atexit.register(shutil.rmtree, tmpdir, True)
+        path = os.path.join(tmpdir, 'rpc.sock')
+        serv = remote._create_unix_server(path, 0600)
+        server = remote.SimpleRPC(None, None, 'bench', path=path)
+        client = remote.SimpleRPC(None, None, 'bench', path=path)
+    else:
+        serv = remote._create_server('127.0.0.1', 0)
+        port = serv.getsockname()[1]
+        server = remote.SimpleRPC('127.0.0.1', port, 'bench')
+        client = remote.SimpleRPC('127.0.0.1', port, 'bench')
+
+    # Serve the client connection from a background thread; the
+    # benchmarks don't run under eventlet
+    def serve():
+        sock, addr = serv.accept()
+        serv.close()
+        server.serve(remote.Connection(sock), ('bench', transport))
+    thread = threading.Thread(target=serve)
+    thread.daemon = True
+    thread.start()
+
+    client.connect()
+    return client.ping
+
+
+for _transport in ('tcp', 'unix'):
+    benchmark('remote.rpc.ping.%s' % _transport)(
+        functools.partial(_bench_rpc_ping, _transport))
+
+
+@benchmark('tools.parse_limit_node')
+def _bench_parse_limit_node():
+    # The tools module imports this one, so import it here
+    from turnstile import tools
+
+    node = etree.fromstring(
+        '<limit class="turnstile.limits:Limit">'
+        '<attr name="uri">/resource/{tenant}/{id}</attr>'
+        '<attr name="value">100</attr>'
+        '<attr name="unit">minute</attr>'
+        '<attr name="verbs"><value>GET</value><value>POST</value></attr>'
+        '<attr name="use"><value>tenant</value></attr>'
+        '</limit>')
+    return lambda: tools.parse_limit_node(None, 0, node)
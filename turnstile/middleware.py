@@ -17,19 +17,25 @@ import collections
 import logging
 import math
 import traceback
+import weakref
 
 import eventlet
 import routes
 
 from turnstile import config
 from turnstile import control
-from turnstile import database
+from turnstile import limits
+from turnstile import metrics
 from turnstile import remote
 from turnstile import utils
 
 
 LOG = logging.getLogger('turnstile')
 
+# The middleware instances configured for pre-fork operation; see
+# pre_fork() and post_fork()
+_prefork_middleware = weakref.WeakSet()
+
 
 class HeadersDict(collections.MutableMapping):
     """
@@ -150,6 +156,35 @@ def turnstile_filter(global_conf, **local_conf):
     return wrapper
 
 
+def pre_fork():
+    """
+    Pre-fork hook for servers which load the application in a master
+    process, then fork worker processes, such as gunicorn with the
+    "--preload" option.  Calls the pre_fork() method of each instance
+    of the middleware configured with the 'control.prefork' option,
+    loading the limits and building the routes once, in the master
+    process, so that the workers share them.  Should be called in the
+    master process before forking the workers.
+    """
+
+    for midware in list(_prefork_middleware):
+        midware.pre_fork()
+
+
+def post_fork():
+    """
+    Post-fork hook for servers which load the application in a master
+    process, then fork worker processes.  Calls the post_fork()
+    method of each instance of the middleware configured with the
+    'control.prefork' option, which opens new connections and starts
+    the control daemon.  Should be called in each worker process
+    after it has been forked.
+    """
+
+    for midware in list(_prefork_middleware):
+        midware.post_fork()
+
+
 class TurnstileMiddleware(object):
     """
     Turnstile Middleware.
@@ -169,12 +204,22 @@ class TurnstileMiddleware(object):
         self.app = app
         self.limits = []
         self.limit_sum = None
+        self.limit_src = {}
         self.mapper = None
         self.mapper_lock = eventlet.semaphore.Semaphore()
 
         # Save the configuration
         self.conf = config.Config(conf_dict=local_conf)
 
+        # Interpret the compactor settings used by the limits once,
+        # rather than on every request
+        self.compactor = limits.compactor_settings(self.conf['compactor'])
+
+        # Set up the metrics emitter, and the path at which the
+        # metrics may be scraped, if enabled
+        self.metrics = metrics.get_metrics(self.conf)
+        self.metrics_path = self.conf['metrics'].get('path')
+
         # We will lazy-load the database
         self._db = None
 
@@ -222,16 +267,56 @@ class TurnstileMiddleware(object):
 
         # Initialize the control daemon
         if self.conf.to_bool(self.conf['control'].get('remote', 'no'), False):
-            self.control_daemon = remote.RemoteControlDaemon(self, self.conf)
+            klass = remote.RemoteControlDaemon
+        else:
+            klass = control.ControlDaemon
+        self.control_daemon = control.get_daemon(klass, self, self.conf)
+
+        # Now start the control daemon; in pre-fork mode, this waits
+        # for the post-fork hook
+        if self.conf.to_bool(self.conf['control'].get('prefork', 'no'),
+                             False):
+            _prefork_middleware.add(self)
         else:
-            self.control_daemon = control.ControlDaemon(self, self.conf)
+            self.control_daemon.start()
 
-        # Now start the control daemon
-        self.control_daemon.start()
+            # If the limits may have been loaded from the cache file,
+            # build the routes now, so we can serve immediately
+            if self.conf['control'].get('cache_file'):
+                self.recheck_limits()
 
         # Emit a log message to indicate that we're running
         LOG.info("Turnstile middleware initialized")
 
+    def pre_fork(self):
+        """
+        Prepare the middleware for forking.  Loads the limits and
+        builds the routes mapper, without starting the control
+        daemon's listening thread, so that the worker processes
+        forked afterwards share the loaded limits.
+        """
+
+        self.control_daemon.preload()
+        self.recheck_limits()
+
+    def post_fork(self):
+        """
+        Complete the middleware initialization in a forked worker
+        process.  Discards the connections inherited from the master
+        process, then starts the control daemon.  The control daemon
+        finds the limits loaded by pre_fork() still current, so the
+        worker need not reload them.
+        """
+
+        self._db = None
+        self.control_daemon.reset()
+
+        # The limits were hydrated with the master's database handle
+        for lim in self.limits:
+            lim.db = self.db
+
+        self.control_daemon.start()
+
     def recheck_limits(self):
         """
         Re-check that the cached limits are the current limits.
@@ -240,27 +325,46 @@ class TurnstileMiddleware(object):
         limit_data = self.control_daemon.get_limits()
 
         try:
-            # Get the new checksum and list of limits
-            new_sum, new_limits = limit_data.get_limits(self.limit_sum)
-
-            # Convert the limits list into a list of objects
-            lims = database.limits_hydrate(self.db, new_limits)
-
-            # Build a new mapper
-            mapper = routes.Mapper(register=False)
-            for lim in lims:
-                lim._route(mapper)
+            # Get the new checksum and the changes to apply
+            new_sum, changes = limit_data.get_changes(self.limit_sum)
+
+            with self.metrics.timer('reload'):
+                if changes is None:
+                    # Changes not available; get the full list of
+                    # limits and convert it into a list of objects
+                    new_sum, new_limits = limit_data.get_limits(
+                        self.limit_sum)
+                    lims = self._reuse_limits(new_limits)
+                else:
+                    # Apply the changes to the current list of limits
+                    lims = self._apply_changes(changes)
+                    self.metrics.incr('reload.changes', len(changes))
+
+                # Build a new mapper
+                mapper = routes.Mapper(register=False)
+                for lim in lims:
+                    lim._route(mapper)
+
+                # Compile the routes now, rather than on the next
+                # request
+                mapper.create_regs()
 
             # Save the new data
             self.limits = lims
             self.limit_sum = new_sum
             self.mapper = mapper
+
+            # Keep track of the reloads
+            self.metrics.incr('reload')
+            self.metrics.gauge('limits', len(lims))
+            self.metrics.info('limits', checksum=new_sum)
         except control.NoChangeException:
             # No changes to process; just keep going...
             return
         except Exception:
             # Log an error
             LOG.exception("Could not load limits")
+            self.metrics.incr('reload.errors')
 
             # Get our error set and publish channel
             control_args = self.conf['control']
@@ -281,6 +385,74 @@ class TurnstileMiddleware(object):
             with utils.ignore_except():
                 self.db.publish(error_channel, msg)
 
+    def _hydrate_limit(self, limit):
+        """
+        Hydrate a single limit, remembering the data it was hydrated
+        from so that later reloads can reuse the limit object.
+
+        :param limit: The dehydrated limit, as a dictionary.
+
+        :returns: The limit object.
+        """
+
+        lim = limits.Limit.hydrate(self.db, dict(limit))
+        self.limit_src[lim.uuid] = (limit, lim)
+        self.metrics.incr('reload.hydrated')
+        return lim
+
+    def _reuse_limits(self, new_limits):
+        """
+        Convert a full list of dehydrated limits into a list of limit
+        objects.  Limits with the same UUID and the same data as a
+        limit that is already loaded reuse the existing limit object,
+        along with any per-limit caches it has built up; only the new
+        and changed limits are hydrated.
+
+        :param new_limits: A list of dehydrated limits, as
+                           dictionaries.
+
+        :returns: The new list of limit objects.
+        """
+
+        old_src = self.limit_src
+        self.limit_src = {}
+
+        lims = []
+        for limit in new_limits:
+            # Reuse the existing object if the limit is unchanged
+            src, lim = old_src.get(limit.get('uuid'), (None, None))
+            if src is not None and src == limit:
+                self.limit_src[lim.uuid] = (src, lim)
+            else:
+                lim = self._hydrate_limit(limit)
+
+            lims.append(lim)
+
+        return lims
+
+    def _apply_changes(self, changes):
+        """
+        Apply changes to individual limits to the current list of
+        limits.  Only the new and changed limits are hydrated.
+
+        :param changes: A list of changes, as returned by
+                        turnstile.control:LimitData.get_changes().
+
+        :returns: The new list of limit objects.
+        """
+
+        lims = list(self.limits or [])
+        for uuid, index, limit in changes:
+            # Drop the old version of the limit
+            lims = [lim for lim in lims if lim.uuid != uuid]
+            self.limit_src.pop(uuid, None)
+
+            # Add the new version
+            if limit is not None:
+                lims.insert(index, self._hydrate_limit(limit))
+
+        return lims
+
     def __call__(self, environ, start_response):
         """
         Implements the processing of the turnstile middleware.  Walks
@@ -290,6 +462,13 @@ class TurnstileMiddleware(object):
         is needed, the request is passed on to the application.
         """
 
+        # Answer requests for the metrics page directly
+        if (self.metrics_path and
+                environ.get('PATH_INFO') == self.metrics_path):
+            return self.format_metrics(environ, start_response)
+
+        self.metrics.incr('requests')
+
         with self.mapper_lock:
             # Check for updates to the limits
             self.recheck_limits()
@@ -308,18 +487,25 @@ class TurnstileMiddleware(object):
         # Make configuration available to the limit classes as well
         environ['turnstile.conf'] = self.conf
 
+        # Set up the context shared by all the limits
+        environ['turnstile.context'] = limits.RequestContext(
+            environ, self.compactor, self.metrics)
+
         # Now, if we have a mapper, run through it
         if mapper:
-            mapper.routematch(environ=environ)
+            with self.metrics.timer('route_match'):
+                mapper.routematch(environ=environ)
 
         # If there were any delays, deal with them
         if 'turnstile.delay' in environ and environ['turnstile.delay']:
             # Find the longest delay
             delay, limit, bucket = sorted(environ['turnstile.delay'],
                                           key=lambda x: x[0])[-1]
+            self.metrics.incr('rejects')
 
-            return self.formatter(delay, limit, bucket,
-                                  environ, start_response)
+            with self.metrics.timer('format'):
+                return self.formatter(delay, limit, bucket,
+                                      environ, start_response)
 
         with self.mapper_lock:
             # Run the request postprocessors; some may want to refer
@@ -354,6 +540,21 @@ class TurnstileMiddleware(object):
         start_response(status, headers.items())
         return entity
 
+    def format_metrics(self, environ, start_response):
+        """
+        Formats the metrics page, in the Prometheus text exposition
+        format.  May be overridden in subclasses to allow alternate
+        responses.
+        """
+
+        body = self.metrics.expose()
+
+        start_response('200 OK', [
+            ('Content-Type', 'text/plain; version=0.0.4'),
+            ('Content-Length', str(len(body))),
+        ])
+        return [body]
+
     @property
     def db(self):
         """
@@ -361,8 +562,9 @@ class TurnstileMiddleware(object):
         initialization of the database handle.
         """
 
-        # Initialize the database handle
+        # Initialize the database handle; the control daemon decides
+        # what kind of handle to use
         if not self._db:
-            self._db = self.conf.get_database()
+            self._db = self.control_daemon.get_database()
 
         return self._db
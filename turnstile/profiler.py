@@ -0,0 +1,191 @@
+# Copyright 2013 Rackspace
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import cProfile
+import os
+import pstats
+import signal
+
+
+class SamplingProfiler(object):
+    """
+    A statistical profiler.  While running, the process receives a
+    SIGPROF signal at a fixed interval of CPU time, and the stack of
+    the code executing at that moment is recorded.  Since Turnstile
+    runs its greenthreads within a single operating system thread,
+    this samples whichever greenthread is currently running.  The
+    results are saved in the "collapsed stack" format understood by
+    flame graph tools.
+
+    Note that the profiler must be started and stopped from the main
+    thread, as only that thread may install signal handlers;
+    otherwise, start() raises a ValueError.  Also note that, under
+    Python 2, a signal may interrupt a blocking system call with an
+    EINTR error.  System calls are restarted after a SIGPROF where the
+    operating system permits, but calls which cannot be restarted,
+    such as select(), may still fail in code which doesn't retry
+    them; the eventlet hub retries them.
+    """
+
+    extension = 'collapsed'
+
+    def __init__(self, interval=0.005):
+        """
+        Initialize a SamplingProfiler.
+
+        :param interval: The sampling interval, in seconds of CPU
+                         time.  Defaults to 5 milliseconds.
+        """
+
+        self.interval = interval
+        self.stacks = {}
+        self.samples = 0
+        self._old_handler = None
+
+    def start(self):
+        """
+        Start sampling.
+        """
+
+        self._old_handler = signal.signal(signal.SIGPROF, self._sample)
+        try:
+            # Restart system calls interrupted by the signal
+            signal.siginterrupt(signal.SIGPROF, False)
+            signal.setitimer(signal.ITIMER_PROF, self.interval,
+                             self.interval)
+        except Exception:
+            signal.signal(signal.SIGPROF, self._old_handler or signal.SIG_DFL)
+            self._old_handler = None
+            raise
+
+    def stop(self):
+        """
+        Stop sampling.
+        """
+
+        signal.setitimer(signal.ITIMER_PROF, 0, 0)
+        signal.signal(signal.SIGPROF, self._old_handler or signal.SIG_DFL)
+        self._old_handler = None
+
+    def _sample(self, signum, frame):
+        """
+        Signal handler.  Records the stack of the interrupted frame.
+
+        :param signum: The signal number.
+        :param frame: The interrupted frame.
+        """
+
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append('%s:%s' % (os.path.basename(code.co_filename),
+                                    code.co_name))
+            frame = frame.f_back
+
+        # Collapsed stacks are listed from the outermost frame
+        key = ';'.join(reversed(stack))
+        self.stacks[key] = self.stacks.get(key, 0) + 1
+        self.samples += 1
+
+    def save(self, filename):
+        """
+        Save the profile.
+
+        :param filename: The name of the file to save the profile to.
+        """
+
+        with open(filename, 'w') as f:
+            for stack, count in sorted(self.stacks.items()):
+                print >>f, "%s %d" % (stack, count)
+
+    def summary(self):
+        """
+        Summarize the profile.
+
+        :returns: A short, human-readable summary of the profile.
+        """
+
+        # Find the function seen most often at the top of the stack
+        leaves = {}
+        for stack, count in self.stacks.items():
+            leaf = stack.rpartition(';')[-1]
+            leaves[leaf] = leaves.get(leaf, 0) + count
+
+        if not leaves:
+            return "%d samples" % self.samples
+
+        leaf, count = max(leaves.items(), key=lambda x: x[1])
+        return "%d samples, top %s (%d%%)" % (
+            self.samples, leaf, count * 100 // self.samples)
+
+
+class DeterministicProfiler(object):
+    """
+    A deterministic profiler, based on cProfile.  All function calls
+    made while the profiler is running are recorded.  This is much
+    more expensive than the SamplingProfiler, but produces exact call
+    counts.  The results are saved in the pstats format, which may be
+    examined using the standard "pstats" module.
+    """
+
+    extension = 'pstats'
+
+    def __init__(self):
+        """
+        Initialize a DeterministicProfiler.
+        """
+
+        self.profile = cProfile.Profile()
+
+    def start(self):
+        """
+        Start profiling.
+        """
+
+        self.profile.enable()
+
+    def stop(self):
+        """
+        Stop profiling.
+        """
+
+        self.profile.disable()
+
+    def save(self, filename):
+        """
+        Save the profile.
+
+        :param filename: The name of the file to save the profile to.
+        """
+
+        self.profile.dump_stats(filename)
+
+    def summary(self):
+        """
+        Summarize the profile.
+
+        :returns: A short, human-readable summary of the profile.
+        """
+
+        stats = pstats.Stats(self.profile)
+        return "%d calls in %.3f seconds" % (stats.total_calls,
+                                             stats.total_tt)
+
+
+# Map of the recognized profiler modes
+profilers = {
+    'sample': SamplingProfiler,
+    'pstats': DeterministicProfiler,
+}
@@ -13,16 +13,27 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import collections
+import errno
 import functools
+import itertools
 import json
 import logging
+import mmap
+import os
+import select
 import socket
+import stat
+import struct
 import sys
 import time
 import warnings
 
 import eventlet
+import eventlet.corolocal
+import msgpack
 
+from turnstile import config
 from turnstile import control
 from turnstile import utils
 
@@ -36,16 +47,77 @@ class ConnectionClosed(Exception):
     pass
 
 
+# The highest version of the RPC protocol supported.  Protocol
+# version 1 sends each message as a line of JSON; version 2 sends
+# each message as a msgpack'd list of the command and payload,
+# preceded by its length as a 4-byte, big-endian integer.  Version 3
+# uses the same framing as version 2, and adds the MCALL command,
+# which tags each call with a request ID so that several calls may be
+# outstanding on one connection.  Clients advertise the highest
+# version they support when authenticating, and the server replies
+# with the version to use; see SimpleRPC.serve().
+PROTOCOL_VERSION = 3
+
+# The length prefix of a protocol version 2 message
+_FRAME_HEADER = struct.Struct('>I')
+
+# Delivered to a greenthread waiting for the response to a
+# multiplexed call to make it the reader; see SimpleRPC._mcall()
+_READER = object()
+
+
 class Connection(object):
     """Buffered network connection."""
 
-    def __init__(self, sock):
-        """Initialize a Connection object."""
+    # The initial size of the receive buffer used by protocol
+    # version 2; it grows as needed to hold larger messages
+    frame_bufsize = 65536
+
+    def __init__(self, sock, protocol=1):
+        """
+        Initialize a Connection object.
+
+        :param sock: The socket.
+        :param protocol: The version of the RPC protocol to use.
+                         Defaults to 1; see set_protocol().
+        """
 
         self._sock = sock
-        self._recvbuf = []
+        self._send_lock = eventlet.semaphore.Semaphore()
+        self._recvbuf = collections.deque()
         self._recvbuf_partial = ''
 
+        # Receive buffer for protocol version 2
+        self._frame_buf = None
+        self._frame_start = 0
+        self._frame_end = 0
+
+        self.protocol = 1
+        self.set_protocol(protocol)
+
+    def set_protocol(self, protocol):
+        """
+        Select the version of the RPC protocol used for subsequent
+        messages.  Any partially received data is carried over.
+
+        :param protocol: The protocol version; must be between 1 and
+                         PROTOCOL_VERSION.  Versions 2 and up use
+                         the same framing.
+        """
+
+        if protocol not in range(1, PROTOCOL_VERSION + 1):
+            raise ValueError("Unsupported protocol version %r" % protocol)
+
+        self.protocol = protocol
+        if protocol >= 2 and self._frame_buf is None:
+            self._frame_buf = bytearray(max(self.frame_bufsize,
+                                            len(self._recvbuf_partial)))
+            self._frame_buf[:len(self._recvbuf_partial)] = \
+                self._recvbuf_partial
+            self._frame_start = 0
+            self._frame_end = len(self._recvbuf_partial)
+            self._recvbuf_partial = ''
+
     def close(self):
         """
         Close the connection.
@@ -61,8 +133,29 @@ class Connection(object):
             self._sock = None
 
         # Purge the message buffers
-        self._recvbuf = []
+        self._recvbuf = collections.deque()
         self._recvbuf_partial = ''
+        self._frame_start = 0
+        self._frame_end = 0
+
+    def readable(self):
+        """
+        Determine whether a message can be received.  Note that
+        recv() may still wait for the rest of a partially sent
+        message.
+
+        :returns: True if a message has been received or data is
+                  waiting to be read from the socket, False otherwise.
+        """
+
+        # If it's closed, raise an error up front
+        if not self._sock:
+            raise ConnectionClosed("Connection closed")
+
+        if self._recvbuf:
+            return True
+
+        return bool(select.select([self._sock], [], [], 0)[0])
 
     def send(self, cmd, *payload):
         """
@@ -70,7 +163,9 @@ class Connection(object):
 
         :param cmd: The command to send to the other end.
         :param payload: The command payload.  Note that all elements
-                        of the payload must be serializable to JSON.
+                        of the payload must be serializable to JSON
+                        (for protocol version 1) or msgpack (for
+                        protocol versions 2 and up).
         """
 
         # If it's closed, raise an error up front
@@ -78,11 +173,17 @@ class Connection(object):
             raise ConnectionClosed("Connection closed")
 
         # Construct the outgoing message
-        msg = json.dumps(dict(cmd=cmd, payload=payload)) + '\n'
-
-        # Send it
+        if self.protocol >= 2:
+            data = msgpack.dumps([cmd, payload])
+            msg = _FRAME_HEADER.pack(len(data)) + data
+        else:
+            msg = json.dumps(dict(cmd=cmd, payload=payload)) + '\n'
+
+        # Send it; messages from several greenthreads must not be
+        # interleaved
         try:
-            self._sock.sendall(msg)
+            with self._send_lock:
+                self._sock.sendall(msg)
         except socket.error:
             # We'll need to re-raise
             e_type, e_value, e_tb = sys.exc_info()
@@ -101,11 +202,120 @@ class Connection(object):
         """
 
         # Pop a message off the recv buffer and return (or raise) it
-        msg = self._recvbuf.pop(0)
+        msg = self._recvbuf.popleft()
         if isinstance(msg, Exception):
             raise msg
         return msg['cmd'], msg['payload']
 
+    def _parse_frames(self):
+        """
+        Internal helper to parse the complete protocol version 2
+        messages in the receive buffer, adding them to the queue of
+        received messages.
+        """
+
+        buf = self._frame_buf
+        start = self._frame_start
+        end = self._frame_end
+        while end - start >= _FRAME_HEADER.size:
+            # Do we have the whole message?
+            length = _FRAME_HEADER.unpack_from(buf, start)[0]
+            msg_start = start + _FRAME_HEADER.size
+            if end - msg_start < length:
+                break
+
+            # Parse the message, without copying it out of the buffer
+            try:
+                cmd, payload = msgpack.loads(buffer(buf, msg_start, length))
+                self._recvbuf.append(dict(cmd=cmd, payload=payload))
+            except Exception as exc:
+                # Error parsing the message; save the exception, which
+                # we will re-raise
+                self._recvbuf.append(ValueError(str(exc)))
+
+            start = msg_start + length
+
+        # If we've consumed everything, start over at the beginning
+        if start == end:
+            start = end = 0
+
+        self._frame_start = start
+        self._frame_end = end
+
+    def _frame_space(self):
+        """
+        Internal helper to make room in the protocol version 2
+        receive buffer for the rest of the message being received.
+        Moves the partially received message to the beginning of the
+        buffer, and grows the buffer if it is too small to hold the
+        message.
+
+        :returns: A memoryview of the free space in the buffer.
+        """
+
+        buf = self._frame_buf
+        start = self._frame_start
+        end = self._frame_end
+
+        # Figure out how big the message is, if we know
+        needed = _FRAME_HEADER.size
+        if end - start >= needed:
+            needed += _FRAME_HEADER.unpack_from(buf, start)[0]
+
+        if start + needed > len(buf):
+            if needed > len(buf):
+                # Replace the buffer with one big enough to hold the
+                # message; we can't resize it in place while views of
+                # it may still exist
+                self._frame_buf = bytearray(needed)
+                self._frame_buf[:end - start] = buf[start:end]
+                buf = self._frame_buf
+            elif start:
+                # Move the partial message to the beginning of the
+                # buffer
+                buf[:end - start] = buf[start:end]
+
+            end -= start
+            start = 0
+
+            self._frame_start = start
+            self._frame_end = end
+
+        return memoryview(buf)[end:]
+
+    def _recv_data(self, func, *args):
+        """
+        Internal helper to read from the socket.  Closes the
+        connection if an error occurs or if the other end has closed
+        the connection.
+
+        :param func: The socket method to call, i.e., recv or
+                     recv_into.
+        :param args: The arguments for the method.
+
+        :returns: The return value of the method.
+        """
+
+        try:
+            data = func(*args)
+        except socket.error:
+            # We'll need to re-raise
+            e_type, e_value, e_tb = sys.exc_info()
+
+            # Make sure the socket is closed
+            self.close()
+
+            # Re-raise
+            raise e_type, e_value, e_tb
+
+        # Did the connection get closed?
+        if not data:
+            # There can never be anything in the buffer here
+            self.close()
+            raise ConnectionClosed("Connection closed")
+
+        return data
+
     def recv(self):
         """
         Receive a message from the other end.  Returns a tuple of the
@@ -120,25 +330,21 @@ class Connection(object):
         if not self._sock:
             raise ConnectionClosed("Connection closed")
 
-        # OK, get some data from the socket
-        while True:
-            try:
-                data = self._sock.recv(4096)
-            except socket.error:
-                # We'll need to re-raise
-                e_type, e_value, e_tb = sys.exc_info()
-
-                # Make sure the socket is closed
-                self.close()
+        # Protocol versions 2 and up read directly into the receive
+        # buffer
+        if self.protocol >= 2:
+            while True:
+                self._frame_end += self._recv_data(self._sock.recv_into,
+                                                   self._frame_space())
+                self._parse_frames()
 
-                # Re-raise
-                raise e_type, e_value, e_tb
+                # Make sure we have a message to return
+                if self._recvbuf:
+                    return self._recvbuf_pop()
 
-            # Did the connection get closed?
-            if not data:
-                # There can never be anything in the buffer here
-                self.close()
-                raise ConnectionClosed("Connection closed")
+        # OK, get some data from the socket
+        while True:
+            data = self._recv_data(self._sock.recv, 4096)
 
             # Begin parsing the read-in data
             partial = self._recvbuf_partial + data
@@ -185,11 +391,19 @@ def remote(func):
         if not self.conn:
             self.connect()
 
-        # Call the remote function
-        self.conn.send('CALL', func.__name__, args, kwargs)
+        # Call the remote function, receiving the response
+        if self.multiplexed:
+            cmd, payload = self._mcall(func.__name__, args, kwargs)
+        else:
+            self.conn.send('CALL', func.__name__, args, kwargs)
+            cmd, payload = self.conn.recv()
+
+            # A notification may arrive ahead of the response; save
+            # it for notifications()
+            while cmd == 'NOTE':
+                self._notes.append(payload)
+                cmd, payload = self.conn.recv()
 
-        # Receive the response
-        cmd, payload = self.conn.recv()
         if cmd == 'ERR':
             self.close()
             raise Exception("Catastrophic error from server: %s" %
@@ -238,6 +452,64 @@ def _create_server(host, port):
     raise exc
 
 
+def _create_unix_server(path, mode):
+    """
+    Helper function.  Creates a listening Unix domain socket at the
+    designated path.  A stale socket left at the path by a previous
+    server is removed first; if another server is still listening on
+    the socket, a socket.error with errno EADDRINUSE is raised
+    instead.
+
+    :param path: The path of the socket.
+    :param mode: The permissions to give the socket file.  Only
+                 users with write permission on the socket may
+                 connect to it.
+    """
+
+    # Remove a stale socket, but don't clobber anything else
+    try:
+        is_sock = stat.S_ISSOCK(os.lstat(path).st_mode)
+    except OSError:
+        is_sock = False
+    if is_sock:
+        # Make sure no server is listening on it; a second server
+        # started by mistake must not steal the first one's clients
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(path)
+        except socket.error as exc:
+            if exc.errno not in (errno.ECONNREFUSED, errno.ENOENT):
+                raise
+        else:
+            raise socket.error(errno.EADDRINUSE,
+                               "Another server is listening on %r" % path)
+        finally:
+            probe.close()
+
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        # Create the socket with no permissions, then set the desired
+        # ones, so that there is no window in which clients could
+        # connect to a more permissive socket
+        old_umask = os.umask(0777)
+        try:
+            sock.bind(path)
+        finally:
+            os.umask(old_umask)
+        os.chmod(path, mode)
+        sock.listen(1024)
+    except Exception:
+        sock.close()
+        raise
+
+    return sock
+
+
 class SimpleRPC(object):
     """
     Implements simple remote procedure call.  When run in client mode
@@ -256,7 +528,12 @@ class SimpleRPC(object):
     connection_class = Connection
     max_err_thresh = 10
 
-    def __init__(self, host, port, authkey):
+    # Set when the connection to the server supports multiplexed
+    # calls; see _mcall()
+    multiplexed = False
+
+    def __init__(self, host, port, authkey, protocol=PROTOCOL_VERSION,
+                 path=None, mode=0600):
         """
         Initialize a SimpleRPC object.
 
@@ -266,15 +543,44 @@ class SimpleRPC(object):
         :param port: The TCP port the server will listen on.
         :param authkey: An authentication key.  The server and all
                         clients must use the same authentication key.
+        :param protocol: The highest version of the RPC protocol to
+                         use.  The version actually used for a
+                         connection is negotiated when the client
+                         authenticates.
+        :param path: If given, the path of a Unix domain socket the
+                     server will listen on.  The host and port are
+                     ignored.
+        :param mode: The permissions the server gives the Unix domain
+                     socket.  Defaults to 0600, allowing only the user
+                     running the server to connect.
         """
 
         self.host = host
         self.port = port
         self.authkey = authkey
+        self.protocol = protocol
+        self.path = path
+        self.sock_mode = mode
 
         self.mode = None
         self.conn = None
 
+        # State for multiplexed calls: the IDs of outstanding calls
+        # map to the queues their responses are delivered to, and
+        # the reader is the ID of the call whose greenthread is
+        # reading responses
+        self._req_ids = itertools.count(1)
+        self._pending = {}
+        self._reader = None
+
+        # Notifications received while waiting for a response; see
+        # notifications()
+        self._notes = collections.deque()
+
+        # In server mode, the connection of the client whose call is
+        # being handled, for remote methods which need it
+        self.local = eventlet.corolocal.local()
+
     def close(self):
         """
         Close the connection to the server.
@@ -284,6 +590,8 @@ class SimpleRPC(object):
         if self.conn:
             self.conn.close()
         self.conn = None
+        self.multiplexed = False
+        self._notes.clear()
 
     def ping(self):
         """
@@ -307,6 +615,142 @@ class SimpleRPC(object):
         # Return the RTT
         return recv_ts - payload[0]
 
+    def notifications(self):
+        """
+        Retrieve any notifications the server has sent, without
+        waiting for more.  Notifications are sent on connections
+        which have subscribed to them, and such connections should
+        not be used for other calls.
+
+        :returns: A list of the payloads of the notifications.
+        """
+
+        if not self.conn:
+            raise ConnectionClosed("Not connected")
+
+        # Start with those received while waiting for a response
+        notes = list(self._notes)
+        self._notes.clear()
+
+        try:
+            while self.conn.readable():
+                cmd, payload = self.conn.recv()
+                if cmd == 'NOTE':
+                    notes.append(payload)
+        except Exception:
+            self.close()
+            raise
+
+        return notes
+
+    def _mcall(self, funcname, args, kwargs):
+        """
+        Perform a multiplexed call of a remote function.  Several
+        greenthreads may have calls outstanding on the connection at
+        once.  One of them at a time acts as the reader, reading
+        responses and delivering them to the greenthreads waiting for
+        them; when the reader receives its own response, it hands
+        the job off to another waiting greenthread.
+
+        :param funcname: The name of the remote function.
+        :param args: The positional arguments for the function.
+        :param kwargs: The keyword arguments for the function.
+
+        :returns: A tuple of the response command and payload, in the
+                  same form as for the CALL command.
+        """
+
+        conn = self.conn
+        req_id = self._req_ids.next()
+        responses = eventlet.queue.LightQueue()
+        self._pending[req_id] = responses
+
+        try:
+            conn.send('MCALL', req_id, funcname, args, kwargs)
+
+            # Become the reader if there isn't one
+            if self._reader is None:
+                self._reader = req_id
+
+            while True:
+                if self._reader == req_id and responses.empty():
+                    self._recv_response(conn)
+                    continue
+
+                # Wait for our response, or for the reader to hand
+                # off to us
+                response = responses.get()
+                if response is not _READER:
+                    break
+        finally:
+            del self._pending[req_id]
+
+            # Hand off the reader job to another call
+            if self._reader == req_id:
+                self._reader = None
+                for other, other_responses in self._pending.items():
+                    self._reader = other
+                    other_responses.put(_READER)
+                    break
+
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+    def _recv_response(self, conn):
+        """
+        Receive one response to a multiplexed call and deliver it to
+        the greenthread waiting for it.  If the connection fails, or
+        the server reports a catastrophic error, all outstanding
+        calls fail and the connection is closed.
+
+        :param conn: The connection to read from.
+        """
+
+        try:
+            cmd, payload = conn.recv()
+        except Exception as exc:
+            self._fail_pending(conn, exc)
+            return
+
+        if cmd in ('MRES', 'MEXC'):
+            # Deliver the response as if it were a RES or EXC
+            # response to a CALL command
+            responses = self._pending.get(payload[0])
+            if responses is not None:
+                responses.put((cmd[1:], payload[1:]))
+        elif cmd == 'NOTE':
+            # A notification may arrive ahead of a response; save it
+            # for notifications()
+            self._notes.append(payload)
+        elif cmd == 'ERR':
+            self._fail_pending(conn, Exception(
+                "Catastrophic error from server: %s" % payload[0]))
+        else:
+            self._fail_pending(conn, Exception(
+                "Invalid command response from server: %s" % cmd))
+
+    def _fail_pending(self, conn, exc):
+        """
+        Fail all outstanding multiplexed calls and close the
+        connection.
+
+        :param conn: The connection that failed.
+        :param exc: The exception to raise in the greenthreads waiting
+                    for responses.
+        """
+
+        for responses in self._pending.values():
+            responses.put(exc)
+        self._reader = None
+
+        # Close the connection, taking care not to close a
+        # replacement connection
+        if self.conn is conn:
+            self.close()
+        else:
+            conn.close()
+
     def connect(self):
         """
         Connect to the server.  This method causes the SimpleRPC
@@ -325,19 +769,32 @@ class SimpleRPC(object):
             return
 
         # OK, attempt the connection
-        fd = socket.create_connection((self.host, self.port))
+        if self.path:
+            fd = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                fd.connect(self.path)
+            except Exception:
+                fd.close()
+                raise
+        else:
+            fd = socket.create_connection((self.host, self.port))
 
         # Initialize the connection object
         self.conn = self.connection_class(fd)
 
-        # Authenticate
+        # Authenticate, advertising the highest protocol version we
+        # support; servers predating protocol negotiation ignore it
+        # and reply with a bare "OK", so we stay with version 1
         try:
-            self.conn.send('AUTH', self.authkey)
+            self.conn.send('AUTH', self.authkey, self.protocol)
             cmd, payload = self.conn.recv()
             if cmd != 'OK':
                 LOG.error("Failed to authenticate to %s port %s: %s" %
                           (self.host, self.port, payload[0]))
                 self.close()
+            elif payload and payload[0] > 1:
+                self.conn.set_protocol(payload[0])
+                self.multiplexed = payload[0] >= 3
         except Exception:
             exc_type, exc_value, exc_tb = sys.exc_info()
 
@@ -371,7 +828,10 @@ class SimpleRPC(object):
         self.mode = 'server'
 
         # Obtain a listening socket
-        serv = _create_server(self.host, self.port)
+        if self.path:
+            serv = _create_unix_server(self.path, self.sock_mode)
+        else:
+            serv = _create_server(self.host, self.port)
 
         # If we have too many errors, we want to bail out
         err_thresh = 0
@@ -390,6 +850,11 @@ class SimpleRPC(object):
             # Decrement error count on successful connections
             err_thresh = max(err_thresh - 1, 0)
 
+            # Unix domain socket clients have no address; identify
+            # them by the socket path and file descriptor
+            if self.path:
+                addr = (self.path, sock.fileno())
+
             # Log the connection attempt
             LOG.info("Accepted connection from %s port %s" %
                      (addr[0], addr[1]))
@@ -400,6 +865,9 @@ class SimpleRPC(object):
         # Close the listening socket
         with utils.ignore_except():
             serv.close()
+        if self.path:
+            with utils.ignore_except():
+                os.unlink(self.path)
 
     def _get_remote_method(self, funcname):
         """
@@ -427,6 +895,8 @@ class SimpleRPC(object):
                      Provided for debugging.
         """
 
+        self.local.conn = conn
+
         try:
             # Handle data from the client
             while True:
@@ -455,6 +925,18 @@ class SimpleRPC(object):
                         # Don't give them a second chance
                         conn.send('ERR', "Invalid authentication key")
                         return
+                    elif len(payload) > 1:
+                        # Authentication successful; the client
+                        # advertised the highest protocol version it
+                        # supports, so tell it which one we'll use and
+                        # switch to it
+                        try:
+                            protocol = min(int(payload[1]), self.protocol)
+                        except (TypeError, ValueError):
+                            protocol = 1
+                        conn.send('OK', protocol)
+                        conn.set_protocol(protocol)
+                        auth = True
                     else:
                         # Authentication successful
                         conn.send('OK')
@@ -494,6 +976,20 @@ class SimpleRPC(object):
                         # Return the result
                         conn.send('RES', result)
 
+                # Handle a multiplexed function call command; calls
+                # are handled concurrently, and the responses carry
+                # the request ID
+                elif cmd == 'MCALL' and conn.protocol >= 3:
+                    try:
+                        req_id, funcname, args, kwargs = payload
+                    except ValueError as exc:
+                        conn.send('ERR', "Invalid payload for 'MCALL' "
+                                  "command: %s" % str(exc))
+                        continue
+
+                    eventlet.spawn_n(self._serve_mcall, conn, addr, req_id,
+                                     funcname, args, kwargs)
+
                 # Handle all other commands by returning an ERR
                 else:
                     conn.send('ERR', "Unrecognized command %r" % cmd)
@@ -513,13 +1009,46 @@ class SimpleRPC(object):
             # Make sure the socket gets closed
             conn.close()
 
+    def _serve_mcall(self, conn, addr, req_id, funcname, args, kwargs):
+        """
+        Handle a multiplexed call from a client.  Runs in its own
+        greenthread.
+
+        :param conn: The Connection instance.
+        :param addr: The address of the client, for logging purposes.
+        :param req_id: The request ID assigned by the client.
+        :param funcname: The name of the function to call.
+        :param args: The positional arguments for the function.
+        :param kwargs: The keyword arguments for the function.
+        """
+
+        self.local.conn = conn
+
+        try:
+            # Look up and call the function
+            try:
+                func = self._get_remote_method(funcname)
+                result = func(*args, **kwargs)
+            except Exception as exc:
+                exc_name = '%s:%s' % (exc.__class__.__module__,
+                                      exc.__class__.__name__)
+                conn.send('MEXC', req_id, exc_name, str(exc))
+            else:
+                conn.send('MRES', req_id, result)
+        except ConnectionClosed:
+            # The client went away; nothing to do
+            pass
+        except Exception as exc:
+            LOG.exception("Error responding to client at %s port %s: %s" %
+                          (addr[0], addr[1], str(exc)))
+
 
 class ControlDaemonRPC(SimpleRPC):
     """
     A SimpleRPC subclass for use by the Turnstile control daemon.
     """
 
-    def __init__(self, host, port, authkey, daemon):
+    def __init__(self, host, port, authkey, daemon, **kwargs):
         """
         Initialize a ControlDaemonRPC object.
 
@@ -530,11 +1059,56 @@ class ControlDaemonRPC(SimpleRPC):
         :param authkey: An authentication key.  The server and all
                         clients must use the same authentication key.
         :param daemon: The control daemon instance.
+
+        Additional keyword arguments, such as the path of a Unix
+        domain socket, are passed to SimpleRPC.
         """
 
-        super(ControlDaemonRPC, self).__init__(host, port, authkey)
+        super(ControlDaemonRPC, self).__init__(host, port, authkey, **kwargs)
         self.daemon = daemon
 
+        # The connections subscribed to change notifications
+        self.subscribers = set()
+
+    @remote
+    def subscribe(self):
+        """
+        Subscribe the client to notifications of changes to the
+        limits.  Each time the limits change, a NOTE message
+        containing the new checksum is sent to the client; see
+        notify().  Returns the current checksum.
+        """
+
+        self.subscribers.add(self.local.conn)
+        return self.daemon.limits.limit_sum
+
+    @remote
+    def execute_commands(self, commands, transaction=False):
+        """
+        Execute Redis commands through the bucket proxy.  See
+        BucketProxy.execute() for details.  Fails unless the
+        'control.remote.proxy' configuration is enabled.
+        """
+
+        if not self.daemon.remote_proxy:
+            raise ValueError("The bucket proxy is not enabled")
+
+        return self.daemon.get_bucket_proxy().execute(commands, transaction)
+
+    def notify(self, limit_sum):
+        """
+        Notify the subscribed clients that the limits have changed.
+        Clients which have gone away are unsubscribed.
+
+        :param limit_sum: The new checksum of the limits.
+        """
+
+        for conn in list(self.subscribers):
+            try:
+                conn.send('NOTE', limit_sum)
+            except Exception:
+                self.subscribers.discard(conn)
+
     @remote
     def get_limits(self, limit_sum):
         """
@@ -545,6 +1119,16 @@ class ControlDaemonRPC(SimpleRPC):
 
         return self.daemon.limits.get_limits(limit_sum)
 
+    @remote
+    def get_changes(self, limit_sum):
+        """
+        Retrieve the list of changes needed to bring the limits
+        indicated by the checksum up to date.  Raises
+        turnstile.control.NoChangeException if the checksums match.
+        """
+
+        return self.daemon.limits.get_changes(limit_sum)
+
 
 class RemoteLimitData(object):
     """
@@ -553,14 +1137,124 @@ class RemoteLimitData(object):
     RemoteControlDaemon process.
     """
 
-    def __init__(self, rpc):
+    # How long to wait, in seconds, before trying to subscribe again
+    # after a failure
+    resubscribe_delay = 10.0
+
+    def __init__(self, rpc, pool=(), subscription=None):
         """
         Initialize RemoteLimitData.  Stores a reference to the RPC
         client object.
+
+        :param rpc: The RPC client object.
+        :param pool: Additional RPC client objects.  Calls are spread
+                     across all the clients in turn.
+        :param subscription: An optional RPC client object used only
+                             to subscribe to change notifications.  If
+                             given, the RemoteControlDaemon process is
+                             only asked for the limits after it
+                             announces a change.
         """
 
         self.limit_rpc = rpc
         self.limit_lock = eventlet.semaphore.Semaphore()
+        self.limit_pool = list(pool)
+
+        # State for change notifications
+        self.subscription = subscription
+        self.subscription_lock = eventlet.semaphore.Semaphore()
+        self.subscribed = False
+        self.subscribe_retry = 0.0
+        self.remote_sum = None
+
+        # Clients whose connections don't support multiplexed calls
+        # can only have one call outstanding, so each client gets a
+        # lock
+        clients = [(rpc, self.limit_lock)]
+        clients.extend((client, eventlet.semaphore.Semaphore())
+                       for client in pool)
+        self._clients = itertools.cycle(clients)
+
+    def _call(self, method, limit_sum):
+        """
+        Call a remote method on the next RPC client.  Raises a
+        NoChangeException if the call fails.
+
+        :param method: The name of the remote method.
+        :param limit_sum: The checksum to pass to the method.
+
+        :returns: The return value of the remote method.
+        """
+
+        # If we've been told about every change, we know whether
+        # there has been one
+        if self._unchanged(limit_sum):
+            raise control.NoChangeException()
+
+        rpc, lock = self._clients.next()
+        try:
+            if rpc.multiplexed:
+                return getattr(rpc, method)(limit_sum)
+
+            with lock:
+                return getattr(rpc, method)(limit_sum)
+        except control.NoChangeException:
+            # Expected possibility
+            raise
+        except Exception:
+            # Something happened; maybe the server isn't running.
+            # Pretend that there's no change...
+            raise control.NoChangeException()
+
+    def _unchanged(self, limit_sum):
+        """
+        Use the change notifications to determine whether the limits
+        are unchanged, subscribing to the notifications if necessary.
+
+        :param limit_sum: The checksum of the limits the caller has.
+
+        :returns: True if the limits are known to be unchanged, False
+                  if they have changed or it is not known.
+        """
+
+        if self.subscription is None or limit_sum is None:
+            return False
+
+        with self.subscription_lock:
+            try:
+                if self.subscribed:
+                    # Process the notifications that have arrived
+                    for payload in self.subscription.notifications():
+                        self.remote_sum = payload[0]
+                elif time.time() >= self.subscribe_retry:
+                    self.remote_sum = self.subscription.subscribe()
+                    self.subscribed = True
+                else:
+                    return False
+            except Exception as exc:
+                # Fall back to asking, and try again later
+                LOG.warning("Lost subscription to limit changes: %s" %
+                            str(exc))
+                self.subscription.close()
+                self.subscribed = False
+                self.subscribe_retry = time.time() + self.resubscribe_delay
+                self.remote_sum = None
+                return False
+
+        return limit_sum == self.remote_sum
+
+    def close(self):
+        """
+        Close the connections to the RemoteControlDaemon process.
+        """
+
+        for rpc in [self.limit_rpc] + self.limit_pool:
+            rpc.close()
+
+        if self.subscription is not None:
+            self.subscription.close()
+            self.subscribed = False
+            self.remote_sum = None
 
     def set_limits(self, limits):
         """
@@ -580,17 +1274,562 @@ class RemoteLimitData(object):
         objects.
         """
 
-        with self.limit_lock:
-            # Grab the checksum and limit list
+        # Grab the checksum and limit list
+        return self._call('get_limits', limit_sum)
+
+    def get_changes(self, limit_sum=None):
+        """
+        Gets the changes needed to bring the limit data indicated by
+        limit_sum up to date.  Raises a NoChangeException if the
+        limit_sum represents no change, otherwise returns a tuple
+        consisting of the current limit_sum and a list of changes, or
+        None if get_limits() must be used.  See
+        turnstile.control:LimitData.get_changes() for details.
+        """
+
+        # Grab the checksum and change list
+        return self._call('get_changes', limit_sum)
+
+
+# The header of the limit snapshot file: a magic number, followed by
+# the generation counter
+_SNAPSHOT_MAGIC = 'TSLS'
+_SNAPSHOT_HEADER = struct.Struct('<4s4xQ')
+_SNAPSHOT_GENERATION = struct.Struct('<Q')
+_SNAPSHOT_GENERATION_OFFSET = 8
+
+
+def _snapshot_data_path(path):
+    """
+    Compute the name of the file containing the limit data for a
+    limit snapshot.
+
+    :param path: The name of the snapshot header file.
+
+    :returns: The name of the data file.
+    """
+
+    return path + '.data'
+
+
+class LimitSnapshot(object):
+    """
+    Publishes the limit data maintained by the RemoteControlDaemon
+    process as a snapshot shared with the worker processes.  The
+    snapshot consists of two files: a small header file, which is
+    memory-mapped by all the processes and contains a generation
+    counter, and a data file containing the msgpack'd limit data.
+    Each time the limits change, a new data file is written and
+    renamed into place, then the generation counter is incremented;
+    see SnapshotLimitData for the reader.
+    """
+
+    def __init__(self, path):
+        """
+        Initialize a LimitSnapshot.  Creates the header file if it
+        does not already exist; if it does, the generation counter
+        continues from its current value.
+
+        :param path: The name of the snapshot header file.
+        """
+
+        self.path = path
+        self.limit_sum = None
+
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0644)
+        try:
+            # Initialize the header if it's not valid
+            header = os.read(fd, _SNAPSHOT_HEADER.size)
+            if (len(header) < _SNAPSHOT_HEADER.size or
+                    header[:len(_SNAPSHOT_MAGIC)] != _SNAPSHOT_MAGIC):
+                os.lseek(fd, 0, os.SEEK_SET)
+                os.write(fd, _SNAPSHOT_HEADER.pack(_SNAPSHOT_MAGIC, 0))
+
+            self.header = mmap.mmap(fd, _SNAPSHOT_HEADER.size)
+        finally:
+            os.close(fd)
+
+    @property
+    def generation(self):
+        """
+        The current generation of the snapshot.
+        """
+
+        return _SNAPSHOT_GENERATION.unpack_from(
+            self.header, _SNAPSHOT_GENERATION_OFFSET)[0]
+
+    def publish(self, limit_sum, limit_data):
+        """
+        Publish a new snapshot of the limit data.  If the checksum is
+        identical to that of the last published snapshot, no action
+        is taken.
+
+        :param limit_sum: The checksum of the limits.
+        :param limit_data: A list of the limits, as dictionaries.
+        """
+
+        if limit_sum == self.limit_sum:
+            return
+
+        generation = self.generation + 1
+        data_path = _snapshot_data_path(self.path)
+        tmp_path = '%s.%d.tmp' % (data_path, os.getpid())
+
+        # Write the data to a temporary file, then atomically rename
+        # it into place, so readers never see a partial snapshot
+        with open(tmp_path, 'wb') as f:
+            f.write(msgpack.dumps({
+                'generation': generation,
+                'limit_sum': limit_sum,
+                'limits': limit_data,
+            }))
+        os.rename(tmp_path, data_path)
+
+        # Now announce the new generation
+        _SNAPSHOT_GENERATION.pack_into(self.header,
+                                       _SNAPSHOT_GENERATION_OFFSET,
+                                       generation)
+        self.limit_sum = limit_sum
+
+
+class SnapshotLimitData(object):
+    """
+    Provides access to limit data published by the RemoteControlDaemon
+    process as a LimitSnapshot.  Checking for changes requires only
+    reading the generation counter from the memory-mapped header;
+    the data file is only mapped and decoded when the generation
+    changes.
+    """
+
+    def __init__(self, path):
+        """
+        Initialize SnapshotLimitData.
+
+        :param path: The name of the snapshot header file.
+        """
+
+        self.path = path
+        self.header = None
+        self.generation = None
+        self.limit_sum = None
+        self.limit_data = []
+
+    def set_limits(self, limits):
+        """
+        Snapshot limit data is treated as read-only (with external
+        update).
+        """
+
+        raise ValueError("Cannot set snapshot limit data")
+
+    def _refresh(self):
+        """
+        Ensure that the most recently published limit data has been
+        loaded.  Raises a NoChangeException if the snapshot is not
+        available, e.g., because the RemoteControlDaemon process has
+        not yet published it.
+        """
+
+        try:
+            # Map the header, if we haven't yet
+            if self.header is None:
+                with open(self.path, 'rb') as f:
+                    header = mmap.mmap(f.fileno(), _SNAPSHOT_HEADER.size,
+                                       access=mmap.ACCESS_READ)
+                if header[:len(_SNAPSHOT_MAGIC)] != _SNAPSHOT_MAGIC:
+                    raise ValueError("Invalid limit snapshot %r" %
+                                     self.path)
+                self.header = header
+
+            # Has the snapshot changed?
+            generation = _SNAPSHOT_GENERATION.unpack_from(
+                self.header, _SNAPSHOT_GENERATION_OFFSET)[0]
+            if generation == self.generation:
+                return
+
+            # Map the data and decode it
+            with open(_snapshot_data_path(self.path), 'rb') as f:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
             try:
-                return self.limit_rpc.get_limits(limit_sum)
-            except control.NoChangeException:
-                # Expected possibility
-                raise
-            except Exception:
-                # Something happened; maybe the server isn't running.
-                # Pretend that there's no change...
-                raise control.NoChangeException()
+                snapshot = msgpack.loads(data[:])
+            finally:
+                data.close()
+        except Exception:
+            # Only complain if we've loaded the snapshot before;
+            # otherwise, it probably hasn't been published yet
+            if self.generation is not None:
+                LOG.exception("Could not load limit snapshot %r" %
+                              self.path)
+
+            # Pretend that there's no change...
+            raise control.NoChangeException()
+
+        # Note that the generation is that of the data file, which
+        # may be newer than the one we read from the header
+        self.generation = snapshot['generation']
+        self.limit_sum = snapshot['limit_sum']
+        self.limit_data = snapshot['limits']
+
+    def get_limits(self, limit_sum=None):
+        """
+        Gets the current limit data if it is different from the data
+        indicated by limit_sum.  Raises a NoChangeException if the
+        limit_sum represents no change, otherwise returns a tuple
+        consisting of the current limit_sum and a list of the limits.
+        """
+
+        self._refresh()
+
+        # Any changes?
+        if limit_sum and self.limit_sum == limit_sum:
+            raise control.NoChangeException()
+
+        return (self.limit_sum, self.limit_data)
+
+    def get_changes(self, limit_sum=None):
+        """
+        Gets the changes needed to bring the limit data indicated by
+        limit_sum up to date.  The snapshot does not record
+        individual changes, so the list of changes is always None,
+        indicating that get_limits() must be used; see
+        turnstile.control:LimitData.get_changes() for details.
+        Raises a NoChangeException if the limit_sum represents no
+        change.
+        """
+
+        self._refresh()
+
+        # Any changes?
+        if limit_sum and self.limit_sum == limit_sum:
+            raise control.NoChangeException()
+
+        return (self.limit_sum, None)
+
+
+# The Redis commands which may be sent through the bucket proxy: those
+# the limits issue when updating the buckets (including the summarize
+# records and compactor instructions) or loading them, and those the
+# middleware issues when reporting errors loading the limits
+_PROXY_COMMANDS = set([
+    'expire', 'expireat', 'get', 'lrange', 'publish', 'rpush', 'sadd',
+    'zadd',
+])
+
+
+class BucketProxy(object):
+    """
+    Executes Redis commands on behalf of the worker processes, in the
+    RemoteControlDaemon process.  The commands sent by all the
+    workers are merged into pipelines: while one pipeline is being
+    executed, commands which arrive are queued, and are sent together
+    in the next pipeline.  This keeps the number of Redis connections
+    per host small, and sends the commands in fewer round trips than
+    the workers would on their own.
+    """
+
+    def __init__(self, daemon):
+        """
+        Initialize a BucketProxy.
+
+        :param daemon: The RemoteControlDaemon, which provides the
+                       database handle.
+        """
+
+        self.daemon = daemon
+        self.queue = []
+        self.flushing = False
+
+    def execute(self, commands, transaction=False):
+        """
+        Execute a list of commands.  Unless a transaction is
+        requested, the commands are executed in a pipeline along with
+        the commands from other callers.
+
+        :param commands: A list of tuples of the command name, the
+                         positional arguments, and the keyword
+                         arguments.
+        :param transaction: If True, the commands are executed by
+                            themselves, in a transaction.
+
+        :returns: A list of the results of the commands.  If a
+                  command fails, the first such exception is raised
+                  instead.
+        """
+
+        # Make sure the commands can be sent
+        for name, _args, _kwargs in commands:
+            if name not in _PROXY_COMMANDS:
+                raise ValueError("Command %r cannot be proxied" % name)
+
+        if transaction:
+            pipe = self.daemon.db.pipeline(transaction=True)
+            for name, args, kwargs in commands:
+                getattr(pipe, name)(*args, **kwargs)
+            return pipe.execute()
+
+        # Queue the commands and make sure they'll be sent
+        event = eventlet.event.Event()
+        self.queue.append((commands, event))
+        if not self.flushing:
+            self.flushing = True
+            eventlet.spawn_n(self._flush)
+
+        results = event.wait()
+        for result in results:
+            if isinstance(result, Exception):
+                raise result
+        return results
+
+    def _flush(self):
+        """
+        Send the queued commands to the database, in a pipeline, and
+        deliver the results to the callers.  Repeats until no more
+        commands are queued.
+        """
+
+        try:
+            while self.queue:
+                batch = self.queue
+                self.queue = []
+
+                try:
+                    pipe = self.daemon.db.pipeline(transaction=False)
+                    for commands, _event in batch:
+                        for name, args, kwargs in commands:
+                            getattr(pipe, name)(*args, **kwargs)
+                    results = pipe.execute(raise_on_error=False)
+                except Exception as exc:
+                    # The whole batch failed
+                    for _commands, event in batch:
+                        event.send_exception(exc)
+                    continue
+
+                # Hand each caller its share of the results
+                start = 0
+                for commands, event in batch:
+                    event.send(results[start:start + len(commands)])
+                    start += len(commands)
+        finally:
+            self.flushing = False
+
+
+class ProxyPipeline(object):
+    """
+    A stand-in for a Redis pipeline, for use with ProxyDatabase.
+    Commands are queued until execute() is called, then sent to the
+    RemoteControlDaemon process together.
+    """
+
+    def __init__(self, db, transaction=True):
+        """
+        Initialize a ProxyPipeline.
+
+        :param db: The ProxyDatabase the pipeline belongs to.
+        :param transaction: If True, the commands are executed in a
+                            transaction.
+        """
+
+        self.db = db
+        self.transaction = transaction
+        self.command_stack = []
+
+    def __enter__(self):
+        """
+        Allow the pipeline to be used as a context manager.
+        """
+
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        """
+        Reset the pipeline when the context manager exits.
+        """
+
+        self.reset()
+
+    def __len__(self):
+        """
+        Return the number of queued commands.
+        """
+
+        return len(self.command_stack)
+
+    def __getattr__(self, name):
+        """
+        Retrieve a command.  Calling the command queues it for
+        execution.
+        """
+
+        if name not in _PROXY_COMMANDS:
+            raise AttributeError(name)
+
+        def command(*args, **kwargs):
+            self.command_stack.append((name, args, kwargs))
+            return self
+
+        return command
+
+    def reset(self):
+        """
+        Discard the queued commands.
+        """
+
+        self.command_stack = []
+
+    def execute(self):
+        """
+        Execute the queued commands.
+
+        :returns: A list of the results of the commands.
+        """
+
+        try:
+            if not self.command_stack:
+                return []
+            return self.db.execute_commands(self.command_stack,
+                                            self.transaction)
+        finally:
+            self.reset()
+
+
+class ProxyDatabase(object):
+    """
+    A stand-in for a Redis database handle, used by the worker
+    processes when the bucket proxy is enabled.  Commands are sent to
+    the RemoteControlDaemon process, which executes them along with
+    those of the other workers; see BucketProxy.  Only the commands
+    Turnstile itself needs are supported.  Note that the results of
+    the commands must be serializable by msgpack, so protocol version
+    2 or later is required.
+
+    The clients connect to the RemoteControlDaemon process when first
+    used.  If the process cannot be reached, or the connection uses
+    protocol version 1, the commands are executed directly against the
+    fallback database handle, if one was given, and the proxy is tried
+    again after reconnect_delay seconds.
+    """
+
+    # How long to wait, in seconds, before trying to reach the
+    # RemoteControlDaemon process again after a failure
+    reconnect_delay = 10.0
+
+    def __init__(self, rpc, pool=(), fallback=None):
+        """
+        Initialize a ProxyDatabase.
+
+        :param rpc: The RPC client object.
+        :param pool: Additional RPC client objects.  Commands are
+                     spread across all the clients in turn.
+        :param fallback: An optional database handle, used to execute
+                         the commands while the RemoteControlDaemon
+                         process cannot be reached.  If not given,
+                         the failure to reach it is raised instead.
+        """
+
+        self.proxy_rpcs = [rpc] + list(pool)
+        self.fallback = fallback
+        self.proxy_retry = 0.0
+
+        # As with RemoteLimitData, clients whose connections don't
+        # support multiplexed calls need a lock
+        self._clients = itertools.cycle(
+            [(client, eventlet.semaphore.Semaphore())
+             for client in self.proxy_rpcs])
+
+    def __getattr__(self, name):
+        """
+        Retrieve a command.  Calling the command sends it to the
+        RemoteControlDaemon process and returns its result.
+        """
+
+        if name not in _PROXY_COMMANDS:
+            raise AttributeError(name)
+
+        def command(*args, **kwargs):
+            return self.execute_commands([(name, args, kwargs)])[0]
+
+        return command
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        """
+        Retrieve a pipeline object.
+        """
+
+        return ProxyPipeline(self, transaction)
+
+    def execute_commands(self, commands, transaction=False):
+        """
+        Send commands to the RemoteControlDaemon process for
+        execution.
+
+        :param commands: A list of tuples of the command name, the
+                         positional arguments, and the keyword
+                         arguments.
+        :param transaction: If True, the commands are executed in a
+                            transaction.
+
+        :returns: A list of the results of the commands.
+        """
+
+        rpc, lock = self._clients.next()
+        if time.time() >= self.proxy_retry:
+            try:
+                with lock:
+                    self._connect(rpc)
+            except Exception as exc:
+                if self.fallback is None:
+                    raise
+
+                # Use the database directly for a while
+                LOG.warning("Bucket proxy unavailable; accessing the "
+                            "database directly for %s seconds: %s" %
+                            (self.reconnect_delay, exc))
+                self.proxy_retry = time.time() + self.reconnect_delay
+            else:
+                if rpc.multiplexed:
+                    return rpc.execute_commands(commands, transaction)
+
+                with lock:
+                    return rpc.execute_commands(commands, transaction)
+
+        # Execute the commands as the BucketProxy would
+        pipe = self.fallback.pipeline(transaction=transaction)
+        for name, args, kwargs in commands:
+            getattr(pipe, name)(*args, **kwargs)
+        return pipe.execute()
+
+    def _connect(self, rpc):
+        """
+        Ensure that an RPC client is connected to the
+        RemoteControlDaemon process over a connection which can carry
+        the results of the commands.  Raises an exception if not.
+
+        :param rpc: The RPC client object.
+        """
+
+        if not rpc.conn:
+            rpc.connect()
+            if not rpc.conn:
+                raise ConnectionClosed("Failed to authenticate to the "
+                                       "remote daemon")
+
+        # The binary results of the commands cannot be sent using
+        # version 1 of the RPC protocol
+        if rpc.conn.protocol < 2:
+            protocol = rpc.conn.protocol
+            rpc.close()
+            raise ConnectionClosed("Bucket proxy requires version 2 of the "
+                                   "RPC protocol, but the connection to the "
+                                   "remote daemon uses version %d" %
+                                   protocol)
+
+    def close(self):
+        """
+        Close the connections to the RemoteControlDaemon process.
+        """
+
+        for rpc in self.proxy_rpcs:
+            rpc.close()
 
 
 class RemoteControlDaemon(control.ControlDaemon):
@@ -601,18 +1840,33 @@ class RemoteControlDaemon(control.ControlDaemon):
     limit data from multiple processes.
     """
 
+    # The middleware in the remote_daemon process serves no requests
+    serves_requests = False
+
     def __init__(self, middleware, conf):
         """
         Initialize the RemoteControlDaemon.
         """
 
-        # Grab required configuration values
+        # Grab required configuration values; a Unix domain socket
+        # path replaces the host and port
         required = {
-            'remote.host': lambda x: x,
-            'remote.port': int,
             'remote.authkey': lambda x: x,
         }
-        values = {}
+        values = {'host': None, 'port': None}
+        if 'remote.path' in conf['control']:
+            values['path'] = conf['control']['remote.path']
+            if 'remote.mode' in conf['control']:
+                try:
+                    values['mode'] = int(conf['control']['remote.mode'], 8)
+                except ValueError:
+                    raise ValueError("Invalid value for configuration key "
+                                     "'control.remote.mode'")
+        else:
+            required.update({
+                'remote.host': lambda x: x,
+                'remote.port': int,
+            })
         for conf_key, xform in required.items():
             try:
                 values[conf_key[len('remote.'):]] = \
@@ -638,21 +1892,120 @@ class RemoteControlDaemon(control.ControlDaemon):
 
         # Set up the RPC object
         self.remote = ControlDaemonRPC(daemon=self, **values)
+        self.remote_values = values
         self.remote_limits = None
 
+        # The number of connections the workers make to the remote
+        # daemon, and whether they subscribe to change notifications
+        self.remote_connections = int(
+            conf['control'].get('remote.connections', 1))
+        self.remote_subscribe = config.Config.to_bool(
+            conf['control'].get('remote.subscribe', 'yes'), False)
+
+        # Whether the workers send their database commands through
+        # the bucket proxy in the RemoteControlDaemon process
+        self.remote_proxy = config.Config.to_bool(
+            conf['control'].get('remote.proxy', 'no'), False)
+        self.proxy_db = None
+        self.bucket_proxy = None
+
+        # The limit snapshot, if one is configured; it is only
+        # published by the RemoteControlDaemon process
+        self.snapshot_path = conf['control'].get('remote.snapshot')
+        self.snapshot = None
+
     def get_limits(self):
         """
         Retrieve the LimitData object the middleware will use for
         getting the limits.  This implementation returns a
         RemoteLimitData instance that can access the LimitData stored
-        in the RemoteControlDaemon process.
+        in the RemoteControlDaemon process, or, if the
+        'control.remote.snapshot' configuration is set, a
+        SnapshotLimitData instance that reads the limit snapshot
+        published by that process.
         """
 
         # Set one up if we don't already have it
         if not self.remote_limits:
-            self.remote_limits = RemoteLimitData(self.remote)
+            if self.snapshot_path:
+                self.remote_limits = SnapshotLimitData(self.snapshot_path)
+            else:
+                pool = [ControlDaemonRPC(daemon=self, **self.remote_values)
+                        for _i in range(self.remote_connections - 1)]
+                subscription = None
+                if self.remote_subscribe:
+                    subscription = ControlDaemonRPC(daemon=self,
+                                                    **self.remote_values)
+                self.remote_limits = RemoteLimitData(self.remote, pool,
+                                                     subscription)
         return self.remote_limits
 
+    def get_database(self):
+        """
+        Retrieve the database handle the middleware will use for
+        updating the buckets.  If the 'control.remote.proxy'
+        configuration is enabled, this implementation returns a
+        ProxyDatabase instance, which sends the database commands to
+        the RemoteControlDaemon process; otherwise, a regular
+        database handle is returned.
+
+        The ProxyDatabase only connects to the RemoteControlDaemon
+        process when it is first used.  While that process cannot be
+        reached, or if the connection uses version 1 of the RPC
+        protocol, e.g., because that process predates version 2, the
+        ProxyDatabase falls back to a regular database handle.
+        """
+
+        if not self.remote_proxy:
+            return super(RemoteControlDaemon, self).get_database()
+
+        # Set one up if we don't already have it
+        if not self.proxy_db:
+            pool = [ControlDaemonRPC(daemon=self, **self.remote_values)
+                    for _i in range(self.remote_connections)]
+            fallback = super(RemoteControlDaemon, self).get_database()
+            self.proxy_db = ProxyDatabase(pool[0], pool[1:], fallback)
+        return self.proxy_db
+
+    def get_bucket_proxy(self):
+        """
+        Retrieve the BucketProxy which executes the database commands
+        sent by the workers.  Only used in the RemoteControlDaemon
+        process.
+        """
+
+        if not self.bucket_proxy:
+            self.bucket_proxy = BucketProxy(self)
+        return self.bucket_proxy
+
+    def _publish_snapshot(self):
+        """
+        Publish the current limit data as a snapshot, if a snapshot
+        is configured.
+        """
+
+        if self.snapshot is None:
+            return
+
+        try:
+            with self.limits.limit_lock:
+                self.snapshot.publish(self.limits.limit_sum,
+                                      self.limits.limit_data)
+        except Exception:
+            LOG.exception("Could not publish limit snapshot %r" %
+                          self.snapshot_path)
+
+    def _limits_changed(self):
+        """
+        Called after the limits have been changed.  Saves the limits
+        to the cache file, if one is configured, publishes the limit
+        snapshot, and notifies the subscribed workers.
+        """
+
+        super(RemoteControlDaemon, self)._limits_changed()
+        self._publish_snapshot()
+        self.remote.notify(self.limits.limit_sum)
+
     def start(self):
         """
         Starts the RemoteControlDaemon.
@@ -661,6 +2014,37 @@ class RemoteControlDaemon(control.ControlDaemon):
         # Don't connect the client yet, to avoid problems if we fork
         pass  # Pragma: nocover
 
+    def preload(self):
+        """
+        Loads the limits without starting the listening thread.  The
+        limits are loaded by the RemoteControlDaemon process, so
+        there is nothing to do here.
+        """
+
+        pass  # Pragma: nocover
+
+    def reset(self):
+        """
+        Discards the database handle and the connection to the
+        RemoteControlDaemon process, so that a process forked after
+        they were opened uses its own connections.
+        """
+
+        super(RemoteControlDaemon, self).reset()
+        self.remote.close()
+
+        # Connections made by the RemoteLimitData
+        if self.remote_limits is not None:
+            with utils.ignore_except():
+                self.remote_limits.close()
+            self.remote_limits = None
+
+        # Connections made by the ProxyDatabase
+        if self.proxy_db is not None:
+            with utils.ignore_except():
+                self.proxy_db.close()
+            self.proxy_db = None
+
     def serve(self):
         """
         Starts the RemoteControlDaemon process.  Forks a thread for
@@ -668,6 +2052,10 @@ class RemoteControlDaemon(control.ControlDaemon):
         the RPC server.
         """
 
+        # Set up the limit snapshot
+        if self.snapshot_path:
+            self.snapshot = LimitSnapshot(self.snapshot_path)
+
         # Start the listening thread and load the limits
         super(RemoteControlDaemon, self).start()
 
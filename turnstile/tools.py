@@ -13,11 +13,16 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import calendar
 import functools
 import inspect
+import json
 import logging
 import logging.config
+import multiprocessing
 import pprint
+import random
+import re
 import sys
 import textwrap
 import time
@@ -33,6 +38,10 @@ from turnstile import compactor
 from turnstile import config
 from turnstile import database
 from turnstile import limits
+from turnstile import memdb
+from turnstile import metrics
+from turnstile import microbench
+from turnstile import middleware
 from turnstile import remote
 from turnstile import utils
 
@@ -434,6 +443,94 @@ def parse_limit_node(db, idx, limit):
     return klass(db, **attrs)
 
 
+def parse_limits_file(db, limits_file):
+    """
+    Given the name of an XML file describing limits, return a list of
+    Limit objects.  Limits which cannot be understood are skipped,
+    with a warning.
+
+    :param db: Handle for the Redis database.
+    :param limits_file: Name of the XML file describing the limits.
+    """
+
+    # Parse the limits file
+    limits_tree = etree.parse(limits_file)
+
+    # Now, we parse the limits XML file
+    lims = []
+    key_ids = set()
+    for idx, lim in enumerate(limits_tree.getroot()):
+        # Skip tags we don't recognize
+        if lim.tag != 'limit':
+            warnings.warn("Unrecognized tag %r in limits file at index %d" %
+                          (lim.tag, idx))
+            continue
+
+        # Construct the limit
+        try:
+            limit = parse_limit_node(db, idx, lim)
+        except Exception as exc:
+            warnings.warn("Couldn't understand limit at index %d: %s" %
+                          (idx, exc))
+            continue
+
+        # Key IDs must be unique, or limits would share buckets
+        key_id = getattr(limit, 'key_id', None)
+        if key_id is not None:
+            if key_id in key_ids:
+                warnings.warn("Duplicate key ID %r for limit at index %d; "
+                              "ignoring limit..." % (key_id, idx))
+                continue
+            key_ids.add(key_id)
+
+        # Add it to the list of limits
+        lims.append(limit)
+
+    return lims
+
+
+def limit_deltas(existing, lims):
+    """
+    Determine the changes to individual limits needed to turn the
+    existing list of limits into the desired list.
+
+    :param existing: A list of the msgpack'd limit strings currently
+                     stored in the database, in order.
+    :param lims: The desired list of Limit objects.
+
+    :returns: A list of tuples describing the changes, in order.  The
+              first element of each tuple is the operation: "delete",
+              in which case the second element is the UUID of the
+              limit to remove, or "set", in which case the second
+              element is the Limit object to add or update.  Returns
+              None if the changes cannot be described this way, i.e.,
+              if the limits have been reordered, or if new limits
+              appear anywhere but at the end of the list.
+    """
+
+    old = [(msgpack.loads(lim).get('uuid'), lim) for lim in existing]
+    old_map = dict(old)
+    new_uuids = set(lim.uuid for lim in lims)
+
+    # Limits which are retained must remain in the same order
+    kept = [uuid for uuid, _lim in old if uuid in new_uuids]
+    if kept != [lim.uuid for lim in lims if lim.uuid in old_map]:
+        return None
+
+    # New limits must follow the retained limits
+    added = [lim for lim in lims if lim.uuid not in old_map]
+    if added and lims[-len(added):] != added:
+        return None
+
+    # Remove deleted limits first, then update or add the rest
+    deltas = [('delete', uuid) for uuid, _lim in old
+              if uuid not in new_uuids]
+    deltas.extend(('set', lim) for lim in lims
+                  if old_map.get(lim.uuid) != msgpack.dumps(lim.dehydrate()))
+
+    return deltas
+
+
 @add_argument('conf_file',
               metavar='config',
               help="Name of the configuration file, for connecting "
@@ -441,6 +538,15 @@ def parse_limit_node(db, idx, limit):
 @add_argument('limits_file',
               help="Name of the XML file describing the limits to "
               "configure.")
+@add_argument('--delta', '-D',
+              dest='delta',
+              action='store_true',
+              default=False,
+              help="Update only the limits which have changed, and "
+              "inform the nodes of each change, rather than issuing "
+              "a reload command.  Falls back to a full update if the "
+              "limits have been reordered or if most of the limits "
+              "have changed.")
 @add_argument('--debug', '-d',
               dest='debug',
               action='store_true',
@@ -471,7 +577,7 @@ def parse_limit_node(db, idx, limit):
               help="Cause all nodes to reload the limits "
               "configuration over the specified number of seconds.")
 def setup_limits(conf_file, limits_file, do_reload=True,
-                 dry_run=False, debug=False):
+                 dry_run=False, debug=False, delta=False):
     """
     Set up or update limits in the Redis database.
 
@@ -490,6 +596,12 @@ def setup_limits(conf_file, limits_file, do_reload=True,
                     Implies debug=True.
     :param debug: If True, debugging messages are emitted while
                   loading the limits and updating the database.
+    :param delta: If True, only the limits which have changed are
+                  updated, and the nodes are informed of each change
+                  with a 'limit_set' or 'limit_delete' command, unless
+                  do_reload is False.  If the changes cannot be
+                  described this way, or if they affect more than half
+                  the limits, a full update is performed instead.
     """
 
     # If dry_run is set, default debug to True
@@ -503,24 +615,17 @@ def setup_limits(conf_file, limits_file, do_reload=True,
     control_channel = conf['control'].get('channel', 'control')
 
     # Parse the limits file
-    limits_tree = etree.parse(limits_file)
-
-    # Now, we parse the limits XML file
-    lims = []
-    for idx, lim in enumerate(limits_tree.getroot()):
-        # Skip tags we don't recognize
-        if lim.tag != 'limit':
-            warnings.warn("Unrecognized tag %r in limits file at index %d" %
-                          (lim.tag, idx))
-            continue
-
-        # Construct the limit and add it to the list of limits
-        try:
-            lims.append(parse_limit_node(db, idx, lim))
-        except Exception as exc:
-            warnings.warn("Couldn't understand limit at index %d: %s" %
-                          (idx, exc))
-            continue
+    lims = parse_limits_file(db, limits_file)
+
+    # Apply just the changes, if we can
+    if delta:
+        deltas = limit_deltas(db.zrange(limits_key, 0, -1), lims)
+        if deltas is not None and len(deltas) <= max(len(lims) // 2, 1):
+            _setup_deltas(db, limits_key, control_channel, deltas,
+                          do_reload is not False, dry_run, debug)
+            return
+        elif debug:
+            print >>sys.stderr, "Unable to apply changes individually"
 
     # Now that we have the limits, let's install them
     if debug:
@@ -545,6 +650,10 @@ def setup_limits(conf_file, limits_file, do_reload=True,
     else:
         params = [str(do_reload)]
 
+    # The limits were stored along with the version key, so the
+    # nodes need only fetch them if the version key has changed
+    params.append('versioned')
+
     # Issue the reload command
     if debug:
         cmd = ['reload']
@@ -559,6 +668,44 @@ def setup_limits(conf_file, limits_file, do_reload=True,
 _setup_limits = setup_limits
 
 
+def _setup_deltas(db, limits_key, control_channel, deltas, notify,
+                  dry_run, debug):
+    """
+    Apply changes to individual limits in the Redis database.
+
+    :param db: Handle for the Redis database.
+    :param limits_key: The key the limits are stored under.
+    :param control_channel: The control channel the nodes listen on.
+    :param deltas: A list of the changes to apply, as returned by
+                   limit_deltas().
+    :param notify: If True, the nodes are informed of each change.
+    :param dry_run: If True, no changes are made to the database.
+    :param debug: If True, debugging messages are emitted.
+    """
+
+    for op, arg in deltas:
+        if op == 'delete':
+            if debug:
+                print >>sys.stderr, "Removing limit %s" % arg
+            if dry_run or not database.limit_delete(db, limits_key, arg):
+                continue
+            cmd = ['limit_delete', arg]
+        else:
+            if debug:
+                print >>sys.stderr, "Setting limit %r" % arg
+            if dry_run:
+                continue
+            score = database.limit_set(db, limits_key, arg)
+            cmd = ['limit_set', score, arg.uuid]
+
+        # Inform the nodes of the change
+        if notify:
+            if debug:
+                print >>sys.stderr, ("Issuing command: %s" %
+                                     ' '.join(str(c) for c in cmd))
+            database.command(db, control_channel, *cmd)
+
+
 def make_limit_node(root, limit):
     """
     Given a Limit object, generate an XML node.
@@ -687,12 +834,107 @@ def remote_daemon(conf_file):
 _remote_daemon = remote_daemon
 
 
+# Format of the rows of the table printed for the 'stats' command
+_STATS_FORMAT = "%-24s %7s %9s %9s %8s %8s %7s %-8s %11s %6s"
+_STATS_HEADER = _STATS_FORMAT % ('NODE', 'PID', 'REQ/S', 'REJ/S', 'P50 MS',
+                                 'P99 MS', 'RERRS', 'LIMITS', 'RELOADS',
+                                 'CACHE')
+
+
+def _format_stats(stats):
+    """
+    Format a row of the table printed for the 'stats' command.
+
+    :param stats: A dictionary of statistics, as returned by the
+                  'stats' control command or by _aggregate_stats().
+
+    :returns: The formatted row.
+    """
+
+    def fmt(key, spec):
+        value = stats.get(key)
+        return '-' if value is None else spec % value
+
+    # Reloads are reported as the number performed out of the number
+    # requested
+    reloads = fmt('reloads', '%d')
+    if stats.get('reloads_requested') is not None:
+        reloads += '/%d' % stats['reloads_requested']
+
+    return _STATS_FORMAT % (
+        fmt('node', '%s'),
+        fmt('pid', '%d'),
+        fmt('request_rate', '%.1f'),
+        fmt('reject_rate', '%.1f'),
+        fmt('p50', '%.2f'),
+        fmt('p99', '%.2f'),
+        fmt('redis_errors', '%d'),
+        fmt('limit_sum', '%.8s'),
+        reloads,
+        fmt('cache_hit_rate', '%.0f%%'),
+    )
+
+
+def _aggregate_stats(replies):
+    """
+    Aggregate the replies to the 'stats' command into fleet-wide
+    statistics.  Rates and error counts are summed; the fleet-wide
+    50th percentile overhead is the average of the nodes' values,
+    weighted by request rate, and the fleet-wide 99th percentile
+    overhead is the worst of the nodes' values.  Reload counts are
+    summed.
+
+    :param replies: A list of the dictionaries returned by the nodes.
+
+    :returns: A dictionary of the fleet-wide statistics.
+    """
+
+    def values(key):
+        return [r[key] for r in replies if r.get(key) is not None]
+
+    result = {
+        'node': 'FLEET (%d)' % len(replies),
+        'request_rate': sum(values('request_rate')),
+        'reject_rate': sum(values('reject_rate')),
+        'redis_errors': sum(values('redis_errors')),
+        'p99': max(values('p99')) if values('p99') else None,
+    }
+
+    # Weighted average of the 50th percentiles
+    p50s = [(r['p50'], r.get('request_rate') or 0.0) for r in replies
+            if r.get('p50') is not None]
+    weight = sum(w for _p, w in p50s)
+    if weight:
+        result['p50'] = sum(p * w for p, w in p50s) / weight
+    elif p50s:
+        result['p50'] = sum(p for p, _w in p50s) / len(p50s)
+
+    # All the nodes should be using the same limits
+    limit_sums = set(values('limit_sum'))
+    if len(limit_sums) == 1:
+        result['limit_sum'] = limit_sums.pop()
+    elif limit_sums:
+        result['limit_sum'] = 'MIXED'
+
+    cache_rates = values('cache_hit_rate')
+    if cache_rates:
+        result['cache_hit_rate'] = sum(cache_rates) / len(cache_rates)
+
+    # Sum the reload counts reported by the nodes
+    for key in ('reloads', 'reloads_requested', 'reloads_coalesced'):
+        if values(key):
+            result[key] = sum(values(key))
+
+    return result
+
+
 @add_argument('conf_file',
               metavar='config',
               help="Name of the configuration file.")
 @add_argument('command',
-              help="The command to execute.  Note that 'ping' is handled "
-              "specially; in particular, the --listen parameter is implied.")
+              help="The command to execute.  Note that 'ping' and 'stats' "
+              "are handled specially; in particular, the --listen parameter "
+              "is implied.")
 @add_argument('arguments',
               nargs='*',
               help="The arguments to pass for the command.  Note that the "
@@ -715,10 +957,13 @@ def turnstile_command(conf_file, command, arguments=[], channel=None,
     Issue a command to all running control daemons.
 
     :param conf_file: Name of the configuration file.
-    :param command: The command to execute.  Note that 'ping' is
-                    handled specially; in particular, the "channel"
-                    parameter is implied.  (A random value will be
-                    used for the channel to listen on.)
+    :param command: The command to execute.  Note that 'ping' and
+                    'stats' are handled specially; in particular, the
+                    "channel" parameter is implied.  (A random value
+                    will be used for the channel to listen on.)  The
+                    replies to 'stats' are printed as a table, with a
+                    fleet-wide summary printed once listening is
+                    interrupted.
     :param arguments: A list of arguments for the command.  Note that
                       the colon character (':') cannot be used.
     :param channel: If not None, specifies the name of a message
@@ -752,6 +997,16 @@ def turnstile_command(conf_file, command, arguments=[], channel=None,
 
         # Limit the argument list length
         arguments = arguments[:2]
+    elif command == 'stats':
+        # 'stats' also implies a channel to listen on
+        if arguments:
+            channel = arguments[0]
+        else:
+            channel = str(uuid.uuid4())
+            arguments = [channel]
+
+        # Limit the argument list length
+        arguments = arguments[:1]
 
     # OK, the command is all set up.  Let us now send the command...
     if debug:
@@ -769,6 +1024,7 @@ def turnstile_command(conf_file, command, arguments=[], channel=None,
     pubsub.subscribe(channel)
 
     # Now we listen...
+    stats_replies = []
     try:
         count = 0
         for msg in pubsub.listen():
@@ -782,6 +1038,19 @@ def turnstile_command(conf_file, command, arguments=[], channel=None,
 
             count += 1
 
+            # Tabulate the replies to 'stats'
+            if command == 'stats' and msg['data'].startswith('stats:'):
+                try:
+                    node_stats = msgpack.loads(msg['data'][6:])
+                except Exception:
+                    print >>sys.stderr, "Invalid stats reply: %r" % msg['data']
+                    continue
+                if not stats_replies:
+                    print _STATS_HEADER
+                stats_replies.append(node_stats)
+                print _format_stats(node_stats)
+                continue
+
             # Figure out the response
             response = msg['data'].split(':')
 
@@ -802,6 +1071,10 @@ def turnstile_command(conf_file, command, arguments=[], channel=None,
         # to the caller...
         pass
 
+    # Print the fleet-wide statistics
+    if stats_replies:
+        print _format_stats(_aggregate_stats(stats_replies))
+
 
 @add_argument('conf_file',
               metavar='config',
@@ -827,3 +1100,839 @@ def compactor_daemon(conf_file):
     eventlet.monkey_patch()
     conf = config.Config(conf_file=conf_file)
     compactor.compactor(conf)
+
+
+# Keys used by the benchmark, to avoid disturbing a real installation
+_BENCH_CONF = {
+    'control.channel': 'turnstile_bench:control',
+    'control.limits_key': 'turnstile_bench:limits',
+    'control.errors_key': 'turnstile_bench:errors',
+    'control.errors_channel': 'turnstile_bench:errors',
+}
+
+# The name of the in-memory server used by the benchmark
+_BENCH_MEMORY_HOST = 'turnstile_bench'
+
+# Matches the variables in a limit URI
+_URI_VAR_RE = re.compile(r'{[^}]*}')
+
+
+def _bench_config(redis_host=None):
+    """
+    Build the configuration for a benchmark middleware.
+
+    :param redis_host: The host name of the Redis server to use,
+                       optionally followed by a colon and a port
+                       number.  If not given, the in-memory stand-in
+                       is used.
+
+    :returns: A dictionary of configuration options.
+    """
+
+    conf = dict(_BENCH_CONF)
+    conf['redis.redis_client'] = 'turnstile.memdb:counting_client'
+    if redis_host:
+        host, _sep, port = redis_host.partition(':')
+        conf['redis.host'] = host
+        if port:
+            conf['redis.port'] = port
+    else:
+        conf['redis.counted_client'] = 'turnstile.memdb:MemoryRedis'
+        conf['redis.host'] = _BENCH_MEMORY_HOST
+
+    return conf
+
+
+def _bench_middleware(lims, redis_host=None, options=None):
+    """
+    Set up a middleware for benchmarking.  The limits are installed
+    in the database, and the middleware's database handle counts the
+    Redis commands it issues; see memdb.counting_client().
+
+    :param lims: A list of the limits to install.
+    :param redis_host: The host name of the Redis server to use,
+                       optionally followed by a colon and a port
+                       number.  If not given, the in-memory stand-in
+                       is used, and its contents are discarded first.
+    :param options: An optional dictionary of additional
+                    configuration options for the middleware.  The
+                    options selecting the database and control keys
+                    cannot be overridden.
+
+    :returns: A tuple of the middleware and its database handle, a
+              CountingDatabase.
+    """
+
+    # The control daemon's listening thread must not block the
+    # process while waiting for messages from a Redis server
+    if redis_host:
+        eventlet.monkey_patch()
+    else:
+        memdb.reset(_BENCH_MEMORY_HOST)
+
+    # Build the configuration
+    conf = dict(options or {})
+    conf.update(_bench_config(redis_host))
+
+    # Install the limits in the database
+    db = config.Config(conf_dict=conf).get_database()
+    database.limit_update(db, conf['control.limits_key'], lims)
+
+    # Set up the middleware; this loads the limits
+    midware = middleware.TurnstileMiddleware(_bench_app, conf)
+    counter = midware.db
+
+    # Warm up the middleware, so the initial processing of the limits
+    # is not counted
+    midware(_make_environ('GET', '/'), lambda status, headers: None)
+    counter.reset_counts()
+
+    return midware, counter
+
+
+def _bench_app(environ, start_response):
+    """
+    A trivial WSGI application, which the benchmark middleware wraps.
+    """
+
+    start_response('200 OK', [('Content-Type', 'text/plain')])
+    return ['OK']
+
+
+def _make_environ(method, path, query='', headers=None, remote_addr=None):
+    """
+    Build a minimal WSGI environment for a synthetic request.
+
+    :param method: The request method.
+    :param path: The request path.
+    :param query: The query string.
+    :param headers: An optional dictionary of request headers.
+    :param remote_addr: The optional address of the client.
+
+    :returns: A WSGI environment dictionary.
+    """
+
+    environ = {
+        'REQUEST_METHOD': method,
+        'SCRIPT_NAME': '',
+        'PATH_INFO': path,
+        'QUERY_STRING': query,
+        'SERVER_NAME': 'localhost',
+        'SERVER_PORT': '80',
+        'SERVER_PROTOCOL': 'HTTP/1.1',
+        'HTTP_HOST': 'localhost',
+        'wsgi.url_scheme': 'http',
+    }
+
+    if remote_addr:
+        environ['REMOTE_ADDR'] = remote_addr
+
+    # Translate the headers into CGI variables
+    for name, value in (headers or {}).items():
+        name = name.upper().replace('-', '_')
+        if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            name = 'HTTP_' + name
+        environ[name] = value
+
+    return environ
+
+
+def _synthetic_limits(count, value):
+    """
+    Generate synthetic limits for the benchmark.  Each limit applies
+    to its own URI, and uses a per-key bucket.
+
+    :param count: The number of limits to generate.
+    :param value: The number of requests per minute each limit
+                  permits for each key.
+
+    :returns: A list of Limit objects.
+    """
+
+    return [limits.Limit(None, uri='/bench/%d/{key}' % idx, value=value,
+                         unit='minute', use=['key'])
+            for idx in range(count)]
+
+
+def _bench_requests(lims, count, keys, hit_ratio, rand):
+    """
+    Generate synthetic requests for the benchmark.
+
+    :param lims: The list of limits.  Requests which hit a limit are
+                 generated by substituting a key for the variables in
+                 the URI of a randomly selected limit.
+    :param count: The number of requests to generate.
+    :param keys: The number of distinct keys to use.
+    :param hit_ratio: The fraction of requests which should hit a
+                      limit.  The remaining requests are for a URI
+                      which no limit applies to.
+    :param rand: A random.Random object.
+
+    :returns: A list of WSGI environment dictionaries.
+    """
+
+    requests = []
+    for _i in range(count):
+        key = 'key%d' % rand.randrange(keys)
+        if lims and rand.random() < hit_ratio:
+            lim = rand.choice(lims)
+            requests.append(_make_environ(
+                lim.verbs[0] if lim.verbs else 'GET',
+                _URI_VAR_RE.sub(key, lim.uri),
+                '&'.join('%s=1' % q for q in lim.queries)))
+        else:
+            requests.append(_make_environ('GET', '/miss/%s' % key))
+
+    return requests
+
+
+def _bench_run(params):
+    """
+    Run a benchmark in the current process.  This is a separate
+    function so that it may be run by a multiprocessing pool.
+
+    :param params: A dictionary of the benchmark parameters.  The
+                   "limits" key contains a list of dehydrated limits;
+                   the "redis_host", "requests", "concurrency",
+                   "keys", "hit_ratio", and "seed" keys have the same
+                   meanings as the corresponding arguments of
+                   turnstile_bench().
+
+    :returns: A dictionary containing the number of requests run
+              ("requests"), the number of requests rejected
+              ("rejected"), the elapsed time in seconds ("elapsed"),
+              a list of the request latencies in seconds
+              ("latencies"), and the number of Redis commands and
+              round trips issued while running the requests
+              ("commands" and "round_trips").
+    """
+
+    lims = [limits.Limit.hydrate(None, dict(lim))
+            for lim in params['limits']]
+    midware, counter = _bench_middleware(lims, params['redis_host'])
+
+    # Generate the requests ahead of time, so that doing so is not
+    # counted against the middleware
+    requests = _bench_requests(lims, params['requests'], params['keys'],
+                               params['hit_ratio'],
+                               random.Random(params['seed']))
+
+    latencies = []
+
+    def one_request(environ):
+        status = []
+        start = time.time()
+        midware(environ, lambda st, headers: status.append(st))
+        latencies.append(time.time() - start)
+        return status[0]
+
+    # Now run the requests
+    pool = eventlet.GreenPool(params['concurrency'])
+    start = time.time()
+    statuses = list(pool.imap(one_request, requests))
+    elapsed = time.time() - start
+
+    return {
+        'requests': len(statuses),
+        'rejected': len([st for st in statuses if not st.startswith('2')]),
+        'elapsed': elapsed,
+        'latencies': latencies,
+        'commands': counter.commands,
+        'round_trips': counter.round_trips,
+    }
+
+
+def _format_bench(results):
+    """
+    Format the results of a benchmark for display.
+
+    :param results: A list of the result dictionaries returned by
+                    _bench_run(), one for each process.
+
+    :returns: The text to display.
+    """
+
+    total = sum(r['requests'] for r in results)
+    rejected = sum(r['rejected'] for r in results)
+    elapsed = max(r['elapsed'] for r in results)
+    latencies = sorted(lat * 1000.0 for r in results
+                       for lat in r['latencies'])
+    commands = sum(r['commands'] for r in results)
+    round_trips = sum(r['round_trips'] for r in results)
+
+    # Avoid dividing by zero
+    count = total or 1
+
+    return '\n'.join([
+        "Requests:        %d" % total,
+        "Rejected:        %d (%.1f%%)" % (rejected, rejected * 100.0 / count),
+        "Elapsed:         %.3f s" % elapsed,
+        "Throughput:      %.1f requests/s" % (total / elapsed
+                                              if elapsed else 0.0),
+        "Latency (ms):    p50 %.3f, p90 %.3f, p99 %.3f, max %.3f" % (
+            metrics.percentile(latencies, 50) or 0.0,
+            metrics.percentile(latencies, 90) or 0.0,
+            metrics.percentile(latencies, 99) or 0.0,
+            latencies[-1] if latencies else 0.0),
+        "Redis commands:  %.2f per request (%.2f round trips)" % (
+            float(commands) / count, float(round_trips) / count),
+    ])
+
+
+@add_argument('--limits', '-L',
+              dest='limits_file',
+              default=None,
+              help="Name of an XML file describing the limits to "
+              "benchmark.  If not given, synthetic limits are generated.")
+@add_argument('--redis', '-r',
+              dest='redis_host',
+              metavar='HOST[:PORT]',
+              default=None,
+              help="The Redis server to use.  If not given, an in-memory "
+              "stand-in is used.  Note that the benchmark stores its data "
+              "in the Redis server, so a scratch server should be used.")
+@add_argument('--requests', '-n',
+              type=int,
+              default=10000,
+              help="The total number of requests to issue.  Defaults to "
+              "10000.")
+@add_argument('--concurrency', '-c',
+              type=int,
+              default=10,
+              help="The number of greenthreads issuing requests in each "
+              "process.  Defaults to 10.")
+@add_argument('--processes', '-p',
+              type=int,
+              default=1,
+              help="The number of processes issuing requests.  Defaults "
+              "to 1.")
+@add_argument('--keys', '-k',
+              type=int,
+              default=100,
+              help="The number of distinct keys used in the request URIs.  "
+              "Defaults to 100.")
+@add_argument('--hit-ratio', '-H',
+              dest='hit_ratio',
+              type=float,
+              default=1.0,
+              help="The fraction of requests which hit a limit.  Defaults "
+              "to 1.0.")
+@add_argument('--limit-count', '-C',
+              dest='limit_count',
+              type=int,
+              default=10,
+              help="The number of synthetic limits to generate.  Defaults "
+              "to 10.")
+@add_argument('--limit-value', '-V',
+              dest='limit_value',
+              type=int,
+              default=100,
+              help="The number of requests per minute each synthetic limit "
+              "permits for each key.  Defaults to 100.")
+@add_argument('--seed', '-s',
+              type=int,
+              default=None,
+              help="A seed for the random request generator, to make the "
+              "requests repeatable.")
+@add_argument('--debug', '-d',
+              dest='debug',
+              action='store_true',
+              default=False,
+              help="Run the tool in debug mode.")
+def turnstile_bench(limits_file=None, redis_host=None, requests=10000,
+                    concurrency=10, processes=1, keys=100, hit_ratio=1.0,
+                    limit_count=10, limit_value=100, seed=None, debug=False):
+    """
+    Benchmark the Turnstile middleware.
+
+    Synthetic requests are issued to the Turnstile middleware, wrapped
+    around a trivial application, and the request throughput,
+    latencies, and number of Redis commands issued per request are
+    reported.
+
+    :param limits_file: Name of an XML file describing the limits to
+                        benchmark.  If not given, synthetic limits are
+                        generated.
+    :param redis_host: The host name of the Redis server to use,
+                       optionally followed by a colon and a port
+                       number.  If not given, an in-memory stand-in
+                       is used.
+    :param requests: The total number of requests to issue.
+    :param concurrency: The number of greenthreads issuing requests
+                        in each process.
+    :param processes: The number of processes issuing requests.
+    :param keys: The number of distinct keys used in the request
+                 URIs.
+    :param hit_ratio: The fraction of requests which hit a limit.
+    :param limit_count: The number of synthetic limits to generate.
+    :param limit_value: The number of requests per minute each
+                        synthetic limit permits for each key.
+    :param seed: A seed for the random request generator.
+    :param debug: If True, debugging messages are emitted.
+    """
+
+    # Build the limits
+    if limits_file:
+        lims = parse_limits_file(None, limits_file)
+    else:
+        lims = _synthetic_limits(limit_count, limit_value)
+    if debug:
+        print >>sys.stderr, "Benchmarking the following limits:"
+        for lim in lims:
+            print >>sys.stderr, "  %r" % lim
+
+    # Divide the requests among the processes
+    params = []
+    for idx in range(processes):
+        params.append({
+            'limits': [lim.dehydrate() for lim in lims],
+            'redis_host': redis_host,
+            'requests': (requests // processes +
+                         (1 if idx < requests % processes else 0)),
+            'concurrency': concurrency,
+            'keys': keys,
+            'hit_ratio': hit_ratio,
+            'seed': None if seed is None else seed + idx,
+        })
+
+    # Run the benchmark
+    if processes > 1:
+        pool = multiprocessing.Pool(processes)
+        try:
+            results = pool.map(_bench_run, params)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [_bench_run(params[0])]
+
+    print _format_bench(results)
+
+
+def _format_compare(comparison):
+    """
+    Format a comparison of two microbenchmark runs for display.
+
+    :param comparison: A list of tuples, as returned by
+                       microbench.compare().
+
+    :returns: The text to display.
+    """
+
+    lines = ["%-32s %12s %12s %8s" % ("Benchmark", "Old (us)", "New (us)",
+                                      "Change")]
+    for name, old_time, new_time, ratio in comparison:
+        change = '-' if ratio is None else '%+.1f%%' % ((ratio - 1) * 100)
+        lines.append("%-32s %12.2f %12.2f %8s" % (name, old_time * 1e6,
+                                                  new_time * 1e6, change))
+
+    return '\n'.join(lines)
+
+
+@add_argument('--output', '-o',
+              default=None,
+              help="Name of a file to write the results to, as JSON.  If "
+              "not given, the results are written to standard output.")
+@add_argument('--compare', '-c',
+              default=None,
+              help="Name of a file containing the results of an earlier "
+              "run.  A comparison of the two runs is written to standard "
+              "error.")
+@add_argument('--filter', '-f',
+              dest='pattern',
+              default=None,
+              help="A shell-style wildcard pattern selecting the "
+              "benchmarks to run, e.g., 'bucket_loader.*'.")
+@add_argument('--repeat', '-r',
+              type=int,
+              default=5,
+              help="The number of timed runs of each benchmark.  Defaults "
+              "to 5.")
+@add_argument('--min-time', '-t',
+              dest='min_time',
+              type=float,
+              default=0.2,
+              help="The minimum duration of a timed run, in seconds.  "
+              "Defaults to 0.2.")
+@add_argument('--label', '-l',
+              default=None,
+              help="A label identifying the run, such as the revision of "
+              "the code being measured.")
+@add_argument('--debug', '-d',
+              dest='debug',
+              action='store_true',
+              default=False,
+              help="Run the tool in debug mode.")
+def turnstile_microbench(output=None, compare=None, pattern=None, repeat=5,
+                         min_time=0.2, label=None, debug=False):
+    """
+    Run the microbenchmarks for Turnstile's core data structures.
+
+    The results are reported as JSON, so that runs against different
+    revisions of the code may be compared.
+
+    :param output: Name of a file to write the results to.  If not
+                   given, the results are written to standard output.
+    :param compare: Name of a file containing the results of an
+                    earlier run.  If given, a comparison of the two
+                    runs is written to standard error.
+    :param pattern: A shell-style wildcard pattern selecting the
+                    benchmarks to run.
+    :param repeat: The number of timed runs of each benchmark.
+    :param min_time: The minimum duration of a timed run, in seconds.
+    :param label: A label identifying the run.
+    :param debug: If True, debugging messages are emitted.
+    """
+
+    # Load the earlier results first, so a bad file is caught early
+    old = None
+    if compare:
+        with open(compare) as f:
+            old = json.load(f)
+
+    results = microbench.run_benchmarks(pattern, repeat, min_time, label)
+    if debug:
+        print >>sys.stderr, "Ran %d benchmarks" % len(results['benchmarks'])
+
+    # Emit the results
+    text = json.dumps(results, indent=2, sort_keys=True,
+                      separators=(',', ': '))
+    if output:
+        with open(output, 'w') as f:
+            print >>f, text
+    else:
+        print text
+
+    if old is not None:
+        print >>sys.stderr, _format_compare(microbench.compare(old, results))
+
+
+# Matches a line in the Common or Combined Log Format
+_CLF_RE = re.compile(
+    r'^(?P<remote_addr>\S+) \S+ \S+ \[(?P<time>[^\]]+)\] '
+    r'"(?P<method>[A-Z]+) (?P<uri>\S+)(?: [^"]*)?" \S+ \S+'
+    r'(?: "(?P<referer>[^"]*)" "(?P<user_agent>[^"]*)")?')
+
+
+def _to_str(value):
+    """
+    Convert a value decoded from JSON into a byte string.
+
+    :param value: The value to convert.
+
+    :returns: The value as a UTF-8 encoded string.
+    """
+
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return str(value)
+
+
+def _parse_clf_time(value):
+    """
+    Parse a timestamp in the format used by the Common Log Format,
+    e.g., "10/Oct/2000:13:55:36 -0700".
+
+    :param value: The timestamp to parse.
+
+    :returns: The timestamp, in seconds since the epoch.
+    """
+
+    stamp, _sep, offset = value.partition(' ')
+    result = calendar.timegm(time.strptime(stamp, '%d/%b/%Y:%H:%M:%S'))
+
+    # Account for the time zone offset
+    if offset:
+        sign = -1 if offset[0] == '-' else 1
+        result -= sign * (int(offset[1:3]) * 3600 + int(offset[3:5]) * 60)
+
+    return float(result)
+
+
+def _parse_log_line(line):
+    """
+    Parse a line from an access log.  Two formats are recognized.
+    Lines beginning with "{" are interpreted as JSON objects, with
+    the keys "time" (the time of the request, in seconds since the
+    epoch), "method", "path", "query", "headers" (a dictionary of the
+    selected request headers), and "remote_addr"; only "time" and
+    "path" are required.  Other lines are interpreted as being in the
+    Common or Combined Log Format used by Apache and nginx; for the
+    latter, the Referer and User-Agent headers are included.
+
+    :param line: The line to parse.
+
+    :returns: A tuple of the time of the request and a WSGI
+              environment describing it, or None if the line could
+              not be interpreted.
+    """
+
+    line = line.strip()
+    if not line:
+        return None
+
+    # Handle the JSON format first
+    if line.startswith('{'):
+        try:
+            rec = json.loads(line)
+            headers = dict((_to_str(k), _to_str(v))
+                           for k, v in rec.get('headers', {}).items())
+            return float(rec['time']), _make_environ(
+                _to_str(rec.get('method', 'GET')), _to_str(rec['path']),
+                _to_str(rec.get('query', '')), headers,
+                rec.get('remote_addr') and _to_str(rec['remote_addr']))
+        except (ValueError, KeyError, TypeError, AttributeError):
+            return None
+
+    match = _CLF_RE.match(line)
+    if not match:
+        return None
+
+    try:
+        timestamp = _parse_clf_time(match.group('time'))
+    except ValueError:
+        return None
+
+    headers = {}
+    if match.group('referer') not in (None, '-'):
+        headers['Referer'] = match.group('referer')
+    if match.group('user_agent') not in (None, '-'):
+        headers['User-Agent'] = match.group('user_agent')
+
+    path, _sep, query = match.group('uri').partition('?')
+    return timestamp, _make_environ(match.group('method'), path, query,
+                                    headers, match.group('remote_addr'))
+
+
+def _read_log(log_file):
+    """
+    Read the requests from an access log.
+
+    :param log_file: Name of the access log file.
+
+    :returns: A tuple of a list of the requests, each a tuple of the
+              time of the request and a WSGI environment describing
+              it, and the number of lines which could not be
+              interpreted.
+    """
+
+    entries = []
+    skipped = 0
+    with open(log_file) as f:
+        for line in f:
+            if not line.strip():
+                continue
+
+            entry = _parse_log_line(line)
+            if entry is None:
+                skipped += 1
+            else:
+                entries.append(entry)
+
+    return entries, skipped
+
+
+def _replay(midware, entries, speed=1.0, concurrency=1000):
+    """
+    Replay requests through a middleware.
+
+    :param midware: The middleware.
+    :param entries: A list of the requests, each a tuple of the time
+                    of the request and a WSGI environment describing
+                    it.
+    :param speed: The speed at which to replay the requests, relative
+                  to the original timing.  If 0, the requests are
+                  replayed as fast as possible.
+    :param concurrency: The maximum number of requests in progress at
+                        any one time.
+
+    :returns: A dictionary containing the number of requests replayed
+              ("requests"), the number of requests rejected
+              ("rejected"), the time spent replaying them, in seconds
+              ("elapsed"), the time spanned by the requests in the
+              log, in seconds ("duration"), a list of the request
+              latencies in seconds ("latencies"), and a dictionary
+              mapping the limits which rejected requests to the
+              number of requests they rejected ("fired").
+    """
+
+    latencies = []
+    statuses = []
+    fired = {}
+
+    def one_request(environ):
+        status = []
+        start = time.time()
+        midware(environ, lambda st, headers: status.append(st))
+        latencies.append(time.time() - start)
+        statuses.append(status[0])
+
+        # Keep track of which limits rejected the request
+        for _delay, limit, _bucket in environ.get('turnstile.delay') or []:
+            fired[limit] = fired.get(limit, 0) + 1
+
+    pool = eventlet.GreenPool(concurrency)
+    first = entries[0][0] if entries else 0.0
+    start = time.time()
+    for timestamp, environ in entries:
+        # Wait until it's time to issue the request
+        if speed:
+            delay = (timestamp - first) / speed - (time.time() - start)
+            if delay > 0:
+                eventlet.sleep(delay)
+
+        pool.spawn_n(one_request, environ)
+    pool.waitall()
+
+    return {
+        'requests': len(statuses),
+        'rejected': len([st for st in statuses if not st.startswith('2')]),
+        'elapsed': time.time() - start,
+        'duration': entries[-1][0] - first if entries else 0.0,
+        'latencies': latencies,
+        'fired': fired,
+    }
+
+
+def _format_replay(result):
+    """
+    Format the results of a replay for display.
+
+    :param result: A dictionary of the results, as returned by
+                   _replay(), with the addition of the number of lines
+                   skipped ("skipped"), the number of Redis commands
+                   and round trips ("commands" and "round_trips"),
+                   and the number of keys in and memory used by the
+                   Redis database ("keys" and "memory").
+
+    :returns: The text to display.
+    """
+
+    total = result['requests']
+    count = total or 1
+    latencies = sorted(lat * 1000.0 for lat in result['latencies'])
+
+    lines = [
+        "Requests:        %d (%d lines skipped)" % (total, result['skipped']),
+        "Rejected:        %d (%.1f%%)" % (result['rejected'],
+                                          result['rejected'] * 100.0 / count),
+        "Log duration:    %.3f s" % result['duration'],
+        "Elapsed:         %.3f s" % result['elapsed'],
+        "Overhead (ms):   p50 %.3f, p90 %.3f, p99 %.3f, max %.3f" % (
+            metrics.percentile(latencies, 50) or 0.0,
+            metrics.percentile(latencies, 90) or 0.0,
+            metrics.percentile(latencies, 99) or 0.0,
+            latencies[-1] if latencies else 0.0),
+        "Redis commands:  %.2f per request (%.2f round trips)" % (
+            float(result['commands']) / count,
+            float(result['round_trips']) / count),
+        "Redis keys:      %s" % result['keys'],
+        "Redis memory:    %s bytes" % result['memory'],
+        "Limits fired:",
+    ]
+
+    # List the limits which fired, most active first
+    fired = sorted(result['fired'].items(), key=lambda x: (-x[1], x[0].uri))
+    for limit, rejections in fired:
+        lines.append("  %8d  %s (%d/%s) %s" % (rejections, limit.uri,
+                                               limit.value, limit.unit,
+                                               limit.uuid))
+    if not fired:
+        lines.append("  (none)")
+
+    return '\n'.join(lines)
+
+
+@add_argument('limits_file',
+              metavar='limits',
+              help="Name of the XML file describing the limits to apply.")
+@add_argument('log_file',
+              metavar='log',
+              help="Name of the access log file to replay.")
+@add_argument('--redis', '-r',
+              dest='redis_host',
+              metavar='HOST[:PORT]',
+              default=None,
+              help="The Redis server to use.  If not given, an in-memory "
+              "stand-in is used.  Note that the replay stores its data "
+              "in the Redis server, so a scratch server should be used.")
+@add_argument('--speed', '-S',
+              type=float,
+              default=1.0,
+              help="The speed at which to replay the requests, as a "
+              "multiple of the original speed.  Use 0 to replay the "
+              "requests as fast as possible.  Defaults to 1.0.")
+@add_argument('--concurrency', '-c',
+              type=int,
+              default=1000,
+              help="The maximum number of requests in progress at any one "
+              "time.  Defaults to 1000.")
+@add_argument('--option', '-O',
+              dest='options',
+              metavar='KEY=VALUE',
+              action='append',
+              default=[],
+              help="Set a configuration option for the middleware, such "
+              "as \"enable\" to select preprocessors.  May be given more "
+              "than once.")
+@add_argument('--debug', '-d',
+              dest='debug',
+              action='store_true',
+              default=False,
+              help="Run the tool in debug mode.")
+def turnstile_replay(limits_file, log_file, redis_host=None, speed=1.0,
+                     concurrency=1000, options=None, debug=False):
+    """
+    Replay an access log through the Turnstile middleware.
+
+    The requests from the access log are issued to the Turnstile
+    middleware, wrapped around a trivial application, with their
+    original timing or a multiple of it.  The limits which fired, the
+    limiter overhead, and the resulting size of the Redis database
+    are reported.
+
+    :param limits_file: Name of the XML file describing the limits to
+                        apply.
+    :param log_file: Name of the access log file to replay.
+    :param redis_host: The host name of the Redis server to use,
+                       optionally followed by a colon and a port
+                       number.  If not given, an in-memory stand-in
+                       is used.
+    :param speed: The speed at which to replay the requests, relative
+                  to the original timing.  If 0, the requests are
+                  replayed as fast as possible.
+    :param concurrency: The maximum number of requests in progress at
+                        any one time.
+    :param options: A list of additional configuration options for
+                    the middleware, each of the form "KEY=VALUE".
+    :param debug: If True, debugging messages are emitted.
+    """
+
+    # Interpret the configuration options
+    conf = {}
+    for opt in options or []:
+        key, sep, value = opt.partition('=')
+        if not sep:
+            raise ValueError("Invalid option %r; expected KEY=VALUE" % opt)
+        conf[key] = value
+
+    # Read the limits and the log
+    lims = parse_limits_file(None, limits_file)
+    entries, skipped = _read_log(log_file)
+    if debug:
+        print >>sys.stderr, ("Replaying %d requests (%d lines skipped)" %
+                             (len(entries), skipped))
+
+    midware, counter = _bench_middleware(lims, redis_host, conf)
+    result = _replay(midware, entries, speed, concurrency)
+
+    # Gather the remaining statistics
+    result.update(
+        skipped=skipped,
+        commands=counter.commands,
+        round_trips=counter.round_trips,
+        keys=counter.db.dbsize(),
+        memory=counter.db.info().get('used_memory'),
+    )
+
+    print _format_replay(result)